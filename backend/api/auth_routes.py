@@ -1,8 +1,10 @@
 from fastapi import APIRouter, HTTPException, Depends, Response
+from starlette.concurrency import run_in_threadpool
 from pydantic import BaseModel
 from typing import Optional
-from ..auth import get_password_hash, verify_password, create_access_token, create_refresh_token, decode_token
-from ..repositories.user_repository import UserRepository
+from ..auth import create_access_token, create_refresh_token, decode_token
+from ..password_hasher import password_hasher, PasswordHasherBusy
+from ..repositories.user_repository import UserRepository, UniqueConstraintViolation, valid_username
 import os
 
 router = APIRouter(prefix="/api/v1/auth")
@@ -41,38 +43,61 @@ def _set_refresh_cookie(resp: Response, token: str):
     )
 
 
+def _busy(e: PasswordHasherBusy) -> HTTPException:
+    return HTTPException(status_code=429, detail="too many concurrent logins, retry shortly",
+                         headers={"Retry-After": str(e.retry_after)})
+
+
+# routes are async so bcrypt can be awaited on the process pool; the sync repository calls go to the threadpool
 @router.post("/register")
-def register(req: RegisterReq, resp: Response):
-    existing = USER_REPO.get_by_username(req.username)
+async def register(req: RegisterReq, resp: Response):
+    if not valid_username(req.username):
+        raise HTTPException(status_code=400, detail="username may not contain ':'")
+    existing = await run_in_threadpool(USER_REPO.get_by_username, req.username)
     if existing:
         raise HTTPException(status_code=400, detail="username exists")
-    hashed = get_password_hash(req.password)
+    # cheap pointer reads before spending a bcrypt hash on a doomed registration
+    taken = await run_in_threadpool(USER_REPO.check_available, req.username, req.email) if USER_REPO.container else None
+    if taken:
+        raise HTTPException(status_code=400, detail=f"{taken} exists")
+    try:
+        hashed = await password_hasher.hash(req.password)
+    except PasswordHasherBusy as e:
+        raise _busy(e)
     try:
-        created = USER_REPO.create_user(req.username, req.email, hashed)
+        created = await run_in_threadpool(USER_REPO.create_user, req.username, req.email, hashed)
+    except UniqueConstraintViolation as e:
+        raise HTTPException(status_code=400, detail=f"{e.field} exists")
     except RuntimeError:
         # fallback to ephemeral in-memory store for local dev
         raise HTTPException(status_code=500, detail="user store not configured")
     access = create_access_token(subject=created["id"])
     refresh = create_refresh_token(subject=created["id"])
     # persist refresh token
-    USER_REPO.upsert_refresh_token(created["id"], refresh)
+    await run_in_threadpool(USER_REPO.upsert_refresh_token, created["id"], refresh)
     _set_refresh_cookie(resp, refresh)
     return {"user": {"id": created["id"], "username": created["username"]}, "access": access}
 
 
 @router.post("/login")
-def login(req: LoginReq, resp: Response):
+async def login(req: LoginReq, resp: Response):
     # identifier can be username or email
-    user = USER_REPO.get_by_username(req.identifier)
+    user = await run_in_threadpool(USER_REPO.get_by_username, req.identifier)
     if not user:
-        user = USER_REPO.get_by_email(req.identifier)
-    if not user or not verify_password(req.password, user.get("password_hash")):
+        user = await run_in_threadpool(USER_REPO.get_by_email, req.identifier)
+    if not user:
+        raise HTTPException(status_code=401, detail="invalid credentials")
+    try:
+        ok = await password_hasher.verify(req.password, user.get("password_hash"))
+    except PasswordHasherBusy as e:
+        raise _busy(e)
+    if not ok:
         raise HTTPException(status_code=401, detail="invalid credentials")
     access = create_access_token(subject=user["id"])
     refresh = create_refresh_token(subject=user["id"])
     # persist refresh
     try:
-        USER_REPO.upsert_refresh_token(user["id"], refresh)
+        await run_in_threadpool(USER_REPO.upsert_refresh_token, user["id"], refresh)
     except RuntimeError:
         pass
     _set_refresh_cookie(resp, refresh)
@@ -1,29 +1,57 @@
-from fastapi import APIRouter, HTTPException, Depends
+from fastapi import APIRouter, HTTPException, Depends, Query, Request, Response
 from pydantic import BaseModel
-from typing import List
+from typing import List, Optional
 from ..deps import get_current_user
+from ..character_catalog import CharacterCatalog, MAX_CATALOG_PAGE, name_tokens, normalize_tag
+from ..response_cache import ResponseCache, etag_matches
 
 router = APIRouter(prefix="/api/v1/characters")
 
-CHAR_STORE = {}
+# local stand-in; the app lifespan swaps in a Cosmos-backed catalog when Cosmos is configured
+CATALOG = CharacterCatalog.local()
+# serialized list pages, dropped whenever CATALOG.version moves
+LIST_CACHE = ResponseCache()
 
 
 class CharacterCreateReq(BaseModel):
     name: str
     short_description: str = ""
     tags: List[str] = []
+    nsfw: bool = False
+    published: bool = True
 
 
 @router.get("")
-def list_characters(limit: int = 50):
-    # naive projection
-    items = list(CHAR_STORE.values())[:limit]
-    return {"items": items}
+async def list_characters(request: Request, sort: str = "popular", tags: List[str] = Query(default=[]),
+                          nsfw: Optional[bool] = None, q: Optional[str] = None,
+                          limit: int = Query(default=50, ge=1, le=MAX_CATALOG_PAGE), cursor: Optional[str] = None):
+    # equivalent queries share an entry: tag order/case and search word order do not matter
+    key = (sort, tuple(sorted({normalize_tag(t) for t in tags if t.strip()})), nsfw,
+           " ".join(sorted(name_tokens(q or ""))), limit, cursor or "")
+    catalog = CATALOG
+    try:
+        entry = LIST_CACHE.get(key, (id(catalog), catalog.version),
+                               lambda: catalog.query(sort=sort, tags=tags, nsfw=nsfw, q=q, limit=limit, cursor=cursor))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    headers = {"ETag": entry.etag, "Cache-Control": LIST_CACHE.cache_control}
+    if etag_matches(request.headers.get("if-none-match"), entry.etag):
+        LIST_CACHE.stats["not_modified"] += 1
+        return Response(status_code=304, headers=headers)
+    return Response(content=entry.body, media_type="application/json", headers=headers)
 
 
 @router.post("")
-def create_character(req: CharacterCreateReq, user=Depends(get_current_user)):
-    cid = f"char:{len(CHAR_STORE) + 1}"
-    obj = {"id": cid, "name": req.name, "short_description": req.short_description, "tags": req.tags, "author_id": user["user_id"]}
-    CHAR_STORE[cid] = obj
-    return obj
+async def create_character(req: CharacterCreateReq, user=Depends(get_current_user)):
+    doc = await CATALOG.create(user["user_id"], req.name, req.short_description, req.tags, nsfw=req.nsfw,
+                               published=req.published)
+    # drop Cosmos system fields
+    return {k: v for k, v in doc.items() if not k.startswith("_")}
+
+
+def persona_for(character_id: str) -> str:
+    """System prompt line for a character; empty when the character is unknown."""
+    obj = CATALOG.get(character_id)
+    if not obj:
+        return ""
+    return f"You are {obj['name']}. {obj.get('short_description') or ''}".strip()
@@ -1,7 +1,15 @@
-from fastapi import APIRouter, Depends
+import logging
+from fastapi import APIRouter, Depends, HTTPException
 from pydantic import BaseModel
 from ..deps import get_current_user
-from uuid import uuid4
+from ..chat_engine import CHAT_MAX_REPLY_TOKENS
+from ..context_builder import ContextBuilder
+from ..model_service import MODEL_SERVICE
+from ..pricing import pricing
+from ..session_store import ChatSessionStore, SessionNotFound
+from . import characters
+
+log = logging.getLogger(__name__)
 
 router = APIRouter(prefix="/api/v1/chat")
 
@@ -14,19 +22,48 @@ class MessageReq(BaseModel):
     content: str
 
 
-SESSIONS = {}
+# local stand-in; the app lifespan swaps in a Cosmos-backed store when Cosmos is configured
+SESSION_STORE = ChatSessionStore.local()
+# the app's ChatEngine, set by the lifespan: quotes are then built exactly like the hold of a turn
+ENGINE = None
+# same prompt assembly as ChatEngine's default, for quotes while no engine is running
+_CONTEXT = ContextBuilder(count_tokens=pricing.count, count_persona=pricing.count_cached)
 
 
 @router.post("/sessions")
-def create_session(req: SessionReq, user=Depends(get_current_user)):
-    sid = f"sess:{uuid4().hex}"
-    SESSIONS[sid] = {"id": sid, "character_id": req.character_id, "user_id": user["user_id"], "created_at": None}
-    return {"session_id": sid}
+async def create_session(req: SessionReq, user=Depends(get_current_user)):
+    if characters.CATALOG.get(req.character_id, viewer_id=user["user_id"]) is None:
+        raise HTTPException(status_code=404, detail="unknown character")
+    session = await SESSION_STORE.create(user["user_id"], req.character_id)
+    try:
+        await characters.CATALOG.record_chat(req.character_id)
+    except Exception:
+        # ranking only; never fail the chat over it
+        log.exception("could not record chat for %s", req.character_id)
+    return {"session_id": session.session_id}
 
 
 @router.post("/sessions/{session_id}/message")
-def send_message(session_id: str, req: MessageReq, user=Depends(get_current_user)):
-    # placeholder: in production this enqueues or streams tokens
-    # return a simple ack + estimated cost
-    estimate = max(1, len(req.content) // 50)
-    return {"status": "accepted", "estimated_cost": estimate, "note": "stream via WS in real implementation"}
+async def send_message(session_id: str, req: MessageReq, user=Depends(get_current_user)):
+    """Quote a turn without running it; the reply itself is streamed by chat.send over /ws.
+
+    estimated_cost is what that turn would hold: the full built prompt (persona, summary and the
+    history that fits) plus the reply budget.
+    """
+    try:
+        session = await SESSION_STORE.get(session_id)
+    except SessionNotFound:
+        session = None
+    if session is None or session.user_id != user["user_id"]:
+        raise HTTPException(status_code=404, detail="unknown session")
+    if ENGINE is not None:
+        built = ENGINE.build_prompt(session, req.content)
+        cost = ENGINE.estimate_cost(built.tokens)
+    elif not MODEL_SERVICE:
+        raise HTTPException(status_code=503, detail="chat not configured")
+    else:
+        persona = characters.persona_for(session.character_id) if session.character_id else ""
+        built = _CONTEXT.build(session, req.content, persona)
+        cost = pricing.quote(MODEL_SERVICE, built.tokens, CHAT_MAX_REPLY_TOKENS)
+    return {"status": "accepted", "estimated_cost": cost, "prompt_tokens": built.tokens,
+            "note": "send as chat.send over /ws to stream the reply"}
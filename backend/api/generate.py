@@ -0,0 +1,53 @@
+from fastapi import APIRouter, Depends, HTTPException
+from pydantic import BaseModel
+from typing import Optional
+from ..deps import get_current_user
+from ..gen_jobs import GenerationService, JobError
+
+router = APIRouter(prefix="/api/v1/generate")
+
+# set by the app lifespan once the ledger is available
+SERVICE: Optional[GenerationService] = None
+
+
+class GenerateReq(BaseModel):
+    prompt: str
+    count: int = 1
+    quality: str = "balanced"
+    character_id: Optional[str] = None
+    pose_preset: Optional[str] = None
+    orientation: Optional[str] = None
+    style: Optional[str] = None
+    idempotency_key: Optional[str] = None
+
+
+def _service() -> GenerationService:
+    if SERVICE is None:
+        raise HTTPException(status_code=503, detail="generation not configured")
+    return SERVICE
+
+
+@router.post("", status_code=202)
+async def submit(req: GenerateReq, user=Depends(get_current_user)):
+    try:
+        return await _service().submit(user["user_id"], req.prompt, req.count, req.quality,
+                                       idempotency_key=req.idempotency_key, character_id=req.character_id,
+                                       pose_preset=req.pose_preset, orientation=req.orientation, style=req.style)
+    except JobError as e:
+        raise HTTPException(status_code=e.code, detail=e.detail)
+
+
+@router.get("/{job_id}")
+async def get_job(job_id: str, user=Depends(get_current_user)):
+    try:
+        return await _service().get(user["user_id"], job_id)
+    except JobError as e:
+        raise HTTPException(status_code=e.code, detail=e.detail)
+
+
+@router.delete("/{job_id}")
+async def cancel_job(job_id: str, user=Depends(get_current_user)):
+    try:
+        return await _service().cancel(user["user_id"], job_id)
+    except JobError as e:
+        raise HTTPException(status_code=e.code, detail=e.detail)
@@ -0,0 +1,36 @@
+from fastapi import APIRouter, HTTPException
+from pydantic import BaseModel
+from typing import List, Optional
+from ..pricing import pricing
+
+router = APIRouter(prefix="/api/v1/pricing")
+
+# one preview call prices a whole grid of tier x count options
+MAX_VARIANTS = 200
+
+
+class Variant(BaseModel):
+    model: str
+    tier: Optional[str] = None
+    content: str = ""
+    max_output_tokens: int = 0
+    units: int = 0
+
+
+class EstimateReq(BaseModel):
+    variants: List[Variant]
+
+
+@router.get("")
+def price_table():
+    # clients cache this for the live cost preview and refetch when the version changes
+    return {"version": pricing.version, "models": pricing.table.get("models", {}),
+            "user_tiers": pricing.table.get("user_tiers", {})}
+
+
+@router.post("/estimate")
+def estimate(req: EstimateReq):
+    if len(req.variants) > MAX_VARIANTS:
+        raise HTTPException(status_code=400, detail=f"at most {MAX_VARIANTS} variants")
+    items = pricing.estimate_many([v.model_dump() if hasattr(v, "model_dump") else v.dict() for v in req.variants])
+    return {"version": pricing.version, "items": items}
@@ -1,20 +1,172 @@
 import os
-from fastapi import FastAPI, HTTPException, Depends, WebSocket
+import json
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, Depends, WebSocket, WebSocketDisconnect
+from fastapi.responses import PlainTextResponse, StreamingResponse
 from pydantic import BaseModel
 from fastapi.middleware.cors import CORSMiddleware
 
 try:
-    from azure.cosmos import CosmosClient
+    from azure.cosmos.aio import CosmosClient
 except Exception:
     CosmosClient = None
 
-from .ledger import LedgerService, InsufficientFunds, BatchFailedError
+try:
+    import aiohttp
+    from azure.core.pipeline.transport import AioHttpTransport
+except Exception:
+    aiohttp = None
+    AioHttpTransport = None
+
+from .ledger import AsyncLedgerService, InsufficientFunds, BatchFailedError, ConcurrencyConflict, IdempotencyKeyReused
 from . import ledger as ledger_module
+from .coalescer import SettlementCoalescer, COALESCE_WINDOW_MS
+from .balance_cache import BalanceCache, BalanceChangeFeed
+from .sweeper import HoldSweeper
+from .password_hasher import password_hasher
+from .auth import decode_token
+from .chat_engine import ChatEngine
+from .chat_socket import ChatConnection
+from .model_service import MODEL_SERVICE, get_model_service
+from .session_store import ChatSessionStore
+from .character_catalog import CharacterCatalog
+from .gen_jobs import IMAGE_GENERATOR, GenerationService
+from .event_bus import EventBus, balance_event, get_event_broker
+from .connection_registry import ConnectionRegistry
+from .rate_limit import RATE_LIMIT_ENABLED, AdmissionController, RateLimitMiddleware, get_bucket_store
+from . import rate_limit
+from .metrics import METRICS_ENABLED, REGISTRY, MetricsMiddleware
+from .auth import token_cache
+from .user_cache import profile_cache
+from .job_queue import JOB_QUEUE, get_job_queue
+from .pricing import pricing, load_price_table
 from .api import auth_routes
 from .api import characters as characters_router
 from .api import chat as chat_router
+from .api import pricing as pricing_router
+from .api import generate as generate_router
+
+COSMOS_URL = os.getenv("COSMOS_URL")
+COSMOS_KEY = os.getenv("COSMOS_KEY")
+COSMOS_DB = os.getenv("COSMOS_DB", "appdb")
+COSMOS_CONTAINER = os.getenv("COSMOS_CONTAINER", "ledger")
+COSMOS_CHAT_CONTAINER = os.getenv("COSMOS_CHAT_CONTAINER", "chat_sessions")
+COSMOS_CHARACTERS_CONTAINER = os.getenv("COSMOS_CHARACTERS_CONTAINER", "characters")
+COSMOS_JOBS_CONTAINER = os.getenv("COSMOS_JOBS_CONTAINER", "gen_jobs")
+# max concurrent connections kept open to Cosmos by the shared client
+COSMOS_POOL_SIZE = int(os.getenv("COSMOS_POOL_SIZE", "200"))
+BALANCE_FEED_ENABLED = os.getenv("BALANCE_FEED_ENABLED", "1") == "1"
+# run the expired-hold sweeper in-process (disable when it runs as a separate worker)
+HOLD_SWEEPER_ENABLED = os.getenv("HOLD_SWEEPER_ENABLED", "1") == "1"
+# run generation workers in-process (disable when they run as a separate worker deployment)
+GEN_WORKERS_ENABLED = os.getenv("GEN_WORKERS_ENABLED", "1") == "1"
+
+client = None
+container = None
+ledger_service = None
+# finalize/cancel go through the per-user coalescer when LEDGER_COALESCE_WINDOW_MS > 0
+settlements = None
+balance_cache = BalanceCache()
+balance_feed = None
+hold_sweeper = None
+chat_engine = None
+gen_jobs_container = None
+event_bus = None
+# sockets open on this replica, by user; fed by event_bus
+connections = ConnectionRegistry()
+rate_limit_store = get_bucket_store()
+admission = AdmissionController()
+
+
+def _make_transport():
+    if aiohttp is None or AioHttpTransport is None:
+        return None
+    connector = aiohttp.TCPConnector(limit=COSMOS_POOL_SIZE, limit_per_host=COSMOS_POOL_SIZE)
+    session = aiohttp.ClientSession(connector=connector)
+    return AioHttpTransport(session=session, session_owner=True)
+
 
-app = FastAPI(title="naughty-chats-backend")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # one long-lived async client (and connection pool) shared by every request in this worker
+    global client, container, ledger_service, settlements, balance_feed, hold_sweeper, chat_engine, gen_jobs_container
+    global event_bus
+    # read once per process; a bad PRICE_TABLE_PATH fails startup rather than the first purchase
+    pricing.set_table(load_price_table())
+    if event_bus is None:
+        event_bus = EventBus(get_event_broker())
+        event_bus.subscribe(connections.deliver)
+        await event_bus.start()
+    if COSMOS_URL and COSMOS_KEY and CosmosClient is not None and ledger_service is None:
+        transport = _make_transport()
+        kwargs = {"transport": transport} if transport is not None else {}
+        client = CosmosClient(COSMOS_URL, credential=COSMOS_KEY, **kwargs)
+        db = client.get_database_client(COSMOS_DB)
+        container = db.get_container_client(COSMOS_CONTAINER)
+        ledger_service = AsyncLedgerService(container, balance_cache=balance_cache, events=event_bus)
+        chat_router.SESSION_STORE = ChatSessionStore(db.get_container_client(COSMOS_CHAT_CONTAINER))
+        characters_router.CATALOG = CharacterCatalog(db.get_container_client(COSMOS_CHARACTERS_CONTAINER))
+        gen_jobs_container = db.get_container_client(COSMOS_JOBS_CONTAINER)
+        await characters_router.CATALOG.load()
+        # picks up characters created or re-ranked by other replicas
+        characters_router.CATALOG.start_feed()
+        if BALANCE_FEED_ENABLED:
+            # keeps this replica's balance cache in step with writes made by other replicas
+            balance_feed = BalanceChangeFeed(container, balance_cache)
+            balance_feed.start()
+        if HOLD_SWEEPER_ENABLED:
+            hold_sweeper = HoldSweeper(ledger_service)
+            hold_sweeper.start()
+    # else: ledger_service remains None and endpoints will return 500 with helpful message
+    if ledger_service is not None and settlements is None:
+        settlements = SettlementCoalescer(ledger_service) if COALESCE_WINDOW_MS > 0 else ledger_service
+    # chat needs an explicitly chosen model; without one /ws answers "chat not configured"
+    if ledger_service is not None and chat_engine is None and MODEL_SERVICE:
+        chat_engine = ChatEngine(ledger_service, get_model_service(), settlements, sessions=chat_router.SESSION_STORE,
+                                 persona_lookup=characters_router.persona_for)
+        chat_router.ENGINE = chat_engine
+    # outside dev the generator and queue must be chosen explicitly; until then the routes answer 503
+    if ledger_service is not None and generate_router.SERVICE is None and IMAGE_GENERATOR and JOB_QUEUE:
+        generate_router.SERVICE = GenerationService(
+            ledger_service, get_job_queue(), gen_jobs_container or GenerationService.local_container(),
+            settlements=settlements, events=event_bus)
+        if GEN_WORKERS_ENABLED:
+            generate_router.SERVICE.start()
+    try:
+        yield
+    finally:
+        password_hasher.shutdown()
+        if generate_router.SERVICE is not None:
+            await generate_router.SERVICE.stop()
+            await generate_router.SERVICE.queue.close()
+            generate_router.SERVICE = None
+        if event_bus is not None:
+            await event_bus.close()
+            event_bus = None
+        await characters_router.CATALOG.stop_feed()
+        if hold_sweeper is not None:
+            await hold_sweeper.stop()
+            hold_sweeper = None
+        if balance_feed is not None:
+            await balance_feed.stop()
+            balance_feed = None
+        if isinstance(settlements, SettlementCoalescer):
+            await settlements.close()
+        settlements = None
+        chat_engine = None
+        chat_router.ENGINE = None
+        if client is not None:
+            await client.close()
+            client = None
+            container = None
+            ledger_service = None
+
+
+app = FastAPI(title="naughty-chats-backend", lifespan=lifespan)
+
+if RATE_LIMIT_ENABLED:
+    # added before CORS so CORS wraps it and browsers can read 429/503 responses
+    app.add_middleware(RateLimitMiddleware, store=rate_limit_store, admission=admission)
 
 # configure CORS (allow dev frontend origins)
 _cors_origins = os.getenv("CORS_ORIGINS", "http://localhost:3000,https://naughty-frontend-dev-ysurana.eastus.azurecontainer.io")
@@ -31,6 +183,40 @@ app.add_middleware(
 app.include_router(auth_routes.router)
 app.include_router(characters_router.router)
 app.include_router(chat_router.router)
+app.include_router(pricing_router.router)
+app.include_router(generate_router.router)
+
+if METRICS_ENABLED:
+    # outermost, so 429/503 rejections and CORS preflights are timed too
+    app.add_middleware(MetricsMiddleware)
+
+
+def _register_collectors():
+    # existing component snapshots, read at scrape time; services that are swapped by the lifespan are looked up then
+    REGISTRY.add_collector("password_hasher", password_hasher.snapshot)
+    REGISTRY.add_collector("token_cache", lambda: token_cache.stats)
+    REGISTRY.add_collector("profile_cache", profile_cache.snapshot)
+    REGISTRY.add_collector("balance_cache", balance_cache.snapshot)
+    REGISTRY.add_collector("pricing", lambda: pricing.stats)
+    REGISTRY.add_collector("character_list_cache", lambda: characters_router.LIST_CACHE.snapshot())
+    REGISTRY.add_collector("chat_sessions", lambda: chat_router.SESSION_STORE.stats)
+    REGISTRY.add_collector("chat", lambda: chat_engine.metrics.snapshot() if chat_engine else {})
+    REGISTRY.add_collector("chat_context", lambda: chat_engine.context.metrics.snapshot() if chat_engine else {})
+    REGISTRY.add_collector("ledger", lambda: ledger_service.conflict_stats.totals if ledger_service else {})
+    REGISTRY.add_collector("gen_jobs", lambda: generate_router.SERVICE.snapshot() if generate_router.SERVICE else {})
+    REGISTRY.add_collector("ws", connections.snapshot)
+    REGISTRY.add_collector("events", lambda: event_bus.stats if event_bus else {})
+    REGISTRY.add_collector("admission", admission.snapshot)
+    REGISTRY.add_collector("rate_limited", lambda: rate_limit.limited)
+
+
+_register_collectors()
+
+
+@app.get("/metrics")
+async def metrics():
+    return PlainTextResponse(await REGISTRY.render(), media_type="text/plain; version=0.0.4")
+
 
 @app.get("/")
 def root():
@@ -38,28 +224,34 @@ def root():
 
 
 @app.websocket('/ws')
-async def websocket_endpoint(ws: WebSocket):
+async def websocket_endpoint(ws: WebSocket, token: str | None = None):
+    # browsers cannot set an Authorization header on a WebSocket, so the access token comes in the query
+    payload = decode_token(token) if token else None
+    if not payload or payload.get("typ") == "refresh":
+        await ws.close(code=4401)
+        return
     await ws.accept()
-    await ws.send_text('hello from ws (auth handshake not implemented)')
-    await ws.close()
-
-COSMOS_URL = os.getenv("COSMOS_URL")
-COSMOS_KEY = os.getenv("COSMOS_KEY")
-COSMOS_DB = os.getenv("COSMOS_DB", "appdb")
-COSMOS_CONTAINER = os.getenv("COSMOS_CONTAINER", "ledger")
-
-client = None
-container = None
-ledger_service = None
-
-if COSMOS_URL and COSMOS_KEY and CosmosClient is not None:
-    client = CosmosClient(COSMOS_URL, COSMOS_KEY)
-    db = client.get_database_client(COSMOS_DB)
-    container = db.get_container_client(COSMOS_CONTAINER)
-    ledger_service = LedgerService(container)
-else:
-    # Lazy: ledger_service remains None and endpoints will return 500 with helpful message
-    pass
+    if chat_engine is None:
+        await ws.send_text(json.dumps({"type": "error", "detail": "chat not configured"}))
+        await ws.close(code=1011)
+        return
+    subscription = connections.register(payload["sub"])
+    if ledger_service is not None:
+        try:
+            # start from the current balance; after this the client only hears about changes
+            subscription.offer(balance_event(payload["sub"], await ledger_service.get_balance(payload["sub"])))
+        except Exception:
+            # no balance doc yet (or Cosmos hiccup): the next change is pushed anyway
+            pass
+    conn = ChatConnection(ws, payload["sub"], chat_engine, subscription=subscription)
+    try:
+        await conn.serve()
+    finally:
+        connections.unregister(subscription)
+    try:
+        await ws.close()
+    except (RuntimeError, WebSocketDisconnect):
+        pass
 
 
 class HoldRequest(BaseModel):
@@ -82,33 +274,45 @@ class CancelRequest(BaseModel):
 
 
 @app.get("/api/v1/gems/balance")
-def balance(user_id: str):
+async def balance(user_id: str):
     if not ledger_service:
         raise HTTPException(status_code=500, detail="Cosmos not configured")
     try:
-        bal = ledger_service.get_balance(user_id)
+        bal = await ledger_service.get_balance(user_id)
         return {"user_id": user_id, "balance": bal}
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
 
 @app.get("/api/v1/gems/ledger")
-def ledger_list(user_id: str, limit: int = 50):
+async def ledger_list(user_id: str, limit: int = 50, cursor: str | None = None, format: str = "json"):
     if not ledger_service:
         raise HTTPException(status_code=500, detail="Cosmos not configured")
-    items = ledger_service.list_ledger_events(user_id, limit=limit)
-    return {"items": items}
+    if format == "ndjson":
+        # full-history export, streamed page by page
+        async def lines():
+            async for item in ledger_service.iter_ledger_events(user_id):
+                yield json.dumps(item, separators=(",", ":")) + "\n"
+        return StreamingResponse(lines(), media_type="application/x-ndjson")
+    try:
+        return await ledger_service.list_ledger_events_page(user_id, limit=limit, cursor=cursor)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
 
 
 @app.post("/api/v1/gems/hold")
-def place_hold(req: HoldRequest):
+async def place_hold(req: HoldRequest):
     if not ledger_service:
         raise HTTPException(status_code=500, detail="Cosmos not configured")
     try:
-        out = ledger_service.reserve_hold(req.user_id, req.amount, req.idempotency_key)
+        out = await ledger_service.reserve_hold(req.user_id, req.amount, req.idempotency_key)
         return out
     except InsufficientFunds:
         raise HTTPException(status_code=402, detail="Insufficient gems")
+    except IdempotencyKeyReused as e:
+        raise HTTPException(status_code=422, detail=str(e))
+    except ConcurrencyConflict as e:
+        raise HTTPException(status_code=409, detail=str(e), headers={"Retry-After": "1"})
     except BatchFailedError as e:
         raise HTTPException(status_code=500, detail=str(e))
     except Exception as e:
@@ -116,12 +320,14 @@ def place_hold(req: HoldRequest):
 
 
 @app.post("/api/v1/gems/finalize")
-def finalize(req: FinalizeRequest):
+async def finalize(req: FinalizeRequest):
     if not ledger_service:
         raise HTTPException(status_code=500, detail="Cosmos not configured")
     try:
-        out = ledger_service.finalize_hold(req.user_id, req.hold_id, req.actual_cost, req.idempotency_key)
+        out = await settlements.finalize_hold(req.user_id, req.hold_id, req.actual_cost, req.idempotency_key)
         return out
+    except ConcurrencyConflict as e:
+        raise HTTPException(status_code=409, detail=str(e), headers={"Retry-After": "1"})
     except BatchFailedError as e:
         raise HTTPException(status_code=500, detail=str(e))
     except Exception as e:
@@ -129,12 +335,14 @@ def finalize(req: FinalizeRequest):
 
 
 @app.post("/api/v1/gems/cancel")
-def cancel(req: CancelRequest):
+async def cancel(req: CancelRequest):
     if not ledger_service:
         raise HTTPException(status_code=500, detail="Cosmos not configured")
     try:
-        out = ledger_service.cancel_hold(req.user_id, req.hold_id, req.idempotency_key)
+        out = await settlements.cancel_hold(req.user_id, req.hold_id, req.idempotency_key)
         return out
+    except ConcurrencyConflict as e:
+        raise HTTPException(status_code=409, detail=str(e), headers={"Retry-After": "1"})
     except BatchFailedError as e:
         raise HTTPException(status_code=500, detail=str(e))
     except Exception as e:
@@ -1,17 +1,34 @@
+import base64
+import hashlib
+import hmac
+import json
 import os
+import time
 from datetime import datetime, timedelta
-from typing import Optional
+from typing import Callable, Dict, Optional
 
 from passlib.context import CryptContext
 from jose import jwt, JWTError
 
+from .ttl_cache import TTLCache
+
+try:
+    import jwt as pyjwt
+except Exception:
+    pyjwt = None
+
 # Config
 JWT_SECRET = os.getenv("JWT_SECRET", "dev-secret-change-me")
 JWT_ALGO = os.getenv("JWT_ALGO", "HS256")
 ACCESS_TOKEN_EXPIRE_MINUTES = int(os.getenv("ACCESS_TOKEN_EXPIRE_MINUTES", "15"))
 REFRESH_TOKEN_EXPIRE_DAYS = int(os.getenv("REFRESH_TOKEN_EXPIRE_DAYS", "30"))
+# jose (reference), hmac (stdlib fast path for HS*), pyjwt (if installed)
+JWT_VALIDATOR = os.getenv("JWT_VALIDATOR", "jose")
+TOKEN_CACHE_SIZE = int(os.getenv("TOKEN_CACHE_SIZE", "100000"))
+# bcrypt work factor for new hashes; existing hashes keep verifying at the cost they were made with
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
 
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
 
 
 def get_password_hash(password: str) -> str:
@@ -36,9 +53,105 @@ def create_refresh_token(subject: str, expires_delta: Optional[timedelta] = None
     return jwt.encode(to_encode, JWT_SECRET, algorithm=JWT_ALGO)
 
 
-def decode_token(token: str) -> Optional[dict]:
+def _jose_validator(token: str) -> Optional[dict]:
     try:
-        payload = jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGO])
-        return payload
+        return jwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGO])
     except JWTError:
         return None
+
+
+def _pyjwt_validator(token: str) -> Optional[dict]:
+    try:
+        return pyjwt.decode(token, JWT_SECRET, algorithms=[JWT_ALGO])
+    except pyjwt.PyJWTError:
+        return None
+
+
+_HMAC_DIGESTS = {"HS256": hashlib.sha256, "HS384": hashlib.sha384, "HS512": hashlib.sha512}
+
+
+def _b64decode(seg: str) -> bytes:
+    return base64.urlsafe_b64decode(seg + "=" * (-len(seg) % 4))
+
+
+def _hmac_validator(token: str) -> Optional[dict]:
+    """HS256/384/512 verification with the stdlib only: same checks as jose for the tokens we issue.
+
+    The algorithm is pinned to JWT_ALGO (a header naming anything else, including "none", is rejected),
+    the signature is compared in constant time and exp/nbf are enforced without leeway.
+    """
+    digest = _HMAC_DIGESTS.get(JWT_ALGO)
+    if digest is None:
+        return _jose_validator(token)
+    try:
+        header_seg, payload_seg, sig_seg = token.split(".")
+        header = json.loads(_b64decode(header_seg))
+        if header.get("alg") != JWT_ALGO:
+            return None
+        expected = hmac.new(JWT_SECRET.encode(), f"{header_seg}.{payload_seg}".encode(), digest).digest()
+        if not hmac.compare_digest(expected, _b64decode(sig_seg)):
+            return None
+        payload = json.loads(_b64decode(payload_seg))
+    except (ValueError, TypeError, AttributeError):
+        return None
+    if not isinstance(payload, dict):
+        return None
+    now = time.time()
+    exp, nbf = payload.get("exp"), payload.get("nbf")
+    if exp is not None and (not isinstance(exp, (int, float)) or exp <= now):
+        return None
+    if nbf is not None and (not isinstance(nbf, (int, float)) or nbf > now):
+        return None
+    return payload
+
+
+VALIDATORS: Dict[str, Callable[[str], Optional[dict]]] = {"jose": _jose_validator, "hmac": _hmac_validator}
+if pyjwt is not None:
+    VALIDATORS["pyjwt"] = _pyjwt_validator
+
+
+class TokenCache(TTLCache):
+    """Bounded LRU of already-verified tokens -> payload, valid until the token's own exp.
+
+    Keys are digests, so raw bearer tokens are never kept in memory.
+    """
+
+    def __init__(self, max_entries: int = TOKEN_CACHE_SIZE, clock=time.time):
+        super().__init__(max_entries, clock=clock)
+
+    @staticmethod
+    def key(token: str) -> bytes:
+        return hashlib.blake2b(token.encode(), digest_size=16).digest()
+
+    def get(self, key: bytes) -> Optional[dict]:
+        payload = super().get(key)
+        return None if payload is None else dict(payload)
+
+    def put(self, key: bytes, payload: dict):
+        exp = payload.get("exp")
+        if not isinstance(exp, (int, float)):
+            # tokens without exp are re-verified every time
+            return
+        super().put(key, dict(payload), float(exp))
+
+
+token_cache = TokenCache()
+_validator = VALIDATORS.get(JWT_VALIDATOR, _jose_validator)
+
+
+def set_token_validator(name_or_fn) -> None:
+    """Swap the verifier behind decode_token (a VALIDATORS name or a callable token -> payload|None)."""
+    global _validator
+    _validator = VALIDATORS[name_or_fn] if isinstance(name_or_fn, str) else name_or_fn
+    token_cache.clear()
+
+
+def decode_token(token: str) -> Optional[dict]:
+    key = TokenCache.key(token)
+    payload = token_cache.get(key)
+    if payload is not None:
+        return payload
+    payload = _validator(token)
+    if payload is not None:
+        token_cache.put(key, payload)
+    return payload
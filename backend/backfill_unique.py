@@ -0,0 +1,127 @@
+"""One-off backfill of the unique-constraint pointers for users created before they existed.
+
+UserRepository keeps a "username:..." and an "email:..." pointer doc per user; users written before the
+pointers were introduced have neither, so their email logins fall back to a cross-partition query and
+their addresses are only protected by the EMAIL_INDEX_FALLBACK_SCAN check. This walks every user doc in
+id order, keyset-paginated, and claims both pointers on a thread pool. Claims adopt pointers the user
+already holds, so the job is idempotent and an interrupted run can simply be started again.
+
+Two users sharing an address (possible before the pointers) cannot both hold it: the first claim wins
+and the other is written to the NDJSON report for manual follow-up. Once a run finishes without
+conflicts or errors, set EMAIL_INDEX_FALLBACK_SCAN=0.
+
+    python -m backend.backfill_unique --workers 16 --report unique-conflicts.ndjson
+"""
+import argparse
+import json
+import logging
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Dict, Iterator, List, Optional
+
+from .repositories.user_repository import UNIQUE_FIELDS, UniqueConstraintViolation, UserRepository, valid_username
+
+log = logging.getLogger(__name__)
+
+BACKFILL_WORKERS = int(os.getenv("BACKFILL_WORKERS", "16"))
+BACKFILL_USER_PAGE = 1000
+
+
+class UniqueBackfill:
+    def __init__(self, repo: UserRepository, workers: int = BACKFILL_WORKERS, report_path: Optional[str] = None):
+        self.repo = repo
+        self.container = repo.container
+        self.workers = workers
+        self.report_path = report_path
+        self.stats: Dict[str, Any] = {"users": 0, "claimed": 0, "conflicts": 0, "errors": 0,
+                                      "elapsed_seconds": 0.0}
+
+    def iter_users(self, after: str = "") -> Iterator[Dict[str, Any]]:
+        """Every user doc (pointers carry a docType, users do not), in id order."""
+        q = (f"SELECT TOP {BACKFILL_USER_PAGE} c.id, c.username, c.email FROM c "
+             "WHERE NOT IS_DEFINED(c.docType) AND c.id > @after ORDER BY c.id ASC")
+        while True:
+            page = list(self.container.query_items(query=q, parameters=[{"name": "@after", "value": after}],
+                                                   enable_cross_partition_query=True))
+            yield from page
+            if len(page) < BACKFILL_USER_PAGE:
+                return
+            after = page[-1]["id"]
+
+    def backfill_user(self, user: Dict[str, Any]) -> Dict[str, Any]:
+        out: Dict[str, Any] = {"user_id": user["id"], "claimed": [], "conflicts": []}
+        if not valid_username(user["id"]):
+            # its id lies in the pointer id space; leave it for manual follow-up
+            out["conflicts"].append("invalid_username")
+            return out
+        values = {"username": user["id"], "email": user.get("email")}
+        for field in UNIQUE_FIELDS:
+            if not values[field]:
+                continue
+            try:
+                if self.repo.claim_unique(field, values[field], user["id"], scan_legacy=False) is not None:
+                    out["claimed"].append(field)
+            except UniqueConstraintViolation:
+                out["conflicts"].append(field)
+        return out
+
+    def _record(self, result: Dict[str, Any]):
+        self.stats["users"] += 1
+        self.stats["claimed"] += len(result["claimed"])
+        if result["conflicts"]:
+            self.stats["conflicts"] += 1
+            if self.report_path:
+                with open(self.report_path, "a") as fh:
+                    fh.write(json.dumps(result) + "\n")
+
+    def run(self) -> Dict[str, Any]:
+        started = time.perf_counter()
+        users = self.iter_users()
+        max_in_flight = self.workers * 4
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            in_flight = {}
+            exhausted = False
+            while in_flight or not exhausted:
+                # bounded, so the user pages are consumed as the pool drains rather than all up front
+                while not exhausted and len(in_flight) < max_in_flight:
+                    user = next(users, None)
+                    if user is None:
+                        exhausted = True
+                        break
+                    in_flight[pool.submit(self.backfill_user, user)] = user["id"]
+                if not in_flight:
+                    break
+                finished, _ = wait(list(in_flight), return_when=FIRST_COMPLETED)
+                for fut in finished:
+                    user_id = in_flight.pop(fut)
+                    try:
+                        self._record(fut.result())
+                    except Exception as e:
+                        self.stats["errors"] += 1
+                        log.warning("backfill %s failed: %s", user_id, e)
+        self.stats["elapsed_seconds"] = round(time.perf_counter() - started, 3)
+        return dict(self.stats)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Write unique-constraint pointers for existing users")
+    parser.add_argument("--workers", type=int, default=BACKFILL_WORKERS)
+    parser.add_argument("--report", default="unique-conflicts.ndjson")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    if not os.getenv("COSMOS_URL") or not os.getenv("COSMOS_KEY"):
+        log.error("COSMOS_URL / COSMOS_KEY not set")
+        return 2
+    repo = UserRepository()
+    if repo.container is None:
+        log.error("users container not available")
+        return 2
+    stats = UniqueBackfill(repo, workers=args.workers, report_path=args.report).run()
+    log.info("unique pointer backfill finished: %s", stats)
+    return 0 if stats["errors"] == 0 and stats["conflicts"] == 0 else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,123 @@
+import asyncio
+import logging
+import os
+import time
+from typing import Any, Dict, Optional
+
+from .ttl_cache import TTLCache
+
+log = logging.getLogger(__name__)
+
+BALANCE_CACHE_SIZE = int(os.getenv("BALANCE_CACHE_SIZE", "100000"))
+# PRD: balance updates visible within 1s, so a cached value never outlives that even if the feed lags
+BALANCE_CACHE_TTL_SECONDS = float(os.getenv("BALANCE_CACHE_TTL_SECONDS", "1.0"))
+BALANCE_FEED_POLL_MS = float(os.getenv("BALANCE_FEED_POLL_MS", "250"))
+
+
+class BalanceCache(TTLCache):
+    """TTL + LRU cache of user balances.
+
+    Entries carry the balance doc's updated_at so a late write-through or feed event never replaces a
+    newer value with an older one.
+    """
+
+    def __init__(self, max_entries: int = BALANCE_CACHE_SIZE, ttl_seconds: float = BALANCE_CACHE_TTL_SECONDS,
+                 clock=time.monotonic):
+        # values are (balance, updated_at)
+        super().__init__(max_entries, ttl_seconds, clock)
+        self.stats["feed_updates"] = 0
+
+    def get(self, user_id: str) -> Optional[int]:
+        entry = super().get(user_id)
+        return None if entry is None else entry[0]
+
+    def put(self, user_id: str, balance: int, updated_at: Optional[str] = None):
+        updated_at = updated_at or ""
+        with self._lock:
+            entry = self._items.get(user_id)
+            if entry is not None and entry[0][1] > updated_at:
+                return
+            self._store(user_id, (int(balance), updated_at))
+
+    def put_doc(self, doc: Dict[str, Any]):
+        self.put(doc["user_id"], int(doc.get("balance", 0)), doc.get("updated_at"))
+
+    def apply_feed_doc(self, doc: Dict[str, Any]):
+        """Refresh a cached balance from a change-feed copy of its balance doc; uncached users are ignored."""
+        user_id = doc["user_id"]
+        updated_at = doc.get("updated_at") or ""
+        with self._lock:
+            entry = self._items.get(user_id)
+            if entry is None or entry[0][1] > updated_at:
+                return
+            # refreshed in place: a feed event is not a use, so it does not move the entry up the LRU
+            self._items[user_id] = ((int(doc.get("balance", 0)), updated_at), self._clock() + self.ttl)
+            self.stats["feed_updates"] += 1
+
+    def snapshot(self) -> Dict[str, Any]:
+        out = super().snapshot()
+        out["hit_ratio"] = round(self.hit_ratio(), 4)
+        return out
+
+
+class BalanceChangeFeed:
+    """Tails the ledger container's change feed and applies balance doc changes to a BalanceCache.
+
+    Every replica runs one of these, so a mutation committed by any replica refreshes (or drops) the
+    cached balance everywhere within about one poll interval.
+    """
+
+    def __init__(self, container, cache: BalanceCache, poll_ms: float = BALANCE_FEED_POLL_MS):
+        self.container = container
+        self.cache = cache
+        self.poll = poll_ms / 1000.0
+        self.continuation: Optional[str] = None
+        self._task: Optional[asyncio.Task] = None
+
+    def apply(self, doc: Dict[str, Any]):
+        if doc.get("docType") != "balance" or "user_id" not in doc:
+            return
+        self.cache.apply_feed_doc(doc)
+
+    async def poll_once(self) -> int:
+        headers: Dict[str, Any] = {}
+
+        def hook(h, _):
+            headers.update(h)
+
+        kwargs: Dict[str, Any] = {"response_hook": hook}
+        if self.continuation:
+            kwargs["continuation"] = self.continuation
+        else:
+            kwargs["start_time"] = "Now"
+        n = 0
+        async for doc in self.container.query_items_change_feed(**kwargs):
+            self.apply(doc)
+            n += 1
+        # the change feed continuation comes back in the etag header
+        self.continuation = headers.get("etag") or self.continuation
+        return n
+
+    async def run(self):
+        while True:
+            try:
+                await self.poll_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                # a failed poll only delays refreshes; TTL still bounds staleness
+                log.exception("balance change feed poll failed")
+            await asyncio.sleep(self.poll)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
@@ -0,0 +1,51 @@
+"""Token verification microbenchmarks (single thread, so results read as verifications/sec per core).
+
+    python -m backend.bench_auth [--seconds 1.0] [--tokens 1000]
+
+Each validator in auth.VALIDATORS is timed on its own, then decode_token is timed with a warm cache
+(the steady state for a websocket that re-presents the same access token).
+"""
+import argparse
+import json
+import sys
+import time
+from typing import Callable, Dict, List, Optional
+
+from . import auth
+
+
+def _rate(fn: Callable[[str], Optional[dict]], tokens: List[str], seconds: float) -> float:
+    n = 0
+    deadline = time.perf_counter() + seconds
+    started = time.perf_counter()
+    while time.perf_counter() < deadline:
+        for t in tokens:
+            if fn(t) is None:
+                raise AssertionError("benchmark token failed verification")
+        n += len(tokens)
+    return n / (time.perf_counter() - started)
+
+
+def run(seconds: float = 1.0, n_tokens: int = 1000) -> Dict[str, float]:
+    tokens = [auth.create_access_token(f"bench-user-{i}") for i in range(n_tokens)]
+    out: Dict[str, float] = {}
+    for name, validator in auth.VALIDATORS.items():
+        out[f"{name}_per_sec"] = round(_rate(validator, tokens, seconds), 1)
+    auth.token_cache.clear()
+    for t in tokens:
+        auth.decode_token(t)
+    out["decode_token_cached_per_sec"] = round(_rate(auth.decode_token, tokens, seconds), 1)
+    return out
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="JWT verification microbenchmarks")
+    parser.add_argument("--seconds", type=float, default=1.0)
+    parser.add_argument("--tokens", type=int, default=1000)
+    args = parser.parse_args(argv)
+    print(json.dumps(run(args.seconds, args.tokens), indent=2))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,342 @@
+"""Ledger throughput/latency benchmarks.
+
+Runs against the in-memory Cosmos emulator, so numbers measure our code (batch building, retries, cache,
+routing, serialization) rather than the network. Every scenario is run twice: directly against
+AsyncLedgerService ("service") and through the /api/v1/gems/* routes with an ASGI client ("api").
+
+Scenarios:
+    many_users    N users, one reserve+finalize (or cancel) each, all concurrent
+    hot_user      one user, C concurrent reserve+finalize loops on the same partition (etag contention)
+    long_history  a user with H events, paged through /ledger and iter_ledger_events
+
+    python -m backend.bench_ledger [--quick] [--save bench-baseline.json] [--compare bench-baseline.json]
+
+--compare exits 1 when ops/sec drops or p95 rises by more than --tolerance against the baseline.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import platform
+import sys
+import time
+import tracemalloc
+from typing import Any, Awaitable, Callable, Dict, List, Optional
+
+from .cosmos_emulator import AsyncInMemoryContainer, InMemoryContainer
+from .ledger import AsyncLedgerService, ConcurrencyConflict
+from .retry import ConflictStats, RetryPolicy
+
+try:
+    import httpx
+except Exception:
+    httpx = None
+
+log = logging.getLogger(__name__)
+
+SIZES = {
+    "full": {"users": 2000, "hot_workers": 32, "hot_ops": 20, "history": 5000, "latency_ms": 0.5},
+    "quick": {"users": 200, "hot_workers": 8, "hot_ops": 5, "history": 500, "latency_ms": 0.0},
+}
+# metrics compared against the baseline and the direction that counts as a regression
+_COMPARED = {"ops_per_sec": "lower", "p95_ms": "higher", "p99_ms": "higher", "retries_per_op": "higher"}
+
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    if not sorted_values:
+        return 0.0
+    k = min(len(sorted_values) - 1, max(0, int(round(pct / 100.0 * (len(sorted_values) - 1)))))
+    return sorted_values[k]
+
+
+class Recorder:
+    def __init__(self):
+        self.latencies: List[float] = []
+        self.errors = 0
+
+    async def timed(self, fn: Callable[[], Awaitable[Any]]):
+        t0 = time.perf_counter()
+        try:
+            return await fn()
+        except ConcurrencyConflict:
+            self.errors += 1
+        finally:
+            self.latencies.append((time.perf_counter() - t0) * 1000.0)
+
+    def summary(self, elapsed: float, stats: ConflictStats, container: AsyncInMemoryContainer,
+                alloc: Optional[Dict[str, float]] = None) -> Dict[str, Any]:
+        lat = sorted(self.latencies)
+        ops = len(lat)
+        out = {
+            "ops": ops,
+            "errors": self.errors,
+            "elapsed_s": round(elapsed, 4),
+            "ops_per_sec": round(ops / elapsed, 1) if elapsed > 0 else 0.0,
+            "p50_ms": round(percentile(lat, 50), 3),
+            "p95_ms": round(percentile(lat, 95), 3),
+            "p99_ms": round(percentile(lat, 99), 3),
+            "retries": stats.totals["retries"],
+            "retries_per_op": round(stats.totals["retries"] / ops, 4) if ops else 0.0,
+            "conflicts_412": container.stats["conflicts_412"],
+        }
+        if alloc:
+            out.update(alloc)
+        return out
+
+
+def bench_app(app):
+    """A copy of app (same routes, handlers and middleware) whose rate limiter has no policies or admission.
+
+    Every ASGITransport request comes from one client address, so the per-IP limits and admission control
+    would turn the benchmark into a measurement of 429s and 503s. The limiter itself stays in the stack,
+    so its per-request cost is still measured.
+    """
+    from fastapi import FastAPI
+    from starlette.middleware import Middleware
+    from .rate_limit import RateLimitMiddleware
+
+    out = FastAPI(routes=app.routes, exception_handlers=dict(app.exception_handlers))
+    out.user_middleware = [Middleware(RateLimitMiddleware, policies=[], admission=None)
+                           if m.cls is RateLimitMiddleware else m for m in app.user_middleware]
+    return out
+
+
+class Harness:
+    """One emulated container + ledger, optionally exposed through the FastAPI app."""
+
+    def __init__(self, latency_ms: float, via: str):
+        self.inner = InMemoryContainer()
+        self.container = AsyncInMemoryContainer(self.inner, latency_ms=latency_ms)
+        self.stats = ConflictStats()
+        self.ledger = AsyncLedgerService(self.container, retry_policy=RetryPolicy(max_retries=20),
+                                         conflict_stats=self.stats)
+        self.via = via
+        self.http = None
+
+    def seed(self, user_id: str, balance: int):
+        self.inner.upsert_item({"id": f"balance:{user_id}", "docType": "balance", "user_id": user_id,
+                                "balance": balance, "opening_balance": balance})
+
+    async def __aenter__(self):
+        if self.via == "api":
+            if httpx is None:
+                raise RuntimeError("httpx is required for the api benchmarks")
+            from . import app as app_module
+            self._saved = (app_module.ledger_service, app_module.settlements)
+            # routes read the module globals; the lifespan (and its real Cosmos client) is not run
+            app_module.ledger_service = self.ledger
+            app_module.settlements = self.ledger
+            self.http = httpx.AsyncClient(transport=httpx.ASGITransport(app=bench_app(app_module.app)),
+                                          base_url="http://bench")
+        return self
+
+    async def __aexit__(self, *exc):
+        if self.http is not None:
+            from . import app as app_module
+            await self.http.aclose()
+            app_module.ledger_service, app_module.settlements = self._saved
+
+    async def _post(self, path: str, body: Dict[str, Any]) -> Dict[str, Any]:
+        r = await self.http.post(path, json=body)
+        if r.status_code == 409:
+            raise ConcurrencyConflict(r.text)
+        r.raise_for_status()
+        return r.json()
+
+    async def reserve(self, user_id: str, amount: int) -> Dict[str, Any]:
+        if self.via == "api":
+            return await self._post("/api/v1/gems/hold", {"user_id": user_id, "amount": amount})
+        return await self.ledger.reserve_hold(user_id, amount)
+
+    async def finalize(self, user_id: str, hold_id: str, cost: int) -> Dict[str, Any]:
+        if self.via == "api":
+            return await self._post("/api/v1/gems/finalize", {"user_id": user_id, "hold_id": hold_id, "actual_cost": cost})
+        return await self.ledger.finalize_hold(user_id, hold_id, cost)
+
+    async def cancel(self, user_id: str, hold_id: str) -> Dict[str, Any]:
+        if self.via == "api":
+            return await self._post("/api/v1/gems/cancel", {"user_id": user_id, "hold_id": hold_id})
+        return await self.ledger.cancel_hold(user_id, hold_id)
+
+    async def ledger_page(self, user_id: str, limit: int, cursor: Optional[str]) -> Dict[str, Any]:
+        if self.via == "api":
+            params = {"user_id": user_id, "limit": limit}
+            if cursor:
+                params["cursor"] = cursor
+            r = await self.http.get("/api/v1/gems/ledger", params=params)
+            r.raise_for_status()
+            return r.json()
+        return await self.ledger.list_ledger_events_page(user_id, limit=limit, cursor=cursor)
+
+
+async def _measure(h: Harness, work: Callable[[Recorder], Awaitable[None]], track_alloc: bool) -> Dict[str, Any]:
+    rec = Recorder()
+    if track_alloc:
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+    t0 = time.perf_counter()
+    await work(rec)
+    elapsed = time.perf_counter() - t0
+    alloc = None
+    if track_alloc:
+        after = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        diff = after.compare_to(before, "filename")
+        ops = max(1, len(rec.latencies))
+        # tracemalloc slows everything down, so timings from an alloc run are only indicative
+        alloc = {"alloc_blocks_per_op": round(sum(max(0, d.count_diff) for d in diff) / ops, 2),
+                 "alloc_kib_per_op": round(sum(max(0, d.size_diff) for d in diff) / 1024 / ops, 3),
+                 "peak_kib": round(peak / 1024, 1)}
+    return rec.summary(elapsed, h.stats, h.container, alloc)
+
+
+async def scenario_many_users(via: str, size: Dict[str, Any], track_alloc: bool = False) -> Dict[str, Any]:
+    async with Harness(size["latency_ms"], via) as h:
+        users = [f"bench-user-{i}" for i in range(size["users"])]
+        for u in users:
+            h.seed(u, 1000)
+
+        async def one(rec: Recorder, i: int, u: str):
+            hold = await rec.timed(lambda: h.reserve(u, 50))
+            if hold is None:
+                return
+            if i % 4 == 0:
+                await rec.timed(lambda: h.cancel(u, hold["hold_id"]))
+            else:
+                await rec.timed(lambda: h.finalize(u, hold["hold_id"], 30))
+
+        async def work(rec: Recorder):
+            await asyncio.gather(*[one(rec, i, u) for i, u in enumerate(users)])
+
+        return await _measure(h, work, track_alloc)
+
+
+async def scenario_hot_user(via: str, size: Dict[str, Any], track_alloc: bool = False) -> Dict[str, Any]:
+    async with Harness(size["latency_ms"], via) as h:
+        h.seed("hot-user", 10 ** 9)
+
+        async def loop(rec: Recorder):
+            for _ in range(size["hot_ops"]):
+                hold = await rec.timed(lambda: h.reserve("hot-user", 10))
+                if hold is not None:
+                    await rec.timed(lambda: h.finalize("hot-user", hold["hold_id"], 7))
+
+        async def work(rec: Recorder):
+            await asyncio.gather(*[loop(rec) for _ in range(size["hot_workers"])])
+
+        return await _measure(h, work, track_alloc)
+
+
+async def scenario_long_history(via: str, size: Dict[str, Any], track_alloc: bool = False) -> Dict[str, Any]:
+    async with Harness(size["latency_ms"], via) as h:
+        h.seed("long-user", 10 ** 9)
+        # build the history straight in the store; only the listing is measured
+        for i in range(size["history"]):
+            h.inner.create_item({"id": f"evt:{i:08d}", "docType": "ledger_event", "user_id": "long-user",
+                                 "change": -1, "balance_after": 10 ** 9 - i - 1, "event_type": "hold_placed",
+                                 "reference_id": None, "created_at": f"2024-01-01T00:00:00.{i:08d}Z"})
+
+        async def work(rec: Recorder):
+            cursor = None
+            seen = 0
+            while True:
+                page = await rec.timed(lambda: h.ledger_page("long-user", 100, cursor))
+                seen += len(page["items"])
+                cursor = page["next_cursor"]
+                if not cursor:
+                    break
+            if seen != size["history"]:
+                raise AssertionError(f"paged {seen} of {size['history']} events")
+
+        return await _measure(h, work, track_alloc)
+
+
+SCENARIOS = {
+    "many_users": scenario_many_users,
+    "hot_user": scenario_hot_user,
+    "long_history": scenario_long_history,
+}
+
+
+async def run_all(size_name: str = "full", vias=("service", "api"), scenarios=None,
+                  track_alloc: bool = True) -> Dict[str, Any]:
+    size = SIZES[size_name]
+    results: Dict[str, Any] = {}
+    for name in scenarios or SCENARIOS:
+        for via in vias:
+            key = f"{name}/{via}"
+            results[key] = await SCENARIOS[name](via, size)
+            if track_alloc:
+                # separate pass so tracemalloc overhead does not skew the timings
+                alloc = await SCENARIOS[name](via, size, track_alloc=True)
+                results[key].update({k: v for k, v in alloc.items() if k.startswith(("alloc_", "peak_"))})
+    return {
+        "meta": {"size": size_name, "python": platform.python_version(), "platform": platform.platform(),
+                 "created_at": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime())},
+        "results": results,
+    }
+
+
+def compare(current: Dict[str, Any], baseline: Dict[str, Any], tolerance: float = 0.2) -> List[Dict[str, Any]]:
+    """Per-metric deltas vs the baseline; rows flagged regression=True exceeded the tolerance."""
+    rows = []
+    for key, cur in current["results"].items():
+        base = baseline.get("results", {}).get(key)
+        if not base:
+            continue
+        for metric, bad in _COMPARED.items():
+            old, new = base.get(metric), cur.get(metric)
+            if old is None or new is None:
+                continue
+            change = (new - old) / old if old else (0.0 if new == old else float("inf"))
+            regression = change < -tolerance if bad == "lower" else change > tolerance
+            # retries are noisy around zero; ignore tiny absolute moves
+            if metric == "retries_per_op" and abs(new - old) < 0.05:
+                regression = False
+            rows.append({"scenario": key, "metric": metric, "baseline": old, "current": new,
+                         "change_pct": round(change * 100, 1) if change != float("inf") else None,
+                         "regression": regression})
+    return rows
+
+
+def _print_table(report: Dict[str, Any]):
+    cols = ("ops", "ops_per_sec", "p50_ms", "p95_ms", "p99_ms", "retries_per_op", "alloc_kib_per_op")
+    print(f"{'scenario':<24}" + "".join(f"{c:>18}" for c in cols))
+    for key, row in report["results"].items():
+        print(f"{key:<24}" + "".join(f"{row.get(c, ''):>18}" for c in cols))
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the gem ledger against the in-memory Cosmos emulator")
+    parser.add_argument("--quick", action="store_true", help="small sizes, no simulated latency")
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS))
+    parser.add_argument("--via", action="append", choices=("service", "api"))
+    parser.add_argument("--no-alloc", action="store_true", help="skip the tracemalloc pass")
+    parser.add_argument("--save", help="write the results as a JSON baseline")
+    parser.add_argument("--compare", help="diff against a saved baseline; exit 1 on regression")
+    parser.add_argument("--tolerance", type=float, default=0.2)
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.WARNING)
+
+    report = asyncio.run(run_all("quick" if args.quick else "full", tuple(args.via or ("service", "api")),
+                                 args.scenario, track_alloc=not args.no_alloc))
+    _print_table(report)
+    if args.save:
+        with open(args.save, "w") as fh:
+            json.dump(report, fh, indent=2, sort_keys=True)
+    if args.compare:
+        with open(args.compare) as fh:
+            baseline = json.load(fh)
+        rows = compare(report, baseline, args.tolerance)
+        regressions = [r for r in rows if r["regression"]]
+        for r in regressions:
+            print(f"REGRESSION {r['scenario']} {r['metric']}: {r['baseline']} -> {r['current']} ({r['change_pct']}%)")
+        if regressions:
+            return 1
+        print(f"no regressions vs {args.compare} (tolerance {args.tolerance:.0%})")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,343 @@
+"""Character catalog: persistence plus in-memory indexes for the Tavern listing.
+
+Character docs live in their own container partitioned by /id (ids are "char:<uuid hex>", so replicas
+never collide). Each replica keeps the published catalog indexed in memory:
+
+- inverted indexes tag -> ids and name token -> ids (plus a sorted vocabulary for prefix search),
+- the set of nsfw ids,
+- one rank list per sort key, sorted ascending by (key, id) with the best first, maintained with
+  bisect on every create/update/chat instead of being re-sorted per request.
+
+A query intersects the smallest sets first and then walks the rank list for its sort, so cost grows
+with the page size, not the catalog. Writes from other replicas arrive through the change feed.
+
+Sorts: popular (total chats), trending (chats with exponential time decay), new (created), recent
+(updated). Trending keeps tau * ln(sum(exp(t_i / tau))) over chat times, which orders characters the
+same as the decayed sum at any moment, so it never needs a periodic re-score.
+"""
+import asyncio
+import json
+import logging
+import math
+import os
+import re
+import time
+from bisect import bisect_left, bisect_right, insort
+from datetime import datetime
+from typing import Any, Dict, Iterable, List, Optional, Set, Tuple
+from uuid import uuid4
+
+from .cosmos_emulator import AsyncInMemoryContainer, InMemoryContainer
+from .ledger import decode_cursor, encode_cursor
+from .retry import replace_with_etag
+
+log = logging.getLogger(__name__)
+
+# how fast trending forgets: a chat counts e times less after this many hours
+TRENDING_DECAY_HOURS = float(os.getenv("TRENDING_DECAY_HOURS", "24"))
+CATALOG_FEED_POLL_MS = float(os.getenv("CATALOG_FEED_POLL_MS", "2000"))
+MAX_CATALOG_PAGE = 100
+SORTS = ("popular", "trending", "new", "recent")
+_TOKEN = re.compile(r"\w+", re.UNICODE)
+# a change to any of these (or a new character) bumps CharacterCatalog.version; chat counters do not,
+# so cached listings age out by TTL instead of being dropped on every chat start
+_LISTING_FIELDS = ("name", "short_description", "tags", "nsfw", "published")
+# fields returned by list queries
+SUMMARY_FIELDS = ("id", "name", "short_description", "tags", "nsfw", "author_id", "created_at", "chat_count")
+
+
+class CharacterNotFound(Exception):
+    pass
+
+
+def _now_iso() -> str:
+    return datetime.utcnow().isoformat() + "Z"
+
+
+def _ts(iso: Optional[str]) -> float:
+    if not iso:
+        return 0.0
+    try:
+        return datetime.fromisoformat(iso.rstrip("Z")).timestamp()
+    except ValueError:
+        return 0.0
+
+
+def normalize_tag(tag: str) -> str:
+    return tag.strip().lower()
+
+
+def name_tokens(text: str) -> Set[str]:
+    return {t.lower() for t in _TOKEN.findall(text or "")}
+
+
+def _logaddexp(a: float, b: float) -> float:
+    if a == -math.inf:
+        return b
+    hi, lo = (a, b) if a > b else (b, a)
+    return hi + math.log1p(math.exp(lo - hi))
+
+
+class CharacterCatalog:
+    def __init__(self, container, decay_hours: float = TRENDING_DECAY_HOURS, clock=time.time):
+        self.container = container
+        self.tau = decay_hours * 3600.0
+        self._clock = clock
+        self.docs: Dict[str, Dict[str, Any]] = {}
+        self.by_tag: Dict[str, Set[str]] = {}
+        self.by_token: Dict[str, Set[str]] = {}
+        self._vocab: List[str] = []
+        self.nsfw: Set[str] = set()
+        # sort -> ascending [(key, id)]; keys are negated so the best comes first
+        self.ranks: Dict[str, List[Tuple[float, str]]] = {s: [] for s in SORTS}
+        self._keys: Dict[str, Dict[str, float]] = {s: {} for s in SORTS}
+        self.version = 0
+        self.continuation: Optional[str] = None
+        self._task: Optional[asyncio.Task] = None
+
+    @classmethod
+    def local(cls, **kwargs) -> "CharacterCatalog":
+        return cls(AsyncInMemoryContainer(InMemoryContainer(partition_key_path="/id")), **kwargs)
+
+    # indexes -----------------------------------------------------------------------------------------
+    def _sort_keys(self, doc: Dict[str, Any]) -> Dict[str, float]:
+        return {
+            "popular": -float(doc.get("chat_count") or 0),
+            "trending": -float(doc.get("trend_score", -math.inf)) if doc.get("chat_count") else math.inf,
+            "new": -_ts(doc.get("created_at")),
+            "recent": -_ts(doc.get("updated_at") or doc.get("created_at")),
+        }
+
+    def _unindex(self, cid: str):
+        old = self.docs.pop(cid, None)
+        if old is None:
+            return
+        for tag in old.get("tags") or ():
+            ids = self.by_tag.get(tag)
+            if ids is not None:
+                ids.discard(cid)
+                if not ids:
+                    del self.by_tag[tag]
+        for tok in name_tokens(old.get("name")):
+            ids = self.by_token.get(tok)
+            if ids is not None:
+                ids.discard(cid)
+                if not ids:
+                    del self.by_token[tok]
+                    i = bisect_left(self._vocab, tok)
+                    if i < len(self._vocab) and self._vocab[i] == tok:
+                        del self._vocab[i]
+        self.nsfw.discard(cid)
+        for sort, keys in self._keys.items():
+            key = keys.pop(cid, None)
+            if key is not None:
+                rank = self.ranks[sort]
+                i = bisect_left(rank, (key, cid))
+                if i < len(rank) and rank[i] == (key, cid):
+                    del rank[i]
+
+    def _index(self, doc: Dict[str, Any]):
+        cid = doc["id"]
+        self._unindex(cid)
+        if not doc.get("published", True):
+            # unpublished characters are only reachable by id, for their author
+            self.docs[cid] = doc
+            return
+        self.docs[cid] = doc
+        for tag in doc.get("tags") or ():
+            self.by_tag.setdefault(tag, set()).add(cid)
+        for tok in name_tokens(doc.get("name")):
+            ids = self.by_token.get(tok)
+            if ids is None:
+                self.by_token[tok] = ids = set()
+                insort(self._vocab, tok)
+            ids.add(cid)
+        if doc.get("nsfw"):
+            self.nsfw.add(cid)
+        for sort, key in self._sort_keys(doc).items():
+            self._keys[sort][cid] = key
+            insort(self.ranks[sort], (key, cid))
+
+    def apply(self, doc: Dict[str, Any]):
+        """Index a character doc written here or by another replica (newer _ts wins)."""
+        if doc.get("docType") != "character":
+            return
+        current = self.docs.get(doc["id"])
+        if current is not None and current.get("_ts", 0) > doc.get("_ts", 0):
+            return
+        self._index(doc)
+        if current is None or any(current.get(k) != doc.get(k) for k in _LISTING_FIELDS):
+            self.version += 1
+
+    # persistence -------------------------------------------------------------------------------------
+    async def load(self) -> int:
+        # pin the change feed before the query: whatever is written from here on, even while the query
+        # runs, is replayed by the next poll (apply() skips docs the load already has)
+        if self.continuation is None:
+            await self.poll_once()
+        query = "SELECT * FROM c WHERE c.docType='character'"
+        n = 0
+        async for doc in self.container.query_items(query=query):
+            self._index(doc)
+            n += 1
+        self.version += 1
+        return n
+
+    async def create(self, author_id: str, name: str, short_description: str = "", tags: Iterable[str] = (),
+                     nsfw: bool = False, published: bool = True, **extra) -> Dict[str, Any]:
+        now = _now_iso()
+        doc = dict(extra)
+        doc.update({"id": f"char:{uuid4().hex}", "docType": "character", "name": name,
+                    "short_description": short_description,
+                    "tags": sorted({normalize_tag(t) for t in tags if t and t.strip()}),
+                    "nsfw": bool(nsfw), "published": bool(published), "author_id": author_id,
+                    "chat_count": 0, "trend_score": None, "created_at": now, "updated_at": now})
+        created = await self.container.create_item(body=doc)
+        self.apply(created or doc)
+        return self.docs[doc["id"]]
+
+    async def _save(self, cid: str, change) -> Dict[str, Any]:
+        saved = await replace_with_etag(self.container, cid, cid, change)
+        if saved is None:
+            raise CharacterNotFound(cid)
+        self.apply(saved)
+        return saved
+
+    async def update(self, cid: str, changes: Dict[str, Any]) -> Dict[str, Any]:
+        def change(doc):
+            doc.update(changes)
+            if "tags" in changes:
+                doc["tags"] = sorted({normalize_tag(t) for t in changes["tags"] if t and t.strip()})
+            doc["updated_at"] = _now_iso()
+        return await self._save(cid, change)
+
+    async def record_chat(self, cid: str) -> Dict[str, Any]:
+        """A chat was started: bump popular and trending."""
+        t = self._clock() / self.tau
+
+        def change(doc):
+            doc["chat_count"] = int(doc.get("chat_count") or 0) + 1
+            prev = doc.get("trend_score")
+            doc["trend_score"] = _logaddexp(-math.inf if prev is None else prev, t)
+        return await self._save(cid, change)
+
+    # change feed -------------------------------------------------------------------------------------
+    async def poll_once(self) -> int:
+        headers: Dict[str, Any] = {}
+
+        def hook(h, _):
+            headers.update(h)
+
+        kwargs: Dict[str, Any] = {"response_hook": hook}
+        if self.continuation:
+            kwargs["continuation"] = self.continuation
+        else:
+            kwargs["start_time"] = "Now"
+        n = 0
+        async for doc in self.container.query_items_change_feed(**kwargs):
+            self.apply(doc)
+            n += 1
+        self.continuation = headers.get("etag") or self.continuation
+        return n
+
+    async def run_feed(self, poll_ms: float = CATALOG_FEED_POLL_MS):
+        while True:
+            try:
+                await self.poll_once()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception("catalog change feed poll failed")
+            await asyncio.sleep(poll_ms / 1000.0)
+
+    def start_feed(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self.run_feed())
+
+    async def stop_feed(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+
+    # reads -------------------------------------------------------------------------------------------
+    def get(self, cid: str, viewer_id: Optional[str] = None) -> Optional[Dict[str, Any]]:
+        doc = self.docs.get(cid)
+        if doc is None:
+            return None
+        if not doc.get("published", True) and doc.get("author_id") != viewer_id:
+            return None
+        return doc
+
+    def _prefix_ids(self, prefix: str) -> Set[str]:
+        i = bisect_left(self._vocab, prefix)
+        out: Set[str] = set()
+        while i < len(self._vocab) and self._vocab[i].startswith(prefix):
+            out |= self.by_token[self._vocab[i]]
+            i += 1
+        return out
+
+    def _candidates(self, tags: Iterable[str], q: Optional[str]) -> Optional[Set[str]]:
+        """Ids matching every tag and every query token (prefix match); None means no filter."""
+        sets: List[Set[str]] = []
+        for tag in {normalize_tag(t) for t in tags if t and t.strip()}:
+            sets.append(self.by_tag.get(tag, set()))
+        for tok in name_tokens(q or ""):
+            sets.append(self._prefix_ids(tok))
+        if not sets:
+            return None
+        sets.sort(key=len)
+        out = set(sets[0])
+        for s in sets[1:]:
+            out &= s
+            if not out:
+                break
+        return out
+
+    def query(self, sort: str = "popular", tags: Iterable[str] = (), nsfw: Optional[bool] = None,
+              q: Optional[str] = None, limit: int = 50, cursor: Optional[str] = None) -> Dict[str, Any]:
+        """nsfw: None = everything, False = SFW only, True = NSFW only."""
+        if sort not in self.ranks:
+            raise ValueError(f"unknown sort {sort!r}")
+        limit = max(1, min(limit, MAX_CATALOG_PAGE))
+        rank = self.ranks[sort]
+        start = 0
+        if cursor:
+            try:
+                key, last_id = json.loads(decode_cursor(cursor))
+            except Exception:
+                raise ValueError("invalid cursor")
+            start = bisect_right(rank, (float(key), last_id))
+        candidates = self._candidates(tags, q)
+        if nsfw is True:
+            candidates = self.nsfw if candidates is None else candidates & self.nsfw
+        page: List[Tuple[float, str]] = []
+        if candidates is not None and len(candidates) < (len(rank) - start) // 8:
+            # few matches: sort them instead of walking the whole rank list
+            keys = self._keys[sort]
+            floor = rank[start - 1] if start else None
+            picked = sorted((keys[c], c) for c in candidates if c in keys)
+            if floor is not None:
+                picked = picked[bisect_right(picked, floor):]
+            page = [e for e in picked if nsfw is not False or e[1] not in self.nsfw][:limit + 1]
+        else:
+            for i in range(start, len(rank)):
+                cid = rank[i][1]
+                if candidates is not None and cid not in candidates:
+                    continue
+                if nsfw is False and cid in self.nsfw:
+                    continue
+                page.append(rank[i])
+                if len(page) > limit:
+                    break
+        more = len(page) > limit
+        page = page[:limit]
+        next_cursor = encode_cursor(json.dumps([page[-1][0], page[-1][1]])) if more and page else None
+        return {"items": [self.summary(self.docs[cid]) for _, cid in page], "next_cursor": next_cursor}
+
+    @staticmethod
+    def summary(doc: Dict[str, Any]) -> Dict[str, Any]:
+        return {k: doc.get(k) for k in SUMMARY_FIELDS}
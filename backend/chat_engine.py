@@ -0,0 +1,151 @@
+"""Streaming chat turns with gem holds.
+
+One turn: reserve a hold sized for the prompt plus the reply budget, stream tokens from the ModelService
+to the caller's emit(), then settle the hold with the actual cost. If the turn is cancelled (client
+disconnect, chat.cancel) or fails before settling, the hold is cancelled so the gems come back.
+"""
+import asyncio
+import logging
+import os
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional
+
+from .context_builder import BuiltPrompt, ContextBuilder
+from .ledger import InsufficientFunds
+from .metrics import CHAT_FIRST_TOKEN_SECONDS, LatencyStats
+from .model_service import ModelService
+from .pricing import PricingEngine, pricing as default_pricing
+from .session_store import ChatSessionStore, HotSession, SessionNotFound
+
+log = logging.getLogger(__name__)
+
+CHAT_MAX_REPLY_TOKENS = int(os.getenv("CHAT_MAX_REPLY_TOKENS", "256"))
+
+Emit = Callable[[Dict[str, Any]], Awaitable[None]]
+
+
+class ChatError(Exception):
+    def __init__(self, code: int, detail: str):
+        super().__init__(detail)
+        self.code = code
+        self.detail = detail
+
+
+class ChatMetrics(LatencyStats):
+    def __init__(self):
+        super().__init__(("turns", "completed", "cancelled", "failed", "tokens"), ("first_token_ms", "total_ms"))
+
+
+class ChatEngine:
+    def __init__(self, ledger, model: ModelService, settlements=None, sessions: Optional[ChatSessionStore] = None,
+                 context: Optional[ContextBuilder] = None, persona_lookup: Optional[Callable[[str], str]] = None,
+                 pricing: Optional[PricingEngine] = None, max_reply_tokens: int = CHAT_MAX_REPLY_TOKENS):
+        self.ledger = ledger
+        self.model = model
+        # finalize/cancel go through the coalescer when the app has one
+        self.settlements = settlements or ledger
+        self.sessions = sessions
+        self.pricing = pricing or default_pricing
+        self.context = context or ContextBuilder(count_tokens=self.pricing.count, count_persona=self.pricing.count_cached)
+        self.persona_lookup = persona_lookup
+        self.max_reply_tokens = max_reply_tokens
+        self.metrics = ChatMetrics()
+
+    def build_prompt(self, session: Optional[HotSession], content: str) -> BuiltPrompt:
+        persona = ""
+        if session is not None and self.persona_lookup is not None and session.character_id:
+            persona = self.persona_lookup(session.character_id) or ""
+        return self.context.build(session, content, persona)
+
+    def estimate_cost(self, prompt_tokens: int) -> int:
+        """Worst case for the turn: the whole prompt plus a full reply budget."""
+        return self.pricing.quote(self.model.name, prompt_tokens, self.max_reply_tokens)
+
+    def actual_cost(self, prompt_tokens: int, completion_tokens: int) -> int:
+        return self.pricing.quote(self.model.name, prompt_tokens, completion_tokens)
+
+    async def _session(self, user_id: str, session_id: str) -> Optional[HotSession]:
+        if self.sessions is None:
+            return None
+        try:
+            session = await self.sessions.get(session_id)
+        except SessionNotFound:
+            session = None
+        if session is None or session.user_id != user_id:
+            raise ChatError(404, "unknown session")
+        return session
+
+    async def _record(self, session_id: str, content: str, reply: str, tokens: int, cost: int):
+        if self.sessions is None:
+            return
+        try:
+            await self.sessions.append(session_id, [
+                {"role": "user", "content": content},
+                {"role": "assistant", "content": reply, "tokens": tokens, "cost": cost},
+            ])
+        except Exception:
+            # the turn is paid for and delivered; a lost transcript entry must not fail it
+            log.exception("could not persist turn for session %s", session_id)
+
+    async def _release(self, user_id: str, hold_id: str):
+        try:
+            await self.settlements.cancel_hold(user_id, hold_id)
+        except Exception:
+            # the expired-hold sweeper refunds it later
+            log.exception("cancel_hold %s for %s failed", hold_id, user_id)
+
+    async def run_turn(self, user_id: str, session_id: str, content: str, emit: Emit, request_id: str) -> Dict[str, Any]:
+        started = time.perf_counter()
+        self.metrics.counts["turns"] += 1
+        session = await self._session(user_id, session_id)
+        built = self.build_prompt(session, content)
+        prompt = built.text
+        estimate = self.estimate_cost(built.tokens)
+        try:
+            hold = await self.ledger.reserve_hold(user_id, estimate)
+        except InsufficientFunds:
+            self.metrics.counts["failed"] += 1
+            raise ChatError(402, "Insufficient gems")
+        hold_id = hold["hold_id"]
+        settled = False
+        try:
+            await emit({"type": "chat.accepted", "request_id": request_id, "session_id": session_id,
+                        "hold_id": hold_id, "estimated_cost": estimate})
+            parts = []
+            first_token_ms = None
+            stream = self.model.stream(prompt, self.max_reply_tokens)
+            try:
+                async for token in stream:
+                    if first_token_ms is None:
+                        first_token_ms = (time.perf_counter() - started) * 1000.0
+                        self.metrics.observe("first_token_ms", first_token_ms)
+                        CHAT_FIRST_TOKEN_SECONDS.observe(first_token_ms / 1000.0)
+                    await emit({"type": "chat.token", "request_id": request_id, "index": len(parts), "text": token})
+                    parts.append(token)
+            finally:
+                # abort generation on the model side too when we stop early
+                aclose = getattr(stream, "aclose", None)
+                if aclose is not None:
+                    await aclose()
+            completion_tokens = self.pricing.count("".join(parts))
+            cost = min(estimate, self.actual_cost(built.tokens, completion_tokens))
+            out = await self.settlements.finalize_hold(user_id, hold_id, cost)
+            settled = True
+        except BaseException as e:
+            if not settled:
+                self.metrics.counts["cancelled" if isinstance(e, asyncio.CancelledError) else "failed"] += 1
+                # shielded so a cancelled turn still gets its gems back
+                await asyncio.shield(self._release(user_id, hold_id))
+            raise
+        reply = "".join(parts)
+        total_ms = (time.perf_counter() - started) * 1000.0
+        self.metrics.observe("total_ms", total_ms)
+        self.metrics.counts["completed"] += 1
+        self.metrics.counts["tokens"] += len(parts)
+        await self._record(session_id, content, reply, len(parts), cost)
+        result = {"type": "chat.done", "request_id": request_id, "session_id": session_id, "hold_id": hold_id,
+                  "text": reply, "tokens": len(parts), "cost": cost, "balance_after": out.get("balance_after"),
+                  "first_token_ms": round(first_token_ms or 0.0, 2), "total_ms": round(total_ms, 2),
+                  "prompt_tokens": built.tokens, "prompt_ms": round(built.assembly_ms, 3)}
+        await emit(result)
+        return result
@@ -0,0 +1,165 @@
+"""Multiplexed chat WebSocket connection.
+
+Client -> server (JSON text frames):
+    {"type": "chat.send", "request_id": "...", "session_id": "...", "content": "..."}
+    {"type": "chat.cancel", "request_id": "..."}
+    {"type": "ping"}
+Server -> client:
+    chat.accepted, chat.token, chat.done, chat.cancelled, chat.error, pong
+    balance.updated, job.updated, resync (pushed; see connection_registry)
+
+Several turns can stream at once on one socket (up to WS_MAX_INFLIGHT). Everything the server sends
+goes through a bounded per-connection queue drained by a single writer, so a slow client pushes back on
+the model stream instead of growing memory; a client that stays stalled for WS_SEND_TIMEOUT_SECONDS is
+disconnected. Disconnecting cancels every in-flight turn, which cancels its hold. Pushed events take
+the same queue, drained from the connection's Subscription so they coalesce while the client is behind.
+"""
+import asyncio
+import json
+import logging
+import os
+from typing import Any, Dict, Optional
+
+from .chat_engine import ChatEngine, ChatError
+from .connection_registry import Subscription
+
+log = logging.getLogger(__name__)
+
+WS_SEND_QUEUE_SIZE = int(os.getenv("WS_SEND_QUEUE_SIZE", "256"))
+WS_SEND_TIMEOUT_SECONDS = float(os.getenv("WS_SEND_TIMEOUT_SECONDS", "10"))
+WS_MAX_INFLIGHT = int(os.getenv("WS_MAX_INFLIGHT", "4"))
+WS_MAX_MESSAGE_CHARS = int(os.getenv("WS_MAX_MESSAGE_CHARS", "8000"))
+
+
+class SlowConsumer(Exception):
+    pass
+
+
+class ChatConnection:
+    def __init__(self, ws, user_id: str, engine: ChatEngine, queue_size: int = WS_SEND_QUEUE_SIZE,
+                 send_timeout: float = WS_SEND_TIMEOUT_SECONDS, max_inflight: int = WS_MAX_INFLIGHT,
+                 subscription: Optional[Subscription] = None):
+        self.ws = ws
+        self.user_id = user_id
+        self.engine = engine
+        self.subscription = subscription
+        self.send_timeout = send_timeout
+        self.max_inflight = max_inflight
+        self.queue: "asyncio.Queue[Any]" = asyncio.Queue(maxsize=queue_size)
+        self.turns: Dict[str, asyncio.Task] = {}
+        self._writer: Optional[asyncio.Task] = None
+        self._pusher: Optional[asyncio.Task] = None
+        self.closed = False
+
+    async def emit(self, event: Dict[str, Any]):
+        if self.closed:
+            raise SlowConsumer("connection closed")
+        try:
+            await asyncio.wait_for(self.queue.put(event), self.send_timeout)
+        except asyncio.TimeoutError:
+            self.closed = True
+            # stopping the writer wakes serve(), which tears the connection down
+            if self._writer is not None:
+                self._writer.cancel()
+            raise SlowConsumer(f"send queue full for {self.send_timeout}s")
+
+    async def _write_loop(self):
+        while True:
+            event = await self.queue.get()
+            await self.ws.send_text(json.dumps(event, separators=(",", ":")))
+
+    async def _push_loop(self):
+        try:
+            while True:
+                for event in await self.subscription.next():
+                    await self.emit({k: v for k, v in event.items() if k != "user_id"})
+        except SlowConsumer:
+            pass
+
+    async def _turn(self, request_id: str, session_id: str, content: str):
+        try:
+            await self.engine.run_turn(self.user_id, session_id, content, self.emit, request_id)
+        except asyncio.CancelledError:
+            if not self.closed:
+                await self._try_emit({"type": "chat.cancelled", "request_id": request_id})
+        except ChatError as e:
+            await self._try_emit({"type": "chat.error", "request_id": request_id, "code": e.code, "detail": e.detail})
+        except SlowConsumer:
+            pass
+        except Exception as e:
+            log.exception("chat turn %s failed", request_id)
+            await self._try_emit({"type": "chat.error", "request_id": request_id, "code": 500, "detail": str(e)})
+        finally:
+            self.turns.pop(request_id, None)
+
+    async def _try_emit(self, event: Dict[str, Any]):
+        try:
+            await self.emit(event)
+        except SlowConsumer:
+            pass
+
+    async def handle(self, msg: Dict[str, Any]):
+        kind = msg.get("type")
+        request_id = str(msg.get("request_id") or "")
+        if kind == "ping":
+            await self.emit({"type": "pong"})
+        elif kind == "chat.send":
+            content = msg.get("content")
+            if not request_id or not isinstance(content, str) or not content.strip():
+                await self.emit({"type": "chat.error", "request_id": request_id, "code": 400, "detail": "request_id and content required"})
+            elif len(content) > WS_MAX_MESSAGE_CHARS:
+                await self.emit({"type": "chat.error", "request_id": request_id, "code": 413, "detail": "message too long"})
+            elif request_id in self.turns:
+                await self.emit({"type": "chat.error", "request_id": request_id, "code": 409, "detail": "request_id in flight"})
+            elif len(self.turns) >= self.max_inflight:
+                await self.emit({"type": "chat.error", "request_id": request_id, "code": 429, "detail": "too many turns in flight"})
+            else:
+                self.turns[request_id] = asyncio.create_task(
+                    self._turn(request_id, str(msg.get("session_id") or ""), content))
+        elif kind == "chat.cancel":
+            task = self.turns.get(request_id)
+            if task is not None:
+                task.cancel()
+        else:
+            await self.emit({"type": "chat.error", "request_id": request_id, "code": 400, "detail": f"unknown type {kind!r}"})
+
+    async def serve(self):
+        """Read frames until the client goes away (or falls too far behind), then tear everything down."""
+        self._writer = asyncio.create_task(self._write_loop())
+        if self.subscription is not None:
+            self._pusher = asyncio.create_task(self._push_loop())
+        try:
+            while not self.closed:
+                receive = asyncio.ensure_future(self.ws.receive_text())
+                done, _ = await asyncio.wait({receive, self._writer}, return_when=asyncio.FIRST_COMPLETED)
+                if receive not in done:
+                    # writer stopped: socket broken or client too slow
+                    receive.cancel()
+                    break
+                try:
+                    msg = json.loads(receive.result())
+                except ValueError:
+                    await self.emit({"type": "chat.error", "code": 400, "detail": "invalid JSON"})
+                    continue
+                if isinstance(msg, dict):
+                    await self.handle(msg)
+        except SlowConsumer:
+            log.info("closing slow chat socket for %s", self.user_id)
+        except Exception:
+            # WebSocketDisconnect and transport errors end the connection the same way
+            pass
+        finally:
+            await self.close()
+
+    async def close(self):
+        self.closed = True
+        if self._pusher is not None:
+            self._pusher.cancel()
+        turns = list(self.turns.values())
+        for task in turns:
+            task.cancel()
+        if turns:
+            # wait for the turns so their holds are cancelled before the connection is forgotten
+            await asyncio.gather(*turns, return_exceptions=True)
+        if self._writer is not None and not self._writer.done():
+            self._writer.cancel()
@@ -0,0 +1,162 @@
+import asyncio
+import os
+from typing import Any, Dict, List, Optional, Tuple
+
+from .ledger import AsyncLedgerService, BatchOp
+
+# how long settlements for one user are buffered before they are committed together
+COALESCE_WINDOW_MS = float(os.getenv("LEDGER_COALESCE_WINDOW_MS", "5"))
+# Cosmos transactional batches are limited to 100 operations
+MAX_BATCH_OPS = 100
+
+
+class _Pending:
+    __slots__ = ("kind", "hold_id", "actual_cost", "future")
+
+    def __init__(self, kind: str, hold_id: str, actual_cost: int, future: "asyncio.Future"):
+        self.kind = kind
+        self.hold_id = hold_id
+        self.actual_cost = actual_cost
+        self.future = future
+
+
+class SettlementCoalescer:
+    """Per-user micro-batching of finalize/cancel settlements in front of AsyncLedgerService.
+
+    Settlements for the same user_id partition that arrive within window_ms are applied in arrival order
+    against a single balance read and committed as one transactional batch (one balance replace guarded
+    by if_match), split so no batch exceeds MAX_BATCH_OPS. Every call still gets its own result (or
+    exception) exactly as if it had gone straight to the ledger.
+    """
+
+    def __init__(self, ledger: AsyncLedgerService, window_ms: float = COALESCE_WINDOW_MS, max_batch_ops: int = MAX_BATCH_OPS):
+        self.ledger = ledger
+        self.window = window_ms / 1000.0
+        self.max_batch_ops = max_batch_ops
+        self._pending: Dict[str, List[_Pending]] = {}
+        self._timers: Dict[str, asyncio.Task] = {}
+        self._flushing = set()
+        self._tasks = set()
+        self.stats = {"calls": 0, "batches": 0, "ops": 0}
+
+    async def finalize_hold(self, user_id: str, hold_id: str, actual_cost: int, idempotency_key: Optional[str] = None) -> Dict[str, Any]:
+        return await self._submit(user_id, "finalize", hold_id, int(actual_cost))
+
+    async def cancel_hold(self, user_id: str, hold_id: str, idempotency_key: Optional[str] = None) -> Dict[str, Any]:
+        return await self._submit(user_id, "cancel", hold_id, 0)
+
+    async def _submit(self, user_id: str, kind: str, hold_id: str, actual_cost: int) -> Dict[str, Any]:
+        fut = asyncio.get_running_loop().create_future()
+        pending = self._pending.setdefault(user_id, [])
+        pending.append(_Pending(kind, hold_id, actual_cost, fut))
+        self.stats["calls"] += 1
+        # every settlement needs at least 2 ops plus the shared balance replace
+        if 2 * len(pending) + 1 >= self.max_batch_ops:
+            task = asyncio.create_task(self._flush(user_id))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+        elif user_id not in self._timers:
+            self._timers[user_id] = asyncio.create_task(self._flush_after(user_id))
+        return await fut
+
+    async def _flush_after(self, user_id: str):
+        try:
+            await asyncio.sleep(self.window)
+        finally:
+            self._timers.pop(user_id, None)
+        await self._flush(user_id)
+
+    async def _flush(self, user_id: str):
+        # one flusher per user at a time; it keeps draining whatever arrives while it commits
+        if user_id in self._flushing:
+            return
+        self._flushing.add(user_id)
+        try:
+            while self._pending.get(user_id):
+                items = self._pending.pop(user_id)
+                leftover = await self._commit(user_id, items)
+                if leftover:
+                    # keep arrival order: unprocessed items go ahead of anything queued meanwhile
+                    self._pending[user_id] = leftover + self._pending.get(user_id, [])
+        finally:
+            self._flushing.discard(user_id)
+
+    async def _commit(self, user_id: str, items: List[_Pending]) -> List[_Pending]:
+        """Commit as many items as fit in one batch; returns the ones that did not fit."""
+        state: Dict[str, Any] = {}
+
+        async def attempt():
+            ops, results, leftover = await self._build(user_id, items)
+            state["results"], state["leftover"] = results, leftover
+            if ops:
+                await self.ledger._execute_batch(user_id, ops)
+                self.stats["batches"] += 1
+                self.stats["ops"] += len(ops)
+
+        try:
+            await self.ledger._with_retry(user_id, attempt)
+        except Exception as e:
+            for p in items:
+                if not p.future.done():
+                    p.future.set_exception(e)
+            return []
+
+        for p, res in state["results"]:
+            if p.future.done():
+                continue
+            if isinstance(res, BaseException):
+                p.future.set_exception(res)
+            else:
+                p.future.set_result(res)
+        return state["leftover"]
+
+    async def _build(self, user_id: str, items: List[_Pending]) -> Tuple[List[BatchOp], List[Tuple[_Pending, Any]], List[_Pending]]:
+        hold_ids = list(dict.fromkeys(p.hold_id for p in items))
+        reads = await asyncio.gather(
+            self.ledger.get_balance_doc(user_id),
+            *[self.ledger.container.read_item(item=h, partition_key=user_id) for h in hold_ids],
+            return_exceptions=True,
+        )
+        if isinstance(reads[0], BaseException):
+            raise reads[0]
+        balance_doc = reads[0]
+        holds = dict(zip(hold_ids, reads[1:]))
+
+        ops: List[BatchOp] = []
+        results: List[Tuple[_Pending, Any]] = []
+        balance_op: Optional[BatchOp] = None
+        for i, p in enumerate(items):
+            hold = holds[p.hold_id]
+            if isinstance(hold, BaseException):
+                results.append((p, hold))
+                continue
+            if hold.get("status") != "placed":
+                results.append((p, {"already_settled": True} if p.kind == "finalize" else {"already_settled_or_cancelled": True}))
+                continue
+            if p.kind == "finalize":
+                item_ops, out = self.ledger._build_finalize(user_id, hold, balance_doc, p.actual_cost)
+            else:
+                item_ops, out = self.ledger._build_cancel(user_id, hold, balance_doc)
+            # builders end with the balance replace; keep only the last one for the whole batch
+            item_balance_op = item_ops.pop()
+            if ops and len(ops) + len(item_ops) + 1 > self.max_batch_ops:
+                return ops + [balance_op] if balance_op else ops, results, items[i:]
+            ops.extend(item_ops)
+            balance_op = item_balance_op
+            # later settlements in this batch see the running balance and the updated hold
+            balance_doc = item_balance_op[1][1]
+            holds[p.hold_id] = item_ops[-1][1][1]
+            results.append((p, out))
+        if balance_op is not None:
+            ops.append(balance_op)
+        return ops, results, []
+
+    async def close(self):
+        """Flush everything still buffered (call on shutdown)."""
+        for task in list(self._timers.values()):
+            task.cancel()
+        self._timers.clear()
+        if self._tasks:
+            await asyncio.gather(*self._tasks, return_exceptions=True)
+        for user_id in list(self._pending):
+            await self._flush(user_id)
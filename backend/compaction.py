@@ -0,0 +1,257 @@
+"""Ledger compaction: roll old events of a user partition into a signed ledger_snapshot.
+
+For each user, events older than the horizon (and settled/cancelled holds) are written to cold storage,
+summarised into a ledger_snapshot doc that chains to the previous snapshot, and then deleted from the
+partition. Verification starts from the latest snapshot and only replays events after it.
+
+Run as a job:
+
+    python -m backend.compaction --horizon-days 90 --archive-dir ./ledger-archive [--user USER_ID ...]
+"""
+import argparse
+import asyncio
+import gzip
+import hashlib
+import hmac
+import json
+import logging
+import os
+import re
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+from uuid import uuid4
+
+from .ledger import AsyncLedgerService, now_iso
+
+log = logging.getLogger(__name__)
+
+LEDGER_SNAPSHOT_KEY = os.getenv("LEDGER_SNAPSHOT_KEY", "dev-snapshot-key-change-me")
+COMPACTION_HORIZON_DAYS = int(os.getenv("COMPACTION_HORIZON_DAYS", "90"))
+COMPACTION_ARCHIVE_DIR = os.getenv("COMPACTION_ARCHIVE_DIR", "./ledger-archive")
+# Cosmos transactional batch limit
+DELETE_BATCH_SIZE = 100
+
+# fields covered by the snapshot signature; system fields (_etag, _ts...) are excluded
+_SIGNED_FIELDS = ("id", "docType", "user_id", "prev_snapshot_id", "from_created_at", "through_created_at",
+                  "totals", "cumulative_change", "archive_uri", "created_at")
+
+
+def sign_snapshot(doc: Dict[str, Any], key: str = LEDGER_SNAPSHOT_KEY) -> str:
+    payload = json.dumps({f: doc.get(f) for f in _SIGNED_FIELDS}, sort_keys=True, separators=(",", ":"))
+    return hmac.new(key.encode(), payload.encode(), hashlib.sha256).hexdigest()
+
+
+def verify_snapshot_signature(doc: Dict[str, Any], key: str = LEDGER_SNAPSHOT_KEY) -> bool:
+    return hmac.compare_digest(doc.get("signature") or "", sign_snapshot(doc, key))
+
+
+def expected_balance(balance_doc: Dict[str, Any], snapshot: Optional[Dict[str, Any]], tail_sum: int) -> int:
+    """Balance the ledger accounts for: opening balance + snapshotted changes + changes after the snapshot.
+
+    Shared by verify_balance and the reconciler so both audits agree on every user.
+    """
+    base = snapshot["cumulative_change"] if snapshot else 0
+    return int(balance_doc.get("opening_balance", 0)) + base + int(tail_sum)
+
+
+class LocalFileArchive:
+    """Cold-storage stand-in: one gzipped NDJSON file per snapshot under root/<user>/.
+
+    A blob-backed archive only needs the same writer(user_id, snapshot_id) contract.
+    """
+
+    def __init__(self, root: str = COMPACTION_ARCHIVE_DIR):
+        self.root = root
+
+    def writer(self, user_id: str, snapshot_id: str) -> "_ArchiveWriter":
+        safe_user = re.sub(r"[^A-Za-z0-9_.-]", "_", user_id)
+        safe_snap = re.sub(r"[^A-Za-z0-9_.-]", "_", snapshot_id)
+        path = os.path.join(self.root, safe_user, f"{safe_snap}.ndjson.gz")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        return _ArchiveWriter(path)
+
+
+class _ArchiveWriter:
+    def __init__(self, path: str):
+        self.path = path
+        self.uri = "file://" + os.path.abspath(path)
+        self.count = 0
+        self._fh = gzip.open(path + ".tmp", "wt", encoding="utf-8")
+
+    def write(self, doc: Dict[str, Any]):
+        self._fh.write(json.dumps(doc, sort_keys=True, separators=(",", ":")) + "\n")
+        self.count += 1
+
+    def commit(self):
+        # only a fully written archive becomes visible under its final name
+        self._fh.close()
+        os.replace(self.path + ".tmp", self.path)
+
+    def abort(self):
+        self._fh.close()
+        try:
+            os.remove(self.path + ".tmp")
+        except OSError:
+            pass
+
+
+def _empty_totals() -> Dict[str, Any]:
+    return {"event_count": 0, "change_sum": 0, "debit_sum": 0, "credit_sum": 0, "holds_archived": 0, "by_type": {}}
+
+
+def _fold(totals: Dict[str, Any], ev: Dict[str, Any]):
+    change = int(ev.get("change", 0))
+    totals["event_count"] += 1
+    totals["change_sum"] += change
+    if change < 0:
+        totals["debit_sum"] += -change
+    else:
+        totals["credit_sum"] += change
+    row = totals["by_type"].setdefault(ev.get("event_type") or "unknown", {"count": 0, "sum": 0})
+    row["count"] += 1
+    row["sum"] += change
+
+
+def horizon_iso(days: int) -> str:
+    return (datetime.utcnow() - timedelta(days=days)).isoformat() + "Z"
+
+
+class LedgerCompactor:
+    def __init__(self, ledger: AsyncLedgerService, archive: LocalFileArchive, key: str = LEDGER_SNAPSHOT_KEY):
+        self.ledger = ledger
+        self.container = ledger.container
+        self.archive = archive
+        self.key = key
+
+    async def _query(self, user_id: str, query: str, params: List[Dict[str, Any]]):
+        async for item in self.container.query_items(query=query, parameters=params, partition_key=user_id):
+            yield item
+
+    async def latest_snapshot(self, user_id: str) -> Optional[Dict[str, Any]]:
+        query = ("SELECT TOP 1 * FROM c WHERE c.user_id=@uid AND c.docType='ledger_snapshot' "
+                 "ORDER BY c.created_at DESC")
+        async for doc in self._query(user_id, query, [{"name": "@uid", "value": user_id}]):
+            if not verify_snapshot_signature(doc, self.key):
+                raise ValueError(f"snapshot {doc.get('id')} for {user_id} failed signature check")
+            return doc
+        return None
+
+    async def compact_user(self, user_id: str, horizon: str) -> Optional[Dict[str, Any]]:
+        """Snapshot + archive + delete everything older than horizon. Returns the new snapshot (if any)."""
+        prev = await self.latest_snapshot(user_id)
+        after = prev["through_created_at"] if prev else ""
+        params = [{"name": "@uid", "value": user_id}, {"name": "@after", "value": after}, {"name": "@horizon", "value": horizon}]
+
+        snapshot_id = f"snapshot:{uuid4().hex}"
+        writer = self.archive.writer(user_id, snapshot_id)
+        totals = _empty_totals()
+        first = last = None
+        try:
+            # pass 1: stream events into the archive while folding totals
+            events_q = ("SELECT * FROM c WHERE c.user_id=@uid AND c.docType='ledger_event' "
+                        "AND c.created_at > @after AND c.created_at < @horizon ORDER BY c.created_at ASC")
+            async for ev in self._query(user_id, events_q, params):
+                writer.write(ev)
+                _fold(totals, ev)
+                first = first or ev["created_at"]
+                last = ev["created_at"]
+            holds_q = ("SELECT * FROM c WHERE c.user_id=@uid AND c.docType='hold' AND c.status != 'placed' "
+                       "AND c.settled_at < @horizon")
+            async for hold in self._query(user_id, holds_q, params[:1] + params[2:]):
+                writer.write(hold)
+                totals["holds_archived"] += 1
+        except BaseException:
+            writer.abort()
+            raise
+
+        if totals["event_count"] == 0 and totals["holds_archived"] == 0:
+            writer.abort()
+            # a previous run may have written its snapshot but died before deleting everything
+            await self._delete_compacted(user_id, after, horizon)
+            return None
+        writer.commit()
+
+        through = last or after
+        snapshot = {
+            "id": snapshot_id,
+            "docType": "ledger_snapshot",
+            "user_id": user_id,
+            "prev_snapshot_id": prev["id"] if prev else None,
+            "from_created_at": first,
+            "through_created_at": through,
+            "totals": totals,
+            "cumulative_change": (prev["cumulative_change"] if prev else 0) + totals["change_sum"],
+            "archive_uri": writer.uri,
+            "created_at": now_iso(),
+        }
+        snapshot["signature"] = sign_snapshot(snapshot, self.key)
+        # deletes only start once the snapshot is durable, so a crash never loses events
+        await self.ledger._execute_batch(user_id, [("create", (snapshot,), {})])
+        await self._delete_compacted(user_id, through, horizon)
+        return snapshot
+
+    async def _delete_compacted(self, user_id: str, through: str, horizon: str):
+        params = [{"name": "@uid", "value": user_id}, {"name": "@through", "value": through}, {"name": "@horizon", "value": horizon}]
+        q = ("SELECT c.id FROM c WHERE c.user_id=@uid AND ((c.docType='ledger_event' AND c.created_at <= @through) "
+             "OR (c.docType='hold' AND c.status != 'placed' AND c.settled_at < @horizon))")
+        ids = [doc["id"] async for doc in self._query(user_id, q, params)]
+        for i in range(0, len(ids), DELETE_BATCH_SIZE):
+            ops = [("delete", (item_id,), {}) for item_id in ids[i:i + DELETE_BATCH_SIZE]]
+            await self.ledger._execute_batch(user_id, ops)
+
+    async def verify_balance(self, user_id: str) -> Dict[str, Any]:
+        """Recompute the balance from the opening balance, the latest snapshot and the events after it."""
+        snap = await self.latest_snapshot(user_id)
+        after = snap["through_created_at"] if snap else ""
+        q = "SELECT VALUE SUM(c.change) FROM c WHERE c.user_id=@uid AND c.docType='ledger_event' AND c.created_at > @after"
+        params = [{"name": "@uid", "value": user_id}, {"name": "@after", "value": after}]
+        tail = 0
+        async for v in self._query(user_id, q, params):
+            tail = int(v or 0)
+        balance_doc = await self.ledger.get_balance_doc(user_id)
+        expected = expected_balance(balance_doc, snap, tail)
+        actual = int(balance_doc.get("balance", 0))
+        return {"user_id": user_id, "snapshot_id": snap["id"] if snap else None, "expected": expected,
+                "actual": actual, "drift": actual - expected}
+
+
+async def _list_users(container) -> List[str]:
+    q = "SELECT VALUE c.user_id FROM c WHERE c.docType='balance'"
+    return [uid async for uid in container.query_items(query=q)]
+
+
+async def _main(args) -> int:
+    from azure.cosmos.aio import CosmosClient
+
+    url, key = os.getenv("COSMOS_URL"), os.getenv("COSMOS_KEY")
+    if not url or not key:
+        log.error("COSMOS_URL / COSMOS_KEY not set")
+        return 2
+    async with CosmosClient(url, credential=key) as client:
+        container = client.get_database_client(os.getenv("COSMOS_DB", "appdb")).get_container_client(
+            os.getenv("COSMOS_CONTAINER", "ledger"))
+        compactor = LedgerCompactor(AsyncLedgerService(container), LocalFileArchive(args.archive_dir))
+        horizon = horizon_iso(args.horizon_days)
+        users = args.user or await _list_users(container)
+        done = 0
+        for user_id in users:
+            snap = await compactor.compact_user(user_id, horizon)
+            if snap:
+                done += 1
+                log.info("compacted %s: %s events -> %s", user_id, snap["totals"]["event_count"], snap["id"])
+        log.info("compaction finished: %d/%d users snapshotted (horizon %s)", done, len(users), horizon)
+    return 0
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Compact old ledger events into signed snapshots")
+    parser.add_argument("--horizon-days", type=int, default=COMPACTION_HORIZON_DAYS)
+    parser.add_argument("--archive-dir", default=COMPACTION_ARCHIVE_DIR)
+    parser.add_argument("--user", action="append", help="compact only this user (repeatable)")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    return asyncio.run(_main(args))
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,96 @@
+"""Per-user fan-out of push events to open WebSockets.
+
+Each socket holds a Subscription: a small buffer of pending events keyed by what they describe
+("balance.updated", "job.updated:<id>"), so a burst of balance changes while the socket is busy
+collapses into the latest one. The buffer is bounded by WS_EVENT_BUFFER keys; on overflow it is
+replaced by a single {"type": "resync"} telling the client to refetch state. Nothing here touches the
+socket: the connection drains its subscription through its own send queue.
+"""
+import asyncio
+import os
+from collections import OrderedDict
+from typing import Any, Dict, List, Set
+
+WS_EVENT_BUFFER = int(os.getenv("WS_EVENT_BUFFER", "64"))
+
+RESYNC = {"type": "resync"}
+
+
+def _key(event: Dict[str, Any]) -> str:
+    if "id" in event:
+        return f"{event['type']}:{event['id']}"
+    return event["type"]
+
+
+class Subscription:
+    __slots__ = ("user_id", "max_pending", "pending", "ready", "stats")
+
+    def __init__(self, user_id: str, max_pending: int, stats: Dict[str, int]):
+        self.user_id = user_id
+        self.max_pending = max_pending
+        self.pending: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        self.ready = asyncio.Event()
+        # shared with the registry
+        self.stats = stats
+
+    def offer(self, event: Dict[str, Any]):
+        key = _key(event)
+        current = self.pending.get(key)
+        if current is not None:
+            # events from several replicas can arrive out of order; keep the newer one
+            if (event.get("updated_at") or "") >= (current.get("updated_at") or ""):
+                self.pending[key] = event
+            self.stats["coalesced"] += 1
+        elif len(self.pending) >= self.max_pending:
+            self.pending.clear()
+            self.pending["resync"] = RESYNC
+            self.stats["overflows"] += 1
+        else:
+            self.pending[key] = event
+        self.ready.set()
+
+    def drain(self) -> List[Dict[str, Any]]:
+        events = list(self.pending.values())
+        self.pending.clear()
+        self.ready.clear()
+        return events
+
+    async def next(self) -> List[Dict[str, Any]]:
+        """Wait for at least one event, then take everything pending."""
+        await self.ready.wait()
+        return self.drain()
+
+
+class ConnectionRegistry:
+    def __init__(self, max_pending: int = WS_EVENT_BUFFER):
+        self.max_pending = max_pending
+        self._by_user: Dict[str, Set[Subscription]] = {}
+        self.stats = {"delivered": 0, "coalesced": 0, "overflows": 0}
+
+    def register(self, user_id: str) -> Subscription:
+        sub = Subscription(user_id, self.max_pending, self.stats)
+        self._by_user.setdefault(user_id, set()).add(sub)
+        return sub
+
+    def unregister(self, sub: Subscription):
+        subs = self._by_user.get(sub.user_id)
+        if subs is None:
+            return
+        subs.discard(sub)
+        if not subs:
+            del self._by_user[sub.user_id]
+
+    def deliver(self, event: Dict[str, Any]):
+        """EventBus handler: hand the event to every socket the user has open on this replica."""
+        subs = self._by_user.get(event.get("user_id"))
+        if not subs:
+            return
+        for sub in subs:
+            sub.offer(event)
+        self.stats["delivered"] += len(subs)
+
+    def snapshot(self) -> Dict[str, Any]:
+        out: Dict[str, Any] = dict(self.stats)
+        out["users"] = len(self._by_user)
+        out["connections"] = sum(len(s) for s in self._by_user.values())
+        return out
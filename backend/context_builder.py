@@ -0,0 +1,205 @@
+"""Token-budgeted prompt context for chat turns.
+
+A prompt is: the character persona, a running summary of older turns, the newest history that fits
+CONTEXT_TOKEN_BUDGET, then the new user message. Each hot session carries a ContextWindow holding the
+history lines it has seen, their token counts and a running prefix sum, so a turn only tokenizes the
+messages appended since the last one and picks its history cut with one bisect.
+
+History that falls out of the budget is folded into the summary by a background task, never on the
+request path; until a fold lands, the prompt simply goes without those lines. The summary is written
+onto the session doc and persisted with the session's next append.
+"""
+import asyncio
+import logging
+import os
+import time
+from bisect import bisect_left
+from typing import Any, Callable, Dict, List, Optional, Set
+
+from .metrics import LatencyStats
+
+log = logging.getLogger(__name__)
+
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "3000"))
+CONTEXT_SUMMARY_MAX_TOKENS = int(os.getenv("CONTEXT_SUMMARY_MAX_TOKENS", "400"))
+# folded lines are dropped from the window once this many have piled up at its front
+_COMPACT_AFTER = 64
+
+
+def approx_tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+
+def _line(message: Dict[str, Any]) -> str:
+    return f"{message['role']}: {message['content']}"
+
+
+class Summarizer:
+    async def summarize(self, summary: str, lines: List[str]) -> str:
+        """New summary covering the previous one plus lines (oldest first)."""
+        raise NotImplementedError
+
+
+class ExtractiveSummarizer(Summarizer):
+    """Model-free stand-in: keeps the opening of each folded user line, newest last, within max_tokens."""
+
+    def __init__(self, max_tokens: int = CONTEXT_SUMMARY_MAX_TOKENS, count_tokens: Callable[[str], int] = approx_tokens,
+                 line_chars: int = 160):
+        self.max_tokens = max_tokens
+        self.count_tokens = count_tokens
+        self.line_chars = line_chars
+
+    async def summarize(self, summary: str, lines: List[str]) -> str:
+        points = [p for p in summary.split("\n") if p]
+        for line in lines:
+            if line.startswith("user: "):
+                points.append("- " + line[6:6 + self.line_chars].replace("\n", " "))
+        while len(points) > 1 and self.count_tokens("\n".join(points)) > self.max_tokens:
+            points.pop(0)
+        return "\n".join(points)
+
+
+class ContextWindow:
+    """History lines of one session with cached token counts; prefix[i] is the token total of lines[:i]."""
+
+    __slots__ = ("lines", "seqs", "prefix", "start", "summary", "summary_seq", "summary_tokens", "folding")
+
+    def __init__(self, summary: str = "", summary_seq: int = 0, count_tokens: Callable[[str], int] = approx_tokens):
+        self.lines: List[str] = []
+        self.seqs: List[int] = []
+        self.prefix: List[int] = [0]
+        # lines[:start] are already covered by the summary
+        self.start = 0
+        self.summary = summary
+        self.summary_seq = summary_seq
+        self.summary_tokens = count_tokens(f"summary: {summary}") if summary else 0
+        self.folding = False
+
+    @property
+    def last_seq(self) -> int:
+        return self.seqs[-1] if self.seqs else self.summary_seq
+
+    def add(self, seq: int, line: str, tokens: int):
+        self.lines.append(line)
+        self.seqs.append(seq)
+        self.prefix.append(self.prefix[-1] + tokens)
+
+    def cut(self, budget: int) -> int:
+        """Smallest index i >= start such that lines[i:] fits in budget tokens."""
+        total = self.prefix[-1]
+        return bisect_left(self.prefix, total - budget, self.start, len(self.lines))
+
+    def tokens_from(self, index: int) -> int:
+        return self.prefix[-1] - self.prefix[index]
+
+    def compact(self):
+        if self.start < _COMPACT_AFTER or self.start * 2 < len(self.lines):
+            return
+        # prefix values stay absolute; only the covered front is dropped
+        del self.lines[:self.start]
+        del self.seqs[:self.start]
+        del self.prefix[:self.start]
+        self.start = 0
+
+
+class BuiltPrompt:
+    __slots__ = ("text", "tokens", "history_messages", "dropped_messages", "assembly_ms")
+
+    def __init__(self, text: str, tokens: int, history_messages: int, dropped_messages: int, assembly_ms: float):
+        self.text = text
+        self.tokens = tokens
+        self.history_messages = history_messages
+        self.dropped_messages = dropped_messages
+        self.assembly_ms = assembly_ms
+
+
+class ContextMetrics(LatencyStats):
+    def __init__(self):
+        super().__init__(("builds", "folds", "fold_failures", "folded_messages"), ("assembly_ms", "prompt_tokens"))
+
+
+class ContextBuilder:
+    def __init__(self, budget: int = CONTEXT_TOKEN_BUDGET, summarizer: Optional[Summarizer] = None,
+                 count_tokens: Callable[[str], int] = approx_tokens,
+                 count_persona: Optional[Callable[[str], int]] = None):
+        self.budget = budget
+        self.count_tokens = count_tokens
+        # personas repeat on every turn; the pricing engine passes its cached counter here
+        self.count_persona = count_persona or count_tokens
+        self.summarizer = summarizer or ExtractiveSummarizer(count_tokens=count_tokens)
+        self.metrics = ContextMetrics()
+        self._folds: Set[asyncio.Task] = set()
+
+    def _window(self, session) -> ContextWindow:
+        window = session.window
+        if window is None:
+            window = ContextWindow(session.doc.get("summary") or "", int(session.doc.get("summary_seq") or 0),
+                                   self.count_tokens)
+            session.window = window
+        # only messages appended since the last turn get tokenized
+        fresh = []
+        last = window.last_seq
+        for m in reversed(session.recent):
+            if m["seq"] <= last:
+                break
+            fresh.append(m)
+        for m in reversed(fresh):
+            line = _line(m)
+            window.add(m["seq"], line, self.count_tokens(line))
+        return window
+
+    def build(self, session, content: str, persona: str = "") -> BuiltPrompt:
+        started = time.perf_counter()
+        head = [f"system: {persona}"] if persona else []
+        tail = f"user: {content}"
+        fixed = self.count_tokens(tail) + (self.count_persona(head[0]) if head else 0)
+        if session is None:
+            lines, history, dropped, used = head + [tail], 0, 0, fixed
+        else:
+            window = self._window(session)
+            summary = [f"summary: {window.summary}"] if window.summary else []
+            left = max(0, self.budget - fixed - window.summary_tokens)
+            cut = window.cut(left)
+            history = len(window.lines) - cut
+            dropped = cut - window.start
+            used = fixed + window.summary_tokens + window.tokens_from(cut)
+            lines = head + summary + window.lines[cut:] + [tail]
+            if dropped and not window.folding:
+                self._schedule_fold(session, window, cut)
+        text = "\n".join(lines)
+        elapsed = (time.perf_counter() - started) * 1000.0
+        self.metrics.counts["builds"] += 1
+        self.metrics.observe("assembly_ms", elapsed)
+        self.metrics.observe("prompt_tokens", used)
+        return BuiltPrompt(text, used, history, dropped, elapsed)
+
+    def _schedule_fold(self, session, window: ContextWindow, cut: int):
+        window.folding = True
+        task = asyncio.get_running_loop().create_task(self._fold(session, window, cut))
+        self._folds.add(task)
+        task.add_done_callback(self._folds.discard)
+
+    async def _fold(self, session, window: ContextWindow, cut: int):
+        try:
+            lines = window.lines[window.start:cut]
+            summary = await self.summarizer.summarize(window.summary, lines)
+            window.summary = summary
+            window.summary_tokens = self.count_tokens(f"summary: {summary}") if summary else 0
+            window.summary_seq = window.seqs[cut - 1]
+            window.start = cut
+            window.compact()
+            # persisted with the session's next append
+            session.doc["summary"] = summary
+            session.doc["summary_seq"] = window.summary_seq
+            self.metrics.counts["folds"] += 1
+            self.metrics.counts["folded_messages"] += len(lines)
+        except Exception:
+            self.metrics.counts["fold_failures"] += 1
+            log.exception("summarizing session %s failed", session.session_id)
+        finally:
+            window.folding = False
+
+    async def drain(self):
+        """Wait for in-flight folds (tests, shutdown)."""
+        if self._folds:
+            await asyncio.gather(*list(self._folds), return_exceptions=True)
@@ -0,0 +1,867 @@
+"""In-process emulator of the Cosmos container surface used by the backend.
+
+InMemoryContainer mimics azure.cosmos.ContainerProxy closely enough to run LedgerService (and the other
+services) unmodified: point reads, parameterised SQL queries (the subset this codebase uses: TOP, VALUE,
+projections, SUM/COUNT/MIN/MAX, WHERE with AND/OR/NOT/IN and a few functions, ORDER BY), paging with
+continuation tokens, atomic transactional batches with if_match etag enforcement, and a change feed.
+Each logical partition has its own lock, so concurrent writers contend exactly where Cosmos would make
+them (the balance doc etag) and nowhere else. AsyncInMemoryContainer wraps the same store with the
+azure.cosmos.aio surface and an optional simulated network latency.
+
+    container = InMemoryContainer(partition_key_path="/user_id")
+    ledger = LedgerService(container)
+    aledger = AsyncLedgerService(AsyncInMemoryContainer(container, latency_ms=2))
+"""
+import asyncio
+import copy
+import re
+import threading
+import time
+from functools import lru_cache
+from typing import Any, Callable, Dict, Iterator, List, Optional, Tuple
+from uuid import uuid4
+
+try:
+    from azure.cosmos import exceptions as _cosmos_exceptions
+except Exception:
+    _cosmos_exceptions = None
+
+
+class EmulatorHttpError(Exception):
+    """Fallback error type when azure.cosmos is not installed; carries status_code like the SDK errors."""
+
+    def __init__(self, status_code: int, message: str = "", operation_responses=None):
+        super().__init__(f"Status code: {status_code}\n{message}")
+        self.status_code = status_code
+        self.operation_responses = operation_responses
+
+
+def _http_error(status_code: int, message: str):
+    if _cosmos_exceptions is not None:
+        cls = {
+            404: _cosmos_exceptions.CosmosResourceNotFoundError,
+            409: _cosmos_exceptions.CosmosResourceExistsError,
+            412: _cosmos_exceptions.CosmosAccessConditionFailedError,
+        }.get(status_code, _cosmos_exceptions.CosmosHttpResponseError)
+        return cls(status_code=status_code, message=message)
+    return EmulatorHttpError(status_code, message)
+
+
+def _batch_error(index: int, status_code: int, responses: List[Dict[str, Any]]):
+    message = f"batch operation {index} failed with {status_code}"
+    if _cosmos_exceptions is not None:
+        return _cosmos_exceptions.CosmosBatchOperationError(
+            error_index=index, headers={}, status_code=status_code, message=message, operation_responses=responses)
+    return EmulatorHttpError(status_code, message, operation_responses=responses)
+
+
+# ---------------------------------------------------------------------------------------------------------
+# SQL subset
+# ---------------------------------------------------------------------------------------------------------
+
+class _Undefined:
+    def __repr__(self):
+        return "undefined"
+
+
+UNDEF = _Undefined()
+
+_TOKEN_RE = re.compile(r"""
+    \s*(?:
+      (?P<str>'(?:[^'\\]|\\.)*'|"(?:[^"\\]|\\.)*")
+     |(?P<num>-?\d+(?:\.\d+)?)
+     |(?P<param>@[A-Za-z_][A-Za-z0-9_]*)
+     |(?P<op>!=|<>|<=|>=|=|<|>|\(|\)|,|\*|\[|\])
+     |(?P<ident>[A-Za-z_][A-Za-z0-9_]*(?:\.[A-Za-z_][A-Za-z0-9_]*)*)
+    )""", re.VERBOSE)
+
+_AGGREGATES = {"SUM", "COUNT", "MIN", "MAX", "AVG"}
+
+
+def _tokenize(sql: str) -> List[Tuple[str, str]]:
+    pos, out = 0, []
+    sql = sql.strip()
+    while pos < len(sql):
+        m = _TOKEN_RE.match(sql, pos)
+        if not m or m.end() == pos:
+            raise ValueError(f"cannot parse query near: {sql[pos:pos + 20]!r}")
+        pos = m.end()
+        kind = m.lastgroup
+        out.append((kind, m.group(kind)))
+    return out
+
+
+def _cmp_key(v):
+    # Cosmos orders undefined < null < booleans < numbers < strings
+    if v is UNDEF:
+        return (0, 0)
+    if v is None:
+        return (1, 0)
+    if isinstance(v, bool):
+        return (2, v)
+    if isinstance(v, (int, float)):
+        return (3, v)
+    if isinstance(v, str):
+        return (4, v)
+    return (5, str(v))
+
+
+def _comparable(a, b) -> bool:
+    if a is UNDEF or b is UNDEF:
+        return False
+    if isinstance(a, bool) or isinstance(b, bool):
+        return isinstance(a, bool) and isinstance(b, bool)
+    if isinstance(a, (int, float)) and isinstance(b, (int, float)):
+        return True
+    return type(a) is type(b)
+
+
+_CMP: Dict[str, Callable[[Any, Any], bool]] = {
+    "=": lambda a, b: a == b,
+    "!=": lambda a, b: a != b,
+    "<>": lambda a, b: a != b,
+    "<": lambda a, b: a < b,
+    "<=": lambda a, b: a <= b,
+    ">": lambda a, b: a > b,
+    ">=": lambda a, b: a >= b,
+}
+
+
+def _get_path(doc: Dict[str, Any], parts: Tuple[str, ...]):
+    cur: Any = doc
+    for p in parts:
+        if isinstance(cur, dict) and p in cur:
+            cur = cur[p]
+        else:
+            return UNDEF
+    return cur
+
+
+def _fn_array_contains(arr, val, partial=False):
+    if not isinstance(arr, list):
+        return UNDEF
+    return val in arr
+
+
+def _fn_contains(s, sub, ignore_case=False):
+    if not isinstance(s, str) or not isinstance(sub, str):
+        return UNDEF
+    return sub.lower() in s.lower() if ignore_case else sub in s
+
+
+def _fn_startswith(s, prefix, ignore_case=False):
+    if not isinstance(s, str) or not isinstance(prefix, str):
+        return UNDEF
+    return s.lower().startswith(prefix.lower()) if ignore_case else s.startswith(prefix)
+
+
+_FUNCTIONS: Dict[str, Callable[..., Any]] = {
+    "ARRAY_CONTAINS": _fn_array_contains,
+    "CONTAINS": _fn_contains,
+    "STARTSWITH": _fn_startswith,
+    "LOWER": lambda s: s.lower() if isinstance(s, str) else UNDEF,
+    "UPPER": lambda s: s.upper() if isinstance(s, str) else UNDEF,
+    "IS_DEFINED": lambda v: v is not UNDEF,
+    "ARRAY_LENGTH": lambda a: len(a) if isinstance(a, list) else UNDEF,
+}
+
+Expr = Callable[[Dict[str, Any], Dict[str, Any]], Any]
+
+
+class _Query:
+    __slots__ = ("top", "value", "select", "aggregate", "where", "order_by")
+
+    def __init__(self):
+        self.top: Any = None          # int, "@param" or None
+        self.value = False
+        self.select: Any = "*"        # "*" | [(key, path_parts)] | Expr (VALUE expr)
+        self.aggregate: Optional[Tuple[str, Optional[Expr]]] = None
+        self.where: Optional[Expr] = None
+        self.order_by: List[Tuple[Tuple[str, ...], bool]] = []
+
+
+class _Parser:
+    def __init__(self, sql: str):
+        self.toks = _tokenize(sql)
+        self.i = 0
+        self.alias = "c"
+
+    def peek(self, offset: int = 0) -> Tuple[str, str]:
+        j = self.i + offset
+        return self.toks[j] if j < len(self.toks) else ("eof", "")
+
+    def kw(self, word: str) -> bool:
+        kind, val = self.peek()
+        if kind == "ident" and val.upper() == word:
+            self.i += 1
+            return True
+        return False
+
+    def expect(self, val: str):
+        kind, got = self.peek()
+        if got.upper() != val:
+            raise ValueError(f"expected {val!r}, got {got!r}")
+        self.i += 1
+
+    def parse(self) -> _Query:
+        q = _Query()
+        self.expect("SELECT")
+        if self.kw("TOP"):
+            kind, val = self.peek()
+            self.i += 1
+            q.top = int(val) if kind == "num" else val
+        if self.kw("VALUE"):
+            q.value = True
+        sel_start = self.i
+        # skip to FROM to learn the alias before compiling paths
+        depth = 0
+        while True:
+            kind, val = self.peek()
+            if kind == "eof":
+                raise ValueError("missing FROM")
+            if val == "(":
+                depth += 1
+            elif val == ")":
+                depth -= 1
+            elif depth == 0 and kind == "ident" and val.upper() == "FROM":
+                break
+            self.i += 1
+        from_at = self.i
+        self.i += 1
+        self.alias = self.peek()[1]
+        self.i += 1
+        after_from = self.i
+        self.i = sel_start
+        self._parse_select(q, from_at)
+        self.i = after_from
+        if self.kw("WHERE"):
+            q.where = self.expr()
+        if self.kw("ORDER"):
+            self.expect("BY")
+            while True:
+                parts = self._path(self.peek()[1])
+                self.i += 1
+                desc = False
+                if self.kw("DESC"):
+                    desc = True
+                else:
+                    self.kw("ASC")
+                q.order_by.append((parts, desc))
+                if self.peek()[1] != ",":
+                    break
+                self.i += 1
+        if self.peek()[0] != "eof":
+            raise ValueError(f"unexpected token {self.peek()[1]!r}")
+        return q
+
+    def _path(self, ident: str) -> Tuple[str, ...]:
+        parts = ident.split(".")
+        if parts[0] != self.alias:
+            raise ValueError(f"unknown alias in {ident!r}")
+        return tuple(parts[1:])
+
+    def _parse_select(self, q: _Query, end: int):
+        kind, val = self.peek()
+        if val == "*":
+            self.i += 1
+            q.select = "*"
+            return
+        if kind == "ident" and val.upper() in _AGGREGATES and self.peek(1)[1] == "(":
+            self.i += 2
+            arg = None
+            if self.peek()[1] == "*":
+                self.i += 1
+            else:
+                arg = self.operand()
+            self.expect(")")
+            q.aggregate = (val.upper(), arg)
+            return
+        if q.value:
+            q.select = self.operand()
+            return
+        fields = []
+        while self.i < end:
+            kind, val = self.peek()
+            if kind != "ident":
+                raise ValueError(f"unsupported projection {val!r}")
+            parts = self._path(val)
+            self.i += 1
+            key = parts[-1]
+            if self.kw("AS"):
+                key = self.peek()[1]
+                self.i += 1
+            fields.append((key, parts))
+            if self.peek()[1] == ",":
+                self.i += 1
+        q.select = fields
+
+    # expressions ------------------------------------------------------------------------------------
+    def expr(self) -> Expr:
+        left = self.and_expr()
+        while self.kw("OR"):
+            right = self.and_expr()
+            left = (lambda l, r: lambda d, p: _or(l(d, p), r(d, p)))(left, right)
+        return left
+
+    def and_expr(self) -> Expr:
+        left = self.not_expr()
+        while self.kw("AND"):
+            right = self.not_expr()
+            left = (lambda l, r: lambda d, p: _and(l(d, p), r(d, p)))(left, right)
+        return left
+
+    def not_expr(self) -> Expr:
+        if self.kw("NOT"):
+            inner = self.not_expr()
+            return lambda d, p: (not inner(d, p)) if isinstance(inner(d, p), bool) else UNDEF
+        return self.cmp()
+
+    def cmp(self) -> Expr:
+        left = self.operand()
+        kind, val = self.peek()
+        if kind == "op" and val in _CMP:
+            self.i += 1
+            right = self.operand()
+            fn = _CMP[val]
+            return lambda d, p: (fn(left(d, p), right(d, p)) if _comparable(left(d, p), right(d, p)) else UNDEF)
+        if self.kw("IN"):
+            self.expect("(")
+            options = [self.operand()]
+            while self.peek()[1] == ",":
+                self.i += 1
+                options.append(self.operand())
+            self.expect(")")
+            return lambda d, p: any(_comparable(left(d, p), o(d, p)) and left(d, p) == o(d, p) for o in options)
+        return left
+
+    def operand(self) -> Expr:
+        kind, val = self.peek()
+        self.i += 1
+        if val == "(":
+            inner = self.expr()
+            self.expect(")")
+            return inner
+        if kind == "str":
+            lit = val[1:-1].encode().decode("unicode_escape")
+            return lambda d, p: lit
+        if kind == "num":
+            num = float(val) if "." in val else int(val)
+            return lambda d, p: num
+        if kind == "param":
+            return lambda d, p: p.get(val, UNDEF)
+        if kind == "ident":
+            upper = val.upper()
+            if upper in ("TRUE", "FALSE"):
+                b = upper == "TRUE"
+                return lambda d, p: b
+            if upper == "NULL":
+                return lambda d, p: None
+            if upper in _FUNCTIONS and self.peek()[1] == "(":
+                self.i += 1
+                args = []
+                if self.peek()[1] != ")":
+                    args.append(self.expr())
+                    while self.peek()[1] == ",":
+                        self.i += 1
+                        args.append(self.expr())
+                self.expect(")")
+                fn = _FUNCTIONS[upper]
+                return lambda d, p: fn(*[a(d, p) for a in args])
+            if val == self.alias:
+                return lambda d, p: d
+            parts = self._path(val)
+            return lambda d, p: _get_path(d, parts)
+        raise ValueError(f"unexpected token {val!r}")
+
+
+def _and(a, b):
+    if a is False or b is False:
+        return False
+    if a is True and b is True:
+        return True
+    return UNDEF
+
+
+def _or(a, b):
+    if a is True or b is True:
+        return True
+    if a is False and b is False:
+        return False
+    return UNDEF
+
+
+@lru_cache(maxsize=256)
+def _compile(sql: str) -> _Query:
+    return _Parser(sql).parse()
+
+
+def run_query(sql: str, docs, parameters: Optional[List[Dict[str, Any]]] = None) -> List[Any]:
+    """Evaluate a query over an iterable of docs and return the full result list."""
+    q = _compile(sql)
+    params = {p["name"]: p["value"] for p in (parameters or [])}
+    rows = [d for d in docs if q.where is None or q.where(d, params) is True]
+    for parts, desc in reversed(q.order_by):
+        rows.sort(key=lambda d: _cmp_key(_get_path(d, parts)), reverse=desc)
+    if q.aggregate is not None:
+        name, arg = q.aggregate
+        if name == "COUNT":
+            result: Any = len(rows) if arg is None else sum(1 for d in rows if arg(d, params) is not UNDEF)
+        else:
+            vals = [v for v in (arg(d, params) for d in rows) if isinstance(v, (int, float)) and not isinstance(v, bool)]
+            if not vals:
+                return []
+            result = {"SUM": sum, "MIN": min, "MAX": max, "AVG": lambda v: sum(v) / len(v)}[name](vals)
+        return [result] if q.value else [{"$1": result}]
+    top = params.get(q.top) if isinstance(q.top, str) else q.top
+    if top is not None:
+        rows = rows[:int(top)]
+    if q.select == "*":
+        return [copy.deepcopy(d) for d in rows]
+    if q.value:
+        out = []
+        for d in rows:
+            v = q.select(d, params)
+            if v is not UNDEF:
+                out.append(copy.deepcopy(v))
+        return out
+    out = []
+    for d in rows:
+        row = {}
+        for key, parts in q.select:
+            v = _get_path(d, parts)
+            if v is not UNDEF:
+                row[key] = copy.deepcopy(v)
+        out.append(row)
+    return out
+
+
+# ---------------------------------------------------------------------------------------------------------
+# paging
+# ---------------------------------------------------------------------------------------------------------
+
+def _page_charge(page: List[Any]) -> Dict[str, str]:
+    # rough RU figure for one query page, reported through response_hook like the SDK does per fetch
+    return {"x-ms-request-charge": str(2.0 + 0.1 * len(page))}
+
+
+class _SyncPages:
+    def __init__(self, rows: List[Any], page_size: int, start: int, hook: Optional[Callable] = None):
+        self.rows = rows
+        self.page_size = page_size
+        self.pos = start
+        self.hook = hook
+        self.continuation_token: Optional[str] = None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self) -> Iterator[Any]:
+        if self.pos >= len(self.rows):
+            raise StopIteration
+        page = self.rows[self.pos:self.pos + self.page_size]
+        self.pos += self.page_size
+        self.continuation_token = str(self.pos) if self.pos < len(self.rows) else None
+        if self.hook is not None:
+            self.hook(_page_charge(page), page)
+        return iter(page)
+
+
+class ItemPaged:
+    """Sync query result: iterable of items, with by_page() like azure.core.paging.ItemPaged."""
+
+    def __init__(self, rows: List[Any], page_size: Optional[int], hook: Optional[Callable] = None):
+        self._rows = rows
+        self._page_size = page_size or max(1, len(rows))
+        self._hook = hook
+
+    def __iter__(self):
+        for page in self.by_page():
+            yield from page
+
+    def by_page(self, continuation_token: Optional[str] = None) -> _SyncPages:
+        return _SyncPages(self._rows, self._page_size, int(continuation_token or 0), self._hook)
+
+
+class _AsyncPages:
+    def __init__(self, rows: List[Any], page_size: int, start: int, hook: Optional[Callable] = None):
+        self._sync = _SyncPages(rows, page_size, start, hook)
+
+    @property
+    def continuation_token(self) -> Optional[str]:
+        return self._sync.continuation_token
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            page = next(self._sync)
+        except StopIteration:
+            raise StopAsyncIteration
+        return _AsyncIter(list(page))
+
+
+class _AsyncIter:
+    def __init__(self, items: List[Any]):
+        self._it = iter(items)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self._it)
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+class AsyncItemPaged:
+    """Async query result: async-iterable of items, with by_page() like azure.core.async_paging."""
+
+    def __init__(self, rows: List[Any], page_size: Optional[int], before: Optional[Callable] = None,
+                 hook: Optional[Callable] = None):
+        self._rows = rows
+        self._page_size = page_size or max(1, len(rows))
+        self._before = before
+        self._hook = hook
+
+    def __aiter__(self):
+        return self._iter()
+
+    async def _iter(self):
+        if self._before is not None:
+            await self._before()
+        for page in _SyncPages(self._rows, self._page_size, 0, self._hook):
+            for row in page:
+                yield row
+
+    def by_page(self, continuation_token: Optional[str] = None) -> _AsyncPages:
+        return _AsyncPages(self._rows, self._page_size, int(continuation_token or 0), self._hook)
+
+
+# ---------------------------------------------------------------------------------------------------------
+# container
+# ---------------------------------------------------------------------------------------------------------
+
+class BatchResponse:
+    def __init__(self, results: List[Dict[str, Any]], status_code: int = 200, error_index: Optional[int] = None):
+        self.results = results
+        self.status_code = status_code
+        self.error_index = error_index
+        self.is_successful = error_index is None
+        self.operation_responses = results
+
+    def __iter__(self):
+        return iter(self.results)
+
+    def __len__(self):
+        return len(self.results)
+
+
+class TransactionalBatch:
+    """Sync batch builder matching what LedgerService expects from create_transactional_batch()."""
+
+    def __init__(self, container: "InMemoryContainer", partition_key: Any):
+        self._container = container
+        self._pk = partition_key
+        self.ops: List[Tuple[str, tuple, Dict[str, Any]]] = []
+
+    def create_item(self, body: Dict[str, Any]):
+        self.ops.append(("create", (body,), {}))
+
+    def upsert_item(self, body: Dict[str, Any]):
+        self.ops.append(("upsert", (body,), {}))
+
+    def replace_item(self, item: str, body: Dict[str, Any], if_match: Optional[str] = None):
+        self.ops.append(("replace", (item, body), {"if_match_etag": if_match} if if_match else {}))
+
+    def delete_item(self, item: str, if_match: Optional[str] = None):
+        self.ops.append(("delete", (item,), {"if_match_etag": if_match} if if_match else {}))
+
+    def read_item(self, item: str):
+        self.ops.append(("read", (item,), {}))
+
+    def execute(self) -> BatchResponse:
+        return self._container._execute(self._pk, self.ops, raise_on_error=False)
+
+
+class InMemoryContainer:
+    """Thread-safe in-memory stand-in for azure.cosmos.ContainerProxy."""
+
+    MAX_BATCH_OPS = 100
+
+    def __init__(self, partition_key_path: str = "/user_id", id: str = "emulated"):
+        self.id = id
+        self._pk_parts = tuple(p for p in partition_key_path.split("/") if p)
+        self._partitions: Dict[Any, Dict[str, Dict[str, Any]]] = {}
+        self._locks: Dict[Any, threading.RLock] = {}
+        self._meta_lock = threading.Lock()
+        self._feed: List[Dict[str, Any]] = []
+        self._feed_lock = threading.Lock()
+        self.stats: Dict[str, int] = {"reads": 0, "queries": 0, "writes": 0, "batches": 0, "batch_ops": 0,
+                                      "conflicts_412": 0, "exists_409": 0, "not_found_404": 0}
+        self.partition_conflicts: Dict[Any, int] = {}
+
+    # internals -------------------------------------------------------------------------------------
+    def _pk_of(self, body: Dict[str, Any]):
+        v = _get_path(body, self._pk_parts)
+        return None if v is UNDEF else v
+
+    def _partition(self, pk) -> Tuple[Dict[str, Dict[str, Any]], threading.RLock]:
+        part = self._partitions.get(pk)
+        if part is None:
+            with self._meta_lock:
+                part = self._partitions.setdefault(pk, {})
+                self._locks.setdefault(pk, threading.RLock())
+        return part, self._locks[pk]
+
+    def _stamp(self, body: Dict[str, Any]) -> Dict[str, Any]:
+        doc = copy.deepcopy(body)
+        doc["_etag"] = f'"{uuid4().hex}"'
+        doc["_ts"] = int(time.time())
+        return doc
+
+    def _publish(self, doc: Dict[str, Any]):
+        with self._feed_lock:
+            self._feed.append(copy.deepcopy(doc))
+
+    def _count(self, key: str, n: int = 1):
+        self.stats[key] += n
+
+    def _apply(self, part, pk, op: str, args: tuple, kwargs: Dict[str, Any], staged: Dict[str, Any]):
+        """Validate one op against current+staged state; returns (status, doc_or_None)."""
+        def current(item_id):
+            if item_id in staged:
+                return staged[item_id]
+            return part.get(item_id)
+
+        if op == "create":
+            body = args[0]
+            if self._pk_of(body) != pk:
+                return 400, None
+            if current(body["id"]) is not None:
+                return 409, None
+            return 201, self._stamp(body)
+        if op == "upsert":
+            body = args[0]
+            if self._pk_of(body) != pk:
+                return 400, None
+            return 200, self._stamp(body)
+        if op in ("replace", "delete", "read"):
+            item_id = args[0]
+            existing = current(item_id)
+            if existing is None:
+                return 404, None
+            etag = kwargs.get("if_match_etag")
+            if etag is not None and existing.get("_etag") != etag:
+                return 412, None
+            if op == "read":
+                return 200, existing
+            if op == "delete":
+                return 204, None
+            body = args[1]
+            if body.get("id", item_id) != item_id or self._pk_of(body) != pk:
+                return 400, None
+            return 200, self._stamp(body)
+        raise ValueError(f"unsupported batch op {op}")
+
+    def _execute(self, pk, ops, raise_on_error: bool):
+        if len(ops) > self.MAX_BATCH_OPS:
+            raise _http_error(400, f"batch exceeds {self.MAX_BATCH_OPS} operations")
+        part, lock = self._partition(pk)
+        with lock:
+            self._count("batches")
+            self._count("batch_ops", len(ops))
+            staged: Dict[str, Any] = {}
+            results: List[Dict[str, Any]] = []
+            for i, (op, args, kwargs) in enumerate(ops):
+                status, doc = self._apply(part, pk, op, args, kwargs or {}, staged)
+                if status >= 400:
+                    self._note_failure(pk, status)
+                    # Cosmos reports 424 (failed dependency) for every op that was not the culprit
+                    responses = [{"statusCode": 424} for _ in ops]
+                    responses[i] = {"statusCode": status}
+                    if raise_on_error:
+                        raise _batch_error(i, status, responses)
+                    return BatchResponse(responses, status_code=status, error_index=i)
+                item_id = args[0]["id"] if op in ("create", "upsert") else args[0]
+                if op != "read":
+                    staged[item_id] = doc
+                results.append({"statusCode": status, "resourceBody": copy.deepcopy(doc) if doc else None})
+            # all ops validated: commit atomically
+            for item_id, doc in staged.items():
+                if doc is None:
+                    part.pop(item_id, None)
+                else:
+                    part[item_id] = doc
+                    self._publish(doc)
+            self._count("writes", len(staged))
+            return BatchResponse(results)
+
+    def _note_failure(self, pk, status: int):
+        if status == 412:
+            self._count("conflicts_412")
+            self.partition_conflicts[pk] = self.partition_conflicts.get(pk, 0) + 1
+        elif status == 409:
+            self._count("exists_409")
+        elif status == 404:
+            self._count("not_found_404")
+
+    def _single(self, pk, op, args, kwargs):
+        part, lock = self._partition(pk)
+        with lock:
+            status, doc = self._apply(part, pk, op, args, kwargs, {})
+            if status >= 400:
+                self._note_failure(pk, status)
+                raise _http_error(status, f"{op} failed")
+            if op == "read":
+                self._count("reads")
+                return copy.deepcopy(doc)
+            item_id = args[0]["id"] if op in ("create", "upsert") else args[0]
+            if doc is None:
+                part.pop(item_id, None)
+            else:
+                part[item_id] = doc
+                self._publish(doc)
+            self._count("writes")
+            return copy.deepcopy(doc) if doc else None
+
+    @staticmethod
+    def _charge(kwargs: Dict[str, Any], ru: float, result: Any) -> Any:
+        # rough RU figures (1 per point read, 5 per write) so request-charge accounting has something to read
+        hook = kwargs.get("response_hook")
+        if hook is not None:
+            hook({"x-ms-request-charge": str(ru)}, result)
+        return result
+
+    # ContainerProxy surface ---------------------------------------------------------------------------
+    def read_item(self, item: str, partition_key: Any, **kwargs) -> Dict[str, Any]:
+        return self._charge(kwargs, 1.0, self._single(partition_key, "read", (item,), {}))
+
+    def create_item(self, body: Dict[str, Any], **kwargs) -> Dict[str, Any]:
+        return self._charge(kwargs, 5.0, self._single(self._pk_of(body), "create", (body,), {}))
+
+    def upsert_item(self, body: Dict[str, Any], **kwargs) -> Dict[str, Any]:
+        return self._charge(kwargs, 5.0, self._single(self._pk_of(body), "upsert", (body,), {}))
+
+    def replace_item(self, item: str, body: Dict[str, Any], etag: Optional[str] = None, **kwargs) -> Dict[str, Any]:
+        item_id = item if isinstance(item, str) else item["id"]
+        return self._charge(kwargs, 5.0, self._single(self._pk_of(body), "replace", (item_id, body),
+                                                      {"if_match_etag": etag} if etag else {}))
+
+    def delete_item(self, item: str, partition_key: Any, etag: Optional[str] = None, **kwargs):
+        item_id = item if isinstance(item, str) else item["id"]
+        self._single(partition_key, "delete", (item_id,), {"if_match_etag": etag} if etag else {})
+        self._charge(kwargs, 5.0, None)
+
+    def create_transactional_batch(self, partition_key: Any) -> TransactionalBatch:
+        return TransactionalBatch(self, partition_key)
+
+    def execute_item_batch(self, batch_operations, partition_key: Any, **kwargs) -> List[Dict[str, Any]]:
+        ops = [(op[0], tuple(op[1]), op[2] if len(op) > 2 else {}) for op in batch_operations]
+        results = self._execute(partition_key, ops, raise_on_error=True).results
+        return self._charge(kwargs, 5.0 * len(ops), results)
+
+    def _docs(self, partition_key: Any):
+        if partition_key is not None:
+            part, lock = self._partition(partition_key)
+            with lock:
+                return list(part.values())
+        with self._meta_lock:
+            keys = list(self._partitions)
+        docs = []
+        for pk in keys:
+            part, lock = self._partition(pk)
+            with lock:
+                docs.extend(part.values())
+        return docs
+
+    def query_items(self, query: str, parameters: Optional[List[Dict[str, Any]]] = None, partition_key: Any = None,
+                    enable_cross_partition_query: Optional[bool] = None, max_item_count: Optional[int] = None,
+                    **kwargs) -> ItemPaged:
+        self._count("queries")
+        return ItemPaged(run_query(query, self._docs(partition_key), parameters), max_item_count,
+                         kwargs.get("response_hook"))
+
+    def _change_feed(self, continuation: Optional[str], start_time: Any, max_item_count: Optional[int]):
+        with self._feed_lock:
+            end = len(self._feed)
+            if continuation is not None:
+                start = int(continuation)
+            elif start_time == "Beginning":
+                start = 0
+            else:
+                start = end
+            if max_item_count:
+                end = min(end, start + max_item_count)
+            return self._feed[start:end], str(end)
+
+    def query_items_change_feed(self, continuation: Optional[str] = None, start_time: Any = "Now",
+                                max_item_count: Optional[int] = None, response_hook=None, **kwargs) -> ItemPaged:
+        docs, token = self._change_feed(continuation, start_time, max_item_count)
+        if response_hook is not None:
+            response_hook({"etag": token}, docs)
+        return ItemPaged([copy.deepcopy(d) for d in docs], max_item_count)
+
+    # introspection -----------------------------------------------------------------------------------
+    def all_items(self, partition_key: Any = None) -> List[Dict[str, Any]]:
+        return [copy.deepcopy(d) for d in self._docs(partition_key)]
+
+    def hot_partitions(self, n: int = 10) -> List[Tuple[Any, int]]:
+        return sorted(self.partition_conflicts.items(), key=lambda kv: kv[1], reverse=True)[:n]
+
+
+class AsyncInMemoryContainer:
+    """azure.cosmos.aio.ContainerProxy surface over an InMemoryContainer.
+
+    latency_ms adds a simulated round trip before every call, which is what lets concurrent coroutines
+    interleave between a read and the batch that depends on it (and so produce realistic etag conflicts).
+    """
+
+    def __init__(self, inner: Optional[InMemoryContainer] = None, latency_ms: float = 0.0, partition_key_path: str = "/user_id"):
+        self.inner = inner or InMemoryContainer(partition_key_path=partition_key_path)
+        self.latency = latency_ms / 1000.0
+
+    @property
+    def stats(self) -> Dict[str, int]:
+        return self.inner.stats
+
+    async def _rtt(self):
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        else:
+            # still yield, so coroutines interleave like real I/O
+            await asyncio.sleep(0)
+
+    async def read_item(self, item: str, partition_key: Any, **kwargs) -> Dict[str, Any]:
+        await self._rtt()
+        return self.inner.read_item(item=item, partition_key=partition_key, **kwargs)
+
+    async def create_item(self, body: Dict[str, Any], **kwargs) -> Dict[str, Any]:
+        await self._rtt()
+        return self.inner.create_item(body, **kwargs)
+
+    async def upsert_item(self, body: Dict[str, Any], **kwargs) -> Dict[str, Any]:
+        await self._rtt()
+        return self.inner.upsert_item(body, **kwargs)
+
+    async def replace_item(self, item: str, body: Dict[str, Any], etag: Optional[str] = None, **kwargs) -> Dict[str, Any]:
+        await self._rtt()
+        return self.inner.replace_item(item, body, etag=etag, **kwargs)
+
+    async def delete_item(self, item: str, partition_key: Any, **kwargs):
+        await self._rtt()
+        self.inner.delete_item(item, partition_key=partition_key, **kwargs)
+
+    async def execute_item_batch(self, batch_operations, partition_key: Any, **kwargs) -> List[Dict[str, Any]]:
+        await self._rtt()
+        return self.inner.execute_item_batch(batch_operations, partition_key=partition_key, **kwargs)
+
+    def query_items(self, query: str, parameters: Optional[List[Dict[str, Any]]] = None, partition_key: Any = None,
+                    max_item_count: Optional[int] = None, **kwargs) -> AsyncItemPaged:
+        paged = self.inner.query_items(query, parameters=parameters, partition_key=partition_key, max_item_count=max_item_count)
+        return AsyncItemPaged(paged._rows, max_item_count, before=self._rtt, hook=kwargs.get("response_hook"))
+
+    def query_items_change_feed(self, **kwargs) -> AsyncItemPaged:
+        paged = self.inner.query_items_change_feed(**kwargs)
+        return AsyncItemPaged(paged._rows, kwargs.get("max_item_count"), before=self._rtt)
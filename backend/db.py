@@ -1,4 +1,5 @@
 import os
+import threading
 from typing import Optional
 
 try:
@@ -6,27 +7,51 @@ try:
 except Exception:
     CosmosClient = None
 
+from .metrics import timed_container
+
 COSMOS_URL = os.getenv("COSMOS_URL")
 COSMOS_KEY = os.getenv("COSMOS_KEY")
 COSMOS_DB = os.getenv("COSMOS_DB", "naughtychats-db")
 COSMOS_USERS_CONTAINER = os.getenv("COSMOS_USERS_CONTAINER", "users")
 
+# one client (and its connection pool) per process; building a CosmosClient costs a metadata round trip
+_client = None
+_users_container = None
+_lock = threading.Lock()
+
 
 def get_cosmos_client() -> Optional[CosmosClient]:
+    global _client
     if not CosmosClient:
         return None
     if not COSMOS_URL or not COSMOS_KEY:
         return None
-    return CosmosClient(COSMOS_URL, credential=COSMOS_KEY)
+    if _client is None:
+        with _lock:
+            if _client is None:
+                _client = CosmosClient(COSMOS_URL, credential=COSMOS_KEY)
+    return _client
 
 
 def get_users_container():
+    global _users_container
+    if _users_container is not None:
+        return _users_container
     client = get_cosmos_client()
     if not client:
         return None
     try:
         db = client.get_database_client(COSMOS_DB)
-        container = db.get_container_client(COSMOS_USERS_CONTAINER)
-        return container
+        # UserRepository's Cosmos calls are timed and their RU charge recorded (see metrics)
+        _users_container = timed_container(db.get_container_client(COSMOS_USERS_CONTAINER), "users")
+        return _users_container
     except Exception:
         return None
+
+
+def reset_clients():
+    """Drop the cached client/container (tests, credential rotation)."""
+    global _client, _users_container
+    with _lock:
+        _client = None
+        _users_container = None
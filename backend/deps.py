@@ -1,12 +1,23 @@
 from fastapi import Depends, HTTPException, Header
 from typing import Optional
 from .auth import decode_token
+from .user_cache import profile_cache
 
 try:
     from .repositories.user_repository import UserRepository
 except Exception:
     UserRepository = None
 
+# shared by every request; the repository only holds the process-wide container
+_user_repo = None
+
+
+def _get_user_repo():
+    global _user_repo
+    if _user_repo is None and UserRepository is not None:
+        _user_repo = UserRepository()
+    return _user_repo
+
 
 def get_current_user(authorization: Optional[str] = Header(None)):
     if not authorization:
@@ -20,13 +31,17 @@ def get_current_user(authorization: Optional[str] = Header(None)):
         raise HTTPException(status_code=401, detail="Invalid token")
     sub = payload.get("sub")
 
+    cached = profile_cache.get(sub)
+    if cached is not None:
+        return cached
+
     # attempt to enrich with user data from Cosmos-backed repo
-    if UserRepository is not None:
+    repo = _get_user_repo()
+    if repo is not None:
         try:
-            repo = UserRepository()
             user = repo.get_by_username(sub)
             if user:
-                return {"user_id": sub, "username": user.get("username"), "email": user.get("email")}
+                return profile_cache.put(sub, user)
         except Exception:
             # ignore repo errors and fall back
             pass
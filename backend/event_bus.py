@@ -0,0 +1,169 @@
+"""Push events for connected clients.
+
+Ledger mutations and generation job changes publish small events; every replica subscribes and hands
+them to its ConnectionRegistry, which fans them out to that user's open sockets. Events are plain
+dicts carrying "type" and "user_id":
+
+    {"type": "balance.updated", "user_id": ..., "balance": 42, "updated_at": "..."}
+    {"type": "job.updated", "user_id": ..., "id": "job:...", "status": "running", ...}
+
+publish() is synchronous and never raises, so callers (including the sync LedgerService) can fire it
+right after a commit without waiting on the broker or failing the mutation. Brokers are picked with
+EVENT_BUS: "memory" delivers in-process (one replica); "redis" publishes on a Redis pub/sub channel
+that every replica listens to (needs the redis package).
+"""
+import asyncio
+import json
+import logging
+import os
+from typing import Any, Callable, Dict, List, Optional
+
+try:
+    import redis.asyncio as aioredis
+except Exception:  # redis is optional; only EVENT_BUS=redis needs it
+    aioredis = None
+
+log = logging.getLogger(__name__)
+
+EVENT_BUS = os.getenv("EVENT_BUS", "memory")
+EVENT_BUS_REDIS_URL = os.getenv("EVENT_BUS_REDIS_URL", "redis://localhost:6379/0")
+EVENT_BUS_CHANNEL = os.getenv("EVENT_BUS_CHANNEL", "naughty:events")
+EVENT_BUS_OUTBOX_SIZE = int(os.getenv("EVENT_BUS_OUTBOX_SIZE", "10000"))
+
+# job fields worth pushing; results and prompts stay behind GET /api/v1/generate/{id}
+_JOB_EVENT_FIELDS = ("id", "status", "count", "estimated_cost", "actual_cost", "error")
+
+Handler = Callable[[Dict[str, Any]], None]
+
+
+def balance_event(user_id: str, balance: int, updated_at: Optional[str] = None) -> Dict[str, Any]:
+    return {"type": "balance.updated", "user_id": user_id, "balance": int(balance), "updated_at": updated_at}
+
+
+def job_event(job: Dict[str, Any]) -> Dict[str, Any]:
+    event = {"type": "job.updated", "user_id": job["user_id"]}
+    event.update({k: job.get(k) for k in _JOB_EVENT_FIELDS})
+    return event
+
+
+class EventBroker:
+    def __init__(self):
+        self._handlers: List[Handler] = []
+
+    def subscribe(self, handler: Handler):
+        self._handlers.append(handler)
+
+    def _dispatch(self, event: Dict[str, Any]):
+        for handler in self._handlers:
+            try:
+                handler(event)
+            except Exception:
+                log.exception("event handler failed for %s", event.get("type"))
+
+    def publish(self, event: Dict[str, Any]):
+        raise NotImplementedError
+
+    async def start(self):
+        pass
+
+    async def close(self):
+        pass
+
+
+class InMemoryBroker(EventBroker):
+    def publish(self, event: Dict[str, Any]):
+        self._dispatch(event)
+
+
+class RedisBroker(EventBroker):
+    """One pub/sub channel shared by all replicas; a replica also hears its own events, which is how
+    they reach its local sockets. Publishes go through a bounded outbox so a slow Redis drops events
+    (clients resync on reconnect) instead of stalling ledger writes."""
+
+    def __init__(self, url: str = EVENT_BUS_REDIS_URL, channel: str = EVENT_BUS_CHANNEL,
+                 outbox_size: int = EVENT_BUS_OUTBOX_SIZE):
+        if aioredis is None:
+            raise RuntimeError("EVENT_BUS=redis needs the redis package")
+        super().__init__()
+        self.url = url
+        self.channel = channel
+        self._outbox: "asyncio.Queue[str]" = asyncio.Queue(maxsize=outbox_size)
+        self._redis = None
+        self._tasks: List[asyncio.Task] = []
+        self.dropped = 0
+
+    def publish(self, event: Dict[str, Any]):
+        try:
+            self._outbox.put_nowait(json.dumps(event, separators=(",", ":")))
+        except asyncio.QueueFull:
+            self.dropped += 1
+
+    async def _send_loop(self):
+        while True:
+            payload = await self._outbox.get()
+            try:
+                await self._redis.publish(self.channel, payload)
+            except Exception:
+                self.dropped += 1
+                log.exception("redis publish failed")
+
+    async def _read_loop(self):
+        while True:
+            try:
+                pubsub = self._redis.pubsub()
+                await pubsub.subscribe(self.channel)
+                async for message in pubsub.listen():
+                    if message.get("type") == "message":
+                        self._dispatch(json.loads(message["data"]))
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception("redis subscription dropped; reconnecting")
+                await asyncio.sleep(1.0)
+
+    async def start(self):
+        if self._redis is None:
+            self._redis = aioredis.from_url(self.url)
+            self._tasks = [asyncio.create_task(self._send_loop()), asyncio.create_task(self._read_loop())]
+
+    async def close(self):
+        tasks, self._tasks = self._tasks, []
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        if self._redis is not None:
+            await self._redis.close()
+            self._redis = None
+
+
+EVENT_BROKERS: Dict[str, Callable[[], EventBroker]] = {"memory": InMemoryBroker, "redis": RedisBroker}
+
+
+def get_event_broker(name: Optional[str] = None) -> EventBroker:
+    factory = EVENT_BROKERS.get(name or EVENT_BUS)
+    if factory is None:
+        raise ValueError(f"unknown EVENT_BUS {name or EVENT_BUS!r}")
+    return factory()
+
+
+class EventBus:
+    def __init__(self, broker: Optional[EventBroker] = None):
+        self.broker = broker or InMemoryBroker()
+        self.stats = {"published": 0, "failed": 0}
+
+    def subscribe(self, handler: Handler):
+        self.broker.subscribe(handler)
+
+    def publish(self, event: Dict[str, Any]):
+        try:
+            self.broker.publish(event)
+            self.stats["published"] += 1
+        except Exception:
+            self.stats["failed"] += 1
+            log.exception("publishing %s failed", event.get("type"))
+
+    async def start(self):
+        await self.broker.start()
+
+    async def close(self):
+        await self.broker.close()
@@ -0,0 +1,419 @@
+"""Image generation jobs.
+
+Submitting prices the job, reserves a gem hold for it, stores a gen_job doc (container partitioned by
+/user_id) and enqueues {"job_id", "user_id"} on the job queue. Workers lease messages, keep the lease
+alive while the generator runs, then settle the hold with the actual cost: images that failed are not
+charged (FR-043). A failed attempt goes back on the queue with exponential backoff; after
+GEN_MAX_ATTEMPTS deliveries the message is dead-lettered, the job marked failed and the hold cancelled.
+
+Job doc status: queued -> running -> settling -> completed | partial, or failed / cancelled. Results
+are written ("settling") before the hold is finalized, so a worker that dies in between never
+regenerates or double-charges on redelivery: finalize_hold is a no-op for a settled hold. A hold the
+expired-hold sweeper cancelled meanwhile is charged again through a new hold; if the balance no longer
+covers it the job fails without results.
+"""
+import asyncio
+import hashlib
+import logging
+import math
+import os
+import time
+from collections import deque
+from datetime import datetime
+from typing import Any, Callable, Deque, Dict, List, Optional
+from uuid import uuid4
+
+from .cosmos_emulator import AsyncInMemoryContainer, InMemoryContainer
+from .event_bus import EventBus, job_event
+from .job_queue import JobQueue, Lease, LeaseLost
+from .ledger import InsufficientFunds
+from .metrics import LatencyStats
+from .pricing import PricingEngine, PricingError, pricing as default_pricing
+from .retry import has_status, replace_with_etag
+
+log = logging.getLogger(__name__)
+
+GEN_WORKER_CONCURRENCY = int(os.getenv("GEN_WORKER_CONCURRENCY", "4"))
+GEN_VISIBILITY_TIMEOUT_SECONDS = float(os.getenv("GEN_VISIBILITY_TIMEOUT_SECONDS", "60"))
+GEN_MAX_ATTEMPTS = int(os.getenv("GEN_MAX_ATTEMPTS", "3"))
+GEN_RETRY_BACKOFF_SECONDS = float(os.getenv("GEN_RETRY_BACKOFF_SECONDS", "2"))
+GEN_JOB_TIMEOUT_SECONDS = float(os.getenv("GEN_JOB_TIMEOUT_SECONDS", "120"))
+GEN_POLL_MS = float(os.getenv("GEN_POLL_MS", "250"))
+ENV = os.getenv("ENV", "dev")
+# the fake generator returns placeholder URLs that are still charged for: only a default in dev and tests
+IMAGE_GENERATOR = os.getenv("IMAGE_GENERATOR", "fake" if ENV in ("dev", "test") else "")
+# price table model used for generations
+IMAGE_PRICE_MODEL = os.getenv("IMAGE_PRICE_MODEL", "image")
+FAKE_IMAGE_MS = float(os.getenv("FAKE_IMAGE_MS", "500"))
+
+IMAGE_COUNTS = (1, 4, 9)
+FINAL_STATUSES = ("completed", "partial", "failed", "cancelled")
+
+
+class JobError(Exception):
+    def __init__(self, code: int, detail: str):
+        super().__init__(detail)
+        self.code = code
+        self.detail = detail
+
+
+class HoldLost(Exception):
+    """The job's hold was cancelled before it could be charged, and the charge could not be retaken."""
+
+
+def _now_iso() -> str:
+    return datetime.utcnow().isoformat() + "Z"
+
+
+class ImageGenerator:
+    name = "base"
+
+    async def generate(self, job: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """One result per requested image: {"index", "ok", ...}; raising fails the whole attempt."""
+        raise NotImplementedError
+
+
+class FakeImageGenerator(ImageGenerator):
+    """Local stand-in: sleeps, then returns placeholder URLs. fail_indexes simulates partial failures."""
+
+    name = "fake"
+
+    def __init__(self, latency_ms: float = FAKE_IMAGE_MS, fail_indexes=()):
+        self.latency = latency_ms / 1000.0
+        self.fail_indexes = set(fail_indexes)
+
+    async def generate(self, job: Dict[str, Any]) -> List[Dict[str, Any]]:
+        await asyncio.sleep(self.latency)
+        out = []
+        for i in range(int(job["count"])):
+            if i in self.fail_indexes:
+                out.append({"index": i, "ok": False, "error": "generation failed"})
+            else:
+                out.append({"index": i, "ok": True, "seed": hash((job["id"], i)) & 0xFFFFFFFF,
+                            "url": f"https://example.invalid/{job['id']}/{i}.png"})
+        return out
+
+
+IMAGE_GENERATORS: Dict[str, Callable[[], ImageGenerator]] = {"fake": FakeImageGenerator}
+
+
+def get_image_generator(name: Optional[str] = None) -> ImageGenerator:
+    if not (name or IMAGE_GENERATOR):
+        raise ValueError("IMAGE_GENERATOR not set")
+    factory = IMAGE_GENERATORS.get(name or IMAGE_GENERATOR)
+    if factory is None:
+        raise ValueError(f"unknown IMAGE_GENERATOR {name or IMAGE_GENERATOR!r}")
+    return factory()
+
+
+class JobMetrics(LatencyStats):
+    def __init__(self, clock=time.time):
+        super().__init__(("submitted", "completed", "partial", "failed", "cancelled", "retries", "dead_lettered",
+                          "lease_lost"), ("wait_ms", "run_ms", "total_ms"))
+        self._clock = clock
+        self._finished: Deque[float] = deque(maxlen=100_000)
+
+    def finished(self):
+        self._finished.append(self._clock())
+
+    def throughput_per_minute(self) -> int:
+        cutoff = self._clock() - 60.0
+        while self._finished and self._finished[0] < cutoff:
+            self._finished.popleft()
+        return len(self._finished)
+
+    def snapshot(self) -> Dict[str, Any]:
+        out = super().snapshot()
+        out["throughput_per_min"] = self.throughput_per_minute()
+        return out
+
+
+def _job_id(idempotency_key: Optional[str] = None) -> str:
+    if not idempotency_key:
+        return f"job:{uuid4().hex}"
+    # keys are client strings; hash them into a valid, fixed-length Cosmos id
+    return "job:" + hashlib.sha256(idempotency_key.encode()).hexdigest()[:32]
+
+
+def public_view(job: Dict[str, Any]) -> Dict[str, Any]:
+    return {k: v for k, v in job.items() if not k.startswith("_") and k not in ("docType", "message_id")}
+
+
+class GenerationService:
+    def __init__(self, ledger, queue: JobQueue, container, generator: Optional[ImageGenerator] = None,
+                 settlements=None, pricing: Optional[PricingEngine] = None, price_model: str = IMAGE_PRICE_MODEL,
+                 concurrency: int = GEN_WORKER_CONCURRENCY, visibility_timeout: float = GEN_VISIBILITY_TIMEOUT_SECONDS,
+                 max_attempts: int = GEN_MAX_ATTEMPTS, retry_backoff: float = GEN_RETRY_BACKOFF_SECONDS,
+                 job_timeout: float = GEN_JOB_TIMEOUT_SECONDS, poll_ms: float = GEN_POLL_MS,
+                 events: Optional[EventBus] = None):
+        self.ledger = ledger
+        self.settlements = settlements or ledger
+        self.queue = queue
+        self.container = container
+        self.generator = generator or get_image_generator()
+        self.pricing = pricing or default_pricing
+        self.price_model = price_model
+        self.concurrency = concurrency
+        self.visibility_timeout = visibility_timeout
+        self.max_attempts = max_attempts
+        self.retry_backoff = retry_backoff
+        self.job_timeout = job_timeout
+        self.poll = poll_ms / 1000.0
+        # every status change is pushed to the owner's sockets as job.updated
+        self.events = events
+        self.metrics = JobMetrics()
+        self._workers: List[asyncio.Task] = []
+
+    @staticmethod
+    def local_container() -> AsyncInMemoryContainer:
+        return AsyncInMemoryContainer(InMemoryContainer(partition_key_path="/user_id"))
+
+    # jobs --------------------------------------------------------------------------------------------
+    def quote(self, prompt: str, count: int, quality: str) -> int:
+        if count not in IMAGE_COUNTS:
+            raise JobError(400, f"count must be one of {IMAGE_COUNTS}")
+        try:
+            return self.pricing.quote(self.price_model, self.pricing.count(prompt), units=count, tier=quality)
+        except PricingError as e:
+            raise JobError(400, str(e))
+
+    async def submit(self, user_id: str, prompt: str, count: int, quality: str,
+                     idempotency_key: Optional[str] = None, **options) -> Dict[str, Any]:
+        """Create and enqueue a job. A retried submit with the same idempotency_key maps to the same
+        job id and hold, so it gets the existing job back instead of a second one."""
+        cost = self.quote(prompt, count, quality)
+        job_id = _job_id(idempotency_key)
+        try:
+            # the hold key is derived from the client's key so a retried submit reuses the same hold
+            hold = await self.ledger.reserve_hold(user_id, cost, f"gen:{idempotency_key}" if idempotency_key else None)
+        except InsufficientFunds:
+            raise JobError(402, "Insufficient gems")
+        now = time.time()
+        job = {"id": job_id, "docType": "gen_job", "user_id": user_id, "status": "queued", "prompt": prompt,
+               "count": count, "quality": quality, "hold_id": hold["hold_id"], "estimated_cost": cost,
+               "actual_cost": None, "attempts": 0, "results": [], "error": None,
+               "created_at": _now_iso(), "submitted_ts": now}
+        job.update({k: v for k, v in options.items() if v is not None})
+        try:
+            job = await self.container.create_item(body=job) or job
+        except BaseException as e:
+            if not has_status(e, 409):
+                await asyncio.shield(self._release(user_id, hold["hold_id"]))
+                raise
+            # the job id only repeats for a replayed idempotency key: that job owns the hold
+            existing = await self._read(user_id, job_id)
+            if existing is None:
+                raise
+            return await self._view(existing)
+        try:
+            job["message_id"] = await self.queue.send({"job_id": job_id, "user_id": user_id})
+            job = await self._save(user_id, job_id, lambda d: d.update(message_id=job["message_id"]))
+        except BaseException:
+            # a retry with the same key then finds this failed job rather than one nobody will run
+            await asyncio.shield(self._abort(user_id, job_id, hold["hold_id"]))
+            raise
+        self.metrics.counts["submitted"] += 1
+        return await self._view(job)
+
+    async def get(self, user_id: str, job_id: str) -> Dict[str, Any]:
+        job = await self._read(user_id, job_id)
+        if job is None:
+            raise JobError(404, "unknown job")
+        return await self._view(job)
+
+    async def _view(self, job: Dict[str, Any]) -> Dict[str, Any]:
+        view = public_view(job)
+        if job["status"] == "queued" and job.get("message_id"):
+            view["queue_position"] = await self.queue.position(job["message_id"])
+        return view
+
+    async def _abort(self, user_id: str, job_id: str, hold_id: str):
+        try:
+            await self._save(user_id, job_id, lambda d: d.update(status="failed", error="submit failed",
+                                                                 finished_at=_now_iso()))
+        except Exception:
+            log.exception("could not mark job %s failed", job_id)
+        await self._release(user_id, hold_id)
+
+    async def cancel(self, user_id: str, job_id: str) -> Dict[str, Any]:
+        """Cancel a job that has not started (FR-044); its hold is released."""
+        def change(doc):
+            if doc["status"] != "queued":
+                raise JobError(409, f"job is {doc['status']}")
+            doc["status"] = "cancelled"
+            doc["finished_at"] = _now_iso()
+        job = await self._save(user_id, job_id, change)
+        await self._release(user_id, job["hold_id"])
+        self.metrics.counts["cancelled"] += 1
+        # the worker that later receives the message just completes it
+        return public_view(job)
+
+    async def _read(self, user_id: str, job_id: str) -> Optional[Dict[str, Any]]:
+        try:
+            return await self.container.read_item(item=job_id, partition_key=user_id)
+        except Exception as e:
+            if has_status(e, 404):
+                return None
+            raise
+
+    async def _save(self, user_id: str, job_id: str, change) -> Dict[str, Any]:
+        doc = await replace_with_etag(self.container, job_id, user_id, change)
+        if doc is None:
+            raise JobError(404, "unknown job")
+        if self.events is not None:
+            self.events.publish(job_event(doc))
+        return doc
+
+    async def _release(self, user_id: str, hold_id: str):
+        try:
+            await self.settlements.cancel_hold(user_id, hold_id)
+        except Exception:
+            # the expired-hold sweeper refunds it later
+            log.exception("cancel_hold %s for %s failed", hold_id, user_id)
+
+    # workers -----------------------------------------------------------------------------------------
+    async def _heartbeat(self, lease: Lease):
+        while True:
+            await asyncio.sleep(self.visibility_timeout / 2)
+            await self.queue.renew(lease, self.visibility_timeout)
+
+    async def process(self, lease: Lease):
+        """Handle one delivery of a job message."""
+        user_id, job_id = lease.body["user_id"], lease.body["job_id"]
+        job = await self._read(user_id, job_id)
+        if job is None or job["status"] in FINAL_STATUSES:
+            await self.queue.complete(lease)
+            return
+        heartbeat = asyncio.create_task(self._heartbeat(lease))
+        try:
+            if job["status"] != "settling":
+                def start(doc):
+                    if doc["status"] in FINAL_STATUSES:
+                        raise JobError(409, f"job is {doc['status']}")
+                    doc.update(status="running", attempts=lease.delivery_count, started_at=_now_iso(),
+                               started_ts=time.time())
+                job = await self._save(user_id, job_id, start)
+                results = await asyncio.wait_for(self.generator.generate(job), self.job_timeout)
+                ok = sum(1 for r in results if r.get("ok"))
+                if ok == 0:
+                    raise RuntimeError("every image failed")
+                # charge only for the images that came out
+                actual = min(job["estimated_cost"], math.ceil(job["estimated_cost"] * ok / job["count"]))
+                job = await self._save(user_id, job_id, lambda d: d.update(status="settling", results=results,
+                                                                          actual_cost=actual, error=None))
+            job, out = await self._charge(job)
+            ok = sum(1 for r in job["results"] if r.get("ok"))
+            final = "completed" if ok == job["count"] else "partial"
+            job = await self._save(user_id, job_id, lambda d: d.update(
+                status=final, finished_at=_now_iso(), balance_after=out.get("balance_after")))
+            await self.queue.complete(lease)
+            self._record(job, final)
+        except HoldLost as e:
+            job = await self._save(user_id, job_id, lambda d: d.update(
+                status="failed", results=[], error=str(e), finished_at=_now_iso()))
+            await self.queue.complete(lease)
+            self._record(job, "failed")
+        except JobError:
+            # cancelled between our read and the start
+            await self.queue.complete(lease)
+        except LeaseLost:
+            self.metrics.counts["lease_lost"] += 1
+            log.warning("lease on %s expired mid-job; it will be redelivered", job_id)
+        except Exception as e:
+            await self._failed(lease, job, e)
+        finally:
+            heartbeat.cancel()
+
+    async def _charge(self, job: Dict[str, Any]):
+        """Finalize the job's hold at actual_cost; returns (job, finalize result).
+
+        The hold can already be closed: settled by an earlier delivery that died before recording it,
+        or cancelled by the expired-hold sweeper while the job waited or retried. A cancelled hold was
+        refunded, so the charge is taken again through a new hold keyed by the job id.
+        """
+        user_id = job["user_id"]
+        hold_id = job.get("charge_hold_id") or job["hold_id"]
+        out = await self.settlements.finalize_hold(user_id, hold_id, job["actual_cost"])
+        if not out.get("already_settled"):
+            return job, out
+        hold = await self.ledger.container.read_item(item=hold_id, partition_key=user_id)
+        if hold.get("status") == "settled":
+            return job, {"balance_after": await self.ledger.get_balance(user_id)}
+        if job.get("charge_hold_id"):
+            raise HoldLost("hold expired before the job finished")
+        try:
+            charge = await self.ledger.reserve_hold(user_id, job["actual_cost"], f"gen-charge:{job['id']}")
+        except InsufficientFunds:
+            raise HoldLost("hold expired before the job finished and the balance no longer covers it")
+        job = await self._save(user_id, job["id"], lambda d: d.update(charge_hold_id=charge["hold_id"]))
+        return await self._charge(job)
+
+    async def _failed(self, lease: Lease, job: Dict[str, Any], error: Exception):
+        user_id, job_id = job["user_id"], job["id"]
+        log.warning("job %s attempt %d failed: %s", job_id, lease.delivery_count, error)
+        try:
+            if lease.delivery_count >= self.max_attempts:
+                await self.queue.dead_letter(lease, str(error) or type(error).__name__)
+                self.metrics.counts["dead_lettered"] += 1
+                job = await self._save(user_id, job_id, lambda d: d.update(
+                    status="failed", error=str(error), finished_at=_now_iso()))
+                await self._release(user_id, job["hold_id"])
+                self._record(job, "failed")
+            else:
+                await self._save(user_id, job_id, lambda d: d.update(status="queued", error=str(error)))
+                await self.queue.abandon(lease, self.retry_backoff * (2 ** (lease.delivery_count - 1)))
+                self.metrics.counts["retries"] += 1
+        except LeaseLost:
+            self.metrics.counts["lease_lost"] += 1
+        except Exception:
+            # the lease expires and the message comes back
+            log.exception("could not record failure of job %s", job_id)
+
+    def _record(self, job: Dict[str, Any], status: str):
+        self.metrics.counts[status] += 1
+        self.metrics.finished()
+        now = time.time()
+        submitted = job.get("submitted_ts") or now
+        started = job.get("started_ts") or now
+        self.metrics.observe("wait_ms", (started - submitted) * 1000.0)
+        self.metrics.observe("run_ms", (now - started) * 1000.0)
+        self.metrics.observe("total_ms", (now - submitted) * 1000.0)
+
+    async def _worker(self):
+        while True:
+            try:
+                leases = await self.queue.receive(1, self.visibility_timeout)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception("job queue receive failed")
+                leases = []
+            if not leases:
+                await asyncio.sleep(self.poll)
+                continue
+            try:
+                await self.process(leases[0])
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception("job worker crashed on %s", leases[0].message_id)
+
+    def start(self):
+        if not self._workers:
+            self._workers = [asyncio.create_task(self._worker()) for _ in range(self.concurrency)]
+
+    async def stop(self):
+        workers, self._workers = self._workers, []
+        for task in workers:
+            task.cancel()
+        for task in workers:
+            try:
+                await task
+            except asyncio.CancelledError:
+                pass
+
+    async def snapshot(self) -> Dict[str, Any]:
+        out = self.metrics.snapshot()
+        out["queue_depth"] = await self.queue.depth()
+        out["workers"] = len(self._workers)
+        return out
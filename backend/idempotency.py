@@ -0,0 +1,62 @@
+import os
+from typing import Any, Dict, Optional
+
+from .ttl_cache import TTLCache
+
+IDEMPOTENCY_CACHE_SIZE = int(os.getenv("IDEMPOTENCY_CACHE_SIZE", "10000"))
+# Cosmos per-item ttl (seconds) for idempotency records; only honoured because the ledger container has
+# TTL enabled (defaultTtl: -1 in infra/bicep/modules/cosmosdb.bicep)
+IDEMPOTENCY_TTL_SECONDS = int(os.getenv("IDEMPOTENCY_TTL_SECONDS", str(7 * 24 * 3600)))
+
+
+class IdempotencyKeyReused(Exception):
+    """The idempotency key was already used for a request with different parameters."""
+    pass
+
+
+class IdempotencyRace(Exception):
+    """The idempotency record was created by a concurrent request while our batch was in flight."""
+    pass
+
+
+def idem_id(idempotency_key: str) -> str:
+    return f"idem:{idempotency_key}"
+
+
+def build_record(user_id: str, idempotency_key: str, operation: str, request: Dict[str, Any],
+                 result: Dict[str, Any], created_at: str) -> Dict[str, Any]:
+    """Idempotency record stored in the user's partition, written in the same batch as the mutation."""
+    return {
+        "id": idem_id(idempotency_key),
+        "docType": "idempotency",
+        "user_id": user_id,
+        "idempotency_key": idempotency_key,
+        "operation": operation,
+        "request": request,
+        "result": result,
+        "created_at": created_at,
+        "ttl": IDEMPOTENCY_TTL_SECONDS,
+    }
+
+
+def replay(record: Dict[str, Any], operation: str, request: Dict[str, Any]) -> Dict[str, Any]:
+    """Return the stored result for a replayed request, or raise if the key was used for something else."""
+    if record.get("operation") != operation or record.get("request") != request:
+        raise IdempotencyKeyReused(f"idempotency key {record.get('idempotency_key')} already used for a different request")
+    out = dict(record.get("result") or {})
+    out["replayed"] = True
+    return out
+
+
+class IdempotencyCache(TTLCache):
+    """Bounded in-process LRU of idempotency records keyed by (user_id, idempotency_key)."""
+
+    def __init__(self, max_entries: int = IDEMPOTENCY_CACHE_SIZE):
+        # no TTL: records never change once written, so entries only leave by eviction
+        super().__init__(max_entries)
+
+    def get(self, user_id: str, idempotency_key: str) -> Optional[Dict[str, Any]]:
+        return super().get((user_id, idempotency_key))
+
+    def put(self, record: Dict[str, Any]):
+        super().put((record["user_id"], record["idempotency_key"]), record)
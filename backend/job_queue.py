@@ -0,0 +1,301 @@
+"""Work queues for background jobs.
+
+The interface follows Service Bus peek-lock semantics (the gen-jobs queue in infra): receive() hands
+out a lease that hides the message for visibility_timeout seconds; the worker completes it when done,
+abandons it to retry (optionally after a delay) or dead-letters it. A lease that expires without any
+of those makes the message visible again, so a crashed worker's job is redelivered. Every delivery
+bumps delivery_count; a message received more than max_deliveries times goes to the dead letters.
+
+Two stand-ins ship here, picked with JOB_QUEUE: "memory" (one process) and "sqlite" (survives
+restarts, can be shared by processes on one host via JOB_QUEUE_SQLITE_PATH). "memory" is only the
+default in dev and tests: its queued jobs die with the process, so anywhere else the queue has to be
+chosen explicitly.
+"""
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+from bisect import bisect_left
+from typing import Any, Callable, Dict, List, Optional
+from uuid import uuid4
+
+ENV = os.getenv("ENV", "dev")
+JOB_QUEUE = os.getenv("JOB_QUEUE", "memory" if ENV in ("dev", "test") else "")
+JOB_QUEUE_SQLITE_PATH = os.getenv("JOB_QUEUE_SQLITE_PATH", "jobs.sqlite3")
+JOB_QUEUE_MAX_DELIVERIES = int(os.getenv("JOB_QUEUE_MAX_DELIVERIES", "5"))
+
+
+class LeaseLost(Exception):
+    """The lease expired (or was already settled) and the message may be with another worker."""
+
+
+class Lease:
+    __slots__ = ("message_id", "body", "delivery_count", "token", "locked_until")
+
+    def __init__(self, message_id: str, body: Dict[str, Any], delivery_count: int, token: str, locked_until: float):
+        self.message_id = message_id
+        self.body = body
+        self.delivery_count = delivery_count
+        self.token = token
+        self.locked_until = locked_until
+
+
+class JobQueue:
+    async def send(self, body: Dict[str, Any], delay: float = 0.0) -> str:
+        raise NotImplementedError
+
+    async def receive(self, max_messages: int = 1, visibility_timeout: float = 60.0) -> List[Lease]:
+        raise NotImplementedError
+
+    async def renew(self, lease: Lease, visibility_timeout: float = 60.0):
+        raise NotImplementedError
+
+    async def complete(self, lease: Lease):
+        raise NotImplementedError
+
+    async def abandon(self, lease: Lease, delay: float = 0.0):
+        raise NotImplementedError
+
+    async def dead_letter(self, lease: Lease, reason: str):
+        raise NotImplementedError
+
+    async def position(self, message_id: str) -> Optional[int]:
+        """Messages ahead of this one (0 = next up); None once it is gone. Approximate by design."""
+        raise NotImplementedError
+
+    async def depth(self) -> int:
+        raise NotImplementedError
+
+    async def dead_letters(self) -> List[Dict[str, Any]]:
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+class InMemoryJobQueue(JobQueue):
+    def __init__(self, max_deliveries: int = JOB_QUEUE_MAX_DELIVERIES, clock=time.monotonic):
+        self.max_deliveries = max_deliveries
+        self._clock = clock
+        self._seq = 0
+        # message_id -> record; _order holds the seqs still in the queue, ascending, for position()
+        self._messages: Dict[str, Dict[str, Any]] = {}
+        self._order: List[int] = []
+        self._dead: List[Dict[str, Any]] = []
+        self._lock = threading.Lock()
+
+    def _remove(self, rec: Dict[str, Any]):
+        self._messages.pop(rec["id"], None)
+        i = bisect_left(self._order, rec["seq"])
+        if i < len(self._order) and self._order[i] == rec["seq"]:
+            del self._order[i]
+
+    def _leased(self, lease: Lease) -> Dict[str, Any]:
+        rec = self._messages.get(lease.message_id)
+        if rec is None or rec["token"] != lease.token or rec["visible_at"] < self._clock():
+            raise LeaseLost(lease.message_id)
+        return rec
+
+    async def send(self, body: Dict[str, Any], delay: float = 0.0) -> str:
+        with self._lock:
+            self._seq += 1
+            message_id = uuid4().hex
+            self._messages[message_id] = {"id": message_id, "seq": self._seq, "body": body, "deliveries": 0,
+                                          "token": None, "visible_at": self._clock() + delay}
+            self._order.append(self._seq)
+        return message_id
+
+    async def receive(self, max_messages: int = 1, visibility_timeout: float = 60.0) -> List[Lease]:
+        out: List[Lease] = []
+        with self._lock:
+            now = self._clock()
+            dead = []
+            # dicts keep insertion order, which is seq order
+            for rec in self._messages.values():
+                if len(out) >= max_messages:
+                    break
+                if rec["visible_at"] > now:
+                    continue
+                if rec["deliveries"] >= self.max_deliveries:
+                    dead.append(rec)
+                    continue
+                rec["deliveries"] += 1
+                rec["token"] = uuid4().hex
+                rec["visible_at"] = now + visibility_timeout
+                out.append(Lease(rec["id"], rec["body"], rec["deliveries"], rec["token"], rec["visible_at"]))
+            for rec in dead:
+                self._remove(rec)
+                self._dead.append({"id": rec["id"], "body": rec["body"], "reason": "max deliveries exceeded"})
+        return out
+
+    async def renew(self, lease: Lease, visibility_timeout: float = 60.0):
+        with self._lock:
+            rec = self._leased(lease)
+            rec["visible_at"] = lease.locked_until = self._clock() + visibility_timeout
+
+    async def complete(self, lease: Lease):
+        with self._lock:
+            self._remove(self._leased(lease))
+
+    async def abandon(self, lease: Lease, delay: float = 0.0):
+        with self._lock:
+            rec = self._leased(lease)
+            rec["token"] = None
+            rec["visible_at"] = self._clock() + delay
+
+    async def dead_letter(self, lease: Lease, reason: str):
+        with self._lock:
+            rec = self._leased(lease)
+            self._remove(rec)
+            self._dead.append({"id": rec["id"], "body": rec["body"], "reason": reason})
+
+    async def position(self, message_id: str) -> Optional[int]:
+        with self._lock:
+            rec = self._messages.get(message_id)
+            if rec is None:
+                return None
+            return bisect_left(self._order, rec["seq"])
+
+    async def depth(self) -> int:
+        return len(self._messages)
+
+    async def dead_letters(self) -> List[Dict[str, Any]]:
+        with self._lock:
+            return list(self._dead)
+
+
+class SqliteJobQueue(JobQueue):
+    """Same semantics on a SQLite file; calls run in a thread so the event loop never waits on disk."""
+
+    _SCHEMA = """
+        CREATE TABLE IF NOT EXISTS messages (
+            seq INTEGER PRIMARY KEY AUTOINCREMENT,
+            id TEXT UNIQUE NOT NULL,
+            body TEXT NOT NULL,
+            deliveries INTEGER NOT NULL DEFAULT 0,
+            token TEXT,
+            visible_at REAL NOT NULL,
+            dead_reason TEXT
+        );
+        CREATE INDEX IF NOT EXISTS messages_ready ON messages (dead_reason, visible_at, seq);
+    """
+
+    def __init__(self, path: str = JOB_QUEUE_SQLITE_PATH, max_deliveries: int = JOB_QUEUE_MAX_DELIVERIES,
+                 clock=time.time):
+        # wall clock: visibility deadlines have to mean the same thing to every process on the file
+        self.max_deliveries = max_deliveries
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(self._SCHEMA)
+
+    async def _run(self, fn: Callable[[], Any]) -> Any:
+        def locked():
+            with self._lock:
+                return fn()
+        return await asyncio.to_thread(locked)
+
+    def _tx(self, fn: Callable[[sqlite3.Connection], Any]) -> Any:
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            out = fn(self._db)
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+        self._db.execute("COMMIT")
+        return out
+
+    def _check(self, db: sqlite3.Connection, lease: Lease):
+        row = db.execute("SELECT token, visible_at FROM messages WHERE id=? AND dead_reason IS NULL",
+                         (lease.message_id,)).fetchone()
+        if row is None or row[0] != lease.token or row[1] < self._clock():
+            raise LeaseLost(lease.message_id)
+
+    async def send(self, body: Dict[str, Any], delay: float = 0.0) -> str:
+        message_id = uuid4().hex
+        payload = json.dumps(body, separators=(",", ":"))
+        await self._run(lambda: self._db.execute(
+            "INSERT INTO messages (id, body, visible_at) VALUES (?, ?, ?)", (message_id, payload, self._clock() + delay)))
+        return message_id
+
+    async def receive(self, max_messages: int = 1, visibility_timeout: float = 60.0) -> List[Lease]:
+        def fn(db):
+            now = self._clock()
+            out = []
+            rows = db.execute("SELECT id, body, deliveries FROM messages WHERE dead_reason IS NULL AND visible_at <= ? "
+                              "ORDER BY seq LIMIT ?", (now, max_messages * 2)).fetchall()
+            for message_id, body, deliveries in rows:
+                if len(out) >= max_messages:
+                    break
+                if deliveries >= self.max_deliveries:
+                    db.execute("UPDATE messages SET dead_reason='max deliveries exceeded', token=NULL WHERE id=?",
+                               (message_id,))
+                    continue
+                token = uuid4().hex
+                until = now + visibility_timeout
+                db.execute("UPDATE messages SET deliveries=deliveries+1, token=?, visible_at=? WHERE id=?",
+                           (token, until, message_id))
+                out.append(Lease(message_id, json.loads(body), deliveries + 1, token, until))
+            return out
+        return await self._run(lambda: self._tx(fn))
+
+    async def renew(self, lease: Lease, visibility_timeout: float = 60.0):
+        def fn(db):
+            self._check(db, lease)
+            lease.locked_until = self._clock() + visibility_timeout
+            db.execute("UPDATE messages SET visible_at=? WHERE id=?", (lease.locked_until, lease.message_id))
+        await self._run(lambda: self._tx(fn))
+
+    async def complete(self, lease: Lease):
+        def fn(db):
+            self._check(db, lease)
+            db.execute("DELETE FROM messages WHERE id=?", (lease.message_id,))
+        await self._run(lambda: self._tx(fn))
+
+    async def abandon(self, lease: Lease, delay: float = 0.0):
+        def fn(db):
+            self._check(db, lease)
+            db.execute("UPDATE messages SET token=NULL, visible_at=? WHERE id=?", (self._clock() + delay, lease.message_id))
+        await self._run(lambda: self._tx(fn))
+
+    async def dead_letter(self, lease: Lease, reason: str):
+        def fn(db):
+            self._check(db, lease)
+            db.execute("UPDATE messages SET dead_reason=?, token=NULL WHERE id=?", (reason, lease.message_id))
+        await self._run(lambda: self._tx(fn))
+
+    async def position(self, message_id: str) -> Optional[int]:
+        def fn():
+            row = self._db.execute(
+                "SELECT COUNT(*) FROM messages WHERE dead_reason IS NULL AND seq < "
+                "(SELECT seq FROM messages WHERE id=? AND dead_reason IS NULL)", (message_id,)).fetchone()
+            exists = self._db.execute("SELECT 1 FROM messages WHERE id=? AND dead_reason IS NULL", (message_id,)).fetchone()
+            return row[0] if exists else None
+        return await self._run(fn)
+
+    async def depth(self) -> int:
+        return await self._run(lambda: self._db.execute(
+            "SELECT COUNT(*) FROM messages WHERE dead_reason IS NULL").fetchone()[0])
+
+    async def dead_letters(self) -> List[Dict[str, Any]]:
+        rows = await self._run(lambda: self._db.execute(
+            "SELECT id, body, dead_reason FROM messages WHERE dead_reason IS NOT NULL ORDER BY seq").fetchall())
+        return [{"id": r[0], "body": json.loads(r[1]), "reason": r[2]} for r in rows]
+
+    async def close(self):
+        await self._run(self._db.close)
+
+
+JOB_QUEUES: Dict[str, Callable[[], JobQueue]] = {"memory": InMemoryJobQueue, "sqlite": SqliteJobQueue}
+
+
+def get_job_queue(name: Optional[str] = None) -> JobQueue:
+    if not (name or JOB_QUEUE):
+        raise ValueError("JOB_QUEUE not set")
+    factory = JOB_QUEUES.get(name or JOB_QUEUE)
+    if factory is None:
+        raise ValueError(f"unknown JOB_QUEUE {name or JOB_QUEUE!r}")
+    return factory()
@@ -1,6 +1,13 @@
-from typing import Optional, List, Dict, Any
+from typing import Optional, List, Dict, Any, Tuple
 from uuid import uuid4
 from datetime import datetime
+import base64
+
+from .retry import RetryPolicy, ConflictStats, run_with_retry, arun_with_retry, is_conflict, has_status
+from .balance_cache import BalanceCache
+from .event_bus import EventBus, balance_event
+from .metrics import timed_container
+from .idempotency import IdempotencyCache, IdempotencyKeyReused, IdempotencyRace, build_record, idem_id, replay
 
 try:
     from azure.cosmos import CosmosClient, exceptions
@@ -18,16 +25,48 @@ class BatchFailedError(Exception):
     pass
 
 
+class ConcurrencyConflict(BatchFailedError):
+    """The balance doc changed between read and batch commit (etag mismatch) and retries ran out."""
+    pass
+
+
 def now_iso() -> str:
     return datetime.utcnow().isoformat() + "Z"
 
 
-class LedgerService:
-    def __init__(self, container, db_name: Optional[str] = None):
-        """
-        container: azure.cosmos.ContainerProxy (or a compatible mocked object)
-        """
-        self.container = container
+# fields returned by the ledger listing; everything else on the event doc stays server-side
+LEDGER_EVENT_FIELDS = ("id", "change", "balance_after", "event_type", "reference_id", "idempotency_key", "created_at")
+MAX_LEDGER_PAGE = 200
+
+
+def encode_cursor(continuation: Optional[str]) -> Optional[str]:
+    """Wrap a Cosmos continuation token into an opaque, URL-safe cursor."""
+    if not continuation:
+        return None
+    return base64.urlsafe_b64encode(continuation.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: Optional[str]) -> Optional[str]:
+    if not cursor:
+        return None
+    try:
+        return base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)).decode()
+    except Exception:
+        raise ValueError("invalid cursor")
+
+
+# A batch operation in the shape accepted by ContainerProxy.execute_item_batch:
+# ("create", (body,), {}), ("replace", (item_id, body), {"if_match_etag": etag}) or ("delete", (item_id,), {})
+BatchOp = Tuple[str, tuple, Dict[str, Any]]
+
+
+class _LedgerDocs:
+    """Document/batch builders shared by the sync and async ledger services.
+
+    The builders are pure: they take the docs already read from the partition and return the batch
+    operations to commit plus the result to hand back to the caller, so both services keep identical
+    reserve/finalize/cancel semantics and only differ in how they talk to Cosmos.
+    """
 
     def _balance_id(self, user_id: str) -> str:
         return f"balance:{user_id}"
@@ -38,33 +77,34 @@ class LedgerService:
     def _evt_id(self) -> str:
         return f"evt:{uuid4().hex}"
 
-    def get_balance_doc(self, user_id: str) -> Dict[str, Any]:
-        balance_id = self._balance_id(user_id)
-        try:
-            return self.container.read_item(item=balance_id, partition_key=user_id)
-        except Exception as e:
-            # bubble original for visibility in integration tests
-            raise
-
-    def get_balance(self, user_id: str) -> int:
-        doc = self.get_balance_doc(user_id)
-        return int(doc.get("balance", 0))
-
-    def list_ledger_events(self, user_id: str, limit: int = 50) -> List[Dict[str, Any]]:
-        # simple query by partition
-        query = "SELECT * FROM c WHERE c.user_id=@uid AND c.docType='ledger_event' ORDER BY c.created_at DESC"
+    def _list_query(self, user_id: str):
+        fields = ", ".join(f"c.{f}" for f in LEDGER_EVENT_FIELDS)
+        query = f"SELECT {fields} FROM c WHERE c.user_id=@uid AND c.docType='ledger_event' ORDER BY c.created_at DESC"
         params = [{"name": "@uid", "value": user_id}]
-        items = list(self.container.query_items(query=query, parameters=params, partition_key=user_id, enable_cross_partition_query=False))
-        return items[:limit]
+        return query, params
 
-    def reserve_hold(self, user_id: str, amount: int, idempotency_key: Optional[str] = None) -> Dict[str, Any]:
-        """Place a hold: create ledger_event (negative) + hold doc + update balance in a transactional batch.
-        Returns hold_id and event id and new balance_after.
-        Raises InsufficientFunds if balance < amount.
-        """
+    def _remember_balance(self, user_id: str, ops: List[BatchOp]):
+        # write-through: the committed batch carries the new balance doc; connected clients get it pushed
+        if self.balance_cache is None and self.events is None:
+            return
         balance_id = self._balance_id(user_id)
-        # 1) read balance
-        balance_doc = self.container.read_item(item=balance_id, partition_key=user_id)
+        for op, args, _ in ops:
+            if op == "replace" and args[0] == balance_id:
+                body = args[1]
+                balance = int(body.get("balance", 0))
+                if self.balance_cache is not None:
+                    self.balance_cache.put(user_id, balance, body.get("updated_at"))
+                if self.events is not None:
+                    self.events.publish(balance_event(user_id, balance, body.get("updated_at")))
+
+    def _add_idempotency_record(self, ops: List[BatchOp], user_id: str, idempotency_key: str, amount: int,
+                                out: Dict[str, Any]) -> Dict[str, Any]:
+        # created (not upserted) in the same batch: a concurrent replay makes the whole batch fail with 409
+        record = build_record(user_id, idempotency_key, "reserve_hold", {"amount": int(amount)}, out, now_iso())
+        ops.append(("create", (record,), {}))
+        return record
+
+    def _build_hold(self, user_id: str, balance_doc: Dict[str, Any], amount: int, idempotency_key: Optional[str] = None):
         current_balance = int(balance_doc.get("balance", 0))
         if current_balance < amount:
             raise InsufficientFunds("insufficient balance for hold")
@@ -103,39 +143,16 @@ class LedgerService:
         updated_balance_doc["balance"] = new_balance
         updated_balance_doc["updated_at"] = now_iso()
 
-        # Build transactional batch
-        batch = self.container.create_transactional_batch(partition_key=user_id)
-        batch.create_item(ledger_event)
-        batch.create_item(hold_doc)
-        # use if_match header to protect against concurrent updates if SDK supports
-        try:
-            batch.replace_item(item=balance_id, body=updated_balance_doc, if_match=etag)
-        except TypeError:
-            # older SDKs might not accept if_match param via replace_item; try without it
-            batch.replace_item(item=balance_id, body=updated_balance_doc)
-
-        resp = batch.execute()
-        # SDK returns a BatchResponse-like object; adapt accordingly
-        # If resp is truthy and has status code list we can check success, otherwise rely on exception
-        try:
-            if hasattr(resp, 'is_successful') and not resp.is_successful:
-                raise BatchFailedError("batch execution failed")
-        except AttributeError:
-            # best-effort: if execute didn't raise, assume success
-            pass
-
-        return {"hold_id": hold_id, "event_id": evt_id, "balance_after": new_balance}
-
-    def finalize_hold(self, user_id: str, hold_id: str, actual_cost: int, idempotency_key: Optional[str] = None) -> Dict[str, Any]:
-        """Settle a hold. Compute actual_cost vs hold.amount and either refund or charge the difference.
-        Ensures idempotency if hold already settled.
-        """
-        balance_id = self._balance_id(user_id)
-        hold = self.container.read_item(item=hold_id, partition_key=user_id)
-        if hold.get("status") != "placed":
-            return {"already_settled": True}
+        ops: List[BatchOp] = [
+            ("create", (ledger_event,), {}),
+            ("create", (hold_doc,), {}),
+            # if_match protects against concurrent updates to the balance doc
+            ("replace", (self._balance_id(user_id), updated_balance_doc), {"if_match_etag": etag}),
+        ]
+        return ops, {"hold_id": hold_id, "event_id": evt_id, "balance_after": new_balance}
 
-        balance_doc = self.container.read_item(item=balance_id, partition_key=user_id)
+    def _build_finalize(self, user_id: str, hold: Dict[str, Any], balance_doc: Dict[str, Any], actual_cost: int):
+        hold_id = hold["id"]
         etag = balance_doc.get("_etag")
         hold_amount = int(hold.get("amount", 0))
         delta = int(actual_cost) - hold_amount
@@ -149,6 +166,7 @@ class LedgerService:
                 "docType": "ledger_event",
                 "user_id": user_id,
                 "change": -int(delta),
+                "balance_after": new_balance - delta,
                 "event_type": "debit_settlement",
                 "reference_id": hold_id,
                 "created_at": now_iso(),
@@ -162,6 +180,7 @@ class LedgerService:
                 "docType": "ledger_event",
                 "user_id": user_id,
                 "change": int(refund_amount),
+                "balance_after": new_balance + refund_amount,
                 "event_type": "refund_settlement",
                 "reference_id": hold_id,
                 "created_at": now_iso(),
@@ -177,31 +196,13 @@ class LedgerService:
         updated_balance["balance"] = new_balance
         updated_balance["updated_at"] = now_iso()
 
-        batch = self.container.create_transactional_batch(partition_key=user_id)
-        for ev in events:
-            batch.create_item(ev)
-        batch.replace_item(item=hold_id, body=updated_hold)
-        try:
-            batch.replace_item(item=balance_id, body=updated_balance, if_match=etag)
-        except TypeError:
-            batch.replace_item(item=balance_id, body=updated_balance)
-
-        resp = batch.execute()
-        try:
-            if hasattr(resp, 'is_successful') and not resp.is_successful:
-                raise BatchFailedError("batch execution failed")
-        except AttributeError:
-            pass
-
-        return {"balance_after": new_balance, "events": [e.get("id") for e in events]}
+        ops: List[BatchOp] = [("create", (ev,), {}) for ev in events]
+        ops.append(("replace", (hold_id, updated_hold), {}))
+        ops.append(("replace", (self._balance_id(user_id), updated_balance), {"if_match_etag": etag}))
+        return ops, {"balance_after": new_balance, "events": [e.get("id") for e in events]}
 
-    def cancel_hold(self, user_id: str, hold_id: str, idempotency_key: Optional[str] = None) -> Dict[str, Any]:
-        balance_id = self._balance_id(user_id)
-        hold = self.container.read_item(item=hold_id, partition_key=user_id)
-        if hold.get("status") != "placed":
-            return {"already_settled_or_cancelled": True}
-
-        balance_doc = self.container.read_item(item=balance_id, partition_key=user_id)
+    def _build_cancel(self, user_id: str, hold: Dict[str, Any], balance_doc: Dict[str, Any]):
+        hold_id = hold["id"]
         etag = balance_doc.get("_etag")
         hold_amount = int(hold.get("amount", 0))
 
@@ -211,6 +212,7 @@ class LedgerService:
             "docType": "ledger_event",
             "user_id": user_id,
             "change": int(hold_amount),
+            "balance_after": int(balance_doc.get("balance", 0)) + hold_amount,
             "event_type": "refund_hold_cancel",
             "reference_id": hold_id,
             "created_at": now_iso(),
@@ -224,19 +226,331 @@ class LedgerService:
         updated_balance["balance"] = int(balance_doc.get("balance", 0)) + hold_amount
         updated_balance["updated_at"] = now_iso()
 
-        batch = self.container.create_transactional_batch(partition_key=user_id)
-        batch.create_item(refund_ev)
-        batch.replace_item(item=hold_id, body=updated_hold)
+        ops: List[BatchOp] = [
+            ("create", (refund_ev,), {}),
+            ("replace", (hold_id, updated_hold), {}),
+            ("replace", (self._balance_id(user_id), updated_balance), {"if_match_etag": etag}),
+        ]
+        return ops, {"refunded": hold_amount, "balance_after": updated_balance["balance"]}
+
+
+class LedgerService(_LedgerDocs):
+    def __init__(self, container, db_name: Optional[str] = None, retry_policy: Optional[RetryPolicy] = None,
+                 conflict_stats: Optional[ConflictStats] = None, idempotency_cache: Optional[IdempotencyCache] = None,
+                 balance_cache: Optional[BalanceCache] = None, events: Optional[EventBus] = None):
+        """
+        container: azure.cosmos.ContainerProxy (or a compatible mocked object)
+        retry_policy: budget/backoff for re-running a batch that lost an etag race
+        conflict_stats: per-user conflict counters (shared between services if passed in)
+        idempotency_cache: in-process LRU in front of the per-partition idempotency records
+        balance_cache: optional read cache for get_balance, written through on every committed batch
+        events: optional event bus; every committed balance change is published as balance.updated
+        """
+        # every Cosmos call is timed and its RU charge recorded (see metrics)
+        self.container = timed_container(container, "ledger")
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.conflict_stats = conflict_stats or ConflictStats()
+        self.idempotency_cache = idempotency_cache or IdempotencyCache()
+        self.balance_cache = balance_cache
+        self.events = events
+
+    def get_balance_doc(self, user_id: str) -> Dict[str, Any]:
+        balance_id = self._balance_id(user_id)
         try:
-            batch.replace_item(item=balance_id, body=updated_balance, if_match=etag)
-        except TypeError:
-            batch.replace_item(item=balance_id, body=updated_balance)
+            return self.container.read_item(item=balance_id, partition_key=user_id)
+        except Exception as e:
+            # bubble original for visibility in integration tests
+            raise
+
+    def get_balance(self, user_id: str) -> int:
+        if self.balance_cache is not None:
+            cached = self.balance_cache.get(user_id)
+            if cached is not None:
+                return cached
+        doc = self.get_balance_doc(user_id)
+        balance = int(doc.get("balance", 0))
+        if self.balance_cache is not None:
+            self.balance_cache.put(user_id, balance, doc.get("updated_at"))
+        return balance
+
+    def list_ledger_events(self, user_id: str, limit: int = 50) -> List[Dict[str, Any]]:
+        return self.list_ledger_events_page(user_id, limit=limit)["items"]
+
+    def list_ledger_events_page(self, user_id: str, limit: int = 50, cursor: Optional[str] = None) -> Dict[str, Any]:
+        """One page of the user's events, newest first. next_cursor is None on the last page."""
+        # the page size is pushed to the server (max_item_count) so only one page is read per call
+        limit = max(1, min(int(limit), MAX_LEDGER_PAGE))
+        query, params = self._list_query(user_id)
+        pager = self.container.query_items(query=query, parameters=params, partition_key=user_id,
+                                           enable_cross_partition_query=False, max_item_count=limit).by_page(decode_cursor(cursor))
+        items = list(next(pager, []))[:limit]
+        return {"items": items, "next_cursor": encode_cursor(pager.continuation_token)}
+
+    def iter_ledger_events(self, user_id: str, page_size: int = MAX_LEDGER_PAGE):
+        """Yield the user's full event history page by page without holding it in memory."""
+        cursor = None
+        while True:
+            page = self.list_ledger_events_page(user_id, limit=page_size, cursor=cursor)
+            yield from page["items"]
+            cursor = page["next_cursor"]
+            if not cursor:
+                return
+
+    def _execute_batch(self, user_id: str, ops: List[BatchOp]):
+        batch = self.container.create_transactional_batch(partition_key=user_id)
+        for op, args, kwargs in ops:
+            if op == "create":
+                batch.create_item(*args)
+            elif op == "replace":
+                item_id, body = args
+                etag = kwargs.get("if_match_etag")
+                if etag is None:
+                    batch.replace_item(item=item_id, body=body)
+                    continue
+                try:
+                    batch.replace_item(item=item_id, body=body, if_match=etag)
+                except TypeError:
+                    # older SDKs might not accept if_match param via replace_item; try without it
+                    batch.replace_item(item=item_id, body=body)
+            elif op == "delete":
+                batch.delete_item(item=args[0])
+            else:
+                raise ValueError(f"unsupported batch op {op}")
 
-        resp = batch.execute()
+        try:
+            resp = batch.execute()
+        except Exception as e:
+            if is_conflict(e):
+                raise ConcurrencyConflict("balance changed during batch") from e
+            if has_status(e, 409):
+                raise IdempotencyRace("idempotency record already exists") from e
+            raise
+        # SDK returns a BatchResponse-like object; adapt accordingly
+        # If resp is truthy and has status code list we can check success, otherwise rely on exception
         try:
             if hasattr(resp, 'is_successful') and not resp.is_successful:
+                if is_conflict(resp):
+                    raise ConcurrencyConflict("balance changed during batch")
+                if has_status(resp, 409):
+                    raise IdempotencyRace("idempotency record already exists")
                 raise BatchFailedError("batch execution failed")
         except AttributeError:
+            # best-effort: if execute didn't raise, assume success
             pass
+        self._remember_balance(user_id, ops)
+        return resp
+
+    def _with_retry(self, user_id: str, attempt):
+        return run_with_retry(attempt, user_id, self.retry_policy, self.conflict_stats, ConcurrencyConflict)
+
+    def _lookup_idempotency(self, user_id: str, idempotency_key: str) -> Optional[Dict[str, Any]]:
+        record = self.idempotency_cache.get(user_id, idempotency_key)
+        if record is not None:
+            return record
+        try:
+            record = self.container.read_item(item=idem_id(idempotency_key), partition_key=user_id)
+        except Exception as e:
+            if has_status(e, 404):
+                return None
+            raise
+        self.idempotency_cache.put(record)
+        return record
+
+    def reserve_hold(self, user_id: str, amount: int, idempotency_key: Optional[str] = None) -> Dict[str, Any]:
+        """Place a hold: create ledger_event (negative) + hold doc + update balance in a transactional batch.
+        Returns hold_id and event id and new balance_after.
+        Raises InsufficientFunds if balance < amount.
+        A lost etag race re-reads the balance and rebuilds the batch (see retry_policy).
+        A replayed idempotency_key returns the original result without a new batch.
+        """
+        request = {"amount": int(amount)}
+        if idempotency_key:
+            record = self._lookup_idempotency(user_id, idempotency_key)
+            if record is not None:
+                return replay(record, "reserve_hold", request)
+
+        def attempt():
+            balance_doc = self.container.read_item(item=self._balance_id(user_id), partition_key=user_id)
+            ops, out = self._build_hold(user_id, balance_doc, amount, idempotency_key)
+            record = self._add_idempotency_record(ops, user_id, idempotency_key, amount, out) if idempotency_key else None
+            self._execute_batch(user_id, ops)
+            if record is not None:
+                self.idempotency_cache.put(record)
+            return out
+
+        try:
+            return self._with_retry(user_id, attempt)
+        except IdempotencyRace:
+            # a concurrent request with the same key committed first; hand back its result
+            record = self._lookup_idempotency(user_id, idempotency_key)
+            if record is None:
+                raise BatchFailedError("batch execution failed")
+            return replay(record, "reserve_hold", request)
+
+    def finalize_hold(self, user_id: str, hold_id: str, actual_cost: int, idempotency_key: Optional[str] = None) -> Dict[str, Any]:
+        """Settle a hold. Compute actual_cost vs hold.amount and either refund or charge the difference.
+        Ensures idempotency if hold already settled.
+        """
+        def attempt():
+            # re-read the hold on every attempt: a concurrent settle may have won the race
+            hold = self.container.read_item(item=hold_id, partition_key=user_id)
+            if hold.get("status") != "placed":
+                return {"already_settled": True}
+
+            balance_doc = self.container.read_item(item=self._balance_id(user_id), partition_key=user_id)
+            ops, out = self._build_finalize(user_id, hold, balance_doc, actual_cost)
+            self._execute_batch(user_id, ops)
+            return out
+
+        return self._with_retry(user_id, attempt)
+
+    def cancel_hold(self, user_id: str, hold_id: str, idempotency_key: Optional[str] = None) -> Dict[str, Any]:
+        def attempt():
+            hold = self.container.read_item(item=hold_id, partition_key=user_id)
+            if hold.get("status") != "placed":
+                return {"already_settled_or_cancelled": True}
+
+            balance_doc = self.container.read_item(item=self._balance_id(user_id), partition_key=user_id)
+            ops, out = self._build_cancel(user_id, hold, balance_doc)
+            self._execute_batch(user_id, ops)
+            return out
+
+        return self._with_retry(user_id, attempt)
+
+
+class AsyncLedgerService(_LedgerDocs):
+    """Same reserve/finalize/cancel semantics as LedgerService on top of azure.cosmos.aio.
+
+    container: azure.cosmos.aio.ContainerProxy (or a compatible object with awaitable read_item /
+    execute_item_batch and an async-iterable query_items).
+    """
+
+    def __init__(self, container, retry_policy: Optional[RetryPolicy] = None,
+                 conflict_stats: Optional[ConflictStats] = None, idempotency_cache: Optional[IdempotencyCache] = None,
+                 balance_cache: Optional[BalanceCache] = None, events: Optional[EventBus] = None):
+        self.container = timed_container(container, "ledger", is_async=True)
+        self.retry_policy = retry_policy or RetryPolicy()
+        self.conflict_stats = conflict_stats or ConflictStats()
+        self.idempotency_cache = idempotency_cache or IdempotencyCache()
+        self.balance_cache = balance_cache
+        self.events = events
+
+    async def get_balance_doc(self, user_id: str) -> Dict[str, Any]:
+        return await self.container.read_item(item=self._balance_id(user_id), partition_key=user_id)
+
+    async def get_balance(self, user_id: str) -> int:
+        if self.balance_cache is not None:
+            cached = self.balance_cache.get(user_id)
+            if cached is not None:
+                return cached
+        doc = await self.get_balance_doc(user_id)
+        balance = int(doc.get("balance", 0))
+        if self.balance_cache is not None:
+            self.balance_cache.put(user_id, balance, doc.get("updated_at"))
+        return balance
+
+    async def list_ledger_events(self, user_id: str, limit: int = 50) -> List[Dict[str, Any]]:
+        return (await self.list_ledger_events_page(user_id, limit=limit))["items"]
+
+    async def list_ledger_events_page(self, user_id: str, limit: int = 50, cursor: Optional[str] = None) -> Dict[str, Any]:
+        limit = max(1, min(int(limit), MAX_LEDGER_PAGE))
+        query, params = self._list_query(user_id)
+        pager = self.container.query_items(query=query, parameters=params, partition_key=user_id,
+                                           max_item_count=limit).by_page(decode_cursor(cursor))
+        items: List[Dict[str, Any]] = []
+        async for page in pager:
+            async for item in page:
+                items.append(item)
+            break
+        return {"items": items[:limit], "next_cursor": encode_cursor(pager.continuation_token)}
+
+    async def iter_ledger_events(self, user_id: str, page_size: int = MAX_LEDGER_PAGE):
+        cursor = None
+        while True:
+            page = await self.list_ledger_events_page(user_id, limit=page_size, cursor=cursor)
+            for item in page["items"]:
+                yield item
+            cursor = page["next_cursor"]
+            if not cursor:
+                return
+
+    async def _execute_batch(self, user_id: str, ops: List[BatchOp]):
+        try:
+            resp = await self.container.execute_item_batch(batch_operations=ops, partition_key=user_id)
+        except Exception as e:
+            # CosmosBatchOperationError / CosmosAccessConditionFailedError: surface as a ledger error
+            if is_conflict(e):
+                raise ConcurrencyConflict("balance changed during batch") from e
+            if has_status(e, 409):
+                raise IdempotencyRace("idempotency record already exists") from e
+            if exceptions is not None and isinstance(e, exceptions.CosmosHttpResponseError):
+                raise BatchFailedError(f"batch execution failed: {e}") from e
+            raise
+        self._remember_balance(user_id, ops)
+        return resp
+
+    async def _with_retry(self, user_id: str, attempt):
+        return await arun_with_retry(attempt, user_id, self.retry_policy, self.conflict_stats, ConcurrencyConflict)
+
+    async def _lookup_idempotency(self, user_id: str, idempotency_key: str) -> Optional[Dict[str, Any]]:
+        record = self.idempotency_cache.get(user_id, idempotency_key)
+        if record is not None:
+            return record
+        try:
+            record = await self.container.read_item(item=idem_id(idempotency_key), partition_key=user_id)
+        except Exception as e:
+            if has_status(e, 404):
+                return None
+            raise
+        self.idempotency_cache.put(record)
+        return record
+
+    async def reserve_hold(self, user_id: str, amount: int, idempotency_key: Optional[str] = None) -> Dict[str, Any]:
+        request = {"amount": int(amount)}
+        if idempotency_key:
+            record = await self._lookup_idempotency(user_id, idempotency_key)
+            if record is not None:
+                return replay(record, "reserve_hold", request)
+
+        async def attempt():
+            balance_doc = await self.get_balance_doc(user_id)
+            ops, out = self._build_hold(user_id, balance_doc, amount, idempotency_key)
+            record = self._add_idempotency_record(ops, user_id, idempotency_key, amount, out) if idempotency_key else None
+            await self._execute_batch(user_id, ops)
+            if record is not None:
+                self.idempotency_cache.put(record)
+            return out
+
+        try:
+            return await self._with_retry(user_id, attempt)
+        except IdempotencyRace:
+            record = await self._lookup_idempotency(user_id, idempotency_key)
+            if record is None:
+                raise BatchFailedError("batch execution failed")
+            return replay(record, "reserve_hold", request)
+
+    async def finalize_hold(self, user_id: str, hold_id: str, actual_cost: int, idempotency_key: Optional[str] = None) -> Dict[str, Any]:
+        async def attempt():
+            hold = await self.container.read_item(item=hold_id, partition_key=user_id)
+            if hold.get("status") != "placed":
+                return {"already_settled": True}
+
+            balance_doc = await self.get_balance_doc(user_id)
+            ops, out = self._build_finalize(user_id, hold, balance_doc, actual_cost)
+            await self._execute_batch(user_id, ops)
+            return out
+
+        return await self._with_retry(user_id, attempt)
+
+    async def cancel_hold(self, user_id: str, hold_id: str, idempotency_key: Optional[str] = None) -> Dict[str, Any]:
+        async def attempt():
+            hold = await self.container.read_item(item=hold_id, partition_key=user_id)
+            if hold.get("status") != "placed":
+                return {"already_settled_or_cancelled": True}
+
+            balance_doc = await self.get_balance_doc(user_id)
+            ops, out = self._build_cancel(user_id, hold, balance_doc)
+            await self._execute_batch(user_id, ops)
+            return out
 
-        return {"refunded": hold_amount, "balance_after": updated_balance["balance"]}
+        return await self._with_retry(user_id, attempt)
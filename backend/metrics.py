@@ -0,0 +1,501 @@
+"""Prometheus metrics, Cosmos call timers and per-request profiling.
+
+REGISTRY holds counters, gauges and histograms (label values are tuples, in labelnames order) plus
+collectors: callables, sync or async, that turn the snapshot() of an existing component into gauges
+at scrape time, so components keep their own counters and pay nothing extra per call.
+GET /metrics renders everything in the Prometheus text format (0.0.4).
+
+MetricsMiddleware times every HTTP request into http_request_duration_seconds{method,route,status},
+where route is the route template ("/api/v1/generate/{job_id}") so ids never become labels, and keeps
+http_requests_in_flight{route}.
+
+TimedContainer / AsyncTimedContainer wrap a Cosmos ContainerProxy: every point operation and batch is
+timed into cosmos_request_duration_seconds{component,op} and counted by status code, and its RU charge
+(x-ms-request-charge, read through response_hook) is added to cosmos_request_units_total. Queries are
+lazy pagers, so they are counted and charged per fetched page from the hook instead of being timed.
+
+LatencyStats is the in-process side that those snapshots are built from: named counters plus bounded
+windows of recent samples, reported as counts and p50/p95 per window.
+
+Profiling: a request carrying "X-Profile: <METRICS_PROFILE_TOKEN>" collects every span() on its path
+(Cosmos calls included) and gets them back in a Server-Timing header; other requests pay one
+ContextVar lookup per span.
+"""
+import asyncio
+import contextvars
+import logging
+import os
+import re
+import time
+from bisect import bisect_left
+from collections import deque
+from contextlib import contextmanager
+from typing import Any, Callable, Deque, Dict, Iterable, List, Optional, Sequence, Tuple
+
+try:
+    from starlette.routing import Match
+except Exception:
+    Match = None
+
+log = logging.getLogger(__name__)
+
+METRICS_ENABLED = os.getenv("METRICS_ENABLED", "1") == "1"
+# unset: profiling is off
+METRICS_PROFILE_TOKEN = os.getenv("METRICS_PROFILE_TOKEN", "")
+METRICS_PROFILE_HEADER = os.getenv("METRICS_PROFILE_HEADER", "x-profile")
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+Labels = Tuple[str, ...]
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _labels(names: Sequence[str], values: Sequence[Any], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(str(v))}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _num(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.labelnames = tuple(labelnames)
+
+    def header(self) -> List[str]:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = ()):
+        super().__init__(name, help, labelnames)
+        self.values: Dict[Labels, float] = {}
+
+    def inc(self, labels: Labels = (), amount: float = 1.0):
+        self.values[labels] = self.values.get(labels, 0.0) + amount
+
+    def render(self) -> List[str]:
+        return self.header() + [f"{self.name}{_labels(self.labelnames, k)} {_num(v)}" for k, v in self.values.items()]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, labels: Labels = (), amount: float = 1.0):
+        self.values[labels] = self.values.get(labels, 0.0) - amount
+
+    def set(self, labels: Labels, value: float):
+        self.values[labels] = value
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help: str, labelnames: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, help, labelnames)
+        self.buckets = tuple(sorted(buckets))
+        # labels -> [per-bucket counts (last = +Inf), sum, count]; cumulated only when rendering
+        self.values: Dict[Labels, list] = {}
+
+    def observe(self, value: float, labels: Labels = ()):
+        row = self.values.get(labels)
+        if row is None:
+            row = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        row[0][bisect_left(self.buckets, value)] += 1
+        row[1] += value
+        row[2] += 1
+
+    def render(self) -> List[str]:
+        out = self.header()
+        for labels, (counts, total, count) in self.values.items():
+            running = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts):
+                running += n
+                le = 'le="' + _num(bound) + '"'
+                out.append(f"{self.name}_bucket{_labels(self.labelnames, labels, le)} {running}")
+            out.append(f"{self.name}_sum{_labels(self.labelnames, labels)} {_num(total)}")
+            out.append(f"{self.name}_count{_labels(self.labelnames, labels)} {count}")
+        return out
+
+
+def percentile(samples, pct: float) -> float:
+    if not samples:
+        return 0.0
+    ordered = sorted(samples)
+    return ordered[min(len(ordered) - 1, int(pct / 100.0 * len(ordered)))]
+
+
+class LatencyStats:
+    """Counters plus the most recent samples of each window; snapshot() adds <window>_p50/_p95."""
+
+    def __init__(self, counts: Sequence[str], windows: Sequence[str], samples: int = 2048):
+        self.counts: Dict[str, int] = {name: 0 for name in counts}
+        self.windows: Dict[str, Deque[float]] = {name: deque(maxlen=samples) for name in windows}
+
+    def observe(self, window: str, value: float):
+        self.windows[window].append(value)
+
+    def snapshot(self) -> Dict[str, Any]:
+        out: Dict[str, Any] = dict(self.counts)
+        for name, samples in self.windows.items():
+            out[f"{name}_p50"] = round(percentile(samples, 50), 2)
+            out[f"{name}_p95"] = round(percentile(samples, 95), 2)
+        return out
+
+
+_INVALID_NAME = re.compile(r"[^a-zA-Z0-9_]")
+
+
+def _flatten(prefix: str, snapshot: Dict[str, Any]) -> Iterable[Tuple[str, float]]:
+    for key, value in snapshot.items():
+        name = _INVALID_NAME.sub("_", f"{prefix}_{key}")
+        if isinstance(value, bool):
+            yield name, int(value)
+        elif isinstance(value, (int, float)):
+            yield name, value
+        elif isinstance(value, dict):
+            yield from _flatten(name, value)
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: Dict[str, _Metric] = {}
+        self._collectors: List[Tuple[str, Callable[[], Any]]] = []
+
+    def _add(self, metric: _Metric) -> Any:
+        existing = self._metrics.get(metric.name)
+        if existing is not None:
+            return existing
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Counter:
+        return self._add(Counter(name, help, labelnames))
+
+    def gauge(self, name: str, help: str, labelnames: Sequence[str] = ()) -> Gauge:
+        return self._add(Gauge(name, help, labelnames))
+
+    def histogram(self, name: str, help: str, labelnames: Sequence[str] = (),
+                  buckets: Sequence[float] = LATENCY_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, help, labelnames, buckets))
+
+    def add_collector(self, prefix: str, snapshot: Callable[[], Any]):
+        """Export the numeric fields of snapshot() (a dict, or an awaitable of one) as <prefix>_<field> gauges."""
+        self._collectors = [(p, fn) for p, fn in self._collectors if p != prefix]
+        self._collectors.append((prefix, snapshot))
+
+    async def render(self) -> str:
+        lines: List[str] = []
+        for metric in self._metrics.values():
+            lines.extend(metric.render())
+        for prefix, snapshot in self._collectors:
+            try:
+                data = snapshot()
+                if asyncio.iscoroutine(data):
+                    data = await data
+            except Exception:
+                log.exception("metrics collector %s failed", prefix)
+                continue
+            for name, value in _flatten(prefix, data or {}):
+                lines.append(f"# TYPE {name} gauge")
+                lines.append(f"{name} {_num(value)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+HTTP_SECONDS = REGISTRY.histogram("http_request_duration_seconds", "HTTP request latency",
+                                  ("method", "route", "status"))
+HTTP_IN_FLIGHT = REGISTRY.gauge("http_requests_in_flight", "HTTP requests being served", ("route",))
+COSMOS_SECONDS = REGISTRY.histogram("cosmos_request_duration_seconds", "Cosmos call latency", ("component", "op"))
+COSMOS_REQUESTS = REGISTRY.counter("cosmos_requests_total", "Cosmos calls by status code",
+                                   ("component", "op", "status"))
+COSMOS_RU = REGISTRY.counter("cosmos_request_units_total", "Cosmos request units charged", ("component", "op"))
+CHAT_FIRST_TOKEN_SECONDS = REGISTRY.histogram("chat_first_token_latency_seconds",
+                                              "Time from chat.send to the first streamed token")
+
+
+# profiling ---------------------------------------------------------------------------------------------
+class Profile:
+    __slots__ = ("spans",)
+
+    def __init__(self):
+        self.spans: Dict[str, List[float]] = {}
+
+    def add(self, name: str, seconds: float):
+        row = self.spans.get(name)
+        if row is None:
+            self.spans[name] = [seconds, 1]
+        else:
+            row[0] += seconds
+            row[1] += 1
+
+    def server_timing(self) -> str:
+        return ", ".join(f'{name};dur={total * 1000.0:.2f};desc="x{int(n)}"'
+                         for name, (total, n) in self.spans.items())
+
+
+_profile: "contextvars.ContextVar[Optional[Profile]]" = contextvars.ContextVar("profile", default=None)
+
+
+def record_span(name: str, seconds: float):
+    profile = _profile.get()
+    if profile is not None:
+        profile.add(name, seconds)
+
+
+@contextmanager
+def span(name: str):
+    """Time a block into the current request's profile (no-op unless the request is profiled)."""
+    profile = _profile.get()
+    if profile is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        profile.add(name, time.perf_counter() - started)
+
+
+# Cosmos ------------------------------------------------------------------------------------------------
+_TIMED_OPS = frozenset(("read_item", "create_item", "upsert_item", "replace_item", "delete_item",
+                        "execute_item_batch", "query_items"))
+
+
+def _status(error: Optional[BaseException]) -> str:
+    if error is None:
+        return "200"
+    return str(getattr(error, "status_code", None) or getattr(error, "status", None) or "error")
+
+
+def _takes_response_hook(container) -> bool:
+    """SDK containers (and the emulator) accept response_hook; other stand-ins are only timed."""
+    module = type(container).__module__
+    return module.startswith("azure.cosmos") or module.endswith("cosmos_emulator")
+
+
+class _Charge:
+    """response_hook that keeps the RU charge, chained in front of any hook the caller passed."""
+
+    __slots__ = ("ru", "inner")
+
+    def __init__(self, inner=None):
+        self.ru = 0.0
+        self.inner = inner
+
+    def __call__(self, headers, result=None):
+        try:
+            self.ru += float((headers or {}).get("x-ms-request-charge") or 0)
+        except (TypeError, ValueError):
+            pass
+        if self.inner is not None:
+            self.inner(headers, result)
+
+
+class _PageCharge:
+    """response_hook for query_items: the SDK calls it once per fetched page, so each page is counted
+    as a request and its RU charged as it arrives (the pager is lazy; nothing is known when it is built)."""
+
+    __slots__ = ("component", "inner")
+
+    def __init__(self, component: str, inner=None):
+        self.component = component
+        self.inner = inner
+
+    def __call__(self, headers, result=None):
+        COSMOS_REQUESTS.inc((self.component, "query_items", "200"))
+        try:
+            ru = float((headers or {}).get("x-ms-request-charge") or 0)
+        except (TypeError, ValueError):
+            ru = 0.0
+        if ru:
+            COSMOS_RU.inc((self.component, "query_items"), ru)
+        if self.inner is not None:
+            self.inner(headers, result)
+
+
+def _record(component: str, op: str, started: float, error: Optional[BaseException], charge: _Charge):
+    elapsed = time.perf_counter() - started
+    COSMOS_REQUESTS.inc((component, op, _status(error)))
+    COSMOS_SECONDS.observe(elapsed, (component, op))
+    record_span(f"cosmos.{op}", elapsed)
+    if charge.ru:
+        COSMOS_RU.inc((component, op), charge.ru)
+
+
+def _timed_query(attr, component: str, hooked: bool):
+    def query_items(*args, **kwargs):
+        if not hooked:
+            # no hook to hear the pages through: count the call itself
+            COSMOS_REQUESTS.inc((component, "query_items", "200"))
+            return attr(*args, **kwargs)
+        kwargs["response_hook"] = _PageCharge(component, kwargs.get("response_hook"))
+        try:
+            return attr(*args, **kwargs)
+        except BaseException as e:
+            COSMOS_REQUESTS.inc((component, "query_items", _status(e)))
+            raise
+    return query_items
+
+
+class TimedContainer:
+    """azure.cosmos ContainerProxy wrapper; anything other than the timed operations passes straight through."""
+
+    def __init__(self, container, component: str):
+        self._container = container
+        self._component = component
+        self._hooked = _takes_response_hook(container)
+
+    def __getattr__(self, name):
+        attr = getattr(self._container, name)
+        if name not in _TIMED_OPS:
+            return attr
+        if name == "query_items":
+            return _timed_query(attr, self._component, self._hooked)
+
+        hooked = self._hooked
+
+        def timed(*args, **kwargs):
+            charge = _Charge(kwargs.get("response_hook"))
+            if hooked:
+                kwargs["response_hook"] = charge
+            started = time.perf_counter()
+            error = None
+            try:
+                return attr(*args, **kwargs)
+            except BaseException as e:
+                error = e
+                raise
+            finally:
+                _record(self._component, name, started, error, charge)
+        return timed
+
+
+class AsyncTimedContainer(TimedContainer):
+    """azure.cosmos.aio counterpart: point operations are awaited, query_items still returns its pager."""
+
+    def __getattr__(self, name):
+        attr = getattr(self._container, name)
+        if name not in _TIMED_OPS:
+            return attr
+        if name == "query_items":
+            return _timed_query(attr, self._component, self._hooked)
+
+        hooked = self._hooked
+
+        async def timed(*args, **kwargs):
+            charge = _Charge(kwargs.get("response_hook"))
+            if hooked:
+                kwargs["response_hook"] = charge
+            started = time.perf_counter()
+            error = None
+            try:
+                return await attr(*args, **kwargs)
+            except BaseException as e:
+                error = e
+                raise
+            finally:
+                _record(self._component, name, started, error, charge)
+        return timed
+
+
+def timed_container(container, component: str, is_async: bool = False):
+    if container is None or not METRICS_ENABLED or isinstance(container, TimedContainer):
+        return container
+    return (AsyncTimedContainer if is_async else TimedContainer)(container, component)
+
+
+# HTTP --------------------------------------------------------------------------------------------------
+class MetricsMiddleware:
+    def __init__(self, app, profile_token: str = METRICS_PROFILE_TOKEN, profile_header: str = METRICS_PROFILE_HEADER):
+        self.app = app
+        self.profile_token = profile_token.encode("latin-1")
+        self.profile_header = profile_header.lower().encode("latin-1")
+        # templates of param-free routes by (method, path); paths with ids are matched every time
+        self._static: Dict[Tuple[str, str], str] = {}
+
+    @staticmethod
+    def _match(routes, scope) -> Optional[str]:
+        for route in routes:
+            inner = getattr(route, "original_router", None)
+            if inner is not None:
+                # FastAPI's included-router entry: look at the routes it wraps
+                found = MetricsMiddleware._match(inner.routes, scope)
+                if found is not None:
+                    return found
+                continue
+            match, _ = route.matches(scope)
+            if match == Match.FULL:
+                return getattr(route, "path", None)
+        return None
+
+    def route_of(self, scope) -> str:
+        """Route template before dispatch (for the in-flight gauge); param-free paths are cached."""
+        key = (scope.get("method", ""), scope.get("path", ""))
+        template = self._static.get(key)
+        if template is not None:
+            return template
+        router = getattr(scope.get("app"), "router", None)
+        if Match is not None and router is not None:
+            template = self._match(router.routes, scope)
+        template = template or "unmatched"
+        if "{" not in template and len(self._static) < 4096:
+            self._static[key] = template
+        return template
+
+    def _profiled(self, scope) -> bool:
+        if not self.profile_token:
+            return False
+        for name, value in scope.get("headers") or ():
+            if name == self.profile_header:
+                return value == self.profile_token
+        return False
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        route = self.route_of(scope)
+        profile = Profile() if self._profiled(scope) else None
+        token = _profile.set(profile) if profile is not None else None
+        status = [500]
+        started = time.perf_counter()
+
+        async def send_wrapper(message):
+            if message["type"] == "http.response.start":
+                status[0] = message["status"]
+                if profile is not None:
+                    profile.add("app", time.perf_counter() - started)
+                    headers = list(message.get("headers") or [])
+                    headers.append((b"server-timing", profile.server_timing().encode("latin-1")))
+                    message = dict(message, headers=headers)
+            await send(message)
+
+        HTTP_IN_FLIGHT.inc((route,))
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            elapsed = time.perf_counter() - started
+            HTTP_IN_FLIGHT.dec((route,))
+            # the router records the route it dispatched to; that is authoritative
+            routed = getattr(scope.get("route"), "path", None) or route
+            HTTP_SECONDS.observe(elapsed, (scope.get("method", ""), routed, str(status[0])))
+            if profile is not None:
+                _profile.reset(token)
+                log.info("profile %s %s %.2fms: %s", scope.get("method"), scope.get("path"), elapsed * 1000.0,
+                         profile.server_timing())
@@ -0,0 +1,54 @@
+"""Chat model backends.
+
+A ModelService streams completion tokens for a prompt. The backend is chosen with MODEL_SERVICE; "fake"
+is a local stand-in with configurable time-to-first-token and inter-token delay for tests and load runs.
+Real backends register themselves in MODEL_SERVICES. There is no default: with MODEL_SERVICE unset chat is
+not configured, so the fake is never billed for by accident.
+"""
+import asyncio
+import os
+from typing import AsyncIterator, Callable, Dict, Optional
+
+MODEL_SERVICE = os.getenv("MODEL_SERVICE", "")
+FAKE_MODEL_FIRST_TOKEN_MS = float(os.getenv("FAKE_MODEL_FIRST_TOKEN_MS", "150"))
+FAKE_MODEL_TOKEN_MS = float(os.getenv("FAKE_MODEL_TOKEN_MS", "20"))
+
+
+class ModelService:
+    name = "base"
+
+    def stream(self, prompt: str, max_tokens: int) -> AsyncIterator[str]:
+        """Async iterator of completion tokens; stops after max_tokens. Closing it aborts generation."""
+        raise NotImplementedError
+
+
+class FakeModelService(ModelService):
+    """Deterministic local model: replies by cycling over the words of the prompt."""
+
+    name = "fake"
+
+    def __init__(self, first_token_ms: float = FAKE_MODEL_FIRST_TOKEN_MS, token_ms: float = FAKE_MODEL_TOKEN_MS,
+                 reply_tokens: int = 40):
+        self.first_token = first_token_ms / 1000.0
+        self.token_delay = token_ms / 1000.0
+        self.reply_tokens = reply_tokens
+
+    async def stream(self, prompt: str, max_tokens: int) -> AsyncIterator[str]:
+        words = prompt.split() or ["..."]
+        await asyncio.sleep(self.first_token)
+        for i in range(min(self.reply_tokens, max_tokens)):
+            if i and self.token_delay:
+                await asyncio.sleep(self.token_delay)
+            yield words[i % len(words)] + " "
+
+
+MODEL_SERVICES: Dict[str, Callable[[], ModelService]] = {"fake": FakeModelService}
+
+
+def get_model_service(name: Optional[str] = None) -> ModelService:
+    if not (name or MODEL_SERVICE):
+        raise ValueError("MODEL_SERVICE not set")
+    factory = MODEL_SERVICES.get(name or MODEL_SERVICE)
+    if factory is None:
+        raise ValueError(f"unknown MODEL_SERVICE {name or MODEL_SERVICE!r}")
+    return factory()
@@ -0,0 +1,118 @@
+"""Bcrypt off the event loop.
+
+Hashes and verifications run in a dedicated, size-limited process pool so a login burst neither ties up
+the request threadpool nor holds the GIL against other endpoints. At most PASSWORD_QUEUE_MAX operations
+may be pending (running or queued); beyond that callers get PasswordHasherBusy, which the auth routes
+turn into 429 + Retry-After.
+"""
+import asyncio
+import math
+import multiprocessing
+import os
+import threading
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor
+from typing import Any, Callable, Dict, Optional, Tuple
+
+from .auth import get_password_hash, verify_password
+from .metrics import LatencyStats
+
+PASSWORD_POOL_WORKERS = int(os.getenv("PASSWORD_POOL_WORKERS", str(max(1, (os.cpu_count() or 2) // 2))))
+PASSWORD_QUEUE_MAX = int(os.getenv("PASSWORD_QUEUE_MAX", str(PASSWORD_POOL_WORKERS * 8)))
+# workers are spawned, not forked: forking a process that runs an event loop and client threads is unsafe
+PASSWORD_POOL_START_METHOD = os.getenv("PASSWORD_POOL_START_METHOD", "spawn")
+_LATENCY_SAMPLES = 1024
+
+
+class PasswordHasherBusy(Exception):
+    def __init__(self, retry_after: int):
+        super().__init__(f"password hashing saturated, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+def _hash_job(password: str) -> Tuple[str, float]:
+    t0 = time.perf_counter()
+    return get_password_hash(password), time.perf_counter() - t0
+
+
+def _verify_job(password: str, hashed: str) -> Tuple[bool, float]:
+    t0 = time.perf_counter()
+    return verify_password(password, hashed), time.perf_counter() - t0
+
+
+class PasswordHasher:
+    def __init__(self, workers: int = PASSWORD_POOL_WORKERS, max_pending: int = PASSWORD_QUEUE_MAX,
+                 executor: Optional[Executor] = None,
+                 hash_job: Callable[[str], Tuple[str, float]] = _hash_job,
+                 verify_job: Callable[[str, str], Tuple[bool, float]] = _verify_job):
+        self.workers = workers
+        self.max_pending = max_pending
+        self._executor = executor
+        self._hash_job = hash_job
+        self._verify_job = verify_job
+        self._lock = threading.Lock()
+        self.pending = 0
+        # ms spent inside bcrypt, and end-to-end (queue wait + bcrypt), most recent samples
+        self.metrics = LatencyStats(("submitted", "completed", "rejected", "failed"), ("hash_ms", "total_ms"),
+                                    samples=_LATENCY_SAMPLES)
+        self.stats = self.metrics.counts
+
+    def _pool(self) -> Executor:
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ProcessPoolExecutor(
+                        max_workers=self.workers, mp_context=multiprocessing.get_context(PASSWORD_POOL_START_METHOD))
+        return self._executor
+
+    def _retry_after(self) -> int:
+        cpu_ms = self.metrics.windows["hash_ms"]
+        per_op = (sum(cpu_ms) / len(cpu_ms) / 1000.0) if cpu_ms else 0.25
+        return max(1, math.ceil(per_op * self.pending / max(1, self.workers)))
+
+    def _admit(self):
+        with self._lock:
+            if self.pending >= self.max_pending:
+                self.stats["rejected"] += 1
+                raise PasswordHasherBusy(self._retry_after())
+            self.pending += 1
+            self.stats["submitted"] += 1
+
+    async def _run(self, job: Callable[..., Tuple[Any, float]], *args) -> Any:
+        self._admit()
+        t0 = time.perf_counter()
+        try:
+            result, cpu = await asyncio.get_running_loop().run_in_executor(self._pool(), job, *args)
+        except Exception:
+            self.stats["failed"] += 1
+            raise
+        finally:
+            with self._lock:
+                self.pending -= 1
+        self.metrics.observe("hash_ms", cpu * 1000.0)
+        self.metrics.observe("total_ms", (time.perf_counter() - t0) * 1000.0)
+        self.stats["completed"] += 1
+        return result
+
+    async def hash(self, password: str) -> str:
+        return await self._run(self._hash_job, password)
+
+    async def verify(self, password: str, hashed: Optional[str]) -> bool:
+        if not hashed:
+            return False
+        return await self._run(self._verify_job, password, hashed)
+
+    def snapshot(self) -> Dict[str, Any]:
+        out = self.metrics.snapshot()
+        out["workers"] = self.workers
+        out["in_flight"] = min(self.pending, self.workers)
+        out["queue_depth"] = max(0, self.pending - self.workers)
+        return out
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+password_hasher = PasswordHasher()
@@ -0,0 +1,216 @@
+"""Gem pricing for chat turns and generations.
+
+Costs come from a price table of models and their tiers (chat models usually have one tier, image
+models one per quality level). Each rule charges gems per 1k input tokens, per 1k output tokens and
+per unit (image), with a minimum charge; a tier multiplier can discount whole user tiers. The table
+is read once at startup from PRICE_TABLE_PATH (JSON, same shape as DEFAULT_PRICE_TABLE).
+
+Tokens are counted with a pluggable tokenizer (TOKENIZER: "approx" needs nothing, "tiktoken" needs the
+tiktoken package). Persona/system prompts repeat on every turn, so their counts go through an LRU.
+"""
+import json
+import math
+import os
+import re
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, List, Optional
+
+try:
+    import tiktoken
+except Exception:
+    tiktoken = None
+
+PRICE_TABLE_PATH = os.getenv("PRICE_TABLE_PATH")
+TOKENIZER = os.getenv("TOKENIZER", "approx")
+TIKTOKEN_ENCODING = os.getenv("TIKTOKEN_ENCODING", "cl100k_base")
+PRICING_CACHE_SIZE = int(os.getenv("PRICING_CACHE_SIZE", "4096"))
+DEFAULT_PRICE_TIER = os.getenv("DEFAULT_PRICE_TIER", "standard")
+
+DEFAULT_PRICE_TABLE: Dict[str, Any] = {
+    "version": "default",
+    "models": {
+        # 20 gems per 1k tokens = one gem per 50 tokens, the old flat chat rate
+        "fake": {"standard": {"input_per_1k": 20, "output_per_1k": 20, "min_charge": 1}},
+        "image": {
+            "fast": {"input_per_1k": 0, "per_unit": 1, "min_charge": 1},
+            "balanced": {"input_per_1k": 0, "per_unit": 2, "min_charge": 1},
+            "high": {"input_per_1k": 0, "per_unit": 4, "min_charge": 1},
+        },
+    },
+    # user tier -> multiplier on the final charge
+    "user_tiers": {"standard": 1.0},
+}
+
+_WORD = re.compile(r"\w+|[^\w\s]", re.UNICODE)
+
+
+class PricingError(Exception):
+    pass
+
+
+class Tokenizer:
+    name = "base"
+
+    def count(self, text: str) -> int:
+        raise NotImplementedError
+
+
+class ApproxTokenizer(Tokenizer):
+    """BPE-shaped estimate without a vocabulary: punctuation is a token, words cost one per ~5 chars."""
+
+    name = "approx"
+
+    def count(self, text: str) -> int:
+        return sum((len(piece) + 4) // 5 for piece in _WORD.findall(text))
+
+
+class TiktokenTokenizer(Tokenizer):
+    name = "tiktoken"
+
+    def __init__(self, encoding: str = TIKTOKEN_ENCODING):
+        if tiktoken is None:
+            raise PricingError("TOKENIZER=tiktoken but the tiktoken package is not installed")
+        self._enc = tiktoken.get_encoding(encoding)
+
+    def count(self, text: str) -> int:
+        return len(self._enc.encode(text, disallowed_special=()))
+
+
+TOKENIZERS: Dict[str, Callable[[], Tokenizer]] = {"approx": ApproxTokenizer, "tiktoken": TiktokenTokenizer}
+
+
+def get_tokenizer(name: Optional[str] = None) -> Tokenizer:
+    factory = TOKENIZERS.get(name or TOKENIZER)
+    if factory is None:
+        raise PricingError(f"unknown TOKENIZER {name or TOKENIZER!r}")
+    return factory()
+
+
+class PriceRule:
+    __slots__ = ("input_per_1k", "output_per_1k", "per_unit", "min_charge")
+
+    def __init__(self, input_per_1k: float = 0.0, output_per_1k: float = 0.0, per_unit: float = 0.0,
+                 min_charge: int = 1):
+        self.input_per_1k = float(input_per_1k)
+        self.output_per_1k = float(output_per_1k)
+        self.per_unit = float(per_unit)
+        self.min_charge = int(min_charge)
+
+    def cost(self, input_tokens: int, output_tokens: int = 0, units: int = 0, multiplier: float = 1.0) -> int:
+        raw = (input_tokens * self.input_per_1k + output_tokens * self.output_per_1k) / 1000.0 + units * self.per_unit
+        # round before ceil so 0.1 * 30 does not become 4 gems
+        return max(self.min_charge, math.ceil(round(raw * multiplier, 6)))
+
+
+def _compile(table: Dict[str, Any]) -> Dict[str, Dict[str, PriceRule]]:
+    rules: Dict[str, Dict[str, PriceRule]] = {}
+    for model, tiers in (table.get("models") or {}).items():
+        if not tiers:
+            raise PricingError(f"model {model!r} has no tiers")
+        rules[model] = {tier: PriceRule(**spec) for tier, spec in tiers.items()}
+    if not rules:
+        raise PricingError("price table has no models")
+    return rules
+
+
+def load_price_table(path: Optional[str] = None) -> Dict[str, Any]:
+    path = path or PRICE_TABLE_PATH
+    if not path:
+        return DEFAULT_PRICE_TABLE
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+class PricingEngine:
+    def __init__(self, table: Optional[Dict[str, Any]] = None, tokenizer: Optional[Tokenizer] = None,
+                 cache_size: int = PRICING_CACHE_SIZE, default_tier: str = DEFAULT_PRICE_TIER):
+        self.tokenizer = tokenizer or get_tokenizer()
+        self.cache_size = cache_size
+        self.default_tier = default_tier
+        self._cache: "OrderedDict[str, int]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"cache_hits": 0, "cache_misses": 0}
+        self.set_table(table or DEFAULT_PRICE_TABLE)
+
+    def set_table(self, table: Dict[str, Any]):
+        # compile first so a bad table leaves the current one in place
+        rules = _compile(table)
+        self.table = table
+        self.rules = rules
+        self.user_tiers = {k: float(v) for k, v in (table.get("user_tiers") or {}).items()}
+        self.version = str(table.get("version") or "")
+
+    # tokens ------------------------------------------------------------------------------------------
+    def count(self, text: str) -> int:
+        return self.tokenizer.count(text) if text else 0
+
+    def count_cached(self, text: str) -> int:
+        """count() for text that repeats across requests (personas, system prompts)."""
+        if not text:
+            return 0
+        with self._lock:
+            n = self._cache.get(text)
+            if n is not None:
+                self._cache.move_to_end(text)
+                self.stats["cache_hits"] += 1
+                return n
+        n = self.tokenizer.count(text)
+        with self._lock:
+            self.stats["cache_misses"] += 1
+            self._cache[text] = n
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return n
+
+    # prices ------------------------------------------------------------------------------------------
+    def rule(self, model: str, tier: Optional[str] = None) -> PriceRule:
+        tiers = self.rules.get(model)
+        if tiers is None:
+            raise PricingError(f"no prices for model {model!r}")
+        if tier is None:
+            # single-tier models (chat) need no tier
+            tier = self.default_tier if self.default_tier in tiers else next(iter(tiers))
+        rule = tiers.get(tier)
+        if rule is None:
+            raise PricingError(f"no prices for {model!r} tier {tier!r}")
+        return rule
+
+    def quote(self, model: str, input_tokens: int, output_tokens: int = 0, units: int = 0,
+              tier: Optional[str] = None, user_tier: Optional[str] = None) -> int:
+        multiplier = self.user_tiers.get(user_tier or self.default_tier, 1.0)
+        return self.rule(model, tier).cost(input_tokens, output_tokens, units, multiplier)
+
+    def estimate(self, model: str, content: str = "", persona: str = "", max_output_tokens: int = 0,
+                 units: int = 0, tier: Optional[str] = None, user_tier: Optional[str] = None) -> Dict[str, Any]:
+        input_tokens = self.count(content) + self.count_cached(persona)
+        cost = self.quote(model, input_tokens, max_output_tokens, units, tier, user_tier)
+        return {"model": model, "tier": tier, "input_tokens": input_tokens, "output_tokens": max_output_tokens,
+                "units": units, "cost": cost}
+
+    def estimate_many(self, variants: List[Dict[str, Any]], user_tier: Optional[str] = None) -> List[Dict[str, Any]]:
+        """Price many variants at once (live cost previews). Each distinct text is tokenized once."""
+        counts: Dict[str, int] = {}
+        out = []
+        for v in variants:
+            content = v.get("content") or ""
+            persona = v.get("persona") or ""
+            if content not in counts:
+                counts[content] = self.count(content)
+            model = v["model"]
+            tier = v.get("tier")
+            output_tokens = int(v.get("max_output_tokens") or 0)
+            units = int(v.get("units") or 0)
+            input_tokens = counts[content] + self.count_cached(persona)
+            try:
+                cost = self.quote(model, input_tokens, output_tokens, units, tier, user_tier)
+            except PricingError as e:
+                out.append({"model": model, "tier": tier, "error": str(e)})
+                continue
+            out.append({"model": model, "tier": tier, "input_tokens": input_tokens, "output_tokens": output_tokens,
+                        "units": units, "cost": cost})
+        return out
+
+
+# process-wide engine; the app lifespan reloads it from PRICE_TABLE_PATH
+pricing = PricingEngine()
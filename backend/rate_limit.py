@@ -0,0 +1,337 @@
+"""Per-route rate limits and admission control (FR-113).
+
+RateLimitMiddleware matches each request against POLICIES (first path prefix + method match wins)
+and takes a token from the client IP's bucket and, when the request carries a valid access token
+(Authorization header, or ?token= on the WebSocket), from the JWT sub's bucket. An empty bucket is
+a 429 with Retry-After set to when the next token is due.
+
+Buckets live in a BucketStore: "memory" keeps them per replica in RATE_LIMIT_SHARDS OrderedDicts in
+touch order, so idle buckets fall off the front in O(1); "redis" shares them between replicas with a
+Lua script (needs the redis package, and fails open if Redis is unreachable).
+
+AdmissionController caps concurrent HTTP requests; excess requests wait in a bounded queue for at
+most ADMISSION_QUEUE_TIMEOUT_MS and are shed with 503 + Retry-After when the queue is full or the
+wait runs out, so overload turns into fast rejections instead of every request getting slow.
+"""
+import asyncio
+import json
+import math
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from .auth import decode_token
+
+try:
+    import redis.asyncio as aioredis
+except Exception:  # only RATE_LIMIT_BACKEND=redis needs it
+    aioredis = None
+
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "1") == "1"
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory")
+RATE_LIMIT_REDIS_URL = os.getenv("RATE_LIMIT_REDIS_URL", "redis://localhost:6379/0")
+RATE_LIMIT_SHARDS = int(os.getenv("RATE_LIMIT_SHARDS", "16"))
+# must be at least the slowest policy's refill time (burst / rate), or eviction would hand out fresh bursts
+RATE_LIMIT_IDLE_SECONDS = float(os.getenv("RATE_LIMIT_IDLE_SECONDS", "900"))
+RATE_LIMIT_MAX_KEYS_PER_SHARD = int(os.getenv("RATE_LIMIT_MAX_KEYS_PER_SHARD", "65536"))
+# behind a reverse proxy the client address is the last X-Forwarded-For hop (the one the proxy added)
+RATE_LIMIT_TRUST_FORWARDED = os.getenv("RATE_LIMIT_TRUST_FORWARDED", "0") == "1"
+ADMISSION_MAX_INFLIGHT = int(os.getenv("ADMISSION_MAX_INFLIGHT", "256"))
+ADMISSION_MAX_QUEUE = int(os.getenv("ADMISSION_MAX_QUEUE", "512"))
+ADMISSION_QUEUE_TIMEOUT_MS = float(os.getenv("ADMISSION_QUEUE_TIMEOUT_MS", "2000"))
+
+
+class Limit:
+    __slots__ = ("rate", "burst")
+
+    def __init__(self, rate: float, burst: int):
+        # rate in tokens per second
+        self.rate = rate
+        self.burst = burst
+
+    @classmethod
+    def per_minute(cls, count: int, burst: Optional[int] = None) -> "Limit":
+        return cls(count / 60.0, burst or count)
+
+
+class Policy:
+    __slots__ = ("name", "prefix", "methods", "per_ip", "per_user")
+
+    def __init__(self, name: str, prefix: str, per_ip: Optional[Limit] = None, per_user: Optional[Limit] = None,
+                 methods: Optional[Sequence[str]] = None):
+        self.name = name
+        self.prefix = prefix
+        self.methods = frozenset(methods) if methods else None
+        self.per_ip = per_ip
+        self.per_user = per_user
+
+    def matches(self, path: str, method: str) -> bool:
+        return path.startswith(self.prefix) and (self.methods is None or method in self.methods)
+
+
+# login/register/refresh are keyed by IP only: they run bcrypt and carry no access token
+POLICIES: List[Policy] = [
+    Policy("auth", "/api/v1/auth", per_ip=Limit.per_minute(20, burst=10)),
+    Policy("chat", "/api/v1/chat", per_ip=Limit(10, 40), per_user=Limit(2, 10), methods=("POST",)),
+    Policy("generate", "/api/v1/generate", per_ip=Limit(2, 10), per_user=Limit.per_minute(20, burst=5),
+           methods=("POST",)),
+    Policy("gems", "/api/v1/gems", per_ip=Limit(20, 60), per_user=Limit(5, 20)),
+    Policy("ws", "/ws", per_ip=Limit.per_minute(30, burst=10), per_user=Limit.per_minute(20, burst=10)),
+]
+
+
+# 429s per policy name, process-wide
+limited: Dict[str, int] = {}
+
+
+class BucketStore:
+    async def take(self, key: str, limit: Limit, cost: float = 1.0) -> float:
+        """Take cost tokens from key's bucket; 0.0 if allowed, else seconds until they would be."""
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+class ShardedMemoryStore(BucketStore):
+    def __init__(self, shards: int = RATE_LIMIT_SHARDS, idle_seconds: float = RATE_LIMIT_IDLE_SECONDS,
+                 max_keys_per_shard: int = RATE_LIMIT_MAX_KEYS_PER_SHARD, clock=time.monotonic):
+        # key -> [tokens, last_refill]; each shard is kept in touch order so eviction only looks at the front
+        self._shards: List["OrderedDict[str, List[float]]"] = [OrderedDict() for _ in range(max(1, shards))]
+        self.idle_seconds = idle_seconds
+        self.max_keys = max_keys_per_shard
+        self._clock = clock
+        self.evicted = 0
+
+    def _evict(self, shard: "OrderedDict[str, List[float]]", now: float):
+        while shard:
+            key, bucket = next(iter(shard.items()))
+            if now - bucket[1] < self.idle_seconds and len(shard) <= self.max_keys:
+                break
+            del shard[key]
+            self.evicted += 1
+
+    def take_now(self, key: str, limit: Limit, cost: float = 1.0) -> float:
+        now = self._clock()
+        shard = self._shards[hash(key) % len(self._shards)]
+        bucket = shard.get(key)
+        if bucket is None:
+            bucket = shard[key] = [float(limit.burst), now]
+        else:
+            bucket[0] = min(float(limit.burst), bucket[0] + (now - bucket[1]) * limit.rate)
+            bucket[1] = now
+            shard.move_to_end(key)
+        self._evict(shard, now)
+        if bucket[0] >= cost:
+            bucket[0] -= cost
+            return 0.0
+        return (cost - bucket[0]) / limit.rate
+
+    async def take(self, key: str, limit: Limit, cost: float = 1.0) -> float:
+        return self.take_now(key, limit, cost)
+
+    def __len__(self) -> int:
+        return sum(len(s) for s in self._shards)
+
+
+class RedisBucketStore(BucketStore):
+    # KEYS[1] bucket; ARGV rate, burst, cost, now. Returns seconds to wait as a string (0 = allowed).
+    _SCRIPT = """
+        local b = redis.call('HMGET', KEYS[1], 't', 'ts')
+        local rate, burst, cost, now = tonumber(ARGV[1]), tonumber(ARGV[2]), tonumber(ARGV[3]), tonumber(ARGV[4])
+        local tokens = tonumber(b[1]) or burst
+        local ts = tonumber(b[2]) or now
+        tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+        local wait = 0
+        if tokens >= cost then tokens = tokens - cost else wait = (cost - tokens) / rate end
+        redis.call('HSET', KEYS[1], 't', tokens, 'ts', now)
+        redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+        return tostring(wait)
+    """
+
+    def __init__(self, url: str = RATE_LIMIT_REDIS_URL, prefix: str = "rl:"):
+        if aioredis is None:
+            raise RuntimeError("RATE_LIMIT_BACKEND=redis needs the redis package")
+        self._redis = aioredis.from_url(url)
+        self._script = self._redis.register_script(self._SCRIPT)
+        self.prefix = prefix
+        self.errors = 0
+
+    async def take(self, key: str, limit: Limit, cost: float = 1.0) -> float:
+        try:
+            # wall clock: every replica has to agree on it
+            out = await self._script(keys=[self.prefix + key], args=[limit.rate, limit.burst, cost, time.time()])
+            return float(out)
+        except Exception:
+            # fail open: an outage of the limiter must not take the API down with it
+            self.errors += 1
+            return 0.0
+
+    async def close(self):
+        await self._redis.close()
+
+
+BUCKET_STORES = {"memory": ShardedMemoryStore, "redis": RedisBucketStore}
+
+
+def get_bucket_store(name: Optional[str] = None) -> BucketStore:
+    factory = BUCKET_STORES.get(name or RATE_LIMIT_BACKEND)
+    if factory is None:
+        raise ValueError(f"unknown RATE_LIMIT_BACKEND {name or RATE_LIMIT_BACKEND!r}")
+    return factory()
+
+
+class Overloaded(Exception):
+    def __init__(self, retry_after: float):
+        super().__init__("overloaded")
+        self.retry_after = retry_after
+
+
+class AdmissionController:
+    def __init__(self, max_inflight: int = ADMISSION_MAX_INFLIGHT, max_queue: int = ADMISSION_MAX_QUEUE,
+                 queue_timeout_ms: float = ADMISSION_QUEUE_TIMEOUT_MS):
+        self.max_inflight = max_inflight
+        self.max_queue = max_queue
+        self.queue_timeout = queue_timeout_ms / 1000.0
+        self.inflight = 0
+        self.waiting = 0
+        self._slots = asyncio.Semaphore(max_inflight)
+        # EWMA of request time, for Retry-After
+        self.avg_seconds = 0.05
+        self.stats = {"admitted": 0, "queued": 0, "shed": 0}
+
+    def retry_after(self) -> float:
+        # time for the requests ahead of a newcomer to drain at the current service rate
+        return max(1.0, (self.waiting + 1) * self.avg_seconds / max(1, self.max_inflight))
+
+    async def acquire(self):
+        if self._slots.locked() or self.waiting:
+            if self.waiting >= self.max_queue:
+                self.stats["shed"] += 1
+                raise Overloaded(self.retry_after())
+            self.waiting += 1
+            self.stats["queued"] += 1
+            try:
+                await asyncio.wait_for(self._slots.acquire(), self.queue_timeout)
+            except asyncio.TimeoutError:
+                self.stats["shed"] += 1
+                raise Overloaded(self.retry_after())
+            finally:
+                self.waiting -= 1
+        else:
+            await self._slots.acquire()
+        self.inflight += 1
+        self.stats["admitted"] += 1
+
+    def release(self, seconds: float):
+        self.inflight -= 1
+        self.avg_seconds += 0.1 * (seconds - self.avg_seconds)
+        self._slots.release()
+
+    def snapshot(self) -> Dict[str, Any]:
+        out: Dict[str, Any] = dict(self.stats)
+        out.update(inflight=self.inflight, waiting=self.waiting, avg_ms=round(self.avg_seconds * 1000.0, 2))
+        return out
+
+
+def _headers(scope) -> Dict[bytes, bytes]:
+    return dict(scope.get("headers") or [])
+
+
+def client_ip(scope, trust_forwarded: bool = RATE_LIMIT_TRUST_FORWARDED) -> str:
+    if trust_forwarded:
+        forwarded = _headers(scope).get(b"x-forwarded-for")
+        if forwarded:
+            return forwarded.decode("latin-1").split(",")[-1].strip()
+    client = scope.get("client")
+    return client[0] if client else "unknown"
+
+
+def token_subject(scope) -> Optional[str]:
+    auth = _headers(scope).get(b"authorization", b"").decode("latin-1")
+    token = None
+    if auth[:7].lower() == "bearer ":
+        token = auth[7:].strip()
+    elif scope["type"] == "websocket":
+        for part in scope.get("query_string", b"").decode("latin-1").split("&"):
+            if part.startswith("token="):
+                token = part[6:]
+    if not token:
+        return None
+    # same cached verification get_current_user does, so a forged sub cannot pick its own bucket
+    payload = decode_token(token)
+    if not payload or payload.get("typ") == "refresh":
+        return None
+    return payload.get("sub")
+
+
+class RateLimitMiddleware:
+    def __init__(self, app, store: Optional[BucketStore] = None, admission: Optional[AdmissionController] = None,
+                 policies: Optional[List[Policy]] = None, trust_forwarded: bool = RATE_LIMIT_TRUST_FORWARDED):
+        self.app = app
+        self.store = store or ShardedMemoryStore()
+        self.admission = admission
+        self.policies = POLICIES if policies is None else policies
+        self.trust_forwarded = trust_forwarded
+
+    def match(self, path: str, method: str) -> Optional[Policy]:
+        for policy in self.policies:
+            if policy.matches(path, method):
+                return policy
+        return None
+
+    async def check(self, scope) -> float:
+        policy = self.match(scope.get("path", ""), scope.get("method", "GET"))
+        if policy is None:
+            return 0.0
+        # user bucket first: requests it turns away do not eat the budget of others behind the same NAT
+        checks: List[Tuple[str, Limit]] = []
+        if policy.per_user is not None:
+            sub = token_subject(scope)
+            if sub:
+                checks.append((f"{policy.name}:sub:{sub}", policy.per_user))
+        if policy.per_ip is not None:
+            checks.append((f"{policy.name}:ip:{client_ip(scope, self.trust_forwarded)}", policy.per_ip))
+        for key, limit in checks:
+            wait = await self.store.take(key, limit)
+            if wait > 0:
+                limited[policy.name] = limited.get(policy.name, 0) + 1
+                return wait
+        return 0.0
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] not in ("http", "websocket"):
+            await self.app(scope, receive, send)
+            return
+        wait = await self.check(scope)
+        if wait > 0:
+            await self._reject(scope, send, 429, "Too many requests", wait)
+            return
+        if scope["type"] == "websocket" or self.admission is None:
+            # sockets are long-lived; their work is bounded per connection instead
+            await self.app(scope, receive, send)
+            return
+        try:
+            await self.admission.acquire()
+        except Overloaded as e:
+            await self._reject(scope, send, 503, "Server busy", e.retry_after)
+            return
+        started = time.perf_counter()
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.admission.release(time.perf_counter() - started)
+
+    async def _reject(self, scope, send, status: int, detail: str, retry_after: float):
+        if scope["type"] == "websocket":
+            # closing before accept makes the server answer the handshake with 403
+            await send({"type": "websocket.close", "code": 1008})
+            return
+        body = json.dumps({"detail": detail}).encode("utf-8")
+        await send({"type": "http.response.start", "status": status, "headers": [
+            (b"content-type", b"application/json"),
+            (b"content-length", str(len(body)).encode("ascii")),
+            (b"retry-after", str(math.ceil(retry_after)).encode("ascii")),
+        ]})
+        await send({"type": "http.response.body", "body": body})
@@ -0,0 +1,291 @@
+"""Ledger reconciliation and audit.
+
+For every user partition, checks that the cached balance doc equals the ledger:
+
+    expected = opening_balance + latest snapshot cumulative_change + SUM(change of events after the snapshot)
+
+Partitions are scanned in parallel on a thread pool (the sync Cosmos client is thread-safe and the work is
+I/O bound). In "aggregate" mode the sum is pushed to Cosmos as a single SUM() per partition; "audit" mode
+streams the events and folds them with a vectorized cumulative sum to also check every balance_after.
+Users are processed in user_id order and a checkpoint records the completed prefix and the users that
+failed, so an interrupted nightly run resumes where it stopped and retries the failures; a finished run
+marks the checkpoint complete so the next night starts over.
+
+    python -m backend.reconcile --workers 32 --checkpoint reconcile.ckpt.json --report drift.ndjson [--repair]
+"""
+import argparse
+import itertools
+import json
+import logging
+import os
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Dict, Iterator, List, Optional, Sequence
+from uuid import uuid4
+
+from .compaction import expected_balance, verify_snapshot_signature
+from .ledger import LedgerService, now_iso
+
+try:
+    import numpy as np
+except Exception:
+    np = None
+
+log = logging.getLogger(__name__)
+
+RECONCILE_WORKERS = int(os.getenv("RECONCILE_WORKERS", "32"))
+RECONCILE_USER_PAGE = 1000
+CHECKPOINT_EVERY = 500
+
+
+def fold_changes(changes: Sequence[int]) -> int:
+    """Sum of event changes (numpy when available)."""
+    if np is not None and len(changes) > 64:
+        return int(np.asarray(changes, dtype=np.int64).sum())
+    return int(sum(changes))
+
+
+def count_chain_breaks(changes: Sequence[int], balances_after: Sequence[Optional[int]]) -> int:
+    """Number of events whose balance_after != previous balance_after + change (events in ledger order)."""
+    if np is not None and len(changes) > 64:
+        ch = np.asarray(changes, dtype=np.int64)
+        ba = np.asarray([b if b is not None else 0 for b in balances_after], dtype=np.int64)
+        known = np.asarray([b is not None for b in balances_after], dtype=bool)
+        # each event is checked against the previous event when both carry balance_after
+        both = known[1:] & known[:-1]
+        return int(np.count_nonzero((ba[:-1] + ch[1:] != ba[1:]) & both))
+    breaks = 0
+    for i in range(1, len(changes)):
+        prev, cur = balances_after[i - 1], balances_after[i]
+        if prev is not None and cur is not None and prev + changes[i] != cur:
+            breaks += 1
+    return breaks
+
+
+class Reconciler:
+    def __init__(self, ledger: LedgerService, workers: int = RECONCILE_WORKERS, mode: str = "aggregate",
+                 repair: bool = False, checkpoint_path: Optional[str] = None, report_path: Optional[str] = None):
+        if mode not in ("aggregate", "audit"):
+            raise ValueError("mode must be 'aggregate' or 'audit'")
+        self.ledger = ledger
+        self.container = ledger.container
+        self.workers = workers
+        self.mode = mode
+        self.repair = repair
+        self.checkpoint_path = checkpoint_path
+        self.report_path = report_path
+        self.run_id = f"recon:{uuid4().hex}"
+        self.stats: Dict[str, Any] = {"users": 0, "drifted": 0, "drift_total": 0, "repaired": 0,
+                                      "chain_breaks": 0, "errors": 0, "elapsed_seconds": 0.0}
+
+    def _query(self, query: str, params: List[Dict[str, Any]], partition_key: Optional[str] = None):
+        if partition_key is None:
+            return self.container.query_items(query=query, parameters=params, enable_cross_partition_query=True)
+        return self.container.query_items(query=query, parameters=params, partition_key=partition_key)
+
+    def iter_users(self, after: str = "") -> Iterator[str]:
+        """All user_ids with a balance doc, in order, keyset-paginated so millions never sit in memory."""
+        q = (f"SELECT TOP {RECONCILE_USER_PAGE} VALUE c.user_id FROM c "
+             "WHERE c.docType='balance' AND c.user_id > @after ORDER BY c.user_id ASC")
+        while True:
+            page = list(self._query(q, [{"name": "@after", "value": after}]))
+            yield from page
+            if len(page) < RECONCILE_USER_PAGE:
+                return
+            after = page[-1]
+
+    def _latest_snapshot(self, user_id: str) -> Optional[Dict[str, Any]]:
+        q = "SELECT TOP 1 * FROM c WHERE c.user_id=@uid AND c.docType='ledger_snapshot' ORDER BY c.created_at DESC"
+        for doc in self._query(q, [{"name": "@uid", "value": user_id}], partition_key=user_id):
+            if not verify_snapshot_signature(doc):
+                raise ValueError(f"snapshot {doc.get('id')} failed signature check")
+            return doc
+        return None
+
+    def _ledger_tail(self, user_id: str, after: str) -> Dict[str, int]:
+        params = [{"name": "@uid", "value": user_id}, {"name": "@after", "value": after}]
+        if self.mode == "aggregate":
+            q = "SELECT VALUE SUM(c.change) FROM c WHERE c.user_id=@uid AND c.docType='ledger_event' AND c.created_at > @after"
+            total = 0
+            for v in self._query(q, params, partition_key=user_id):
+                total = int(v or 0)
+            return {"sum": total, "chain_breaks": 0}
+        q = ("SELECT c.change, c.balance_after FROM c WHERE c.user_id=@uid AND c.docType='ledger_event' "
+             "AND c.created_at > @after ORDER BY c.created_at ASC")
+        changes: List[int] = []
+        balances: List[Optional[int]] = []
+        for ev in self._query(q, params, partition_key=user_id):
+            changes.append(int(ev.get("change", 0)))
+            b = ev.get("balance_after")
+            balances.append(int(b) if b is not None else None)
+        return {"sum": fold_changes(changes), "chain_breaks": count_chain_breaks(changes, balances)}
+
+    def reconcile_user(self, user_id: str, attempts: int = 3) -> Dict[str, Any]:
+        for _ in range(attempts):
+            balance_doc = self.ledger.get_balance_doc(user_id)
+            snap = self._latest_snapshot(user_id)
+            tail = self._ledger_tail(user_id, snap["through_created_at"] if snap else "")
+            expected = expected_balance(balance_doc, snap, tail["sum"])
+            actual = int(balance_doc.get("balance", 0))
+            drift = actual - expected
+            if drift == 0:
+                break
+            # a mutation committed while we were summing shows up as drift; re-check against a fresh doc
+            if self.ledger.get_balance_doc(user_id).get("_etag") == balance_doc.get("_etag"):
+                break
+        out = {"user_id": user_id, "expected": expected, "actual": actual, "drift": drift,
+               "chain_breaks": tail["chain_breaks"], "snapshot_id": snap["id"] if snap else None, "repaired": False}
+        if drift and self.repair:
+            out["repaired"] = self._repair(user_id, balance_doc, expected, drift)
+        return out
+
+    def _repair(self, user_id: str, balance_doc: Dict[str, Any], expected: int, drift: int) -> bool:
+        """Record the drift as a reconcile_adjustment event so the ledger sums to the balance.
+
+        The balance doc is replaced with if_match, so the repair only commits if nothing moved since the check.
+        """
+        ev = {
+            "id": self.ledger._evt_id(),
+            "docType": "ledger_event",
+            "user_id": user_id,
+            "change": int(drift),
+            "balance_after": int(balance_doc.get("balance", 0)),
+            "event_type": "reconcile_adjustment",
+            "reference_id": self.run_id,
+            "metadata": {"expected": expected, "actual": int(balance_doc.get("balance", 0))},
+            "created_at": now_iso(),
+        }
+        updated = dict(balance_doc)
+        updated["reconciled_at"] = now_iso()
+        ops = [("create", (ev,), {}),
+               ("replace", (self.ledger._balance_id(user_id), updated), {"if_match_etag": balance_doc.get("_etag")})]
+        try:
+            # execute_item_batch takes the ledger's (op, args, kwargs) tuples as they are; the sync
+            # SDK has no create_transactional_batch, so LedgerService._execute_batch cannot be used here
+            self.container.execute_item_batch(batch_operations=ops, partition_key=user_id)
+            return True
+        except Exception as e:
+            log.warning("repair for %s not applied: %s", user_id, e)
+            return False
+
+    def _load_checkpoint(self) -> Dict[str, Any]:
+        """The checkpoint of an interrupted run; a finished run's checkpoint means start over."""
+        if self.checkpoint_path and os.path.exists(self.checkpoint_path):
+            with open(self.checkpoint_path) as fh:
+                ckpt = json.load(fh)
+            if not ckpt.get("complete"):
+                return ckpt
+        return {}
+
+    def _save_checkpoint(self, after: str, failed: Sequence[str] = (), complete: bool = False):
+        if not self.checkpoint_path:
+            return
+        tmp = self.checkpoint_path + ".tmp"
+        with open(tmp, "w") as fh:
+            json.dump({"run_id": self.run_id, "after": after, "failed": sorted(failed), "complete": complete,
+                       "stats": self.stats, "saved_at": now_iso()}, fh)
+        os.replace(tmp, self.checkpoint_path)
+
+    def _record(self, result: Dict[str, Any]):
+        self.stats["users"] += 1
+        self.stats["chain_breaks"] += result["chain_breaks"]
+        if result["drift"]:
+            self.stats["drifted"] += 1
+            self.stats["drift_total"] += abs(result["drift"])
+            self.stats["repaired"] += 1 if result["repaired"] else 0
+        if self.report_path and (result["drift"] or result["chain_breaks"]):
+            with open(self.report_path, "a") as fh:
+                fh.write(json.dumps(result) + "\n")
+
+    def run(self, users: Optional[Sequence[str]] = None) -> Dict[str, Any]:
+        """Reconcile every user (or the given ones).
+
+        An interrupted run resumes after the checkpointed user_id, retrying the users that failed first.
+        A run that got through every user without errors marks its checkpoint complete, and the next run
+        starts from the beginning.
+        """
+        started = time.perf_counter()
+        ckpt = self._load_checkpoint()
+        if ckpt:
+            self.run_id = ckpt.get("run_id", self.run_id)
+            self.stats.update(ckpt.get("stats") or {})
+            # the failed users are retried below; their errors are counted again if they fail again
+            self.stats["errors"] = 0
+        after = ckpt.get("after", "")
+        # users whose reconcile raised: never treated as done, carried in the checkpoint until they pass
+        failed = set(ckpt.get("failed") or ())
+        retry = sorted(failed)
+        rest = iter(sorted(u for u in users if u > after)) if users is not None else self.iter_users(after)
+        source = itertools.chain(retry, (u for u in rest if u not in failed))
+
+        # futures complete out of order; the checkpoint only advances over a fully finished prefix
+        order: deque = deque()
+        done: Dict[str, bool] = {}
+        since_ckpt = 0
+        max_in_flight = self.workers * 4
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            in_flight = {}
+            exhausted = False
+            while in_flight or not exhausted:
+                while not exhausted and len(in_flight) < max_in_flight:
+                    user_id = next(source, None)
+                    if user_id is None:
+                        exhausted = True
+                        break
+                    order.append(user_id)
+                    in_flight[pool.submit(self.reconcile_user, user_id)] = user_id
+                if not in_flight:
+                    break
+                finished, _ = wait(list(in_flight), return_when=FIRST_COMPLETED)
+                for fut in finished:
+                    user_id = in_flight.pop(fut)
+                    try:
+                        self._record(fut.result())
+                        failed.discard(user_id)
+                    except Exception as e:
+                        self.stats["errors"] += 1
+                        failed.add(user_id)
+                        log.warning("reconcile %s failed: %s", user_id, e)
+                    done[user_id] = True
+                    since_ckpt += 1
+                while order and done.pop(order[0], False):
+                    # retried users sort before the checkpoint; it never moves backwards
+                    after = max(after, order.popleft())
+                if since_ckpt >= CHECKPOINT_EVERY:
+                    self._save_checkpoint(after, failed)
+                    since_ckpt = 0
+        self.stats["elapsed_seconds"] = round(self.stats.get("elapsed_seconds", 0.0) + time.perf_counter() - started, 3)
+        self._save_checkpoint(after, failed, complete=not failed)
+        return dict(self.stats)
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Reconcile balance docs against the gem ledger")
+    parser.add_argument("--workers", type=int, default=RECONCILE_WORKERS)
+    parser.add_argument("--mode", choices=("aggregate", "audit"), default="aggregate")
+    parser.add_argument("--repair", action="store_true", help="write reconcile_adjustment events for drift")
+    parser.add_argument("--checkpoint", default="reconcile.ckpt.json")
+    parser.add_argument("--report", default="reconcile-drift.ndjson")
+    parser.add_argument("--user", action="append", help="reconcile only this user (repeatable)")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+
+    from azure.cosmos import CosmosClient
+
+    url, key = os.getenv("COSMOS_URL"), os.getenv("COSMOS_KEY")
+    if not url or not key:
+        log.error("COSMOS_URL / COSMOS_KEY not set")
+        return 2
+    client = CosmosClient(url, credential=key)
+    container = client.get_database_client(os.getenv("COSMOS_DB", "appdb")).get_container_client(
+        os.getenv("COSMOS_CONTAINER", "ledger"))
+    rec = Reconciler(LedgerService(container), workers=args.workers, mode=args.mode, repair=args.repair,
+                     checkpoint_path=args.checkpoint, report_path=args.report)
+    stats = rec.run(users=args.user)
+    log.info("reconciliation finished: %s", stats)
+    return 0 if stats["errors"] == 0 else 1
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
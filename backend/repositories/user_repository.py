@@ -1,15 +1,161 @@
+import os
 from typing import Optional
 from datetime import datetime
+from uuid import uuid4
 
 from ..db import get_users_container
+from ..retry import has_status
+from ..user_cache import profile_cache
+
+# fields kept unique across users through pointer docs ("email:{value}", "username:{value}")
+UNIQUE_FIELDS = ("username", "email")
+# until backend.backfill_unique has written pointers for every existing user, email lookups and claims
+# fall back to a cross-partition query for users without one; turn it off once a backfill run is clean
+EMAIL_INDEX_FALLBACK_SCAN = os.getenv("EMAIL_INDEX_FALLBACK_SCAN", "1") == "1"
+# a pointer whose owner does not (yet) hold the value is only taken over once it is this old: younger
+# ones belong to a registration or email change that is still in flight
+UNIQUE_CLAIM_GRACE_SECONDS = float(os.getenv("UNIQUE_CLAIM_GRACE_SECONDS", "60"))
+
+
+class UniqueConstraintViolation(Exception):
+    def __init__(self, field: str):
+        super().__init__(f"{field} already in use")
+        self.field = field
+
+
+def _normalize(value: str) -> str:
+    return value.strip().lower()
+
+
+def valid_username(username: str) -> bool:
+    # ":" is reserved for pointer ids ("email:..."), which live in the same id space as user docs
+    return bool(username) and ":" not in username
+
+
+def unique_id(field: str, value: str) -> str:
+    return f"{field}:{_normalize(value)}"
+
+
+def _age_seconds(doc: dict) -> float:
+    try:
+        created = datetime.fromisoformat((doc.get("created_at") or "").rstrip("Z"))
+    except ValueError:
+        return float("inf")
+    return (datetime.utcnow() - created).total_seconds()
 
 
 class UserRepository:
-    """Simple Cosmos-backed user repository. Returns minimal user dict with id, username, email, password_hash."""
+    """Simple Cosmos-backed user repository. Returns minimal user dict with id, username, email, password_hash.
+
+    The users container is partitioned by /id, so a user doc can only be point-read by username. Every
+    unique field also gets a pointer doc whose id is "<field>:<normalized value>" (its own partition):
+    creating it fails with 409 when the value is taken, which is the uniqueness check, and reading it
+    turns an email login into two point reads instead of a fan-out query.
+    """
 
     def __init__(self):
         self.container = get_users_container()
 
+    # unique-constraint pointers -----------------------------------------------------------------------
+    def _read(self, item_id: str) -> Optional[dict]:
+        try:
+            return self.container.read_item(item=item_id, partition_key=item_id)
+        except Exception as e:
+            if has_status(e, 404):
+                return None
+            raise
+
+    def _legacy_email_holder(self, email: str, user_id: str) -> Optional[str]:
+        """Id of another user doc holding email, for users written before pointers existed."""
+        query = ("SELECT TOP 1 c.id FROM c WHERE LOWER(c.email)=@email AND NOT IS_DEFINED(c.docType) "
+                 "AND c.id != @id")
+        params = [{"name": "@email", "value": _normalize(email)}, {"name": "@id", "value": user_id}]
+        for doc in self.container.query_items(query=query, parameters=params, partition_key=None):
+            return doc["id"]
+        return None
+
+    def claim_unique(self, field: str, value: str, user_id: str, adopt: bool = True,
+                     scan_legacy: bool = True) -> Optional[str]:
+        """Reserve value for user_id; raises UniqueConstraintViolation if another user holds it.
+
+        Every pointer written carries a fresh claim nonce, which is returned so a rollback can release
+        exactly this claim. With adopt, a pointer user_id already holds is accepted as is (None is
+        returned); create_user passes adopt=False, since user_id == username there and a pointer with
+        its name on it may belong to a concurrent registration of the same username.
+
+        While EMAIL_INDEX_FALLBACK_SCAN is on, users without pointers may still exist, so an email claim
+        first checks that no other user doc holds the address. The backfill passes scan_legacy=False:
+        it writes every user's pointer, so a duplicate shows up as a held pointer anyway.
+        """
+        pointer_id = unique_id(field, value)
+        if field == "email" and scan_legacy and EMAIL_INDEX_FALLBACK_SCAN:
+            if self._legacy_email_holder(value, user_id) is not None:
+                raise UniqueConstraintViolation(field)
+        claim = uuid4().hex
+        pointer = {"id": pointer_id, "docType": "unique_index", "field": field, "value": _normalize(value),
+                   "user_id": user_id, "claim": claim, "created_at": datetime.utcnow().isoformat() + "Z"}
+        try:
+            self.container.create_item(pointer)
+            return claim
+        except Exception as e:
+            if not has_status(e, 409):
+                raise
+        existing = self._read(pointer_id)
+        if existing is None:
+            # released between our create and read; one more try decides it
+            try:
+                self.container.create_item(pointer)
+                return claim
+            except Exception as e:
+                if has_status(e, 409):
+                    raise UniqueConstraintViolation(field)
+                raise
+        if existing.get("docType") != "unique_index":
+            # a user doc whose username looks like a pointer id; never a claim, never taken over
+            raise UniqueConstraintViolation(field)
+        if adopt and existing.get("user_id") == user_id:
+            return None
+        owner = self.get_by_username(existing.get("user_id"))
+        if owner is not None and _normalize(owner.get(field) or "") == _normalize(value):
+            raise UniqueConstraintViolation(field)
+        if _age_seconds(existing) < UNIQUE_CLAIM_GRACE_SECONDS:
+            raise UniqueConstraintViolation(field)
+        # orphan left by a registration that died before its user doc was written: take it over,
+        # guarded by the etag so two claimants cannot both win
+        try:
+            self.container.replace_item(item=pointer_id, body=pointer, etag=existing.get("_etag"),
+                                        match_condition=_if_match())
+        except Exception as e:
+            if has_status(e, 412):
+                raise UniqueConstraintViolation(field)
+            raise
+        return claim
+
+    def release_unique(self, field: str, value: str, user_id: str, claim: Optional[str] = None):
+        """Delete user_id's pointer for value; with claim, only if it is still that claim's pointer."""
+        pointer_id = unique_id(field, value)
+        existing = self._read(pointer_id)
+        if existing is None or existing.get("docType") != "unique_index" or existing.get("user_id") != user_id:
+            return
+        if claim is not None and existing.get("claim") != claim:
+            return
+        try:
+            self.container.delete_item(item=pointer_id, partition_key=pointer_id, etag=existing.get("_etag"),
+                                       match_condition=_if_match())
+        except Exception as e:
+            # 412: taken over since we read it, so no longer ours to delete
+            if not (has_status(e, 404) or has_status(e, 412)):
+                raise
+
+    def check_available(self, username: str, email: str) -> Optional[str]:
+        """First unique field already taken (None if both are free). Advisory; create_user enforces."""
+        for field, value in (("username", username), ("email", email)):
+            pointer = self._read(unique_id(field, value))
+            if pointer is not None and (pointer.get("docType") != "unique_index" or pointer.get("user_id") != username):
+                return field
+        return None
+
+    # users -------------------------------------------------------------------------------------------
     def create_user(self, username: str, email: str, password_hash: str) -> dict:
         user = {
             "id": username,
@@ -21,23 +167,88 @@ class UserRepository:
         if not self.container:
             # fallback to raising when container not available
             raise RuntimeError("Cosmos users container not configured")
-        return self.container.create_item(user)
+        if not valid_username(username):
+            raise ValueError("username may not contain ':'")
+        # pointers live in other partitions, so they are claimed first and released if the user create fails
+        claimed = []
+        try:
+            for field in UNIQUE_FIELDS:
+                claimed.append((field, self.claim_unique(field, user[field], username, adopt=False)))
+            try:
+                created = self.container.create_item(user)
+            except Exception as e:
+                if has_status(e, 409):
+                    raise UniqueConstraintViolation("username")
+                raise
+        except BaseException:
+            for field, claim in claimed:
+                try:
+                    self.release_unique(field, user[field], username, claim)
+                except Exception:
+                    # an orphaned pointer is reclaimable, see claim_unique
+                    pass
+            raise
+        # drop anything cached for an earlier user with the same id
+        profile_cache.invalidate(username)
+        return created
 
     def get_by_username(self, username: str) -> Optional[dict]:
         if not self.container:
             return None
         try:
-            return self.container.read_item(item=username, partition_key=username)
+            user = self.container.read_item(item=username, partition_key=username)
         except Exception:
             return None
+        # pointer docs share the id space; "email:..." is not a user
+        return None if user.get("docType") == "unique_index" else user
 
     def get_by_email(self, email: str) -> Optional[dict]:
         if not self.container:
             return None
+        pointer = self._read(unique_id("email", email))
+        if pointer is not None:
+            user = self.get_by_username(pointer["user_id"])
+            if user is not None and _normalize(user.get("email") or "") == _normalize(email):
+                return user
+            return None
+        if not EMAIL_INDEX_FALLBACK_SCAN:
+            return None
         query = "SELECT * FROM c WHERE c.email=@email"
         params = [{"name": "@email", "value": email}]
         items = list(self.container.query_items(query=query, parameters=params, partition_key=None))
-        return items[0] if items else None
+        if not items:
+            return None
+        # backfill so the next lookup for this address is a point read
+        try:
+            self.claim_unique("email", email, items[0]["id"])
+        except Exception:
+            pass
+        return items[0]
+
+    def update_profile(self, user_id: str, changes: dict) -> dict:
+        if not self.container:
+            raise RuntimeError("Cosmos users container not configured")
+        user = self.get_by_username(user_id)
+        if not user:
+            raise RuntimeError("user not found")
+        old_email = user.get("email")
+        new_email = changes.get("email")
+        email_changed = new_email is not None and _normalize(new_email) != _normalize(old_email or "")
+        claim = None
+        if email_changed:
+            claim = self.claim_unique("email", new_email, user_id)
+        user.update(changes)
+        user["updated_at"] = datetime.utcnow().isoformat() + "Z"
+        try:
+            saved = self.container.upsert_item(user)
+        except BaseException:
+            if claim is not None:
+                self.release_unique("email", new_email, user_id, claim)
+            raise
+        if email_changed and old_email:
+            self.release_unique("email", old_email, user_id)
+        profile_cache.invalidate(user_id)
+        return saved
 
     def upsert_refresh_token(self, user_id: str, refresh_token: str):
         if not self.container:
@@ -49,3 +260,11 @@ class UserRepository:
         user["refresh_token"] = refresh_token
         user["refresh_updated_at"] = datetime.utcnow().isoformat() + "Z"
         return self.container.upsert_item(user)
+
+
+def _if_match():
+    try:
+        from azure.core import MatchConditions
+        return MatchConditions.IfNotModified
+    except Exception:
+        return None
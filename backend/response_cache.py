@@ -0,0 +1,133 @@
+"""Pre-serialized response cache with ETags and stale-while-revalidate.
+
+Entries hold the JSON body as bytes plus a strong ETag (hash of those bytes), keyed by a normalized
+query and stamped with the source's version. Within fresh_seconds an entry is served as is; up to
+stale_seconds past that it is still served while one background task recomputes it; after that, or as
+soon as the source version moves (e.g. a character was created), it is recomputed inline.
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Dict, Hashable, Optional, Set
+
+log = logging.getLogger(__name__)
+
+LIST_CACHE_SIZE = int(os.getenv("LIST_CACHE_SIZE", "1024"))
+LIST_CACHE_FRESH_SECONDS = float(os.getenv("LIST_CACHE_FRESH_SECONDS", "60"))
+LIST_CACHE_STALE_SECONDS = float(os.getenv("LIST_CACHE_STALE_SECONDS", "300"))
+
+
+def serialize(payload: Any) -> bytes:
+    return json.dumps(payload, separators=(",", ":"), ensure_ascii=False).encode("utf-8")
+
+
+def strong_etag(body: bytes) -> str:
+    return '"' + hashlib.blake2b(body, digest_size=16).hexdigest() + '"'
+
+
+def etag_matches(if_none_match: Optional[str], etag: str) -> bool:
+    if not if_none_match:
+        return False
+    for tag in if_none_match.split(","):
+        tag = tag.strip()
+        # If-None-Match uses weak comparison
+        if tag == "*" or tag == etag or tag == "W/" + etag:
+            return True
+    return False
+
+
+class CachedResponse:
+    __slots__ = ("body", "etag", "version", "created")
+
+    def __init__(self, body: bytes, version: int, created: float):
+        self.body = body
+        self.etag = strong_etag(body)
+        self.version = version
+        self.created = created
+
+
+class ResponseCache:
+    def __init__(self, max_entries: int = LIST_CACHE_SIZE, fresh_seconds: float = LIST_CACHE_FRESH_SECONDS,
+                 stale_seconds: float = LIST_CACHE_STALE_SECONDS, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.fresh = fresh_seconds
+        self.stale = stale_seconds
+        self._clock = clock
+        self._entries: "OrderedDict[Hashable, CachedResponse]" = OrderedDict()
+        self._refreshing: Set[Hashable] = set()
+        self._tasks: Set[asyncio.Task] = set()
+        self.stats = {"hits": 0, "stale_hits": 0, "misses": 0, "refreshes": 0, "refresh_failures": 0, "not_modified": 0}
+
+    @property
+    def cache_control(self) -> str:
+        return f"public, max-age={int(self.fresh)}, stale-while-revalidate={int(self.stale)}"
+
+    def _store(self, key: Hashable, compute: Callable[[], Any], version: int) -> CachedResponse:
+        entry = CachedResponse(serialize(compute()), version, self._clock())
+        self._entries[key] = entry
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return entry
+
+    def get(self, key: Hashable, version: int, compute: Callable[[], Any]) -> CachedResponse:
+        """Cached response for key, computing it inline on a miss or a version change."""
+        entry = self._entries.get(key)
+        if entry is None or entry.version != version:
+            self.stats["misses"] += 1
+            return self._store(key, compute, version)
+        age = self._clock() - entry.created
+        if age <= self.fresh:
+            self.stats["hits"] += 1
+            self._entries.move_to_end(key)
+            return entry
+        if age <= self.fresh + self.stale:
+            self.stats["stale_hits"] += 1
+            self._entries.move_to_end(key)
+            self._refresh_later(key, version, compute)
+            return entry
+        self.stats["misses"] += 1
+        return self._store(key, compute, version)
+
+    def _refresh_later(self, key: Hashable, version: int, compute: Callable[[], Any]):
+        if key in self._refreshing:
+            return
+        try:
+            loop = asyncio.get_running_loop()
+        except RuntimeError:
+            # no loop (sync caller): the stale entry is served until a request comes in on one
+            return
+        self._refreshing.add(key)
+        task = loop.create_task(self._refresh(key, version, compute))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _refresh(self, key: Hashable, version: int, compute: Callable[[], Any]):
+        try:
+            # yield first so the stale response goes out before the recompute
+            await asyncio.sleep(0)
+            current = self._entries.get(key)
+            if current is None or current.version == version:
+                self._store(key, compute, version)
+                self.stats["refreshes"] += 1
+        except Exception:
+            self.stats["refresh_failures"] += 1
+            log.exception("background refresh of %r failed", key)
+        finally:
+            self._refreshing.discard(key)
+
+    def clear(self):
+        self._entries.clear()
+
+    async def drain(self):
+        if self._tasks:
+            await asyncio.gather(*list(self._tasks), return_exceptions=True)
+
+    def snapshot(self) -> Dict[str, Any]:
+        out: Dict[str, Any] = dict(self.stats)
+        out["entries"] = len(self._entries)
+        return out
@@ -0,0 +1,153 @@
+import asyncio
+import os
+import random
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Iterator, List, Optional, Tuple, Type, TypeVar
+
+T = TypeVar("T")
+
+LEDGER_MAX_RETRIES = int(os.getenv("LEDGER_MAX_RETRIES", "5"))
+LEDGER_RETRY_BASE_MS = float(os.getenv("LEDGER_RETRY_BASE_MS", "10"))
+LEDGER_RETRY_MAX_MS = float(os.getenv("LEDGER_RETRY_MAX_MS", "500"))
+
+
+def has_status(obj: Any, status: int) -> bool:
+    """True if an exception or batch response carries the given HTTP status."""
+    for attr in ("status_code", "status"):
+        if getattr(obj, attr, None) == status:
+            return True
+    # CosmosBatchOperationError reports the failing op's status in operation_responses
+    for op in getattr(obj, "operation_responses", None) or []:
+        if isinstance(op, dict) and op.get("statusCode") == status:
+            return True
+    return False
+
+
+def is_conflict(obj: Any) -> bool:
+    """True if an exception or batch response represents an etag precondition failure (HTTP 412)."""
+    return has_status(obj, 412)
+
+
+def batch_resource(results, index: int = 0) -> Optional[Dict[str, Any]]:
+    """Body of the batch result at index (with its new etag) when the SDK returns it."""
+    try:
+        body = results[index].get("resourceBody")
+    except Exception:
+        return None
+    return body if isinstance(body, dict) else None
+
+
+async def replace_with_etag(container, item_id: str, partition_key: str, change: Callable[[Dict[str, Any]], None],
+                            attempts: int = 5) -> Optional[Dict[str, Any]]:
+    """Read-modify-write guarded by the doc's etag; change(doc) mutates a copy in place.
+
+    A 412 means another writer got in between, so the doc is re-read and change applied again. Returns
+    the saved doc, or None when it does not exist.
+    """
+    for _ in range(attempts):
+        try:
+            current = await container.read_item(item=item_id, partition_key=partition_key)
+        except Exception as e:
+            if has_status(e, 404):
+                return None
+            raise
+        doc = dict(current)
+        change(doc)
+        ops = [("replace", (item_id, doc), {"if_match_etag": current.get("_etag")})]
+        try:
+            results = await container.execute_item_batch(batch_operations=ops, partition_key=partition_key)
+        except Exception as e:
+            if is_conflict(e):
+                continue
+            raise
+        return batch_resource(results) or doc
+    raise RuntimeError(f"could not update {item_id}: too much contention")
+
+
+class RetryPolicy:
+    """Retry budget with capped exponential backoff and full jitter."""
+
+    def __init__(self, max_retries: int = LEDGER_MAX_RETRIES, base_ms: float = LEDGER_RETRY_BASE_MS,
+                 max_ms: float = LEDGER_RETRY_MAX_MS, rng: Optional[random.Random] = None):
+        self.max_retries = max_retries
+        self.base_ms = base_ms
+        self.max_ms = max_ms
+        self._rng = rng or random.Random()
+
+    def delays(self) -> Iterator[float]:
+        """Yield one sleep (in seconds) per allowed retry."""
+        for attempt in range(self.max_retries):
+            cap = min(self.max_ms, self.base_ms * (2 ** attempt))
+            yield self._rng.uniform(0, cap) / 1000.0
+
+
+class ConflictStats:
+    """Per-user conflict/retry counters, bounded to the most recently active users."""
+
+    def __init__(self, max_users: int = 10000):
+        self.max_users = max_users
+        self._users: "OrderedDict[str, Dict[str, int]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.totals = {"conflicts": 0, "retries": 0, "exhausted": 0}
+
+    def record(self, user_id: str, field: str):
+        with self._lock:
+            row = self._users.get(user_id)
+            if row is None:
+                row = {"conflicts": 0, "retries": 0, "exhausted": 0}
+                self._users[user_id] = row
+                if len(self._users) > self.max_users:
+                    self._users.popitem(last=False)
+            else:
+                self._users.move_to_end(user_id)
+            row[field] += 1
+            self.totals[field] += 1
+
+    def for_user(self, user_id: str) -> Dict[str, int]:
+        with self._lock:
+            return dict(self._users.get(user_id) or {"conflicts": 0, "retries": 0, "exhausted": 0})
+
+    def hot_partitions(self, n: int = 10) -> List[Tuple[str, Dict[str, int]]]:
+        with self._lock:
+            rows = [(uid, dict(r)) for uid, r in self._users.items()]
+        rows.sort(key=lambda r: r[1]["conflicts"], reverse=True)
+        return rows[:n]
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {"totals": dict(self.totals), "hot_partitions": self.hot_partitions()}
+
+
+def run_with_retry(attempt: Callable[[], T], user_id: str, policy: RetryPolicy, stats: ConflictStats,
+                   retry_on: Type[BaseException], sleep: Callable[[float], None] = time.sleep) -> T:
+    """Run attempt() (read + build + execute) until it stops raising retry_on or the budget is spent."""
+    delays = policy.delays()
+    while True:
+        try:
+            return attempt()
+        except retry_on:
+            stats.record(user_id, "conflicts")
+            delay = next(delays, None)
+            if delay is None:
+                stats.record(user_id, "exhausted")
+                raise
+            stats.record(user_id, "retries")
+            sleep(delay)
+
+
+async def arun_with_retry(attempt: Callable[[], Awaitable[T]], user_id: str, policy: RetryPolicy,
+                          stats: ConflictStats, retry_on: Type[BaseException]) -> T:
+    """Async counterpart of run_with_retry."""
+    delays = policy.delays()
+    while True:
+        try:
+            return await attempt()
+        except retry_on:
+            stats.record(user_id, "conflicts")
+            delay = next(delays, None)
+            if delay is None:
+                stats.record(user_id, "exhausted")
+                raise
+            stats.record(user_id, "retries")
+            await asyncio.sleep(delay)
@@ -0,0 +1,197 @@
+"""Chat session persistence.
+
+Sessions live in their own container partitioned by /session_id: one chat_session doc (id = session_id)
+plus one chat_message doc per message (id = "msg:<seq>"). A turn's messages are appended in a single
+transactional batch together with the session doc update, guarded by the session doc's etag, so two
+writers can never hand out the same seq.
+
+In front of the container sits a bounded LRU of hot sessions (__slots__ objects holding only the last
+SESSION_CONTEXT_TURNS turns) with idle eviction; building the next prompt never reads the transcript.
+Without Cosmos, ChatSessionStore.local() keeps everything in the in-memory container emulator.
+"""
+import asyncio
+import os
+import time
+from collections import OrderedDict, deque
+from datetime import datetime
+from typing import Any, Deque, Dict, List, Optional
+from uuid import uuid4
+
+from .cosmos_emulator import AsyncInMemoryContainer, InMemoryContainer
+from .retry import batch_resource, has_status
+
+SESSION_CACHE_SIZE = int(os.getenv("SESSION_CACHE_SIZE", "10000"))
+SESSION_IDLE_SECONDS = float(os.getenv("SESSION_IDLE_SECONDS", "900"))
+# turns (user + assistant message pairs) kept hot and handed to the prompt builder
+SESSION_CONTEXT_TURNS = int(os.getenv("SESSION_CONTEXT_TURNS", "20"))
+_APPEND_ATTEMPTS = 5
+
+
+def _now() -> str:
+    return datetime.utcnow().isoformat() + "Z"
+
+
+def message_id(seq: int) -> str:
+    return f"msg:{seq:010d}"
+
+
+class SessionNotFound(Exception):
+    pass
+
+
+class HotSession:
+    __slots__ = ("session_id", "user_id", "character_id", "doc", "recent", "last_used", "window")
+
+    def __init__(self, doc: Dict[str, Any], recent: List[Dict[str, Any]], max_messages: int, now: float):
+        self.session_id = doc["session_id"]
+        self.user_id = doc["user_id"]
+        self.character_id = doc.get("character_id")
+        self.doc = doc
+        self.recent: Deque[Dict[str, Any]] = deque(recent, maxlen=max_messages)
+        self.last_used = now
+        # prompt-side token bookkeeping, owned by context_builder
+        self.window = None
+
+    @property
+    def last_seq(self) -> int:
+        return int(self.doc.get("last_seq", 0))
+
+
+class ChatSessionStore:
+    def __init__(self, container, max_sessions: int = SESSION_CACHE_SIZE, idle_seconds: float = SESSION_IDLE_SECONDS,
+                 context_turns: int = SESSION_CONTEXT_TURNS, clock=time.monotonic):
+        self.container = container
+        self.max_sessions = max_sessions
+        self.idle = idle_seconds
+        self.context_turns = context_turns
+        self._clock = clock
+        self._hot: "OrderedDict[str, HotSession]" = OrderedDict()
+        self._loading: Dict[str, asyncio.Future] = {}
+        self.stats = {"hits": 0, "loads": 0, "evicted_idle": 0, "evicted_lru": 0, "appends": 0, "append_retries": 0}
+
+    @classmethod
+    def local(cls, **kwargs) -> "ChatSessionStore":
+        return cls(AsyncInMemoryContainer(InMemoryContainer(partition_key_path="/session_id")), **kwargs)
+
+    # cache ---------------------------------------------------------------------------------------------
+    def _remember(self, hot: HotSession):
+        self.evict_idle()
+        self._hot[hot.session_id] = hot
+        self._hot.move_to_end(hot.session_id)
+        while len(self._hot) > self.max_sessions:
+            self._hot.popitem(last=False)
+            self.stats["evicted_lru"] += 1
+
+    def evict_idle(self) -> int:
+        """Drop sessions unused for idle_seconds. LRU order means the idle ones are at the front."""
+        cutoff = self._clock() - self.idle
+        n = 0
+        while self._hot:
+            hot = next(iter(self._hot.values()))
+            if hot.last_used > cutoff:
+                break
+            self._hot.popitem(last=False)
+            n += 1
+        self.stats["evicted_idle"] += n
+        return n
+
+    async def _load(self, session_id: str) -> HotSession:
+        try:
+            doc = await self.container.read_item(item=session_id, partition_key=session_id)
+        except Exception as e:
+            if has_status(e, 404):
+                raise SessionNotFound(session_id)
+            raise
+        query = ("SELECT TOP @n * FROM c WHERE c.session_id=@sid AND c.docType='chat_message' "
+                 "ORDER BY c.seq DESC")
+        params = [{"name": "@n", "value": self.context_turns * 2}, {"name": "@sid", "value": session_id}]
+        recent = [m async for m in self.container.query_items(query=query, parameters=params, partition_key=session_id)]
+        recent.reverse()
+        self.stats["loads"] += 1
+        return HotSession(doc, recent, self.context_turns * 2, self._clock())
+
+    async def get(self, session_id: str) -> HotSession:
+        hot = self._hot.get(session_id)
+        if hot is not None:
+            self.stats["hits"] += 1
+            hot.last_used = self._clock()
+            self._hot.move_to_end(session_id)
+            return hot
+        # concurrent misses for one session share a single load
+        pending = self._loading.get(session_id)
+        if pending is not None:
+            return await asyncio.shield(pending)
+        fut = asyncio.get_running_loop().create_future()
+        self._loading[session_id] = fut
+        try:
+            hot = await self._load(session_id)
+            self._remember(hot)
+            fut.set_result(hot)
+            return hot
+        except BaseException as e:
+            if isinstance(e, asyncio.CancelledError):
+                fut.cancel()
+            else:
+                fut.set_exception(e)
+                # nobody may be waiting; mark retrieved so asyncio does not log it
+                fut.exception()
+            raise
+        finally:
+            self._loading.pop(session_id, None)
+
+    def invalidate(self, session_id: str):
+        self._hot.pop(session_id, None)
+
+    # sessions ------------------------------------------------------------------------------------------
+    async def create(self, user_id: str, character_id: str) -> HotSession:
+        session_id = f"sess:{uuid4().hex}"
+        doc = {"id": session_id, "session_id": session_id, "docType": "chat_session", "user_id": user_id,
+               "character_id": character_id, "last_seq": 0, "message_count": 0, "created_at": _now(), "updated_at": _now()}
+        created = await self.container.create_item(body=doc)
+        hot = HotSession(created or doc, [], self.context_turns * 2, self._clock())
+        self._remember(hot)
+        return hot
+
+    async def context(self, session_id: str, turns: Optional[int] = None) -> List[Dict[str, Any]]:
+        """The last `turns` turns (default: all hot ones), oldest first."""
+        hot = await self.get(session_id)
+        msgs = list(hot.recent)
+        if turns is not None:
+            msgs = msgs[-2 * turns:] if turns > 0 else []
+        return msgs
+
+    async def append(self, session_id: str, messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+        """Persist messages ({"role", "content", ...}) in one batch; returns the stored docs."""
+        for _ in range(_APPEND_ATTEMPTS):
+            hot = await self.get(session_id)
+            seq = hot.last_seq
+            created_at = _now()
+            docs = []
+            for m in messages:
+                seq += 1
+                doc = dict(m)
+                doc.update({"id": message_id(seq), "session_id": session_id, "docType": "chat_message",
+                            "seq": seq, "created_at": doc.get("created_at") or created_at})
+                docs.append(doc)
+            session_doc = dict(hot.doc)
+            session_doc["last_seq"] = seq
+            session_doc["message_count"] = int(session_doc.get("message_count", 0)) + len(docs)
+            session_doc["updated_at"] = created_at
+            ops = [("create", (d,), {}) for d in docs]
+            ops.append(("replace", (session_id, session_doc), {"if_match_etag": hot.doc.get("_etag")}))
+            try:
+                results = await self.container.execute_item_batch(batch_operations=ops, partition_key=session_id)
+            except Exception as e:
+                if has_status(e, 412) or has_status(e, 409):
+                    # another writer appended first: reload the tail and renumber
+                    self.stats["append_retries"] += 1
+                    self.invalidate(session_id)
+                    continue
+                raise
+            # the session doc, with its new etag
+            stored = batch_resource(results, len(docs))
+            hot.doc = stored or session_doc
+            hot.recent.extend(docs)
+            self.stats["appends"] += 1
+            return docs
+        raise RuntimeError(f"could not append to {session_id}: too much contention")
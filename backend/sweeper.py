@@ -0,0 +1,184 @@
+"""Expired-hold sweeper.
+
+Holds left in status "placed" (client vanished between reserve and finalize) keep gems locked forever.
+The sweeper finds placed holds older than HOLD_TTL_SECONDS, groups them by user partition and cancels
+them with cancel_hold semantics: every user's expired holds are refunded in one coalesced batch, with at
+most HOLD_SWEEPER_CONCURRENCY partitions in flight.
+
+Runs inside the app lifespan, or standalone:
+
+    python -m backend.sweeper [--once]
+"""
+import argparse
+import asyncio
+import logging
+import os
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Any, Dict, List, Optional
+
+from .coalescer import SettlementCoalescer
+from .ledger import AsyncLedgerService
+
+log = logging.getLogger(__name__)
+
+HOLD_TTL_SECONDS = int(os.getenv("HOLD_TTL_SECONDS", "900"))
+HOLD_SWEEP_INTERVAL_SECONDS = float(os.getenv("HOLD_SWEEP_INTERVAL_SECONDS", "60"))
+HOLD_SWEEPER_CONCURRENCY = int(os.getenv("HOLD_SWEEPER_CONCURRENCY", "16"))
+HOLD_SWEEP_PAGE_SIZE = int(os.getenv("HOLD_SWEEP_PAGE_SIZE", "500"))
+# upper bound of holds handled per run so one run never monopolises RU
+HOLD_SWEEP_MAX_PER_RUN = int(os.getenv("HOLD_SWEEP_MAX_PER_RUN", "20000"))
+
+
+def _parse_iso(ts: str) -> Optional[datetime]:
+    try:
+        return datetime.fromisoformat(ts.rstrip("Z"))
+    except Exception:
+        return None
+
+
+class HoldSweeper:
+    def __init__(self, ledger: AsyncLedgerService, ttl_seconds: int = HOLD_TTL_SECONDS,
+                 interval_seconds: float = HOLD_SWEEP_INTERVAL_SECONDS, concurrency: int = HOLD_SWEEPER_CONCURRENCY,
+                 page_size: int = HOLD_SWEEP_PAGE_SIZE, max_per_run: int = HOLD_SWEEP_MAX_PER_RUN):
+        self.ledger = ledger
+        self.ttl = ttl_seconds
+        self.interval = interval_seconds
+        self.concurrency = concurrency
+        self.page_size = page_size
+        self.max_per_run = max_per_run
+        # window 0: cancels submitted together for one user still land in the same batch
+        self.coalescer = SettlementCoalescer(ledger, window_ms=0)
+        self._task: Optional[asyncio.Task] = None
+        self.stats: Dict[str, Any] = {
+            "runs": 0, "cancelled": 0, "already_settled": 0, "errors": 0, "gems_released": 0,
+            "last_run_seconds": 0.0, "last_run_cancelled": 0, "last_throughput_per_sec": 0.0,
+            "backlog": 0, "oldest_age_seconds": 0.0,
+        }
+
+    def _cutoff(self) -> str:
+        return (datetime.utcnow() - timedelta(seconds=self.ttl)).isoformat() + "Z"
+
+    async def find_expired(self, limit: int) -> List[Dict[str, Any]]:
+        """Oldest placed holds past the TTL, across all partitions."""
+        query = ("SELECT TOP @n c.id, c.user_id, c.amount, c.created_at FROM c "
+                 "WHERE c.docType='hold' AND c.status='placed' AND c.created_at < @cutoff ORDER BY c.created_at ASC")
+        params = [{"name": "@n", "value": int(limit)}, {"name": "@cutoff", "value": self._cutoff()}]
+        return [h async for h in self.ledger.container.query_items(query=query, parameters=params)]
+
+    async def count_backlog(self) -> int:
+        query = "SELECT VALUE COUNT(1) FROM c WHERE c.docType='hold' AND c.status='placed' AND c.created_at < @cutoff"
+        params = [{"name": "@cutoff", "value": self._cutoff()}]
+        async for n in self.ledger.container.query_items(query=query, parameters=params):
+            return int(n or 0)
+        return 0
+
+    async def _sweep_user(self, sem: asyncio.Semaphore, user_id: str, holds: List[Dict[str, Any]]) -> int:
+        async with sem:
+            results = await asyncio.gather(
+                *[self.coalescer.cancel_hold(user_id, h["id"]) for h in holds], return_exceptions=True)
+        cancelled = 0
+        for res in results:
+            if isinstance(res, BaseException):
+                self.stats["errors"] += 1
+                log.warning("hold sweep for %s failed: %s", user_id, res)
+            elif res.get("already_settled_or_cancelled"):
+                self.stats["already_settled"] += 1
+            else:
+                cancelled += 1
+                self.stats["gems_released"] += int(res.get("refunded", 0))
+        return cancelled
+
+    async def run_once(self) -> int:
+        started = time.perf_counter()
+        sem = asyncio.Semaphore(self.concurrency)
+        cancelled = 0
+        seen = 0
+        oldest = None
+        while seen < self.max_per_run:
+            page = await self.find_expired(min(self.page_size, self.max_per_run - seen))
+            if not page:
+                break
+            if oldest is None:
+                oldest = _parse_iso(page[0].get("created_at") or "")
+            seen += len(page)
+            by_user: Dict[str, List[Dict[str, Any]]] = defaultdict(list)
+            for h in page:
+                by_user[h["user_id"]].append(h)
+            counts = await asyncio.gather(*[self._sweep_user(sem, u, hs) for u, hs in by_user.items()])
+            cancelled += sum(counts)
+            if len(page) < self.page_size or sum(counts) == 0:
+                # short page = backlog drained; nothing cancelled = only failures left, retry next run
+                break
+
+        elapsed = time.perf_counter() - started
+        self.stats["runs"] += 1
+        self.stats["cancelled"] += cancelled
+        self.stats["last_run_cancelled"] = cancelled
+        self.stats["last_run_seconds"] = round(elapsed, 3)
+        self.stats["last_throughput_per_sec"] = round(cancelled / elapsed, 1) if elapsed > 0 else 0.0
+        self.stats["oldest_age_seconds"] = (datetime.utcnow() - oldest).total_seconds() if oldest else 0.0
+        try:
+            self.stats["backlog"] = await self.count_backlog()
+        except Exception:
+            log.exception("hold sweeper backlog count failed")
+        return cancelled
+
+    async def run(self):
+        while True:
+            try:
+                n = await self.run_once()
+                if n:
+                    log.info("hold sweeper cancelled %d expired holds (%s/s, backlog %s)",
+                             n, self.stats["last_throughput_per_sec"], self.stats["backlog"])
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                log.exception("hold sweeper run failed")
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        await self.coalescer.close()
+
+
+async def _main(args) -> int:
+    from azure.cosmos.aio import CosmosClient
+
+    url, key = os.getenv("COSMOS_URL"), os.getenv("COSMOS_KEY")
+    if not url or not key:
+        log.error("COSMOS_URL / COSMOS_KEY not set")
+        return 2
+    async with CosmosClient(url, credential=key) as client:
+        container = client.get_database_client(os.getenv("COSMOS_DB", "appdb")).get_container_client(
+            os.getenv("COSMOS_CONTAINER", "ledger"))
+        sweeper = HoldSweeper(AsyncLedgerService(container))
+        if args.once:
+            n = await sweeper.run_once()
+            log.info("cancelled %d holds: %s", n, sweeper.stats)
+        else:
+            await sweeper.run()
+    return 0
+
+
+def main(argv: Optional[List[str]] = None) -> int:
+    parser = argparse.ArgumentParser(description="Cancel placed holds older than HOLD_TTL_SECONDS")
+    parser.add_argument("--once", action="store_true", help="run a single sweep and exit")
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=logging.INFO)
+    return asyncio.run(_main(args))
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,52 @@
+import base64
+import json
+import time
+from datetime import timedelta
+
+import pytest
+from .. import auth
+
+
+@pytest.fixture(autouse=True)
+def _reset_validator():
+    yield
+    auth.set_token_validator("jose")
+
+
+def _forge(payload, alg="HS256"):
+    enc = lambda obj: base64.urlsafe_b64encode(json.dumps(obj).encode()).rstrip(b"=").decode()
+    return f"{enc({'alg': alg, 'typ': 'JWT'})}.{enc(payload)}."
+
+
+def test_hmac_validator_matches_jose():
+    token = auth.create_access_token("alice")
+    assert auth._hmac_validator(token) == auth._jose_validator(token)
+    header, payload, sig = token.split(".")
+    assert auth._hmac_validator(f"{header}.{payload}.{sig[:-2]}AA") is None
+    assert auth._hmac_validator(_forge({"sub": "mallory", "exp": time.time() + 60}, alg="none")) is None
+    expired = auth.create_access_token("alice", expires_delta=timedelta(seconds=-1))
+    assert auth._hmac_validator(expired) is None and auth._jose_validator(expired) is None
+    assert auth._hmac_validator("not-a-token") is None
+
+
+def test_decode_token_caches_until_exp():
+    calls = []
+
+    def counting(token):
+        calls.append(token)
+        return auth._hmac_validator(token)
+
+    auth.set_token_validator(counting)
+    token = auth.create_access_token("bob")
+    for _ in range(5):
+        assert auth.decode_token(token)["sub"] == "bob"
+    assert len(calls) == 1
+    assert auth.decode_token(token + "x") is None
+
+    now = [time.time()]
+    cache = auth.TokenCache(clock=lambda: now[0])
+    key = cache.key(token)
+    cache.put(key, {"sub": "bob", "exp": now[0] + 10})
+    assert cache.get(key)["sub"] == "bob"
+    now[0] += 11
+    assert cache.get(key) is None and cache.stats["expired"] == 1
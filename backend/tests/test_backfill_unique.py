@@ -0,0 +1,31 @@
+import json
+
+from ..backfill_unique import UniqueBackfill
+from ..repositories import user_repository
+from .test_user_repository import make_repo
+
+
+def test_backfill_writes_pointers_and_reports_duplicates(tmp_path, monkeypatch):
+    repo = make_repo()
+    for uid, email in (("ann", "ann@x.io"), ("bea", "Shared@x.io"), ("cat", "shared@x.io"), ("dan", None)):
+        repo.container.create_item({"id": uid, "username": uid, "email": email})
+    repo.create_user("eve", "eve@x.io", "h")
+    report = str(tmp_path / "conflicts.ndjson")
+
+    # one worker, so bea (first in id order) deterministically wins the shared address
+    stats = UniqueBackfill(repo, workers=1, report_path=report).run()
+    assert stats["users"] == 5 and stats["conflicts"] == 1 and stats["errors"] == 0
+    # ann, bea, cat, dan usernames plus ann's and bea's emails; eve already had both
+    assert stats["claimed"] == 6
+    with open(report) as fh:
+        assert [json.loads(line) for line in fh] == [{"user_id": "cat", "claimed": ["username"],
+                                                      "conflicts": ["email"]}]
+
+    # with every pointer written the scan can go: lookups are point reads and the address stays taken
+    monkeypatch.setattr(user_repository, "EMAIL_INDEX_FALLBACK_SCAN", False)
+    queries = repo.container.stats["queries"]
+    assert repo.get_by_email("ANN@x.io")["id"] == "ann"
+    assert repo.container.stats["queries"] == queries
+    assert repo.check_available("zed", "ann@x.io") == "email"
+    # a second run is a no-op
+    assert UniqueBackfill(repo, workers=2).run()["claimed"] == 0
@@ -0,0 +1,78 @@
+import pytest
+from ..balance_cache import BalanceCache, BalanceChangeFeed
+from ..ledger import AsyncLedgerService
+from .test_ledger_async import make_container
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_cache_ttl_lru_and_ordering():
+    clock = FakeClock()
+    cache = BalanceCache(max_entries=2, ttl_seconds=1.0, clock=clock)
+    cache.put("a", 10, "2024-01-01T00:00:01Z")
+    # an older write never replaces a newer one
+    cache.put("a", 99, "2024-01-01T00:00:00Z")
+    assert cache.get("a") == 10
+    cache.put("b", 20)
+    cache.put("c", 30)
+    assert cache.get("b") == 20 and cache.get("c") == 30
+    # "a" was least recently used when "c" arrived
+    assert cache.get("a") is None
+    clock.now = 5.0
+    assert cache.get("b") is None
+    assert cache.stats["hits"] == 3 and cache.stats["evictions"] == 1 and cache.stats["expired"] == 1
+
+
+@pytest.mark.asyncio
+async def test_ledger_balance_read_through_and_write_through():
+    c = make_container(balance=1000)
+    cache = BalanceCache()
+    svc = AsyncLedgerService(c, balance_cache=cache)
+    reads = []
+    original = c.read_item
+
+    async def counting_read(item, partition_key):
+        reads.append(item)
+        return await original(item, partition_key)
+
+    c.read_item = counting_read
+    assert await svc.get_balance("user-1") == 1000
+    assert await svc.get_balance("user-1") == 1000
+    assert reads.count("balance:user-1") == 1
+
+    await svc.reserve_hold("user-1", 100)
+    n = reads.count("balance:user-1")
+    assert await svc.get_balance("user-1") == 900
+    assert reads.count("balance:user-1") == n
+
+
+@pytest.mark.asyncio
+async def test_change_feed_refreshes_cached_balance():
+    cache = BalanceCache()
+    cache.put("user-1", 1000, "2024-01-01T00:00:00Z")
+
+    class FeedContainer:
+        async def _items(self, docs):
+            for d in docs:
+                yield d
+
+        def query_items_change_feed(self, **kwargs):
+            kwargs["response_hook"]({"etag": "cont-1"}, None)
+            return self._items([
+                {"id": "balance:user-1", "docType": "balance", "user_id": "user-1", "balance": 400, "updated_at": "2024-01-01T00:00:05Z"},
+                {"id": "balance:user-2", "docType": "balance", "user_id": "user-2", "balance": 5},
+                {"id": "evt:1", "docType": "ledger_event", "user_id": "user-1", "change": -600},
+            ])
+
+    feed = BalanceChangeFeed(FeedContainer(), cache)
+    assert await feed.poll_once() == 3
+    assert feed.continuation == "cont-1"
+    assert cache.get("user-1") == 400
+    # users not cached on this replica are not pulled in
+    assert cache.get("user-2") is None
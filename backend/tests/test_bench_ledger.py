@@ -0,0 +1,37 @@
+import pytest
+from .. import app as app_module, bench_ledger, rate_limit
+
+TINY = {"users": 10, "hot_workers": 3, "hot_ops": 3, "history": 120, "latency_ms": 0.0}
+
+
+@pytest.mark.asyncio
+async def test_scenarios_run_through_service_and_api(monkeypatch):
+    monkeypatch.setitem(bench_ledger.SIZES, "tiny", TINY)
+    report = await bench_ledger.run_all("tiny", scenarios=["many_users", "hot_user"], track_alloc=False)
+    assert set(report["results"]) == {"many_users/service", "many_users/api", "hot_user/service", "hot_user/api"}
+    for row in report["results"].values():
+        assert row["errors"] == 0 and row["ops"] > 0 and row["p99_ms"] >= row["p50_ms"]
+
+    history = await bench_ledger.scenario_long_history("api", TINY, track_alloc=True)
+    assert history["ops"] == 2 and history["alloc_blocks_per_op"] >= 0
+
+
+@pytest.mark.asyncio
+async def test_api_scenarios_are_not_rate_limited(monkeypatch):
+    # 60 reserve+finalize pairs from one client address: well past the gems routes' per-IP burst
+    monkeypatch.setitem(bench_ledger.SIZES, "tiny", dict(TINY, users=60))
+    report = await bench_ledger.run_all("tiny", vias=("api",), scenarios=["many_users"], track_alloc=False)
+    assert report["results"]["many_users/api"]["ops"] == 120
+    # the production app keeps its limits; only the benchmark's copy runs without policies
+    [limiter] = [m for m in app_module.app.user_middleware if m.cls is rate_limit.RateLimitMiddleware]
+    assert "policies" not in limiter.kwargs
+    [bench_limiter] = [m for m in bench_ledger.bench_app(app_module.app).user_middleware
+                       if m.cls is rate_limit.RateLimitMiddleware]
+    assert bench_limiter.kwargs == {"policies": [], "admission": None}
+
+
+def test_compare_flags_regressions():
+    base = {"results": {"hot_user/api": {"ops_per_sec": 1000.0, "p95_ms": 10.0, "p99_ms": 20.0, "retries_per_op": 0.1}}}
+    cur = {"results": {"hot_user/api": {"ops_per_sec": 700.0, "p95_ms": 10.5, "p99_ms": 20.0, "retries_per_op": 0.12}}}
+    flagged = {r["metric"] for r in bench_ledger.compare(cur, base, tolerance=0.2) if r["regression"]}
+    assert flagged == {"ops_per_sec"}
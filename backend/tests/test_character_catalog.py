@@ -0,0 +1,138 @@
+import random
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+from .. import app as app_module
+from ..api import characters as characters_router
+from ..character_catalog import CharacterCatalog
+from ..deps import get_current_user
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1_700_000_000.0
+
+    def __call__(self):
+        return self.now
+
+
+def ids(page):
+    return [c["name"] for c in page["items"]]
+
+
+@pytest.mark.asyncio
+async def test_filters_search_and_sorts():
+    clock = Clock()
+    cat = CharacterCatalog.local(decay_hours=1, clock=clock)
+    luna = await cat.create("u1", "Luna Moonshadow", tags=["Fantasy", "elf"])
+    rex = await cat.create("u1", "Rex the Pirate", tags=["pirate"], nsfw=True)
+    mira = await cat.create("u2", "Mira Moonfall", tags=["fantasy"], nsfw=True)
+    await cat.create("u2", "Hidden Draft", tags=["fantasy"], published=False)
+
+    assert ids(cat.query(sort="new", tags=["fantasy"])) == ["Mira Moonfall", "Luna Moonshadow"]
+    assert ids(cat.query(tags=["fantasy"], nsfw=False)) == ["Luna Moonshadow"]
+    assert ids(cat.query(nsfw=True, q="rex")) == ["Rex the Pirate"]
+    assert set(ids(cat.query(q="moon"))) == {"Luna Moonshadow", "Mira Moonfall"}  # prefix match
+    assert ids(cat.query(q="moon", tags=["elf"])) == ["Luna Moonshadow"]
+    assert cat.get("missing") is None
+
+    # popular counts every chat; trending favours recent ones
+    for _ in range(3):
+        await cat.record_chat(rex["id"])
+    clock.now += 3 * 3600
+    await cat.record_chat(luna["id"])
+    await cat.record_chat(luna["id"])
+    assert ids(cat.query(sort="popular"))[:2] == ["Rex the Pirate", "Luna Moonshadow"]
+    assert ids(cat.query(sort="trending"))[:2] == ["Luna Moonshadow", "Rex the Pirate"]
+    assert ids(cat.query(sort="trending"))[-1] == "Mira Moonfall"
+
+    await cat.update(mira["id"], {"tags": ["scifi"]})
+    assert ids(cat.query(tags=["fantasy"])) == ["Luna Moonshadow"]
+    with pytest.raises(ValueError):
+        cat.query(sort="random")
+
+
+@pytest.mark.asyncio
+async def test_exact_token_does_not_hide_longer_prefix_matches():
+    cat = CharacterCatalog.local()
+    await cat.create("u1", "Anna Lee")
+    assert ids(cat.query(q="ann")) == ["Anna Lee"]
+    await cat.create("u2", "Ann")
+    assert set(ids(cat.query(q="ann"))) == {"Ann", "Anna Lee"}
+
+
+@pytest.mark.asyncio
+async def test_cursor_pages_are_stable_under_inserts():
+    cat = CharacterCatalog.local()
+    for i in range(25):
+        c = await cat.create("u1", f"char {i}", tags=["t"])
+        for _ in range(i):
+            await cat.record_chat(c["id"])
+    first = cat.query(sort="popular", limit=10)
+    await cat.create("u1", "newcomer", tags=["t"])
+    second = cat.query(sort="popular", limit=10, cursor=first["next_cursor"])
+    third = cat.query(sort="popular", limit=10, cursor=second["next_cursor"])
+    names = ids(first) + ids(second) + ids(third)
+    # ties (zero chats) fall back to id order
+    assert names[:24] == [f"char {i}" for i in range(24, 0, -1)] and set(names[24:]) == {"char 0", "newcomer"}
+    assert third["next_cursor"] is None
+
+
+@pytest.mark.asyncio
+async def test_other_replicas_see_writes_through_load_and_change_feed():
+    a = CharacterCatalog.local()
+    b = CharacterCatalog(a.container)
+    await a.create("u1", "Early", tags=["x"])
+    await b.load()
+    await b.poll_once()
+    late = await a.create("u1", "Late", tags=["x"])
+    await a.record_chat(late["id"])
+    assert await b.poll_once() == 2
+    assert ids(b.query(sort="popular", tags=["x"])) == ["Late", "Early"]
+
+
+@pytest.mark.asyncio
+async def test_write_between_load_and_first_poll_is_not_lost():
+    a = CharacterCatalog.local()
+    b = CharacterCatalog(a.container)
+    await a.create("u1", "Early", tags=["x"])
+    await b.load()
+    # another replica writes before b's feed task gets to its first poll
+    await a.create("u1", "Gap", tags=["x"])
+    assert await b.poll_once() == 1
+    assert sorted(ids(b.query(tags=["x"]))) == ["Early", "Gap"]
+
+
+@pytest.mark.asyncio
+async def test_query_cost_tracks_page_not_catalog():
+    cat = CharacterCatalog.local()
+    rng = random.Random(7)
+    tags = [f"tag{i}" for i in range(40)]
+    for i in range(3000):
+        cat._index({"id": f"char:{i}", "docType": "character", "name": f"name{i} word{i % 50}",
+                    "tags": rng.sample(tags, 3), "nsfw": i % 3 == 0, "chat_count": rng.randint(0, 500),
+                    "created_at": "2024-01-01T00:00:00Z"})
+    started = time.perf_counter()
+    for i in range(200):
+        cat.query(sort="popular", tags=[tags[i % 40]], nsfw=False, q=f"word{i % 50}", limit=20)
+        cat.query(sort="new", limit=50)
+    assert (time.perf_counter() - started) / 400 < 0.005
+
+
+def test_list_and_create_routes(monkeypatch):
+    monkeypatch.setattr(characters_router, "CATALOG", CharacterCatalog.local())
+    app_module.app.dependency_overrides[get_current_user] = lambda: {"user_id": "u1"}
+    try:
+        client = TestClient(app_module.app)
+        created = client.post("/api/v1/characters", json={"name": "Ada", "tags": ["Sci-Fi"]}).json()
+        assert created["id"].startswith("char:") and created["tags"] == ["sci-fi"]
+        r = client.get("/api/v1/characters", params={"tags": "sci-fi", "sort": "new"})
+        assert [c["id"] for c in r.json()["items"]] == [created["id"]]
+        assert client.get("/api/v1/characters", params={"sort": "nope"}).status_code == 400
+        session = client.post("/api/v1/chat/sessions", json={"character_id": created["id"]})
+        assert session.status_code == 200
+        assert characters_router.CATALOG.get(created["id"])["chat_count"] == 1
+        assert client.post("/api/v1/chat/sessions", json={"character_id": "char:nope"}).status_code == 404
+    finally:
+        app_module.app.dependency_overrides.clear()
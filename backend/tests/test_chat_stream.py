@@ -0,0 +1,170 @@
+import asyncio
+import json
+
+import pytest
+from fastapi.testclient import TestClient
+from .. import app as app_module
+from ..auth import create_access_token
+from ..chat_engine import ChatEngine
+from ..chat_socket import ChatConnection
+from ..cosmos_emulator import AsyncInMemoryContainer, InMemoryContainer
+from ..ledger import AsyncLedgerService
+from ..model_service import FakeModelService
+from ..pricing import PricingEngine
+from ..session_store import ChatSessionStore
+
+
+def make_engine(balance=100, **model):
+    inner = InMemoryContainer()
+    inner.create_item({"id": "balance:u1", "docType": "balance", "user_id": "u1", "balance": balance})
+    ledger = AsyncLedgerService(AsyncInMemoryContainer(inner))
+    sessions = ChatSessionStore.local()
+    sessions.container.inner.create_item({"id": "s1", "session_id": "s1", "docType": "chat_session", "user_id": "u1",
+                                          "last_seq": 0, "message_count": 0})
+    # one gem per 10 tokens
+    prices = PricingEngine({"models": {"fake": {"standard": {"input_per_1k": 100, "output_per_1k": 100}}}})
+    engine = ChatEngine(ledger, FakeModelService(**model), sessions=sessions, pricing=prices, max_reply_tokens=100)
+    return engine, ledger, inner
+
+
+def holds(inner):
+    return [d for d in inner.all_items("u1") if d["docType"] == "hold"]
+
+
+class FakeSocket:
+    """Feeds scripted frames; a None frame means the client disconnected."""
+
+    def __init__(self, frames):
+        self.frames = list(frames)
+        self.sent = []
+
+    async def receive_text(self):
+        if not self.frames:
+            await asyncio.sleep(3600)
+        if self.frames[0] is None:
+            await asyncio.sleep(0.05)
+            raise ConnectionError("disconnected")
+        return json.dumps(self.frames.pop(0))
+
+    async def send_text(self, text):
+        self.sent.append(json.loads(text))
+
+
+@pytest.mark.asyncio
+async def test_turn_streams_tokens_and_settles_actual_cost():
+    engine, ledger, inner = make_engine(first_token_ms=0, token_ms=0, reply_tokens=20)
+    events = []
+
+    async def emit(ev):
+        events.append(ev)
+
+    done = await engine.run_turn("u1", "s1", "hello " * 40, emit, "r1")
+    assert [e["type"] for e in events[:2]] == ["chat.accepted", "chat.token"] and events[-1] is done
+    assert done["tokens"] == 20 and done["cost"] < events[0]["estimated_cost"]
+    assert await ledger.get_balance("u1") == 100 - done["cost"]
+    assert holds(inner)[0]["status"] == "settled"
+    assert engine.metrics.snapshot()["completed"] == 1
+
+
+@pytest.mark.asyncio
+async def test_completed_turn_is_persisted_and_feeds_next_prompt():
+    engine, ledger, inner = make_engine(first_token_ms=0, token_ms=0, reply_tokens=3)
+
+    async def emit(ev):
+        pass
+
+    done = await engine.run_turn("u1", "s1", "first question", emit, "r1")
+    context = await engine.sessions.context("s1")
+    assert [(m["role"], m["seq"]) for m in context] == [("user", 1), ("assistant", 2)]
+    assert context[1]["content"] == done["text"] and context[1]["cost"] == done["cost"]
+    prompt = engine.build_prompt(await engine.sessions.get("s1"), "second")
+    assert prompt.text.splitlines() == ["user: first question", f"assistant: {done['text']}", "user: second"]
+
+
+@pytest.mark.asyncio
+async def test_disconnect_mid_stream_cancels_hold():
+    engine, ledger, inner = make_engine(first_token_ms=0, token_ms=20, reply_tokens=50)
+    ws = FakeSocket([{"type": "chat.send", "request_id": "r1", "session_id": "s1", "content": "hi there"}, None])
+    await ChatConnection(ws, "u1", engine).serve()
+    assert any(e["type"] == "chat.token" for e in ws.sent)
+    assert not any(e["type"] == "chat.done" for e in ws.sent)
+    assert holds(inner)[0]["status"] == "cancelled"
+    assert await ledger.get_balance("u1") == 100
+    assert engine.metrics.counts["cancelled"] == 1
+
+
+@pytest.mark.asyncio
+async def test_stalled_client_is_disconnected_and_refunded():
+    engine, ledger, inner = make_engine(first_token_ms=0, token_ms=0, reply_tokens=50)
+
+    class StalledSocket(FakeSocket):
+        async def send_text(self, text):
+            await asyncio.sleep(3600)
+
+    # the client keeps the socket open but never reads
+    ws = StalledSocket([{"type": "chat.send", "request_id": "r1", "session_id": "s1", "content": "hi"}])
+    ws.frames.append({"type": "ping"})
+    conn = ChatConnection(ws, "u1", engine, queue_size=4, send_timeout=0.05)
+    await asyncio.wait_for(conn.serve(), 5)
+    assert holds(inner)[0]["status"] == "cancelled"
+    assert await ledger.get_balance("u1") == 100
+
+
+def test_ws_endpoint_end_to_end(monkeypatch):
+    engine, ledger, inner = make_engine(first_token_ms=0, token_ms=0, reply_tokens=5)
+    monkeypatch.setattr(app_module, "chat_engine", engine)
+    client = TestClient(app_module.app)
+    with client.websocket_connect(f"/ws?token={create_access_token('u1')}") as ws:
+        ws.send_json({"type": "chat.send", "request_id": "r1", "session_id": "s1", "content": "one two"})
+        seen = []
+        while not seen or seen[-1]["type"] not in ("chat.done", "chat.error"):
+            seen.append(ws.receive_json())
+        ws.send_json({"type": "chat.send", "request_id": "r2", "session_id": "other", "content": "x"})
+        assert ws.receive_json() == {"type": "chat.error", "request_id": "r2", "code": 404, "detail": "unknown session"}
+    assert [e["type"] for e in seen].count("chat.token") == 5
+    assert seen[-1]["text"] == "user: one two user: one "
+
+
+def test_http_quote_covers_the_built_prompt(monkeypatch):
+    from ..api import chat as chat_router
+    from ..deps import get_current_user
+
+    engine, _, _ = make_engine()
+    history = [{"role": "user" if i % 2 == 0 else "assistant", "content": f"message number {i} " * 20}
+               for i in range(6)]
+    asyncio.run(engine.sessions.append("s1", history))
+    monkeypatch.setattr(chat_router, "SESSION_STORE", engine.sessions)
+    monkeypatch.setattr(chat_router, "ENGINE", engine)
+    app_module.app.dependency_overrides[get_current_user] = lambda: {"user_id": "u1"}
+    try:
+        r = TestClient(app_module.app).post("/api/v1/chat/sessions/s1/message", json={"content": "hi"})
+    finally:
+        app_module.app.dependency_overrides.clear()
+    assert r.status_code == 200
+    built = engine.build_prompt(asyncio.run(engine.sessions.get("s1")), "hi")
+    assert r.json()["estimated_cost"] == engine.estimate_cost(built.tokens)
+    assert r.json()["prompt_tokens"] == built.tokens > engine.pricing.count("user: hi")
+
+
+def test_chat_is_not_configured_without_a_model_service(monkeypatch):
+    from ..api import chat as chat_router
+    from ..deps import get_current_user
+    from .. import model_service
+
+    engine, _, _ = make_engine()
+    monkeypatch.setattr(model_service, "MODEL_SERVICE", "")
+    monkeypatch.setattr(chat_router, "MODEL_SERVICE", "")
+    monkeypatch.setattr(chat_router, "SESSION_STORE", engine.sessions)
+    monkeypatch.setattr(chat_router, "ENGINE", None)
+    monkeypatch.setattr(app_module, "chat_engine", None)
+    with pytest.raises(ValueError):
+        model_service.get_model_service()
+    app_module.app.dependency_overrides[get_current_user] = lambda: {"user_id": "u1"}
+    try:
+        client = TestClient(app_module.app)
+        r = client.post("/api/v1/chat/sessions/s1/message", json={"content": "hi"})
+        with client.websocket_connect(f"/ws?token={create_access_token(subject='u1')}") as ws:
+            assert ws.receive_json() == {"type": "error", "detail": "chat not configured"}
+    finally:
+        app_module.app.dependency_overrides.clear()
+    assert r.status_code == 503
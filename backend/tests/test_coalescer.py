@@ -0,0 +1,47 @@
+import asyncio
+import pytest
+from ..ledger import AsyncLedgerService
+from ..coalescer import SettlementCoalescer
+from .test_ledger_async import make_container
+
+
+@pytest.mark.asyncio
+async def test_settlements_for_one_user_share_a_batch():
+    c = make_container(balance=1000)
+    svc = AsyncLedgerService(c)
+    holds = [await svc.reserve_hold("user-1", 100) for _ in range(3)]
+    assert await svc.get_balance("user-1") == 700
+    batches_before = len(c.batches)
+
+    co = SettlementCoalescer(svc, window_ms=5)
+    results = await asyncio.gather(
+        co.finalize_hold("user-1", holds[0]["hold_id"], 50),
+        co.finalize_hold("user-1", holds[1]["hold_id"], 150),
+        co.cancel_hold("user-1", holds[2]["hold_id"]),
+        co.cancel_hold("user-1", holds[2]["hold_id"]),
+    )
+
+    assert len(c.batches) == batches_before + 1
+    # applied in arrival order against a running balance
+    assert [r.get("balance_after") for r in results[:3]] == [750, 700, 800]
+    assert results[3] == {"already_settled_or_cancelled": True}
+    assert await svc.get_balance("user-1") == 800
+    # a single balance replace per batch
+    balance_ops = [op for op in c.batches[-1] if op[0] == "replace" and op[1][0] == "balance:user-1"]
+    assert len(balance_ops) == 1
+
+
+@pytest.mark.asyncio
+async def test_coalescer_splits_at_batch_op_limit():
+    c = make_container(balance=1000)
+    svc = AsyncLedgerService(c)
+    holds = [await svc.reserve_hold("user-1", 10) for _ in range(5)]
+    batches_before = len(c.batches)
+
+    co = SettlementCoalescer(svc, window_ms=5, max_batch_ops=7)
+    await asyncio.gather(*[co.cancel_hold("user-1", h["hold_id"]) for h in holds])
+
+    new_batches = c.batches[batches_before:]
+    assert all(len(b) <= 7 for b in new_batches)
+    assert len(new_batches) == 2
+    assert await svc.get_balance("user-1") == 1000
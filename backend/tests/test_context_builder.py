@@ -0,0 +1,91 @@
+import pytest
+from ..context_builder import ContextBuilder, ContextWindow, Summarizer
+from ..session_store import ChatSessionStore
+
+
+def words(line):
+    return len(line.split())
+
+
+class CountingTokenizer:
+    def __init__(self):
+        self.seen = []
+
+    def __call__(self, text):
+        self.seen.append(text)
+        return words(text)
+
+
+async def chat(store, session_id, turns, start=0):
+    for i in range(start, start + turns):
+        await store.append(session_id, [{"role": "user", "content": f"question {i}"},
+                                        {"role": "assistant", "content": f"answer {i}"}])
+
+
+def test_window_cut_picks_newest_lines_that_fit():
+    window = ContextWindow(count_tokens=words)
+    for seq, tokens in enumerate([5, 3, 4, 2], 1):
+        window.add(seq, f"line {seq}", tokens)
+    assert window.cut(6) == 2 and window.tokens_from(2) == 6
+    assert window.cut(5) == 3
+    assert window.cut(100) == 0
+    assert window.cut(0) == 4
+
+
+@pytest.mark.asyncio
+async def test_only_new_messages_are_tokenized():
+    store = ChatSessionStore.local()
+    sess = await store.create("u1", "c1")
+    tokenizer = CountingTokenizer()
+    builder = ContextBuilder(budget=1000, count_tokens=tokenizer)
+    await chat(store, sess.session_id, 3)
+    first = builder.build(sess, "next", persona="You are Ada.")
+    assert first.text.splitlines()[0] == "system: You are Ada." and first.history_messages == 6
+    tokenizer.seen.clear()
+    await chat(store, sess.session_id, 1, start=3)
+    second = builder.build(sess, "again")
+    history = [t for t in tokenizer.seen if t.startswith(("user: question", "assistant: answer"))]
+    assert history == ["user: question 3", "assistant: answer 3"]
+    assert second.tokens == sum(words(line) for line in second.text.splitlines())
+    assert builder.metrics.snapshot()["builds"] == 2
+
+
+@pytest.mark.asyncio
+async def test_evicted_turns_are_folded_into_summary_off_request_path():
+    store = ChatSessionStore.local()
+    sess = await store.create("u1", "c1")
+    builder = ContextBuilder(budget=14, count_tokens=words)
+    await chat(store, sess.session_id, 4)
+    built = builder.build(sess, "hi")
+    # 2 tokens for the new line leaves 12: the newest two turns
+    assert built.history_messages == 4 and built.dropped_messages == 4
+    assert "summary:" not in built.text
+    await builder.drain()
+    assert sess.window.summary == "- question 0\n- question 1" and sess.doc["summary_seq"] == 4
+    again = builder.build(sess, "hi")
+    assert again.text.startswith("summary: - question 0\n- question 1\n")
+    assert again.tokens == sum(words(line) for line in again.text.splitlines()) <= 14
+    # the summary rides along with the next append
+    await chat(store, sess.session_id, 1, start=4)
+    assert store.container.inner.read_item(sess.session_id, sess.session_id)["summary_seq"] == 4
+
+
+@pytest.mark.asyncio
+async def test_failed_fold_is_retried_next_turn():
+    class Broken(Summarizer):
+        calls = 0
+
+        async def summarize(self, summary, lines):
+            Broken.calls += 1
+            raise RuntimeError("model down")
+
+    store = ChatSessionStore.local()
+    sess = await store.create("u1", "c1")
+    builder = ContextBuilder(budget=6, summarizer=Broken(), count_tokens=words)
+    await chat(store, sess.session_id, 3)
+    builder.build(sess, "hi")
+    await builder.drain()
+    builder.build(sess, "hi")
+    await builder.drain()
+    assert Broken.calls == 2 and builder.metrics.counts["fold_failures"] == 2
+    assert sess.window.start == 0
@@ -0,0 +1,103 @@
+import asyncio
+import threading
+
+import pytest
+from ..cosmos_emulator import AsyncInMemoryContainer, InMemoryContainer, run_query
+from ..ledger import AsyncLedgerService, LedgerService
+from ..retry import RetryPolicy
+from ..sweeper import HoldSweeper
+
+
+def seeded(users=("u1",), balance=1000):
+    c = InMemoryContainer()
+    for u in users:
+        c.create_item({"id": f"balance:{u}", "docType": "balance", "user_id": u, "balance": balance})
+    return c
+
+
+def test_query_subset():
+    docs = [{"id": str(i), "user_id": "u1", "docType": "ledger_event", "change": i - 2, "created_at": f"t{i}"} for i in range(5)]
+    docs.append({"id": "b", "user_id": "u1", "docType": "balance"})
+    ev = "c.docType='ledger_event'"
+    assert run_query(f"SELECT VALUE SUM(c.change) FROM c WHERE {ev}", docs) == [0]
+    assert run_query("SELECT VALUE COUNT(1) FROM c WHERE c.docType='balance'", docs) == [1]
+    top = run_query(f"SELECT TOP @n c.id, c.change FROM c WHERE {ev} AND c.created_at > @after ORDER BY c.created_at DESC",
+                    docs, [{"name": "@n", "value": 2}, {"name": "@after", "value": "t1"}])
+    assert top == [{"id": "4", "change": 2}, {"id": "3", "change": 1}]
+    # missing properties are undefined, so the comparison is false rather than an error
+    assert [d["id"] for d in run_query("SELECT * FROM c WHERE c.change < 0 OR (NOT IS_DEFINED(c.change))", docs)] == ["0", "1", "b"]
+    assert run_query("SELECT VALUE c.id FROM c WHERE c.id IN ('1', 'b')", docs) == ["1", "b"]
+
+
+def test_batch_is_atomic_and_checks_etag():
+    c = seeded()
+    doc = c.read_item("balance:u1", partition_key="u1")
+    batch = c.create_transactional_batch("u1")
+    batch.create_item({"id": "evt:1", "user_id": "u1", "docType": "ledger_event"})
+    batch.replace_item("balance:u1", dict(doc, balance=1), if_match="stale")
+    resp = batch.execute()
+    assert not resp.is_successful and resp.status_code == 412
+    # the create before the failed replace was rolled back with it
+    assert [d["id"] for d in c.all_items("u1")] == ["balance:u1"]
+    assert c.stats["conflicts_412"] == 1
+
+    batch = c.create_transactional_batch("u1")
+    batch.replace_item("balance:u1", dict(doc, balance=1), if_match=doc["_etag"])
+    assert batch.execute().is_successful
+    assert c.read_item("balance:u1", partition_key="u1")["_etag"] != doc["_etag"]
+
+
+def test_sync_ledger_concurrent_threads_keep_balance():
+    c = seeded(balance=10_000)
+    svc = LedgerService(c, retry_policy=RetryPolicy(max_retries=50, base_ms=0, max_ms=1))
+
+    def worker():
+        for _ in range(20):
+            h = svc.reserve_hold("u1", 10)
+            svc.finalize_hold("u1", h["hold_id"], actual_cost=4)
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert svc.get_balance_doc("u1")["balance"] == 10_000 - 8 * 20 * 4
+    assert sum(e["change"] for e in svc.iter_ledger_events("u1")) == -8 * 20 * 4
+
+
+@pytest.mark.asyncio
+async def test_async_ledger_conflicts_under_latency():
+    c = AsyncInMemoryContainer(seeded(balance=1000), latency_ms=1)
+    svc = AsyncLedgerService(c, retry_policy=RetryPolicy(max_retries=100, base_ms=0, max_ms=2))
+    holds = await asyncio.gather(*[svc.reserve_hold("u1", 5) for _ in range(20)])
+    assert await svc.get_balance("u1") == 900
+    assert len({h["hold_id"] for h in holds}) == 20
+    # interleaved read-then-batch on one partition is exactly what the etag check rejects
+    assert c.stats["conflicts_412"] > 0
+    assert c.inner.hot_partitions(1)[0][0] == "u1"
+
+    page = await svc.list_ledger_events_page("u1", limit=7)
+    rest = [e async for e in svc.iter_ledger_events("u1", page_size=7)]
+    assert len(page["items"]) == 7 and page["next_cursor"] and len(rest) == 20
+
+
+@pytest.mark.asyncio
+async def test_change_feed_and_sweeper_queries():
+    inner = seeded(users=("u1", "u2"), balance=100)
+    c = AsyncInMemoryContainer(inner)
+    svc = AsyncLedgerService(c)
+    seen = {}
+
+    def hook(headers, _):
+        seen.update(headers)
+
+    assert [d async for d in c.query_items_change_feed(start_time="Now", response_hook=hook)] == []
+    h = await svc.reserve_hold("u2", 30)
+    changed = [d async for d in c.query_items_change_feed(continuation=seen["etag"])]
+    assert {d["docType"] for d in changed} >= {"hold", "balance", "ledger_event"}
+
+    inner._partitions["u2"][h["hold_id"]]["created_at"] = "2000-01-01T00:00:00Z"
+    sweeper = HoldSweeper(svc, ttl_seconds=60)
+    assert await sweeper.run_once() == 1
+    assert await svc.get_balance("u2") == 100
+    assert sweeper.stats["backlog"] == 0
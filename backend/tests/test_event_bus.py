@@ -0,0 +1,89 @@
+import asyncio
+
+import pytest
+from fastapi.testclient import TestClient
+from .. import app as app_module
+from ..auth import create_access_token
+from ..chat_socket import ChatConnection
+from ..connection_registry import ConnectionRegistry
+from ..cosmos_emulator import AsyncInMemoryContainer, InMemoryContainer
+from ..event_bus import EventBus, balance_event
+from ..gen_jobs import FakeImageGenerator, GenerationService
+from ..job_queue import InMemoryJobQueue
+from ..ledger import AsyncLedgerService
+from ..pricing import PricingEngine
+from .test_chat_stream import FakeSocket, make_engine
+
+
+def make_ledger(bus, balance=100):
+    inner = InMemoryContainer()
+    inner.create_item({"id": "balance:u1", "docType": "balance", "user_id": "u1", "balance": balance})
+    return AsyncLedgerService(AsyncInMemoryContainer(inner), events=bus)
+
+
+@pytest.mark.asyncio
+async def test_ledger_and_job_changes_reach_only_the_owner():
+    bus, registry = EventBus(), ConnectionRegistry()
+    bus.subscribe(registry.deliver)
+    mine, other = registry.register("u1"), registry.register("u2")
+    ledger = make_ledger(bus)
+    service = GenerationService(ledger, InMemoryJobQueue(), GenerationService.local_container(),
+                                generator=FakeImageGenerator(latency_ms=0), events=bus,
+                                pricing=PricingEngine({"models": {"image": {"fast": {"per_unit": 1}}}}))
+    job = await service.submit("u1", "x", 4, "fast")
+    [lease] = await service.queue.receive()
+    await service.process(lease)
+
+    events = mine.drain()
+    # four balance changes (hold, finalize) and five job saves collapse to one of each
+    assert [e["type"] for e in events] == ["balance.updated", "job.updated"]
+    assert events[0]["balance"] == 96 and events[1]["id"] == job["id"] and events[1]["status"] == "completed"
+    assert "prompt" not in events[1] and other.drain() == []
+    assert registry.stats["coalesced"] > 0
+    registry.unregister(mine)
+    registry.unregister(other)
+    assert registry.snapshot()["connections"] == 0
+
+
+def test_bounded_buffer_falls_back_to_resync():
+    registry = ConnectionRegistry(max_pending=3)
+    sub = registry.register("u1")
+    for i in range(4):
+        registry.deliver({"type": "job.updated", "user_id": "u1", "id": f"job:{i}", "status": "queued"})
+    registry.deliver(balance_event("u1", 1, "2024-01-01T00:00:02Z"))
+    # an older balance arriving late does not overwrite the newer one
+    registry.deliver(balance_event("u1", 0, "2024-01-01T00:00:01Z"))
+    assert sub.drain() == [{"type": "resync"}, balance_event("u1", 1, "2024-01-01T00:00:02Z")]
+    assert registry.stats["overflows"] == 1
+
+
+@pytest.mark.asyncio
+async def test_chat_socket_pushes_events_without_user_id():
+    engine, ledger, inner = make_engine()
+    registry = ConnectionRegistry()
+    sub = registry.register("u1")
+    ws = FakeSocket([{"type": "ping"}])
+    conn = ChatConnection(ws, "u1", engine, subscription=sub)
+    serving = asyncio.create_task(conn.serve())
+    registry.deliver(balance_event("u1", 7))
+    for _ in range(50):
+        if len(ws.sent) >= 2:
+            break
+        await asyncio.sleep(0.01)
+    serving.cancel()
+    await asyncio.gather(serving, return_exceptions=True)
+    await conn.close()
+    assert {"type": "balance.updated", "balance": 7, "updated_at": None} in ws.sent
+    assert {"type": "pong"} in ws.sent
+
+
+def test_ws_sends_current_balance_on_connect(monkeypatch):
+    engine, ledger, inner = make_engine(balance=42)
+    monkeypatch.setattr(app_module, "chat_engine", engine)
+    monkeypatch.setattr(app_module, "ledger_service", ledger)
+    client = TestClient(app_module.app)
+    with client.websocket_connect(f"/ws?token={create_access_token('u1')}") as ws:
+        first = ws.receive_json()
+        assert first["type"] == "balance.updated" and first["balance"] == 42
+        assert app_module.connections.snapshot()["connections"] == 1
+    assert app_module.connections.snapshot()["connections"] == 0
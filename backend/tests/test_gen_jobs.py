@@ -0,0 +1,195 @@
+import asyncio
+
+import pytest
+from fastapi.testclient import TestClient
+from .. import app as app_module
+from ..api import generate as generate_router
+from ..cosmos_emulator import AsyncInMemoryContainer, InMemoryContainer
+from ..deps import get_current_user
+from ..gen_jobs import FakeImageGenerator, GenerationService, ImageGenerator, JobError
+from ..job_queue import InMemoryJobQueue
+from ..ledger import AsyncLedgerService
+from ..pricing import PricingEngine
+
+PRICES = {"models": {"image": {"fast": {"per_unit": 1}, "balanced": {"per_unit": 2}}}}
+
+
+def make_service(balance=100, generator=None, **kw):
+    inner = InMemoryContainer()
+    inner.create_item({"id": "balance:u1", "docType": "balance", "user_id": "u1", "balance": balance})
+    ledger = AsyncLedgerService(AsyncInMemoryContainer(inner))
+    service = GenerationService(ledger, InMemoryJobQueue(), GenerationService.local_container(),
+                                generator=generator or FakeImageGenerator(latency_ms=0),
+                                pricing=PricingEngine(PRICES), retry_backoff=0, poll_ms=5, **kw)
+    return service, ledger
+
+
+async def run_next(service):
+    [lease] = await service.queue.receive(1, service.visibility_timeout)
+    await service.process(lease)
+
+
+class Flaky(ImageGenerator):
+    def __init__(self, failures):
+        self.failures = failures
+
+    async def generate(self, job):
+        if self.failures:
+            self.failures -= 1
+            raise RuntimeError("backend down")
+        return await FakeImageGenerator(latency_ms=0).generate(job)
+
+
+@pytest.mark.asyncio
+async def test_job_holds_then_charges_only_delivered_images():
+    service, ledger = make_service(generator=FakeImageGenerator(latency_ms=0, fail_indexes=[1]))
+    first = await service.submit("u1", "a cat", 4, "balanced")
+    second = await service.submit("u1", "a dog", 1, "fast")
+    assert first["status"] == "queued" and first["estimated_cost"] == 8 and first["queue_position"] == 0
+    assert (await service.get("u1", second["id"]))["queue_position"] == 1
+    assert await ledger.get_balance("u1") == 91
+
+    await run_next(service)
+    done = await service.get("u1", first["id"])
+    # 3 of 4 images came out: 8 * 3/4
+    assert done["status"] == "partial" and done["actual_cost"] == 6 and len(done["results"]) == 4
+    assert await ledger.get_balance("u1") == 93
+    with pytest.raises(JobError) as e:
+        await service.get("u2", first["id"])
+    assert e.value.code == 404
+
+
+@pytest.mark.asyncio
+async def test_validation_funds_and_cancel():
+    service, ledger = make_service(balance=5)
+    for count, quality in ((3, "fast"), (1, "ultra")):
+        with pytest.raises(JobError) as e:
+            await service.submit("u1", "x", count, quality)
+        assert e.value.code == 400
+    with pytest.raises(JobError) as e:
+        await service.submit("u1", "x", 9, "fast")
+    assert e.value.code == 402
+
+    job = await service.submit("u1", "x", 4, "fast")
+    assert await ledger.get_balance("u1") == 1
+    assert (await service.cancel("u1", job["id"]))["status"] == "cancelled"
+    assert await ledger.get_balance("u1") == 5
+    # the worker drops the message without generating
+    await run_next(service)
+    assert await service.queue.depth() == 0
+    with pytest.raises(JobError) as e:
+        await service.cancel("u1", job["id"])
+    assert e.value.code == 409
+
+
+@pytest.mark.asyncio
+async def test_retried_submit_returns_the_same_job():
+    service, ledger = make_service()
+    first = await service.submit("u1", "a cat", 4, "balanced", idempotency_key="k1")
+    again = await service.submit("u1", "a cat", 4, "balanced", idempotency_key="k1")
+    assert again["id"] == first["id"] and again["hold_id"] == first["hold_id"] and again["queue_position"] == 0
+    assert await service.queue.depth() == 1 and service.metrics.counts["submitted"] == 1
+    assert await ledger.get_balance("u1") == 92
+
+    await run_next(service)
+    assert (await service.submit("u1", "a cat", 4, "balanced", idempotency_key="k1"))["status"] == "completed"
+    assert await service.queue.depth() == 0 and await ledger.get_balance("u1") == 92
+
+
+@pytest.mark.asyncio
+async def test_retries_with_backoff_then_dead_letters_and_refunds():
+    service, ledger = make_service(generator=Flaky(failures=1), max_attempts=2)
+    ok = await service.submit("u1", "x", 1, "fast")
+    await run_next(service)
+    assert (await service.get("u1", ok["id"]))["status"] == "queued"
+    await run_next(service)
+    assert (await service.get("u1", ok["id"]))["status"] == "completed"
+    assert service.metrics.counts["retries"] == 1
+
+    service.generator = Flaky(failures=5)
+    bad = await service.submit("u1", "x", 4, "fast")
+    await run_next(service)
+    await run_next(service)
+    failed = await service.get("u1", bad["id"])
+    assert failed["status"] == "failed" and "backend down" in failed["error"]
+    assert len(await service.queue.dead_letters()) == 1
+    assert await ledger.get_balance("u1") == 99
+
+
+@pytest.mark.asyncio
+async def test_redelivery_after_results_settles_without_regenerating():
+    calls = []
+
+    class Counting(FakeImageGenerator):
+        async def generate(self, job):
+            calls.append(job["id"])
+            return await super().generate(job)
+
+    service, ledger = make_service(generator=Counting(latency_ms=0))
+    job = await service.submit("u1", "x", 1, "fast")
+    [lease] = await service.queue.receive()
+    job = await service._save("u1", job["id"], lambda d: d.update(status="settling", actual_cost=1,
+                                                                  results=[{"index": 0, "ok": True}]))
+    await service.queue.abandon(lease)
+    await run_next(service)
+    assert calls == [] and (await service.get("u1", job["id"]))["status"] == "completed"
+    assert await ledger.get_balance("u1") == 99
+
+
+@pytest.mark.asyncio
+async def test_swept_hold_is_charged_again_or_fails_the_job():
+    service, ledger = make_service()
+    job = await service.submit("u1", "a cat", 4, "balanced")
+    # the expired-hold sweeper refunds the hold while the job is still queued
+    await ledger.cancel_hold("u1", job["hold_id"])
+    assert await ledger.get_balance("u1") == 100
+    await run_next(service)
+    done = await service.get("u1", job["id"])
+    assert done["status"] == "completed" and done["charge_hold_id"] != job["hold_id"]
+    assert done["balance_after"] == 92 and await ledger.get_balance("u1") == 92
+
+    broke, ledger = make_service(balance=8)
+    job = await broke.submit("u1", "a cat", 4, "balanced")
+    await ledger.cancel_hold("u1", job["hold_id"])
+    await ledger.reserve_hold("u1", 5)
+    await run_next(broke)
+    failed = await broke.get("u1", job["id"])
+    assert failed["status"] == "failed" and failed["results"] == [] and "balance" in failed["error"]
+    assert await ledger.get_balance("u1") == 3 and await broke.queue.depth() == 0
+
+
+@pytest.mark.asyncio
+async def test_workers_drain_the_queue_concurrently():
+    service, ledger = make_service(generator=FakeImageGenerator(latency_ms=50), concurrency=4)
+    jobs = [await service.submit("u1", "x", 1, "fast") for _ in range(8)]
+    service.start()
+    try:
+        for _ in range(100):
+            if service.metrics.counts["completed"] == 8:
+                break
+            await asyncio.sleep(0.02)
+    finally:
+        await service.stop()
+    assert [(await service.get("u1", j["id"]))["status"] for j in jobs] == ["completed"] * 8
+    snap = await service.snapshot()
+    assert snap["throughput_per_min"] == 8 and snap["queue_depth"] == 0 and snap["run_ms_p50"] >= 40
+
+
+def test_routes(monkeypatch):
+    service, _ = make_service()
+    monkeypatch.setattr(generate_router, "SERVICE", service)
+    app_module.app.dependency_overrides[get_current_user] = lambda: {"user_id": "u1"}
+    try:
+        client = TestClient(app_module.app)
+        r = client.post("/api/v1/generate", json={"prompt": "a cat", "count": 4, "quality": "fast"})
+        assert r.status_code == 202 and r.json()["queue_position"] == 0
+        job_id = r.json()["id"]
+        assert client.get(f"/api/v1/generate/{job_id}").json()["status"] == "queued"
+        assert client.post("/api/v1/generate", json={"prompt": "x", "count": 2}).status_code == 400
+        assert client.delete(f"/api/v1/generate/{job_id}").json()["status"] == "cancelled"
+        # job metrics are only exported through the app-wide /metrics collector
+        assert "gen_jobs_cancelled 1" in client.get("/metrics").text
+        monkeypatch.setattr(generate_router, "SERVICE", None)
+        assert client.get(f"/api/v1/generate/{job_id}").status_code == 503
+    finally:
+        app_module.app.dependency_overrides.clear()
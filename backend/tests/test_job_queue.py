@@ -0,0 +1,74 @@
+import pytest
+from .. import job_queue
+from ..job_queue import InMemoryJobQueue, LeaseLost, SqliteJobQueue
+
+
+class Clock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture(params=["memory", "sqlite"])
+def queue_and_clock(request, tmp_path):
+    clock = Clock()
+    if request.param == "memory":
+        queue = InMemoryJobQueue(max_deliveries=2, clock=clock)
+    else:
+        queue = SqliteJobQueue(str(tmp_path / "q.sqlite3"), max_deliveries=2, clock=clock)
+    yield queue, clock
+
+
+@pytest.mark.asyncio
+async def test_peek_lock_lifecycle(queue_and_clock):
+    queue, clock = queue_and_clock
+    a = await queue.send({"n": 1})
+    b = await queue.send({"n": 2})
+    assert await queue.position(a) == 0 and await queue.position(b) == 1
+
+    [lease] = await queue.receive(1, visibility_timeout=10)
+    assert lease.body == {"n": 1} and lease.delivery_count == 1
+    # hidden while leased
+    [other] = await queue.receive(1, visibility_timeout=10)
+    assert other.body == {"n": 2}
+    await queue.complete(other)
+    assert await queue.position(b) is None and await queue.depth() == 1
+
+    # an expired lease is redelivered and the old holder can no longer settle it
+    clock.now += 11
+    [again] = await queue.receive(1, visibility_timeout=10)
+    assert again.message_id == a and again.delivery_count == 2
+    with pytest.raises(LeaseLost):
+        await queue.complete(lease)
+    await queue.renew(again, 30)
+    clock.now += 20
+    await queue.abandon(again)
+
+    # past max deliveries it moves to the dead letters instead of being handed out
+    assert await queue.receive(1) == []
+    assert [d["body"] for d in await queue.dead_letters()] == [{"n": 1}]
+    assert await queue.depth() == 0
+    await queue.close()
+
+
+@pytest.mark.asyncio
+async def test_abandon_with_delay_and_dead_letter(queue_and_clock):
+    queue, clock = queue_and_clock
+    await queue.send({"n": 1})
+    [lease] = await queue.receive()
+    await queue.abandon(lease, delay=5)
+    assert await queue.receive() == []
+    clock.now += 5
+    [lease] = await queue.receive()
+    await queue.dead_letter(lease, "bad input")
+    assert (await queue.dead_letters())[0]["reason"] == "bad input"
+    await queue.close()
+
+
+def test_queue_must_be_chosen_outside_dev(monkeypatch):
+    monkeypatch.setattr(job_queue, "JOB_QUEUE", "")
+    with pytest.raises(ValueError):
+        job_queue.get_job_queue()
+    assert isinstance(job_queue.get_job_queue("memory"), InMemoryJobQueue)
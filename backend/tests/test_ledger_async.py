@@ -0,0 +1,117 @@
+import pytest
+from ..ledger import AsyncLedgerService, InsufficientFunds
+
+
+class NotFound(Exception):
+    status_code = 404
+
+
+class AsyncContainer:
+    def __init__(self, docs):
+        self.docs = {d["id"]: dict(d) for d in docs}
+        self.batches = []
+
+    async def read_item(self, item, partition_key):
+        if item not in self.docs:
+            raise NotFound("not found")
+        return dict(self.docs[item])
+
+    async def execute_item_batch(self, batch_operations, partition_key):
+        self.batches.append(batch_operations)
+        for op, args, kwargs in batch_operations:
+            if op == "create":
+                self.docs[args[0]["id"]] = dict(args[0])
+            else:
+                item_id, body = args
+                self.docs[item_id] = dict(body)
+        return [{"statusCode": 200} for _ in batch_operations]
+
+    def query_items(self, query, parameters, partition_key, max_item_count=None, **kwargs):
+        events = sorted((d for d in self.docs.values() if d.get("docType") == "ledger_event" and d["user_id"] == partition_key),
+                        key=lambda d: d["created_at"], reverse=True)
+        return _Pager(events, max_item_count or len(events))
+
+
+class _Pager:
+    """Minimal AsyncItemPaged stand-in: by_page(token) with continuation tokens."""
+
+    def __init__(self, items, page_size):
+        self.items = items
+        self.page_size = page_size
+        self.continuation_token = None
+
+    def by_page(self, continuation_token=None):
+        self.start = int(continuation_token or 0)
+        return self
+
+    def __aiter__(self):
+        return self._pages()
+
+    async def _pages(self):
+        start = self.start
+        while start < len(self.items):
+            end = start + self.page_size
+            self.continuation_token = str(end) if end < len(self.items) else None
+            yield self._page(self.items[start:end])
+            start = end
+
+    async def _page(self, items):
+        for item in items:
+            yield item
+
+
+def make_container(balance=1000):
+    return AsyncContainer([
+        {"id": "balance:user-1", "docType": "balance", "user_id": "user-1", "balance": balance, "_etag": "etag-1"},
+    ])
+
+
+@pytest.mark.asyncio
+async def test_async_reserve_finalize_cancel():
+    c = make_container(balance=1000)
+    svc = AsyncLedgerService(c)
+
+    out = await svc.reserve_hold("user-1", 100, idempotency_key="k1")
+    assert out["balance_after"] == 900
+    # balance replace carries the etag read before the batch
+    balance_op = [op for op in c.batches[0] if op[0] == "replace" and op[1][0] == "balance:user-1"][0]
+    assert balance_op[2] == {"if_match_etag": "etag-1"}
+    # a replay is answered from the in-process cache without another batch
+    replayed = await svc.reserve_hold("user-1", 100, idempotency_key="k1")
+    assert replayed["hold_id"] == out["hold_id"] and len(c.batches) == 1
+
+    fin = await svc.finalize_hold("user-1", out["hold_id"], actual_cost=60)
+    assert fin["balance_after"] == 940
+    again = await svc.finalize_hold("user-1", out["hold_id"], actual_cost=60)
+    assert again == {"already_settled": True}
+
+    out2 = await svc.reserve_hold("user-1", 40)
+    cancelled = await svc.cancel_hold("user-1", out2["hold_id"])
+    assert cancelled == {"refunded": 40, "balance_after": 940}
+    assert await svc.get_balance("user-1") == 940
+
+
+@pytest.mark.asyncio
+async def test_async_reserve_insufficient():
+    svc = AsyncLedgerService(make_container(balance=10))
+    with pytest.raises(InsufficientFunds):
+        await svc.reserve_hold("user-1", 100)
+
+
+@pytest.mark.asyncio
+async def test_async_ledger_pages_with_cursor():
+    c = make_container(balance=1000)
+    svc = AsyncLedgerService(c)
+    for _ in range(5):
+        await svc.reserve_hold("user-1", 10)
+
+    first = await svc.list_ledger_events_page("user-1", limit=2)
+    assert len(first["items"]) == 2 and first["next_cursor"]
+    second = await svc.list_ledger_events_page("user-1", limit=2, cursor=first["next_cursor"])
+    third = await svc.list_ledger_events_page("user-1", limit=2, cursor=second["next_cursor"])
+    assert len(third["items"]) == 1 and third["next_cursor"] is None
+    ids = [e["id"] for page in (first, second, third) for e in page["items"]]
+    assert len(set(ids)) == 5
+
+    streamed = [e["id"] async for e in svc.iter_ledger_events("user-1", page_size=2)]
+    assert streamed == ids
@@ -1,11 +1,17 @@
 import pytest
 from unittest.mock import MagicMock
-from ..ledger import LedgerService, InsufficientFunds
+from ..ledger import LedgerService, InsufficientFunds, ConcurrencyConflict
+from ..retry import RetryPolicy
 
 
 class DummyResp:
-    def __init__(self, successful=True):
+    def __init__(self, successful=True, status_code=200):
         self.is_successful = successful
+        self.status_code = status_code
+
+
+class NotFound(Exception):
+    status_code = 404
 
 
 class DummyBatch:
@@ -33,7 +39,7 @@ def make_container(balance=1000):
             return dict(balance_doc)
         if item == hold_doc["id"]:
             return dict(hold_doc)
-        raise Exception("not found")
+        raise NotFound("not found")
 
     container.read_item.side_effect = read_item
     container.create_transactional_batch.side_effect = lambda partition_key: DummyBatch()
@@ -68,7 +74,7 @@ def test_finalize_hold_refund_and_debit():
             return {"id": "balance:user-1", "docType": "balance", "user_id": "user-1", "balance": 800, "_etag": 'etag-2'}
         if item == "hold:h1":
             return dict(hold)
-        raise Exception("not found")
+        raise NotFound("not found")
 
     c.read_item.side_effect = read_item
     c.create_transactional_batch.side_effect = lambda partition_key: DummyBatch()
@@ -84,9 +90,81 @@ def test_finalize_hold_refund_and_debit():
             return {"id": "balance:user-1", "docType": "balance", "user_id": "user-1", "balance": 900, "_etag": 'etag-3'}
         if item == "hold:h2":
             return dict(hold2)
-        raise Exception("not found")
+        raise NotFound("not found")
 
     c.read_item.side_effect = read_item2
     out_debit = svc.finalize_hold("user-1", "hold:h2", actual_cost=250)
     # hold was 100, actual 250 -> delta 150 debited from 900 -> 750
     assert out_debit["balance_after"] == 750
+
+
+def test_reserve_hold_retries_on_etag_conflict():
+    c = make_container(balance=1000)
+    results = [DummyResp(successful=False, status_code=412), DummyResp(successful=True)]
+
+    class ConflictBatch(DummyBatch):
+        def execute(self):
+            return results.pop(0)
+
+    c.create_transactional_batch.side_effect = lambda partition_key: ConflictBatch()
+    svc = LedgerService(c, retry_policy=RetryPolicy(max_retries=3, base_ms=0))
+    out = svc.reserve_hold("user-1", 100)
+    assert out["balance_after"] == 900
+    # balance re-read once per attempt
+    assert c.read_item.call_count == 2
+    assert svc.conflict_stats.for_user("user-1") == {"conflicts": 1, "retries": 1, "exhausted": 0}
+
+
+def test_reserve_hold_conflict_budget_exhausted():
+    c = make_container(balance=1000)
+
+    class AlwaysConflict(DummyBatch):
+        def execute(self):
+            return DummyResp(successful=False, status_code=412)
+
+    c.create_transactional_batch.side_effect = lambda partition_key: AlwaysConflict()
+    svc = LedgerService(c, retry_policy=RetryPolicy(max_retries=2, base_ms=0))
+    with pytest.raises(ConcurrencyConflict):
+        svc.reserve_hold("user-1", 100)
+    assert svc.conflict_stats.for_user("user-1") == {"conflicts": 3, "retries": 2, "exhausted": 1}
+
+
+def test_reserve_hold_replay_returns_cached_result():
+    c = make_container(balance=1000)
+    batches = []
+
+    def make_batch(partition_key):
+        batches.append(DummyBatch())
+        return batches[-1]
+
+    c.create_transactional_batch.side_effect = make_batch
+    svc = LedgerService(c)
+    first = svc.reserve_hold("user-1", 100, idempotency_key="k-replay")
+    # idempotency record is written in the same batch as the hold
+    created = [op[1] for op in batches[0].ops if op[0] == "create"]
+    assert any(d["id"] == "idem:k-replay" and d["result"]["hold_id"] == first["hold_id"] for d in created)
+
+    again = svc.reserve_hold("user-1", 100, idempotency_key="k-replay")
+    assert again["hold_id"] == first["hold_id"]
+    assert again["balance_after"] == 900
+    assert again["replayed"] is True
+    assert len(batches) == 1
+
+
+def test_reserve_hold_replay_from_partition_record():
+    c = make_container(balance=1000)
+    record = {"id": "idem:k9", "docType": "idempotency", "user_id": "user-1", "idempotency_key": "k9",
+              "operation": "reserve_hold", "request": {"amount": 100},
+              "result": {"hold_id": "hold:orig", "event_id": "evt:orig", "balance_after": 900}}
+    base_read = c.read_item.side_effect
+
+    def read_item(item, partition_key):
+        if item == "idem:k9":
+            return dict(record)
+        return base_read(item, partition_key)
+
+    c.read_item.side_effect = read_item
+    svc = LedgerService(c)
+    out = svc.reserve_hold("user-1", 100, idempotency_key="k9")
+    assert out["hold_id"] == "hold:orig"
+    c.create_transactional_batch.assert_not_called()
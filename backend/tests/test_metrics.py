@@ -0,0 +1,103 @@
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from .. import app as app_module
+from ..cosmos_emulator import AsyncInMemoryContainer, InMemoryContainer
+from ..ledger import AsyncLedgerService
+from ..metrics import (COSMOS_REQUESTS, COSMOS_RU, COSMOS_SECONDS, AsyncTimedContainer, MetricsMiddleware, Registry,
+                       TimedContainer, span)
+
+
+@pytest.mark.asyncio
+async def test_registry_renders_histograms_and_collectors():
+    registry = Registry()
+    hist = registry.histogram("op_seconds", "op latency", ("op",), buckets=(0.1, 1.0))
+    for value in (0.05, 0.5, 5.0):
+        hist.observe(value, ("read",))
+    registry.counter("calls_total", "calls").inc()
+
+    async def snapshot():
+        return {"depth": 3, "p50-ms": 1.5, "nested": {"ok": True}, "label": "skipped"}
+
+    registry.add_collector("queue", snapshot)
+    text = await registry.render()
+    assert 'op_seconds_bucket{op="read",le="0.1"} 1' in text
+    assert 'op_seconds_bucket{op="read",le="1.0"} 2' in text
+    assert 'op_seconds_bucket{op="read",le="+Inf"} 3' in text
+    assert 'op_seconds_count{op="read"} 3' in text and "calls_total 1.0" in text
+    assert "queue_depth 3" in text and "queue_p50_ms 1.5" in text and "queue_nested_ok 1" in text
+    assert "label" not in text
+
+
+@pytest.mark.asyncio
+async def test_ledger_cosmos_calls_are_timed_with_status_and_ru():
+    inner = InMemoryContainer()
+    inner.create_item({"id": "balance:u1", "docType": "balance", "user_id": "u1", "balance": 50})
+    ledger = AsyncLedgerService(AsyncInMemoryContainer(inner))
+    reads = COSMOS_REQUESTS.values.get(("ledger", "read_item", "200"), 0)
+    missing = COSMOS_REQUESTS.values.get(("ledger", "read_item", "404"), 0)
+    batch_ru = COSMOS_RU.values.get(("ledger", "execute_item_batch"), 0)
+
+    await ledger.reserve_hold("u1", 10)
+    with pytest.raises(Exception):
+        await ledger.get_balance("nobody")
+    assert COSMOS_REQUESTS.values[("ledger", "read_item", "200")] > reads
+    assert COSMOS_REQUESTS.values[("ledger", "read_item", "404")] == missing + 1
+    assert COSMOS_RU.values[("ledger", "execute_item_batch")] > batch_ru
+    assert COSMOS_SECONDS.values[("ledger", "execute_item_batch")][2] >= 1
+    # everything else is passed through untouched
+    assert ledger.container.inner is inner
+
+
+@pytest.mark.asyncio
+async def test_queries_are_counted_and_charged_per_page():
+    inner = InMemoryContainer()
+    for i in range(5):
+        inner.create_item({"id": f"d{i}", "user_id": "u1", "n": i})
+    sync = TimedContainer(inner, "sync_test")
+    pager = sync.query_items("SELECT * FROM c", partition_key="u1", max_item_count=2)
+    assert ("sync_test", "query_items", "200") not in COSMOS_REQUESTS.values
+    assert len(list(pager)) == 5
+    assert COSMOS_REQUESTS.values[("sync_test", "query_items", "200")] == 3
+    assert COSMOS_RU.values[("sync_test", "query_items")] > 0
+
+    seen = []
+    aio = AsyncTimedContainer(AsyncInMemoryContainer(inner), "async_test")
+    pages = aio.query_items("SELECT * FROM c", partition_key="u1", max_item_count=4,
+                            response_hook=lambda headers, page: seen.append(len(page))).by_page()
+    assert [len([d async for d in page]) async for page in pages] == [4, 1]
+    assert seen == [4, 1] and COSMOS_REQUESTS.values[("async_test", "query_items", "200")] == 2
+
+
+def test_metrics_endpoint_reports_route_templates_and_snapshots():
+    client = TestClient(app_module.app)
+    client.get("/")
+    client.get("/api/v1/generate/job:abc", headers={"Authorization": "Bearer x"})
+    text = client.get("/metrics").text
+    assert 'http_request_duration_seconds_count{method="GET",route="/",status="200"}' in text
+    assert 'route="/api/v1/generate/{job_id}"' in text and "job:abc" not in text
+    assert 'http_requests_in_flight{route="/metrics"} 1.0' in text
+    for prefix in ("password_hasher_", "admission_", "character_list_cache_", "ws_connections", "pricing_"):
+        assert prefix in text
+
+
+def test_profiled_request_gets_server_timing():
+    container = AsyncInMemoryContainer(InMemoryContainer())
+    ledger = AsyncLedgerService(container)
+    app = FastAPI()
+
+    @app.get("/balance")
+    async def balance():
+        with span("lookup"):
+            try:
+                await ledger.get_balance("u1")
+            except Exception:
+                pass
+        return {}
+
+    app.add_middleware(MetricsMiddleware, profile_token="secret")
+    client = TestClient(app)
+    timing = client.get("/balance", headers={"X-Profile": "secret"}).headers["server-timing"]
+    assert "cosmos.read_item;dur=" in timing and "lookup;dur=" in timing and "app;dur=" in timing
+    assert "server-timing" not in client.get("/balance").headers
+    assert "server-timing" not in client.get("/balance", headers={"X-Profile": "guess"}).headers
@@ -0,0 +1,50 @@
+import asyncio
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import httpx
+import pytest
+from .. import password_hasher as ph
+from ..app import app
+
+
+def slow_hash(release: threading.Event):
+    def job(password):
+        t0 = time.perf_counter()
+        release.wait(5)
+        return f"hashed:{password}", time.perf_counter() - t0
+    return job
+
+
+@pytest.mark.asyncio
+async def test_pool_rejects_when_saturated_and_reports_metrics():
+    release = threading.Event()
+    hasher = ph.PasswordHasher(workers=1, max_pending=2, executor=ThreadPoolExecutor(1), hash_job=slow_hash(release),
+                               verify_job=lambda p, h: (h == f"hashed:{p}", 0.001))
+    running = [asyncio.create_task(hasher.hash(f"pw{i}")) for i in range(2)]
+    await asyncio.sleep(0.01)
+    snap = hasher.snapshot()
+    assert snap["in_flight"] == 1 and snap["queue_depth"] == 1
+    with pytest.raises(ph.PasswordHasherBusy) as busy:
+        await hasher.hash("one-too-many")
+    assert busy.value.retry_after >= 1
+
+    release.set()
+    assert await asyncio.gather(*running) == ["hashed:pw0", "hashed:pw1"]
+    assert await hasher.verify("pw0", "hashed:pw0") is True
+    assert await hasher.verify("pw0", None) is False
+    snap = hasher.snapshot()
+    assert snap["completed"] == 3 and snap["rejected"] == 1 and snap["queue_depth"] == 0
+    hasher.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_register_returns_429_with_retry_after(monkeypatch):
+    full = ph.PasswordHasher(workers=1, max_pending=0, executor=ThreadPoolExecutor(1))
+    from ..api import auth_routes
+    monkeypatch.setattr(auth_routes, "password_hasher", full)
+    async with httpx.AsyncClient(transport=httpx.ASGITransport(app=app), base_url="http://test") as client:
+        r = await client.post("/api/v1/auth/register", json={"email": "a@x", "username": "a", "password": "pw"})
+    assert r.status_code == 429 and int(r.headers["Retry-After"]) >= 1
+    full.shutdown()
@@ -0,0 +1,89 @@
+import json
+import time
+
+import pytest
+from fastapi.testclient import TestClient
+from .. import app as app_module
+from ..pricing import ApproxTokenizer, PricingEngine, PricingError, load_price_table
+
+TABLE = {
+    "version": "t1",
+    "models": {
+        "chat": {"standard": {"input_per_1k": 10, "output_per_1k": 30}},
+        "image": {"fast": {"per_unit": 1}, "high": {"per_unit": 4, "input_per_1k": 5}},
+    },
+    "user_tiers": {"standard": 1.0, "premium": 0.5},
+}
+
+
+class CountingTokenizer(ApproxTokenizer):
+    def __init__(self):
+        self.calls = 0
+
+    def count(self, text):
+        self.calls += 1
+        return super().count(text)
+
+
+def test_quotes_follow_price_table():
+    engine = PricingEngine(TABLE)
+    assert engine.quote("chat", 1000, 1000) == 40
+    assert engine.quote("chat", 1000, 1000, user_tier="premium") == 20
+    assert engine.quote("chat", 10) == 1  # min charge
+    assert engine.quote("image", 0, units=4, tier="high") == 16
+    with pytest.raises(PricingError):
+        engine.quote("image", 0, units=1, tier="ultra")
+    with pytest.raises(PricingError):
+        engine.quote("video", 10)
+
+
+def test_tokenizer_tracks_length_not_characters_per_gem():
+    tok = ApproxTokenizer()
+    assert tok.count("hello, world!") == 4
+    assert tok.count("internationalization") == 4
+    assert tok.count("") == 0
+
+
+def test_persona_counts_are_cached_and_batches_tokenize_once():
+    tokenizer = CountingTokenizer()
+    engine = PricingEngine(TABLE, tokenizer=tokenizer)
+    persona = "You are a very long persona. " * 50
+    variants = [{"model": "image", "tier": tier, "content": "a castle at dusk", "persona": persona, "units": n}
+                for tier in ("fast", "high") for n in (1, 4, 9)]
+    out = engine.estimate_many(variants)
+    assert [o["cost"] for o in out[:3]] == [1, 4, 9]
+    # the high tier also charges for prompt tokens
+    assert all(o["cost"] > 4 * o["units"] for o in out[3:])
+    assert tokenizer.calls == 2  # one content string, one persona
+    engine.estimate("chat", "hi", persona=persona)
+    assert engine.stats["cache_hits"] >= 6
+
+
+def test_estimate_many_is_fast_enough_for_live_preview():
+    engine = PricingEngine(TABLE)
+    prompt = "a knight in silver armour standing on a cliff, dramatic lighting, " * 20
+    variants = [{"model": "image", "tier": tier, "content": prompt + str(i % 10), "units": n}
+                for i in range(100) for tier in ("fast", "high") for n in (1, 4)]
+    started = time.perf_counter()
+    out = engine.estimate_many(variants)
+    assert (time.perf_counter() - started) < 0.15 and len(out) == 400
+
+
+def test_bad_table_keeps_current_prices(tmp_path):
+    engine = PricingEngine(TABLE)
+    with pytest.raises(PricingError):
+        engine.set_table({"models": {}})
+    assert engine.version == "t1"
+    path = tmp_path / "prices.json"
+    path.write_text(json.dumps(dict(TABLE, version="t2")))
+    engine.set_table(load_price_table(str(path)))
+    assert engine.version == "t2"
+
+
+def test_estimate_route_reports_errors_per_variant():
+    client = TestClient(app_module.app)
+    r = client.post("/api/v1/pricing/estimate", json={"variants": [
+        {"model": "image", "tier": "balanced", "units": 4}, {"model": "image", "tier": "nope", "units": 1}]})
+    assert r.status_code == 200
+    items = r.json()["items"]
+    assert items[0]["cost"] == 8 and "error" in items[1]
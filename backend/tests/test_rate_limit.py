@@ -0,0 +1,118 @@
+import asyncio
+
+import pytest
+from fastapi import FastAPI
+from fastapi.testclient import TestClient
+from ..auth import create_access_token, create_refresh_token
+from ..rate_limit import (AdmissionController, Limit, Overloaded, Policy, RateLimitMiddleware, ShardedMemoryStore,
+                          token_subject)
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_bucket_refills_and_reports_wait():
+    clock = Clock()
+    store = ShardedMemoryStore(shards=4, clock=clock)
+    limit = Limit(rate=2, burst=3)
+    assert [store.take_now("k", limit) for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert store.take_now("k", limit) == pytest.approx(0.5)
+    clock.now += 1.0
+    assert store.take_now("k", limit) == 0.0 and store.take_now("k", limit) == 0.0
+    assert store.take_now("k", limit) > 0
+
+
+def test_idle_and_excess_buckets_are_evicted():
+    clock = Clock()
+    store = ShardedMemoryStore(shards=1, idle_seconds=10, max_keys_per_shard=3, clock=clock)
+    limit = Limit(1, 1)
+    for key in "abc":
+        store.take_now(key, limit)
+    clock.now = 5
+    store.take_now("a", limit)
+    store.take_now("d", limit)
+    # over the cap: the least recently touched goes first
+    assert len(store) == 3 and store.evicted == 1
+    clock.now = 20
+    store.take_now("e", limit)
+    assert len(store) == 1
+
+
+def test_subject_comes_from_verified_access_tokens_only():
+    def scope(auth=None, query=b"", kind="http"):
+        headers = [(b"authorization", auth.encode())] if auth else []
+        return {"type": kind, "headers": headers, "query_string": query}
+
+    assert token_subject(scope(f"Bearer {create_access_token('u1')}")) == "u1"
+    assert token_subject(scope(query=f"x=1&token={create_access_token('u2')}".encode(), kind="websocket")) == "u2"
+    assert token_subject(scope(f"Bearer {create_refresh_token('u1')}")) is None
+    assert token_subject(scope("Bearer forged.token.here")) is None
+
+
+def make_app(**kw):
+    app = FastAPI()
+
+    @app.post("/api/v1/chat/send")
+    async def send():
+        return {"ok": True}
+
+    @app.get("/api/v1/slow")
+    async def slow():
+        await asyncio.sleep(0.2)
+        return {"ok": True}
+
+    policies = [Policy("chat", "/api/v1/chat", per_ip=Limit(0.1, 4), per_user=Limit(0.1, 2), methods=("POST",))]
+    app.add_middleware(RateLimitMiddleware, store=ShardedMemoryStore(), policies=policies, **kw)
+    return app
+
+
+def test_per_user_and_per_ip_limits_return_429_with_retry_after():
+    client = TestClient(make_app())
+    auth = {"Authorization": f"Bearer {create_access_token('u1')}"}
+    assert [client.post("/api/v1/chat/send", headers=auth).status_code for _ in range(3)] == [200, 200, 429]
+    limited = client.post("/api/v1/chat/send", headers=auth)
+    assert limited.status_code == 429 and int(limited.headers["retry-after"]) >= 1
+    # u1's rejected requests did not spend the address's budget, so u2 gets its own two
+    other = {"Authorization": f"Bearer {create_access_token('u2')}"}
+    assert [client.post("/api/v1/chat/send", headers=other).status_code for _ in range(2)] == [200, 200]
+    # now the address is out, whoever asks
+    third = {"Authorization": f"Bearer {create_access_token('u3')}"}
+    assert client.post("/api/v1/chat/send", headers=third).status_code == 429
+    assert client.post("/api/v1/chat/send").status_code == 429
+
+
+@pytest.mark.asyncio
+async def test_admission_queues_then_sheds():
+    admission = AdmissionController(max_inflight=1, max_queue=1, queue_timeout_ms=50)
+    await admission.acquire()
+    queued = asyncio.create_task(admission.acquire())
+    await asyncio.sleep(0)
+    with pytest.raises(Overloaded):
+        await admission.acquire()
+    admission.release(0.01)
+    await queued
+    with pytest.raises(Overloaded) as e:
+        await admission.acquire()
+    assert e.value.retry_after >= 1
+    admission.release(0.01)
+    assert admission.snapshot()["shed"] == 2 and admission.inflight == 0
+
+
+def test_middleware_sheds_with_503():
+    admission = AdmissionController(max_inflight=1, max_queue=0, queue_timeout_ms=10)
+    app = make_app(admission=admission)
+
+    async def run():
+        import httpx
+        transport = httpx.ASGITransport(app=app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://t") as client:
+            return await asyncio.gather(*(client.get("/api/v1/slow") for _ in range(3)))
+
+    responses = asyncio.run(run())
+    assert sorted(r.status_code for r in responses) == [200, 503, 503]
+    assert all("retry-after" in r.headers for r in responses if r.status_code == 503)
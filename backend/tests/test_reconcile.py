@@ -0,0 +1,134 @@
+import json
+
+from ..cosmos_emulator import InMemoryContainer
+from ..ledger import LedgerService
+from ..reconcile import Reconciler, count_chain_breaks, fold_changes
+
+
+def test_fold_and_chain_breaks_python_and_vectorized():
+    changes = [-10, 5, -3] * 50
+    balances = []
+    bal = 1000
+    for c in changes:
+        bal += c
+        balances.append(bal)
+    assert fold_changes(changes) == sum(changes)
+    assert fold_changes(changes[:3]) == -8
+    assert count_chain_breaks(changes, balances) == 0
+    broken = list(balances)
+    broken[10] += 1
+    assert count_chain_breaks(changes, broken) == 2
+    # events without balance_after are skipped
+    broken[10] = None
+    assert count_chain_breaks(changes, broken) == 0
+    assert count_chain_breaks(changes[:3], [990, None, 992]) == 0
+
+
+class FakeLedger:
+    def __init__(self, balances):
+        self.container = None
+        self.balances = balances
+
+    def get_balance_doc(self, user_id):
+        return {"id": f"balance:{user_id}", "balance": self.balances[user_id], "_etag": "e"}
+
+
+class FakeReconciler(Reconciler):
+    def __init__(self, ledger, sums, **kwargs):
+        super().__init__(ledger, **kwargs)
+        self.sums = sums
+        self.seen = []
+
+    def _latest_snapshot(self, user_id):
+        return None
+
+    def _ledger_tail(self, user_id, after):
+        self.seen.append(user_id)
+        return {"sum": self.sums[user_id], "chain_breaks": 0}
+
+
+def test_reconciler_reports_drift_and_resumes_from_checkpoint(tmp_path):
+    users = [f"u{i:03d}" for i in range(20)]
+    ledger = FakeLedger({u: 0 for u in users})
+    sums = {u: 0 for u in users}
+    sums["u007"] = -5
+    ckpt, report = str(tmp_path / "ckpt.json"), str(tmp_path / "drift.ndjson")
+
+    rec = FakeReconciler(ledger, sums, workers=4, checkpoint_path=ckpt, report_path=report)
+    stats = rec.run(users=users[:10])
+    assert stats["users"] == 10 and stats["drifted"] == 1 and stats["drift_total"] == 5
+    with open(report) as fh:
+        assert [json.loads(line)["user_id"] for line in fh] == ["u007"]
+    with open(ckpt) as fh:
+        saved = json.load(fh)
+    assert saved["after"] == "u009" and saved["complete"] and saved["failed"] == []
+
+    # the last run finished, so the next one starts over with fresh stats
+    rec2 = FakeReconciler(ledger, sums, workers=4, checkpoint_path=ckpt)
+    assert rec2.run(users=users)["users"] == 20 and sorted(rec2.seen) == users
+
+    # an interrupted run leaves an incomplete checkpoint: the next run skips the finished prefix
+    with open(ckpt, "w") as fh:
+        json.dump({"run_id": "recon:x", "after": "u009", "failed": [], "complete": False,
+                   "stats": {"users": 10, "elapsed_seconds": 1.0}}, fh)
+    rec3 = FakeReconciler(ledger, sums, workers=4, checkpoint_path=ckpt)
+    stats3 = rec3.run(users=users)
+    assert sorted(rec3.seen) == users[10:]
+    assert stats3["users"] == 20 and rec3.run_id == "recon:x"
+
+
+def test_failed_users_are_retried_on_the_next_run(tmp_path):
+    users = [f"u{i:03d}" for i in range(20)]
+    ledger = FakeLedger({u: 0 for u in users})
+    ckpt = str(tmp_path / "ckpt.json")
+    broken = {"u003", "u015"}
+
+    class Failing(FakeReconciler):
+        def _ledger_tail(self, user_id, after):
+            if user_id in broken:
+                raise RuntimeError("throttled")
+            return super()._ledger_tail(user_id, after)
+
+    rec = Failing(ledger, {u: 0 for u in users}, workers=4, checkpoint_path=ckpt)
+    assert rec.run(users=users)["errors"] == 2
+    with open(ckpt) as fh:
+        saved = json.load(fh)
+    assert saved["failed"] == ["u003", "u015"] and not saved["complete"]
+
+    broken.clear()
+    rec2 = Failing(ledger, {u: 0 for u in users}, workers=4, checkpoint_path=ckpt)
+    stats = rec2.run(users=users)
+    assert sorted(rec2.seen) == ["u003", "u015"]
+    assert stats["users"] == 20 and stats["errors"] == 0
+    with open(ckpt) as fh:
+        assert json.load(fh)["complete"]
+
+
+class BatchOnlyContainer:
+    """The sync ContainerProxy surface the reconciler may use: no create_transactional_batch."""
+
+    def __init__(self, inner):
+        self.inner = inner
+
+    def read_item(self, item, partition_key, **kwargs):
+        return self.inner.read_item(item, partition_key, **kwargs)
+
+    def query_items(self, query, parameters=None, partition_key=None, **kwargs):
+        return self.inner.query_items(query, parameters=parameters, partition_key=partition_key, **kwargs)
+
+    def execute_item_batch(self, batch_operations, partition_key, **kwargs):
+        return self.inner.execute_item_batch(batch_operations, partition_key, **kwargs)
+
+
+def test_repair_writes_an_adjustment_through_execute_item_batch():
+    inner = InMemoryContainer()
+    inner.create_item({"id": "balance:u1", "docType": "balance", "user_id": "u1", "balance": 100})
+    inner.create_item({"id": "evt:1", "docType": "ledger_event", "user_id": "u1", "change": 90,
+                       "balance_after": 90, "created_at": "2026-01-01T00:00:00Z"})
+    ledger = LedgerService(BatchOnlyContainer(inner))
+
+    result = Reconciler(ledger, workers=1, repair=True).reconcile_user("u1")
+    assert result["drift"] == 10 and result["repaired"]
+    [adjustment] = [d for d in inner.query_items("SELECT * FROM c WHERE c.event_type='reconcile_adjustment'")]
+    assert adjustment["change"] == 10 and adjustment["balance_after"] == 100
+    assert Reconciler(ledger, workers=1).reconcile_user("u1")["drift"] == 0
@@ -0,0 +1,71 @@
+import pytest
+from fastapi.testclient import TestClient
+from .. import app as app_module
+from ..api import characters as characters_router
+from ..character_catalog import CharacterCatalog
+from ..deps import get_current_user
+from ..response_cache import ResponseCache, etag_matches
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.mark.asyncio
+async def test_fresh_stale_and_expired_entries():
+    clock = Clock()
+    cache = ResponseCache(fresh_seconds=10, stale_seconds=20, clock=clock)
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return {"n": len(calls)}
+
+    first = cache.get("k", 1, compute)
+    assert first.body == b'{"n":1}' and cache.get("k", 1, compute) is first
+    clock.now = 15
+    # stale: old body now, recomputed in the background
+    assert cache.get("k", 1, compute) is first
+    await cache.drain()
+    refreshed = cache.get("k", 1, compute)
+    assert refreshed.body == b'{"n":2}' and refreshed.etag != first.etag
+    # a version bump recomputes inline
+    assert cache.get("k", 2, compute).body == b'{"n":3}'
+    clock.now = 100
+    assert cache.get("k", 2, compute).body == b'{"n":4}'
+    assert cache.snapshot()["stale_hits"] == 1 and cache.stats["refreshes"] == 1
+
+
+def test_etag_matching():
+    assert etag_matches('"a", "b"', '"b"')
+    assert etag_matches('W/"b"', '"b"')
+    assert etag_matches("*", '"b"')
+    assert not etag_matches(None, '"b"') and not etag_matches('"c"', '"b"')
+
+
+def test_list_route_serves_etags_304s_and_sees_new_characters(monkeypatch):
+    monkeypatch.setattr(characters_router, "CATALOG", CharacterCatalog.local())
+    monkeypatch.setattr(characters_router, "LIST_CACHE", ResponseCache())
+    app_module.app.dependency_overrides[get_current_user] = lambda: {"user_id": "u1"}
+    try:
+        client = TestClient(app_module.app)
+        client.post("/api/v1/characters", json={"name": "Ada", "tags": ["scifi"]})
+        r = client.get("/api/v1/characters", params={"tags": ["SciFi"], "sort": "new"})
+        etag = r.headers["etag"]
+        assert r.status_code == 200 and "stale-while-revalidate" in r.headers["cache-control"]
+        # same query spelled differently hits the same entry
+        again = client.get("/api/v1/characters", params={"tags": ["scifi "], "sort": "new"},
+                           headers={"If-None-Match": etag})
+        assert again.status_code == 304 and again.content == b"" and again.headers["etag"] == etag
+        assert characters_router.LIST_CACHE.stats["hits"] == 1
+
+        client.post("/api/v1/characters", json={"name": "Bob", "tags": ["scifi"]})
+        after = client.get("/api/v1/characters", params={"tags": ["scifi"], "sort": "new"},
+                           headers={"If-None-Match": etag})
+        assert after.status_code == 200 and [c["name"] for c in after.json()["items"]] == ["Bob", "Ada"]
+    finally:
+        app_module.app.dependency_overrides.clear()
@@ -0,0 +1,68 @@
+import asyncio
+
+import pytest
+from ..cosmos_emulator import AsyncInMemoryContainer, InMemoryContainer
+from ..session_store import ChatSessionStore, SessionNotFound
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def turn(i):
+    return [{"role": "user", "content": f"q{i}"}, {"role": "assistant", "content": f"a{i}"}]
+
+
+@pytest.mark.asyncio
+async def test_append_and_context_keep_only_recent_turns():
+    store = ChatSessionStore.local(context_turns=3)
+    sess = await store.create("u1", "c1")
+    for i in range(5):
+        await store.append(sess.session_id, turn(i))
+    context = await store.context(sess.session_id)
+    assert [m["content"] for m in context] == ["q2", "a2", "q3", "a3", "q4", "a4"]
+    assert [m["content"] for m in await store.context(sess.session_id, turns=1)] == ["q4", "a4"]
+    assert sess.doc["last_seq"] == 10 and sess.doc["message_count"] == 10
+
+    # a cold load reads the session doc and only the tail of the transcript
+    store.invalidate(sess.session_id)
+    fresh = await store.get(sess.session_id)
+    assert [m["seq"] for m in fresh.recent] == [5, 6, 7, 8, 9, 10]
+    with pytest.raises(SessionNotFound):
+        await store.get("sess:missing")
+
+
+@pytest.mark.asyncio
+async def test_lru_and_idle_eviction():
+    clock = Clock()
+    store = ChatSessionStore.local(max_sessions=2, idle_seconds=10, clock=clock)
+    a = await store.create("u1", "c")
+    b = await store.create("u1", "c")
+    await store.get(a.session_id)
+    await store.create("u1", "c")
+    # b was least recently used
+    assert b.session_id not in store._hot and a.session_id in store._hot
+    clock.now = 11
+    assert store.evict_idle() == 2 and not store._hot
+    # evicted sessions come back from the container
+    assert (await store.get(b.session_id)).user_id == "u1"
+    assert store.stats["loads"] == 1
+
+
+@pytest.mark.asyncio
+async def test_concurrent_writers_never_reuse_seq():
+    inner = InMemoryContainer(partition_key_path="/session_id")
+    first = ChatSessionStore(AsyncInMemoryContainer(inner, latency_ms=1))
+    second = ChatSessionStore(AsyncInMemoryContainer(inner, latency_ms=1))
+    sess = await first.create("u1", "c")
+    await second.get(sess.session_id)
+    await asyncio.gather(*(store.append(sess.session_id, turn(i))
+                           for i, store in enumerate([first, second, first, second])))
+    seqs = sorted(d["seq"] for d in inner.all_items(sess.session_id) if d["docType"] == "chat_message")
+    assert seqs == list(range(1, 9))
+    assert first.stats["append_retries"] + second.stats["append_retries"] >= 1
+    assert inner.read_item(sess.session_id, sess.session_id)["last_seq"] == 8
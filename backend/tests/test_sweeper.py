@@ -0,0 +1,42 @@
+import pytest
+from ..ledger import AsyncLedgerService
+from ..sweeper import HoldSweeper
+from .test_ledger_async import AsyncContainer
+
+
+class FakeSweeper(HoldSweeper):
+    async def find_expired(self, limit):
+        cutoff = self._cutoff()
+        holds = sorted((d for d in self.ledger.container.docs.values()
+                        if d.get("docType") == "hold" and d["status"] == "placed" and d["created_at"] < cutoff),
+                       key=lambda d: d["created_at"])
+        return holds[:limit]
+
+    async def count_backlog(self):
+        return len(await self.find_expired(10 ** 9))
+
+
+@pytest.mark.asyncio
+async def test_sweeper_cancels_expired_holds_per_user():
+    c = AsyncContainer([
+        {"id": "balance:u1", "docType": "balance", "user_id": "u1", "balance": 100, "_etag": "e1"},
+        {"id": "balance:u2", "docType": "balance", "user_id": "u2", "balance": 100, "_etag": "e2"},
+    ])
+    svc = AsyncLedgerService(c)
+    stale = [await svc.reserve_hold("u1", 10), await svc.reserve_hold("u1", 20), await svc.reserve_hold("u2", 5)]
+    fresh = await svc.reserve_hold("u2", 7)
+    for h in stale:
+        c.docs[h["hold_id"]]["created_at"] = "2000-01-01T00:00:00Z"
+    batches_before = len(c.batches)
+
+    sweeper = FakeSweeper(svc, ttl_seconds=60, page_size=2)
+    assert await sweeper.run_once() == 3
+
+    assert await svc.get_balance("u1") == 100
+    assert await svc.get_balance("u2") == 93
+    assert c.docs[fresh["hold_id"]]["status"] == "placed"
+    # both of u1's holds were refunded in one batch
+    assert len(c.batches) - batches_before == 2
+    assert sweeper.stats["gems_released"] == 35
+    assert sweeper.stats["backlog"] == 0
+    assert sweeper.stats["oldest_age_seconds"] > 0
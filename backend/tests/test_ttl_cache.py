@@ -0,0 +1,34 @@
+from ..ttl_cache import TTLCache
+
+
+class Clock:
+    def __init__(self):
+        self.now = 0.0
+
+    def __call__(self):
+        return self.now
+
+
+def test_expiry_lru_eviction_and_stats():
+    clock = Clock()
+    cache = TTLCache(2, ttl_seconds=10, clock=clock)
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1
+    cache.put("c", 3)
+    # "b" was least recently used
+    assert cache.get("b") is None and cache.stats["evictions"] == 1
+    cache.put("a", 1, expires_at=5)
+    clock.now = 5
+    assert cache.get("a") is None and cache.stats["expired"] == 1
+    cache.invalidate("c")
+    cache.invalidate("c")
+    assert cache.snapshot() == {"hits": 1, "misses": 2, "expired": 1, "evictions": 1, "invalidations": 1, "size": 0}
+
+
+def test_without_ttl_entries_only_leave_by_eviction():
+    clock = Clock()
+    cache = TTLCache(1, clock=clock)
+    cache.put(("u1", "k"), {"r": 1})
+    clock.now = 1e12
+    assert cache.get(("u1", "k")) == {"r": 1} and len(cache) == 1
@@ -0,0 +1,72 @@
+from .. import db, deps
+from ..auth import create_access_token
+from ..cosmos_emulator import InMemoryContainer
+from ..repositories.user_repository import UserRepository
+from ..user_cache import UserProfileCache, profile_cache
+
+
+class CountingContainer(InMemoryContainer):
+    def __init__(self):
+        super().__init__(partition_key_path="/id")
+        self.point_reads = 0
+
+    def read_item(self, item, partition_key, **kwargs):
+        self.point_reads += 1
+        return super().read_item(item, partition_key, **kwargs)
+
+
+def test_profile_cache_ttl_and_lru():
+    now = [0.0]
+    cache = UserProfileCache(max_entries=2, ttl_seconds=10, clock=lambda: now[0])
+    cache.put("a", {"username": "a", "email": "a@x", "password_hash": "secret"})
+    assert cache.get("a") == {"user_id": "a", "username": "a", "email": "a@x"}
+    cache.put("b", {"username": "b"})
+    cache.get("a")
+    cache.put("c", {"username": "c"})
+    assert cache.get("b") is None and cache.stats["evictions"] == 1
+    now[0] = 11
+    assert cache.get("a") is None and cache.stats["expired"] == 1
+
+
+def test_get_current_user_hits_cache_until_profile_changes(monkeypatch):
+    container = CountingContainer()
+    repo = UserRepository()
+    repo.container = container
+    monkeypatch.setattr(deps, "_user_repo", repo)
+    profile_cache.clear()
+
+    repo.create_user("alice", "alice@example.com", "hash")
+    header = f"Bearer {create_access_token('alice')}"
+    assert deps.get_current_user(header)["email"] == "alice@example.com"
+    reads = container.point_reads
+    for _ in range(10):
+        assert deps.get_current_user(header)["username"] == "alice"
+    assert container.point_reads == reads
+
+    repo.update_profile("alice", {"email": "new@example.com"})
+    assert deps.get_current_user(header)["email"] == "new@example.com"
+
+
+def test_cosmos_client_is_built_once(monkeypatch):
+    built = []
+
+    class FakeClient:
+        def __init__(self, url, credential):
+            built.append(url)
+
+        def get_database_client(self, name):
+            return self
+
+        def get_container_client(self, name):
+            return object()
+
+    monkeypatch.setattr(db, "CosmosClient", FakeClient)
+    monkeypatch.setattr(db, "COSMOS_URL", "https://cosmos.example")
+    monkeypatch.setattr(db, "COSMOS_KEY", "key")
+    db.reset_clients()
+    try:
+        assert db.get_users_container() is db.get_users_container()
+        assert UserRepository().container is UserRepository().container
+        assert built == ["https://cosmos.example"]
+    finally:
+        db.reset_clients()
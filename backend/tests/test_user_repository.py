@@ -0,0 +1,133 @@
+import pytest
+from ..cosmos_emulator import InMemoryContainer
+from ..repositories import user_repository
+from ..repositories.user_repository import UniqueConstraintViolation, UserRepository
+
+
+class CountingContainer(InMemoryContainer):
+    def __init__(self):
+        super().__init__(partition_key_path="/id")
+        self.point_reads = 0
+
+    def read_item(self, item, partition_key, **kwargs):
+        self.point_reads += 1
+        return super().read_item(item, partition_key, **kwargs)
+
+
+def make_repo():
+    repo = UserRepository()
+    repo.container = CountingContainer()
+    return repo
+
+
+def backdate(repo, pointer_id):
+    pointer = repo.container.read_item(pointer_id, partition_key=pointer_id)
+    pointer["created_at"] = "2020-01-01T00:00:00Z"
+    repo.container.upsert_item(pointer)
+
+
+def test_email_lookup_is_two_point_reads():
+    repo = make_repo()
+    repo.create_user("alice", "Alice@Example.com", "h")
+    queries = repo.container.stats["queries"]
+    reads = repo.container.point_reads
+    assert repo.get_by_email("alice@example.com")["id"] == "alice"
+    assert repo.container.point_reads - reads == 2
+    assert repo.container.stats["queries"] == queries
+    assert repo.get_by_email("nobody@example.com") is None
+
+
+def test_unique_username_and_email(monkeypatch):
+    repo = make_repo()
+    repo.create_user("alice", "alice@example.com", "h")
+    with pytest.raises(UniqueConstraintViolation) as e:
+        repo.create_user("bob", "ALICE@example.com", "h")
+    assert e.value.field == "email"
+    with pytest.raises(UniqueConstraintViolation) as e:
+        repo.create_user("Alice", "other@example.com", "h")
+    assert e.value.field == "username"
+    # failed registrations released their email claims
+    assert repo.check_available("carol", "other@example.com") is None
+    assert repo.check_available("carol", "alice@example.com") == "email"
+
+
+def test_orphaned_pointer_is_reclaimed_and_email_change_moves_pointer():
+    repo = make_repo()
+    # a registration that died after claiming the email but before writing the user
+    repo.claim_unique("email", "dana@example.com", "ghost")
+    with pytest.raises(UniqueConstraintViolation):
+        # still inside the grace period: it could be a registration in flight
+        repo.create_user("dana", "dana@example.com", "h")
+    backdate(repo, "email:dana@example.com")
+    repo.create_user("dana", "dana@example.com", "h")
+    assert repo.get_by_email("dana@example.com")["id"] == "dana"
+
+    repo.update_profile("dana", {"email": "dana@new.example"})
+    assert repo.get_by_email("dana@new.example")["id"] == "dana"
+    assert repo.get_by_email("dana@example.com") is None
+    repo.create_user("erin", "dana@example.com", "h")
+
+
+def test_duplicate_registration_never_releases_the_winners_pointers():
+    repo = make_repo()
+    # the first registration of "alice" has claimed both pointers but not written its user doc yet
+    claims = [repo.claim_unique(f, v, "alice", adopt=False) for f, v in (("username", "alice"), ("email", "a@x.io"))]
+    with pytest.raises(UniqueConstraintViolation) as e:
+        repo.create_user("alice", "a@x.io", "h")
+    assert e.value.field == "username"
+    repo.container.create_item({"id": "alice", "username": "alice", "email": "a@x.io", "password_hash": "h"})
+
+    with pytest.raises(UniqueConstraintViolation):
+        repo.create_user("alice", "a@x.io", "h")
+    for pointer_id, claim in zip(("username:alice", "email:a@x.io"), claims):
+        assert repo.container.read_item(pointer_id, partition_key=pointer_id)["claim"] == claim
+    with pytest.raises(UniqueConstraintViolation) as e:
+        repo.create_user("carol", "A@x.io", "h")
+    assert e.value.field == "email"
+
+    # a release for some other claim of the same user is a no-op
+    repo.release_unique("email", "a@x.io", "alice", claim="not-mine")
+    assert repo.get_by_email("a@x.io")["id"] == "alice"
+
+
+def test_legacy_user_found_by_scan_gets_backfilled(monkeypatch):
+    repo = make_repo()
+    repo.container.create_item({"id": "legacy", "username": "legacy", "email": "legacy@example.com"})
+    assert repo.get_by_email("legacy@example.com")["id"] == "legacy"
+    queries = repo.container.stats["queries"]
+    assert repo.get_by_email("legacy@example.com")["id"] == "legacy"
+    assert repo.container.stats["queries"] == queries
+
+    monkeypatch.setattr(user_repository, "EMAIL_INDEX_FALLBACK_SCAN", False)
+    repo.container.create_item({"id": "legacy2", "username": "legacy2", "email": "l2@example.com"})
+    assert repo.get_by_email("l2@example.com") is None
+
+
+def test_user_doc_in_pointer_id_space_is_never_taken_over():
+    repo = make_repo()
+    # written before usernames were validated: a user doc whose id is the victim's email pointer id
+    repo.container.create_item({"id": "email:victim@x.io", "username": "email:victim@x.io", "email": "s@x.io",
+                                "created_at": "2020-01-01T00:00:00Z"})
+    with pytest.raises(UniqueConstraintViolation):
+        repo.create_user("victim", "victim@x.io", "h")
+    assert repo.container.read_item("email:victim@x.io", partition_key="email:victim@x.io")["username"] \
+        == "email:victim@x.io"
+    with pytest.raises(ValueError):
+        repo.create_user("email:other@x.io", "o@x.io", "h")
+
+    repo.create_user("frank", "f@x.io", "h")
+    assert repo.get_by_username("email:f@x.io") is None
+    assert repo.get_by_username("frank")["id"] == "frank"
+
+
+def test_legacy_email_is_not_claimable_while_scan_is_on():
+    repo = make_repo()
+    repo.container.create_item({"id": "lee", "username": "lee", "email": "L@x.io"})
+    assert repo.check_available("bob", "l@x.io") is None  # advisory only: no pointer yet
+    with pytest.raises(UniqueConstraintViolation) as e:
+        repo.create_user("bob", "l@x.io", "h")
+    assert e.value.field == "email"
+    assert repo.get_by_email("L@x.io")["id"] == "lee"
+    repo.create_user("alice", "a@x.io", "h")
+    with pytest.raises(UniqueConstraintViolation):
+        repo.update_profile("alice", {"email": "l@x.io"})
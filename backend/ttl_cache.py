@@ -0,0 +1,78 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Dict, Hashable, Optional, Tuple
+
+
+class TTLCache:
+    """Thread-safe TTL + LRU map: entries expire at a per-entry deadline and the least recently used
+    ones are evicted past max_entries.
+
+    Values are stored as given; subclasses copy what they hand out. ttl_seconds=None keeps entries
+    until they are evicted.
+    """
+
+    def __init__(self, max_entries: int, ttl_seconds: Optional[float] = None, clock=time.monotonic):
+        self.max_entries = max_entries
+        self.ttl = ttl_seconds
+        self._clock = clock
+        # key -> (value, expires_at)
+        self._items: "OrderedDict[Hashable, Tuple[Any, float]]" = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0, "expired": 0, "evictions": 0, "invalidations": 0}
+
+    def _lookup(self, key: Hashable) -> Optional[Tuple[Any, float]]:
+        """Live entry for key, counted as a hit or miss; call with the lock held."""
+        entry = self._items.get(key)
+        if entry is None:
+            self.stats["misses"] += 1
+            return None
+        if entry[1] <= self._clock():
+            del self._items[key]
+            self.stats["expired"] += 1
+            self.stats["misses"] += 1
+            return None
+        self._items.move_to_end(key)
+        self.stats["hits"] += 1
+        return entry
+
+    def _store(self, key: Hashable, value: Any, expires_at: Optional[float] = None):
+        """Insert as most recently used and evict past max_entries; call with the lock held."""
+        if expires_at is None:
+            expires_at = self._clock() + self.ttl if self.ttl is not None else math.inf
+        self._items[key] = (value, expires_at)
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_entries:
+            self._items.popitem(last=False)
+            self.stats["evictions"] += 1
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            entry = self._lookup(key)
+        return None if entry is None else entry[0]
+
+    def put(self, key: Hashable, value: Any, expires_at: Optional[float] = None):
+        with self._lock:
+            self._store(key, value, expires_at)
+
+    def invalidate(self, key: Hashable):
+        with self._lock:
+            if self._items.pop(key, None) is not None:
+                self.stats["invalidations"] += 1
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def hit_ratio(self) -> float:
+        total = self.stats["hits"] + self.stats["misses"]
+        return self.stats["hits"] / total if total else 0.0
+
+    def snapshot(self) -> Dict[str, Any]:
+        out = dict(self.stats)
+        out["size"] = len(self._items)
+        return out
@@ -0,0 +1,33 @@
+import os
+import time
+from typing import Any, Dict, Optional
+
+from .ttl_cache import TTLCache
+
+USER_CACHE_SIZE = int(os.getenv("USER_CACHE_SIZE", "50000"))
+# bounds how long another replica can serve a profile that changed elsewhere
+USER_CACHE_TTL_SECONDS = float(os.getenv("USER_CACHE_TTL_SECONDS", "60"))
+
+# only these fields are cached; password hash and refresh token never sit in the cache
+PROFILE_FIELDS = ("username", "email")
+
+
+class UserProfileCache(TTLCache):
+    """TTL + LRU cache of public user profile fields keyed by the JWT sub."""
+
+    def __init__(self, max_entries: int = USER_CACHE_SIZE, ttl_seconds: float = USER_CACHE_TTL_SECONDS,
+                 clock=time.monotonic):
+        super().__init__(max_entries, ttl_seconds, clock)
+
+    def get(self, sub: str) -> Optional[Dict[str, Any]]:
+        profile = super().get(sub)
+        return None if profile is None else dict(profile)
+
+    def put(self, sub: str, user_doc: Dict[str, Any]) -> Dict[str, Any]:
+        profile = {"user_id": sub}
+        profile.update({f: user_doc.get(f) for f in PROFILE_FIELDS})
+        super().put(sub, profile)
+        return dict(profile)
+
+
+profile_cache = UserProfileCache()